@@ -0,0 +1,481 @@
+# Copyright 2020 CEA
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# This file is part of cortical-voluba.
+#
+# cortical-voluba is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# cortical-voluba is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License
+# for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with cortical-voluba. If not, see <https://www.gnu.org/licenses/>.
+
+"""Load test of the v0 API.
+
+A number of concurrent virtual users send a mix of requests to the API for a
+given duration: submissions of computations (which verify the images on the
+image service synchronously), and polling of the status of the submitted
+computations. For example, to compare the worker classes of gunicorn::
+
+    python benchmarks/api_load.py --worker-class sync --workers 4
+    python benchmarks/api_load.py --worker-class gthread --workers 2 \\
+        --threads 8
+    python benchmarks/api_load.py --worker-class gevent --workers 2
+
+The API is served by gunicorn in a subprocess (``--server gunicorn``, the
+default), by the threaded development server of werkzeug in this process
+(``--server werkzeug``), or by an existing deployment (``--url``). The image
+service is replaced by `cortical_voluba.fake_image_service` (with a
+configurable latency), running in this process. Unless ``--broker`` is given,
+the tasks are submitted to an in-memory Celery broker, so that no task is
+ever executed: only the cost of the API itself is measured.
+
+Latency percentiles, throughput and error rates are reported for each
+endpoint, and optionally written as JSON (``--output``).
+
+Submitting a computation must take a single round trip to the image service
+(the listing of the images and the headers of the inputs are downloaded
+concurrently). The exit status is 1 if the median latency of an endpoint
+that submits computations exceeds a bound (``--max-submit-latency``), which
+defaults to `SUBMIT_LATENCY_ROUND_TRIPS` times the latency of the fake
+image service plus `SUBMIT_LATENCY_OVERHEAD`.
+"""
+
+import argparse
+import collections
+import contextlib
+import datetime
+import gzip
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import nibabel
+import numpy
+import requests
+
+import cortical_voluba
+from cortical_voluba import fake_image_service
+from cortical_voluba import image_service
+
+
+DEFAULT_MIX = 'alignment=1,depth-map=1,poll=8'
+"""Default relative frequencies of the actions of the virtual users."""
+
+ACTIONS = ('alignment', 'depth-map', 'depth-map-and-alignment', 'poll',
+           'health')
+
+SERVER_START_TIMEOUT = 30
+"""Time (in seconds) allowed for the API server to start."""
+
+SUBMIT_LATENCY_ROUND_TRIPS = 1.5
+"""Default bound of the median submission latency, in image service latencies.
+
+A submission should wait for one round trip to the image service, the margin
+leaves room for the download of the listing and of the headers.
+"""
+
+SUBMIT_LATENCY_OVERHEAD = 0.05
+"""Processing time (in seconds) allowed in the submission latency bound."""
+
+TRANSFORMATION_MATRIX = numpy.eye(4).tolist()
+
+
+#
+# Test environment
+#
+
+def populate_image_service(base_url, num_images):
+    """Upload a segmentation, an image, and num_images other images."""
+    client = image_service.ImageServiceClient(base_url)
+    img = nibabel.Nifti1Image(numpy.zeros((4, 4, 4), dtype=numpy.uint8),
+                              numpy.eye(4))
+    data = gzip.compress(img.to_bytes())
+    client.upload_image(io.BytesIO(data), file_name='segmentation.nii.gz',
+                        segmentation=True)
+    client.upload_image(io.BytesIO(data), file_name='image.nii.gz')
+    for i in range(num_images):
+        client.upload_image(io.BytesIO(data),
+                            file_name='other{0}.nii.gz'.format(i))
+
+
+def find_free_port():
+    with contextlib.closing(socket.socket()) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def api_config(args):
+    return {
+        'CELERY_BROKER_URL': args.broker or 'memory://',
+        'CELERY_RESULT_BACKEND': args.result_backend or 'cache+memory://',
+        'CORS_ORIGINS': None,
+    }
+
+
+@contextlib.contextmanager
+def run_gunicorn(args, scratch_dir):
+    """Run the API under gunicorn, yield its base URL."""
+    config_path = os.path.join(scratch_dir, 'config.py')
+    with open(config_path, 'w') as f:
+        for key, value in api_config(args).items():
+            f.write('{0} = {1!r}\n'.format(key, value))
+    env = dict(os.environ)
+    env['INSTANCE_PATH'] = os.path.join(scratch_dir, 'instance')
+    env['CORTICAL_VOLUBA_SETTINGS'] = config_path
+    port = find_free_port()
+    command = [
+        sys.executable, '-m', 'gunicorn',
+        '--bind', '127.0.0.1:{0}'.format(port),
+        '--worker-class', args.worker_class,
+        '--workers', str(args.workers),
+        '--threads', str(args.threads),
+        '--log-level', 'warning',
+        'cortical_voluba.wsgi:application',
+    ]
+    process = subprocess.Popen(command, env=env)
+    try:
+        yield 'http://127.0.0.1:{0}/'.format(port)
+    finally:
+        process.terminate()
+        process.wait()
+
+
+@contextlib.contextmanager
+def run_werkzeug(args):
+    """Run the API in a thread of this process, yield its base URL."""
+    test_config = dict(api_config(args), TESTING=True)
+    app = cortical_voluba.create_app(test_config=test_config)
+    with fake_image_service.serve_in_background(app) as base_url:
+        yield base_url
+
+
+def wait_for_server(base_url):
+    deadline = time.monotonic() + SERVER_START_TIMEOUT
+    while True:
+        try:
+            requests.get(base_url + 'health', timeout=1).raise_for_status()
+            return
+        except requests.RequestException:
+            if time.monotonic() > deadline:
+                raise RuntimeError('The API server did not start')
+            time.sleep(0.1)
+
+
+#
+# Load generation
+#
+
+def weighted_choice(rng, weights):
+    threshold = rng.uniform(0, sum(weights.values()))
+    for choice, weight in weights.items():
+        threshold -= weight
+        if threshold <= 0:
+            break
+    return choice
+
+
+class VirtualUser:
+    """Sends random requests to the API, records their latency."""
+    def __init__(self, api_url, image_service_url, weights, records, rng):
+        self.api_url = api_url
+        self.image_service_url = image_service_url
+        self.weights = weights
+        self.records = records
+        self.rng = rng
+        self.session = requests.Session()
+        self.session.headers['Authorization'] = 'Bearer load-test'
+        self.submitted = []  # (kind, status polling URL)
+
+    def request(self, label, method, url, expected_status, **kwargs):
+        start_time = time.monotonic()
+        try:
+            r = self.session.request(method, url, timeout=60, **kwargs)
+            status = r.status_code
+        except requests.RequestException:
+            r = None
+            status = None
+        self.records.append({
+            'endpoint': label,
+            'latency': time.monotonic() - start_time,
+            'status': status,
+            'ok': status == expected_status,
+        })
+        return r
+
+    def submit(self, kind, params):
+        params = dict(params, image_service_base_url=self.image_service_url)
+        r = self.request('POST /v0/{0}-computation/'.format(kind), 'POST',
+                         self.api_url + 'v0/{0}-computation/'.format(kind),
+                         202, json=params)
+        if r is not None and r.status_code == 202:
+            self.submitted.append((kind, r.json()['status_polling_url']))
+
+    def step(self):
+        action = weighted_choice(self.rng, self.weights)
+        if action == 'poll' and not self.submitted:
+            action = 'health'
+        alignment_params = {
+            'image_name': 'image',
+            'transformation_matrix': TRANSFORMATION_MATRIX,
+            'landmark_pairs': [],
+        }
+        if action == 'alignment':
+            self.submit('alignment',
+                        dict(alignment_params, depth_map_name='image'))
+        elif action == 'depth-map':
+            self.submit('depth-map', {'segmentation_name': 'segmentation'})
+        elif action == 'depth-map-and-alignment':
+            self.submit('depth-map-and-alignment',
+                        dict(alignment_params,
+                             segmentation_name='segmentation'))
+        elif action == 'poll':
+            kind, url = self.rng.choice(self.submitted)
+            self.request('GET /v0/{0}-computation/<id>'.format(kind), 'GET',
+                         self.api_url + url.lstrip('/'), 200)
+        else:
+            self.request('GET /health', 'GET', self.api_url + 'health', 200)
+
+    def run(self, deadline):
+        while time.monotonic() < deadline:
+            self.step()
+
+
+def run_load(api_url, image_service_url, weights, concurrency, duration,
+             seed=0):
+    """Run concurrent virtual users for duration seconds.
+
+    :returns: the records of all the requests
+    """
+    records = []
+    deadline = time.monotonic() + duration
+    threads = []
+    for i in range(concurrency):
+        user = VirtualUser(api_url, image_service_url, weights, records,
+                           random.Random(seed + i))
+        thread = threading.Thread(target=user.run, args=(deadline,))
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    return records
+
+
+#
+# Statistics
+#
+
+def percentile(sorted_values, q):
+    """Percentile of sorted values, by the nearest-rank method."""
+    if not sorted_values:
+        return None
+    rank = max(int(-(-q * len(sorted_values) // 100)), 1)
+    return sorted_values[rank - 1]
+
+
+def summarize(records, duration):
+    """Latency percentiles, throughput and error rate of each endpoint."""
+    by_endpoint = collections.defaultdict(list)
+    for record in records:
+        by_endpoint[record['endpoint']].append(record)
+    by_endpoint['all'] = records
+    summary = {}
+    for endpoint, endpoint_records in sorted(by_endpoint.items()):
+        latencies = sorted(r['latency'] for r in endpoint_records)
+        errors = sum(not r['ok'] for r in endpoint_records)
+        summary[endpoint] = {
+            'requests': len(endpoint_records),
+            'throughput': len(endpoint_records) / duration,
+            'error_rate': (errors / len(endpoint_records)
+                           if endpoint_records else 0),
+            'statuses': dict(collections.Counter(
+                str(r['status']) for r in endpoint_records)),
+            'latency': {
+                'p50': percentile(latencies, 50),
+                'p90': percentile(latencies, 90),
+                'p99': percentile(latencies, 99),
+                'max': latencies[-1] if latencies else None,
+            },
+        }
+    return summary
+
+
+def print_summary(summary):
+    print('{0:<46} {1:>7} {2:>8} {3:>7} {4:>8} {5:>8} {6:>8}'.format(
+        'endpoint', 'req/s', 'errors', 'p50 ms', 'p90 ms', 'p99 ms',
+        'max ms'), file=sys.stderr)
+    for endpoint, stats in summary.items():
+        latency = stats['latency']
+        print('{0:<46} {1:7.1f} {2:7.1%} {3:8.1f} {4:8.1f} {5:8.1f} '
+              '{6:8.1f}'.format(
+                  endpoint, stats['throughput'], stats['error_rate'],
+                  *(1000 * latency[key]
+                    for key in ('p50', 'p90', 'p99', 'max'))),
+              file=sys.stderr)
+
+
+def parse_mix(mix):
+    weights = {}
+    for item in mix.split(','):
+        action, _, weight = item.partition('=')
+        if action not in ACTIONS:
+            raise argparse.ArgumentTypeError(
+                'unknown action {0!r} (valid actions: {1})'
+                .format(action, ', '.join(ACTIONS)))
+        weights[action] = float(weight or 1)
+    return weights
+
+
+def parse_command_line(argv):
+    parser = argparse.ArgumentParser(
+        description=__doc__.split('\n\n')[0])
+    parser.add_argument('--server', choices=['gunicorn', 'werkzeug'],
+                        default='gunicorn',
+                        help='how to serve the API (default: %(default)s)')
+    parser.add_argument('--url',
+                        help='base URL of an existing deployment of the API '
+                        '(no server is started)')
+    parser.add_argument('--worker-class', default='sync',
+                        help='gunicorn worker class, e.g. sync, gthread or '
+                        'gevent (default: %(default)s)')
+    parser.add_argument('--workers', type=int, default=2,
+                        help='number of gunicorn workers (default: '
+                        '%(default)s)')
+    parser.add_argument('--threads', type=int, default=1,
+                        help='threads per gunicorn worker, for the gthread '
+                        'worker class (default: %(default)s)')
+    parser.add_argument('--broker',
+                        help='Celery broker URL (default: in-memory)')
+    parser.add_argument('--result-backend',
+                        help='Celery result backend URL (default: '
+                        'in-memory)')
+    parser.add_argument('--concurrency', type=int, default=10,
+                        help='number of virtual users (default: '
+                        '%(default)s)')
+    parser.add_argument('--duration', type=float, default=30,
+                        help='duration of the test in seconds (default: '
+                        '%(default)s)')
+    parser.add_argument('--mix', type=parse_mix, default=DEFAULT_MIX,
+                        help='relative frequencies of the actions of the '
+                        'virtual users, among {0} (default: %(default)s)'
+                        .format(', '.join(ACTIONS)))
+    parser.add_argument('--image-service-url',
+                        help='URL of the image service (default: a fake '
+                        'image service is run locally)')
+    parser.add_argument('--image-service-latency', type=float, default=0.05,
+                        help='latency of the fake image service, in seconds '
+                        '(default: %(default)s)')
+    parser.add_argument('--num-images', type=int, default=20,
+                        help='number of additional images in the listing of '
+                        'the fake image service (default: %(default)s)')
+    parser.add_argument('--max-submit-latency', type=float,
+                        help='maximum median latency of the submissions of '
+                        'computations, in seconds (default: computed from '
+                        'the latency of the fake image service, no bound '
+                        'with --image-service-url)')
+    parser.add_argument('--output', metavar='FILE',
+                        help='write the results to FILE (JSON)')
+    return parser.parse_args(argv[1:])
+
+
+def check_submit_latency(summary, max_latency):
+    """Check the median latency of the submissions of computations.
+
+    :returns: the number of endpoints whose median latency exceeds
+              max_latency
+    """
+    num_violations = 0
+    for endpoint, stats in summary.items():
+        if not endpoint.startswith('POST '):
+            continue
+        p50 = stats['latency']['p50']
+        if p50 is not None and p50 > max_latency:
+            print('{0}: the median latency ({1:.1f} ms) exceeds the bound of '
+                  '{2:.1f} ms'.format(endpoint, 1000 * p50,
+                                      1000 * max_latency),
+                  file=sys.stderr)
+            num_violations += 1
+    return num_violations
+
+
+def main(argv=sys.argv):
+    args = parse_command_line(argv)
+    scratch_dir = tempfile.mkdtemp(prefix='cortical_voluba_load_')
+    try:
+        with contextlib.ExitStack() as exit_stack:
+            image_service_url = args.image_service_url
+            if not image_service_url:
+                storage_dir = os.path.join(scratch_dir, 'image_service')
+                os.mkdir(storage_dir)
+                image_service_url = exit_stack.enter_context(
+                    fake_image_service.serve_in_background(
+                        fake_image_service.create_app(storage_dir)))
+                populate_image_service(image_service_url, args.num_images)
+                requests.post(image_service_url + '_fake/config', json={
+                    'latency': args.image_service_latency,
+                }).raise_for_status()
+            if args.url:
+                api_url = args.url.rstrip('/') + '/'
+            elif args.server == 'gunicorn':
+                api_url = exit_stack.enter_context(
+                    run_gunicorn(args, scratch_dir))
+            else:
+                api_url = exit_stack.enter_context(run_werkzeug(args))
+            wait_for_server(api_url)
+            records = run_load(api_url, image_service_url, args.mix,
+                               args.concurrency, args.duration)
+    finally:
+        shutil.rmtree(scratch_dir)
+
+    summary = summarize(records, args.duration)
+    print_summary(summary)
+    max_submit_latency = args.max_submit_latency
+    if max_submit_latency is None and not args.image_service_url:
+        max_submit_latency = (
+            SUBMIT_LATENCY_ROUND_TRIPS * args.image_service_latency
+            + SUBMIT_LATENCY_OVERHEAD)
+    num_violations = 0
+    if max_submit_latency is not None:
+        num_violations = check_submit_latency(summary, max_submit_latency)
+    if args.output:
+        results = {
+            'version': cortical_voluba.__version__,
+            'date': datetime.datetime.utcnow().replace(
+                microsecond=0).isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'server': ('external' if args.url else args.server),
+            'worker_class': args.worker_class,
+            'workers': args.workers,
+            'threads': args.threads,
+            'concurrency': args.concurrency,
+            'duration': args.duration,
+            'mix': args.mix,
+            'image_service_latency': args.image_service_latency,
+            'num_images': args.num_images,
+            'max_submit_latency': max_submit_latency,
+            'endpoints': summary,
+        }
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    return 1 if summary['all']['requests'] == 0 or num_violations else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
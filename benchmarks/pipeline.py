@@ -0,0 +1,494 @@
+# Copyright 2020 CEA
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# This file is part of cortical-voluba.
+#
+# cortical-voluba is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# cortical-voluba is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License
+# for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with cortical-voluba. If not, see <https://www.gnu.org/licenses/>.
+
+"""Benchmark of the worker pipelines on synthetic volumes.
+
+The depth map and alignment tasks are run end-to-end on synthetic volumes
+(a folded cortical slab) of increasing size, e.g.::
+
+    python benchmarks/pipeline.py --sizes 64 128 256 --output results.json
+
+The code of the tasks and all the in-process stages (cropping, downsampling,
+composition of the displacement field, resampling...) are the real ones.
+The external tools are replaced by stand-ins, so that the benchmark runs
+without BrainVISA or ANTs:
+
+- the BrainVISA commands are emulated with NumPy, the depth map being
+  computed by a fixed number of Jacobi iterations of the Laplace equation;
+- the registration is replaced by a backend that writes a smooth synthetic
+  deformation field;
+- the image service is replaced by a local directory, or optionally by
+  `cortical_voluba.fake_image_service` (``--fake-image-service``), which
+  exercises the real HTTP client under a configurable latency and bandwidth.
+
+For each task and size, the wall time, peak resident memory and number of
+bytes written are measured for every stage of the task (as delimited by the
+task checkpoints). The results are written as JSON. Use ``--compare`` to
+compare the results with those of a previous run: the exit status is 1 if a
+stage became slower by more than the threshold.
+
+Peak memory and bytes written are read from ``/proc/self``, they are only
+available on Linux.
+"""
+
+import argparse
+import contextlib
+import datetime
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from unittest import mock
+
+import nibabel
+import numpy
+
+import cortical_voluba
+from cortical_voluba import checkpoints
+from cortical_voluba import fake_image_service
+from cortical_voluba import image_service
+from cortical_voluba import registration_backends
+
+
+DEFAULT_SIZES = [64, 128, 256]
+
+FIELD_OF_VIEW = 20.0
+"""Size of the synthetic volumes in millimetres (whatever their shape)."""
+
+LAPLACE_ITERATIONS = 20
+"""Iterations of the stand-in depth map computation."""
+
+TEMPLATE_NAME = 'template-equivolumetric-depth'
+SEGMENTATION_NAME = 'segmentation'
+DEPTH_MAP_NAME = 'depthmap'
+IMAGE_NAME = 'image'
+
+MIN_COMPARED_TIME = 0.05
+"""Stages that are faster than this (in seconds) are not compared."""
+
+
+#
+# Synthetic data
+#
+
+def synthetic_depth(size, phase=0.0):
+    """Depth of a folded cortical slab, NaN outside of the cortex.
+
+    The pial surface (depth 0) and white surface (depth 1) are sinusoidal
+    sheets, the slab covers the central part of the volume in x and y.
+    """
+    x, y, z = (numpy.linspace(0, 1, size, dtype=numpy.float32)
+               .reshape(shape) for shape in ((-1, 1, 1), (1, -1, 1),
+                                             (1, 1, -1)))
+    fold = 0.08 * numpy.sin(2 * numpy.pi * (2 * x + phase)) * numpy.sin(
+        2 * numpy.pi * 2 * y)
+    depth = (0.7 + fold - z) / 0.3
+    inside = (x > 0.125) & (x < 0.875) & (y > 0.125) & (y < 0.875)
+    return numpy.where(inside, depth, numpy.float32(numpy.nan))
+
+
+def make_synthetic_data(directory, size):
+    """Write the synthetic volumes into directory (image service layout)."""
+    voxel_size = FIELD_OF_VIEW / size
+    affine = numpy.diag([voxel_size] * 3 + [1])
+    depth = synthetic_depth(size)
+    labels = numpy.zeros(depth.shape, dtype=numpy.uint8)
+    with numpy.errstate(invalid='ignore'):
+        labels[(depth >= 0) & (depth <= 1)] = 100
+        labels[depth > 1] = 200
+    save(labels, affine, directory, SEGMENTATION_NAME)
+    del labels
+    # The depth maps have zeros outside of the cortex, as the output of the
+    # depth map task.
+    with numpy.errstate(invalid='ignore'):
+        depth[~((depth >= 0) & (depth <= 1))] = 0
+    save(depth, affine, directory, DEPTH_MAP_NAME)
+    del depth
+    template = synthetic_depth(size, phase=0.05)
+    with numpy.errstate(invalid='ignore'):
+        template[~((template >= 0) & (template <= 1))] = 0
+    save(template, affine, directory, TEMPLATE_NAME)
+    del template
+    rng = numpy.random.RandomState(0)
+    image = rng.randint(0, 256, size=(size, size, size), dtype=numpy.uint8)
+    save(image, affine, directory, IMAGE_NAME)
+
+
+def save(data, affine, directory, name):
+    img = nibabel.Nifti1Image(data, affine)
+    img.set_qform(affine, code=1)
+    nibabel.save(img, os.path.join(directory, name + '.nii.gz'))
+
+
+#
+# Stand-ins for the external services and tools
+#
+
+class LocalImageService:
+    """Stand-in for `cortical_voluba.image_service.ImageServiceClient`."""
+    def __init__(self, directory):
+        self.directory = directory
+        self.base_url = 'http://image-service.invalid/'
+
+    def _path(self, name):
+        return os.path.join(self.directory, name + '.nii.gz')
+
+    def download_compressed_nifti(self, name, output_file):
+        with open(self._path(name), 'rb') as f:
+            shutil.copyfileobj(f, output_file)
+
+    def preflight_image(self, image_file, *, file_name):
+        pass
+
+    def upload_image_and_get_name(self, image_file, *, file_name):
+        name = file_name[:-len('.nii.gz')]
+        with open(self._path(name), 'wb') as f:
+            shutil.copyfileobj(image_file, f)
+        return name, {'fileName': file_name}
+
+    def get_image_info(self, name):
+        return {'links': {'normalized': '/nifti/' + name}}
+
+
+def laplace_depth(classif, iterations=LAPLACE_ITERATIONS):
+    """Crude equivolumetric depth: relaxation of the Laplace equation."""
+    cortex = classif == 100
+    depth = numpy.where(classif == 200, numpy.float32(1), numpy.float32(0))
+    depth[cortex] = 0.5
+    for _ in range(iterations):
+        neighbours = numpy.zeros_like(depth)
+        for axis in range(3):
+            neighbours += numpy.roll(depth, 1, axis=axis)
+            neighbours += numpy.roll(depth, -1, axis=axis)
+        depth[cortex] = neighbours[cortex] / 6
+    depth[~cortex] = numpy.nan
+    return depth
+
+
+def fake_bv_command(command):
+    """Emulate the BrainVISA commands that are run by the tasks."""
+    def argument(option):
+        return command[command.index(option) + 1]
+    if command[0] == 'AimsFileConvert':
+        img = nibabel.load(argument('--input'))
+        data = numpy.asanyarray(img.dataobj).astype(numpy.int16)
+        nibabel.save(nibabel.Nifti1Image(data, img.affine, img.header),
+                     argument('--output'))
+    elif command[0] == 'python':
+        pipeline_args = dict(arg.split('=', 1) for arg in command
+                             if '=' in arg)
+        img = nibabel.load(pipeline_args['classif'])
+        start_time = time.perf_counter()
+        depth = laplace_depth(numpy.asanyarray(img.dataobj))
+        nibabel.save(nibabel.Nifti1Image(depth, img.affine),
+                     pipeline_args['equivolumetric_depth'])
+        if '--timings' in command:
+            with open(argument('--timings'), 'w') as f:
+                json.dump({'laplace': time.perf_counter() - start_time}, f)
+    elif command[0] == 'AimsRemoveNaN':
+        img = nibabel.load(argument('-i'))
+        data = numpy.nan_to_num(numpy.asanyarray(img.dataobj),
+                                nan=float(argument('--value')))
+        nibabel.save(nibabel.Nifti1Image(data, img.affine), argument('-o'))
+    elif command[0] == 'AimsThreshold':
+        img = nibabel.load(argument('--input'))
+        data = numpy.clip(numpy.asanyarray(img.dataobj), 0, 1)
+        nibabel.save(nibabel.Nifti1Image(data, img.affine),
+                     argument('--output'))
+    else:
+        raise ValueError('no stand-in for the command {0}'.format(command))
+
+
+class SyntheticRegistrationBackend(registration_backends.RegistrationBackend):
+    """Stand-in for ANTs, writes a smooth displacement of about a voxel."""
+    name = 'synthetic'
+
+    def register(self, fixed_path, moving_path, initial_moving_transform,
+                 schedule, output_prefix, work_dir):
+        fixed_img = nibabel.load(fixed_path)
+        shape = fixed_img.shape[:3]
+        voxel_size = numpy.asarray(fixed_img.header.get_zooms()[:3])
+        x = numpy.linspace(0, 2 * numpy.pi, shape[0], dtype=numpy.float32)
+        warp = numpy.zeros(shape + (1, 3), dtype=numpy.float32)
+        warp[..., 0, 2] = (voxel_size[2]
+                           * numpy.sin(x).reshape((-1, 1, 1)))
+        for suffix, sign in (('1Warp.nii.gz', 1), ('1InverseWarp.nii.gz', -1)):
+            warp_img = nibabel.Nifti1Image(sign * warp, fixed_img.affine)
+            warp_img.header.set_intent('vector')
+            nibabel.save(warp_img, output_prefix + suffix)
+
+    def apply_transforms(self, input_path, reference_path, output_path,
+                         transforms, work_dir):
+        input_img = nibabel.load(input_path)
+        reference_img = nibabel.load(reference_path)
+        data = numpy.zeros(reference_img.shape[:3], dtype=numpy.float32)
+        if input_img.shape[:3] == reference_img.shape[:3]:
+            data[...] = numpy.asanyarray(input_img.dataobj)
+        nibabel.save(nibabel.Nifti1Image(data, reference_img.affine),
+                     output_path)
+
+
+#
+# Measurements
+#
+
+def _read_proc(file_name, key):
+    """Read a numeric field of /proc/self/<file_name> (None if unavailable)."""
+    try:
+        with open(os.path.join('/proc/self', file_name)) as f:
+            for line in f:
+                if line.startswith(key + ':'):
+                    value = line.split()[1]
+                    # VmHWM is given in kB
+                    return int(value) * (1024 if file_name == 'status' else 1)
+    except OSError:
+        pass
+    return None
+
+
+def _reset_peak_rss():
+    # Supported since Linux 4.0
+    with contextlib.suppress(OSError):
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+
+
+@contextlib.contextmanager
+def measure(name, records):
+    """Measure the wall time, peak RSS and bytes written by a block."""
+    _reset_peak_rss()
+    start_written = _read_proc('io', 'wchar')
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        wall_time = time.perf_counter() - start_time
+        end_written = _read_proc('io', 'wchar')
+        records.append({
+            'name': name,
+            'wall_time': wall_time,
+            'peak_rss': _read_proc('status', 'VmHWM'),
+            'bytes_written': (end_written - start_written
+                              if start_written is not None else None),
+        })
+
+
+def run_task(task, params, stages):
+    """Run a task, measuring each of the stages of its checkpoints."""
+    original_run = checkpoints.Checkpoints.run
+
+    def measured_run(self, stage, function, *args, **kwargs):
+        with measure(stage, stages):
+            return original_run(self, stage, function, *args, **kwargs)
+    with mock.patch.object(checkpoints.Checkpoints, 'run', measured_run):
+        return task(params, bearer_token='benchmark')
+
+
+def benchmark_size(size, data_dir, threads, image_service_url=None):
+    """Run the depth map and alignment tasks on volumes of the given size.
+
+    :param str image_service_url: URL of a fake image service that serves
+           the files of data_dir, if None the files are accessed directly
+    """
+    from cortical_voluba import tasks
+
+    # Remove the results of the previous runs
+    for file_name in os.listdir(data_dir):
+        os.unlink(os.path.join(data_dir, file_name))
+    make_synthetic_data(data_dir, size)
+    if image_service_url:
+        client = image_service.ImageServiceClient(image_service_url)
+    else:
+        client = LocalImageService(data_dir)
+    results = []
+    benchmarks = [
+        (tasks.depth_map_computation_task, {
+            'image_service_base_url': client.base_url,
+            'segmentation_name': SEGMENTATION_NAME,
+        }),
+        (tasks.alignment_computation_task, {
+            'image_service_base_url': client.base_url,
+            'image_name': IMAGE_NAME,
+            'depth_map_name': DEPTH_MAP_NAME,
+            'transformation_matrix': numpy.eye(4).tolist(),
+            'landmark_pairs': [],
+        }),
+    ]
+    with mock.patch.object(tasks, 'get_image_service_client',
+                           lambda base_url, bearer_token: client), \
+            mock.patch.object(tasks, 'run_in_bv_env', fake_bv_command):
+        for task, params in benchmarks:
+            stages = []
+            totals = []
+            with measure('total', totals):
+                run_task(task, params, stages)
+            total, = totals
+            if total['peak_rss'] is not None:
+                total['peak_rss'] = max([total['peak_rss']]
+                                        + [s['peak_rss'] for s in stages])
+            result = {
+                'task': task.name.rsplit('.', 1)[-1],
+                'size': size,
+                'threads': threads,
+                'stages': stages,
+                'total': total,
+            }
+            print_result(result)
+            results.append(result)
+    return results
+
+
+def print_result(result):
+    print('{0} at {1}³:'.format(result['task'], result['size']),
+          file=sys.stderr)
+    for record in result['stages'] + [result['total']]:
+        print('  {name:<26} {wall_time:8.3f} s  {rss:>8} MiB  {written:>8} '
+              'MiB written'.format(
+                  rss=_mebibytes(record['peak_rss']),
+                  written=_mebibytes(record['bytes_written']),
+                  **record),
+              file=sys.stderr)
+
+
+def _mebibytes(value):
+    if value is None:
+        return '?'
+    return '{0:.1f}'.format(value / 2 ** 20)
+
+
+def compare(results, baseline, threshold):
+    """Print the ratio of the wall times to those of a previous run.
+
+    :returns: the number of stages that are slower than the baseline by more
+              than threshold (relative)
+    """
+    def wall_times(run):
+        return {
+            (result['task'], result['size'], record['name']):
+            record['wall_time']
+            for result in run['results']
+            for record in result['stages'] + [result['total']]
+        }
+    old_times = wall_times(baseline)
+    num_regressions = 0
+    print('Comparison with version {0}:'.format(baseline.get('version')),
+          file=sys.stderr)
+    for key, new_time in sorted(wall_times(results).items()):
+        old_time = old_times.get(key)
+        if not old_time or max(old_time, new_time) < MIN_COMPARED_TIME:
+            continue
+        ratio = new_time / old_time
+        regression = ratio > 1 + threshold
+        num_regressions += regression
+        print('  {0} {1}³ {2:<26} {3:6.2f}×{4}'.format(
+            key[0], key[1], key[2], ratio,
+            '  REGRESSION' if regression else ''), file=sys.stderr)
+    return num_regressions
+
+
+def parse_command_line(argv):
+    parser = argparse.ArgumentParser(
+        description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES,
+                        help='edge lengths of the synthetic volumes, in '
+                        'voxels (default: %(default)s)')
+    parser.add_argument('--threads', type=int, default=1,
+                        help='thread budget of the tasks (default: '
+                        '%(default)s)')
+    parser.add_argument('--fake-image-service', action='store_true',
+                        help='transfer the images through a local fake '
+                        'image service over HTTP')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='latency of the fake image service, in seconds')
+    parser.add_argument('--bandwidth', type=float,
+                        help='bandwidth of the fake image service, in bytes '
+                        'per second')
+    parser.add_argument('--output', metavar='FILE',
+                        help='write the results to FILE (JSON)')
+    parser.add_argument('--compare', metavar='FILE',
+                        help='compare the results with a previous run')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='relative slowdown that counts as a regression '
+                        'in the comparison (default: %(default)s)')
+    return parser.parse_args(argv[1:])
+
+
+def main(argv=sys.argv):
+    args = parse_command_line(argv)
+    scratch_dir = tempfile.mkdtemp(prefix='cortical_voluba_benchmark_')
+    try:
+        data_dir = os.path.join(scratch_dir, 'image_service')
+        os.mkdir(data_dir)
+        image_service_conditions = None
+        image_service_url = None
+        exit_stack = contextlib.ExitStack()
+        if args.fake_image_service:
+            image_service_conditions = {
+                'latency': args.latency,
+                'bandwidth': args.bandwidth,
+            }
+            image_service_url = exit_stack.enter_context(
+                fake_image_service.serve_in_background(
+                    fake_image_service.create_app(
+                        data_dir, **image_service_conditions)))
+        # The tasks run in the context of this app (through the Celery app)
+        cortical_voluba.create_app(test_config={
+            'TESTING': True,
+            'CELERY_BROKER_URL': 'disabled://',
+            'CELERY_RESULT_BACKEND': 'disabled://',
+            'TEMPLATE_EQUIVOLUMETRIC_DEPTH': os.path.join(
+                data_dir, TEMPLATE_NAME + '.nii.gz'),
+            'REGISTRATION_BACKEND': SyntheticRegistrationBackend.name,
+            'WORKER_THREAD_BUDGET': args.threads,
+        })
+        results = {
+            'version': cortical_voluba.__version__,
+            'date': datetime.datetime.utcnow().replace(
+                microsecond=0).isoformat(),
+            'python': platform.python_version(),
+            'numpy': numpy.__version__,
+            'nibabel': nibabel.__version__,
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'image_service': image_service_conditions,
+            'results': [],
+        }
+        with exit_stack, mock.patch.dict(registration_backends.BACKENDS, {
+                SyntheticRegistrationBackend.name:
+                SyntheticRegistrationBackend}):
+            for size in args.sizes:
+                results['results'] += benchmark_size(
+                    size, data_dir, args.threads, image_service_url)
+    finally:
+        shutil.rmtree(scratch_dir)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,180 @@
+# Copyright 2020 CEA
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# This file is part of cortical-voluba.
+#
+# cortical-voluba is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# cortical-voluba is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License
+# for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with cortical-voluba. If not, see <https://www.gnu.org/licenses/>.
+
+"""Benchmark of the registration backends.
+
+The registration and the resampling are timed with each backend of
+`cortical_voluba.registration_backends` (``ants-cli`` needs the ANTs
+command-line tools, ``antspy`` needs the antspyx package), e.g.::
+
+    python benchmarks/registration_backends.py --sizes 40 80 --output r.json
+
+The inputs are two smooth synthetic depth maps that differ by a small
+deformation. The same backend instance is used for the registration and the
+resampling, as in an alignment task. When several backends are run, the
+largest difference between their inverse warps is also reported (in
+millimetres). The backends that are not available are reported as skipped;
+the exit status is non-zero if none of them could be run.
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+import nibabel
+import numpy
+
+import cortical_voluba
+from cortical_voluba import alignment
+from cortical_voluba import registration_backends
+from cortical_voluba import registration_schedule
+
+
+DEFAULT_SIZES = [40, 80]
+
+
+def make_images(size, directory):
+    """Two smooth depth-like images that differ by a small deformation.
+
+    :returns: the paths of the fixed image, moving image and initial affine
+              transform
+    """
+    grid = numpy.mgrid[0:size, 0:size, 0:size].astype(numpy.float32)
+    radius = numpy.sqrt(numpy.sum((grid - size / 2) ** 2, axis=0))
+    wobble = 1.5 * numpy.sin(grid[0] * 40 / (6 * size))
+    fixed = numpy.clip((radius - size / 5) / (size / 5), 0, 1)
+    moving = numpy.clip((radius + wobble - size / 5) / (size / 5), 0, 1)
+    fixed_path = os.path.join(directory, 'fixed.nii.gz')
+    moving_path = os.path.join(directory, 'moving.nii.gz')
+    nibabel.save(nibabel.Nifti1Image(fixed, numpy.eye(4)), fixed_path)
+    nibabel.save(nibabel.Nifti1Image(moving, numpy.eye(4)), moving_path)
+    affine_path = os.path.join(directory, 'identity.txt')
+    alignment.write_itk_affine_transform(numpy.eye(4), affine_path)
+    return fixed_path, moving_path, affine_path
+
+
+def benchmark_backend(name, size, directory, fixed_path, moving_path,
+                      affine_path):
+    """Time the registration and resampling with a backend.
+
+    :returns: the result, and the inverse warp (None if the backend is not
+              available)
+    """
+    result = {'size': size, 'backend': name}
+    if name == 'ants-cli' and shutil.which('antsRegistration') is None:
+        result['skipped'] = 'the ANTs command-line tools are not installed'
+        return result, None
+    try:
+        backend = registration_backends.get_backend(name)
+    except RuntimeError as exc:
+        result['skipped'] = str(exc)
+        return result, None
+    work_dir = os.path.join(directory, name)
+    os.mkdir(work_dir)
+    schedule = registration_schedule.plan_schedule((size,) * 3, 'fast')
+    output_prefix = os.path.join(work_dir, 'cortical')
+    start_time = time.perf_counter()
+    backend.register(fixed_path, moving_path, affine_path, schedule,
+                     output_prefix, work_dir=work_dir)
+    result['registration_time'] = time.perf_counter() - start_time
+    start_time = time.perf_counter()
+    backend.apply_transforms(
+        moving_path, fixed_path, os.path.join(work_dir, 'resampled.nii.gz'),
+        [output_prefix + '1Warp.nii.gz', '[{0},1]'.format(affine_path)],
+        work_dir=work_dir)
+    result['resampling_time'] = time.perf_counter() - start_time
+    warp = numpy.asanyarray(
+        nibabel.load(output_prefix + '1InverseWarp.nii.gz').dataobj)
+    return result, warp
+
+
+def benchmark_size(size, backends):
+    results = []
+    warps = {}
+    with tempfile.TemporaryDirectory() as directory:
+        images = make_images(size, directory)
+        for name in backends:
+            result, warp = benchmark_backend(name, size, directory, *images)
+            if warp is None:
+                print('{size}³ {backend:<8} skipped: {skipped}'
+                      .format(**result), file=sys.stderr)
+            else:
+                warps[name] = warp
+                print('{size}³ {backend:<8} registration '
+                      '{registration_time:8.3f} s, resampling '
+                      '{resampling_time:8.3f} s'.format(**result),
+                      file=sys.stderr)
+            results.append(result)
+    if len(warps) > 1:
+        reference_name, reference_warp = next(iter(warps.items()))
+        for result in results:
+            if result['backend'] in warps:
+                result['max_warp_difference'] = float(numpy.max(numpy.abs(
+                    warps[result['backend']] - reference_warp)))
+        print('{0}³ largest difference of the inverse warps with {1}: '
+              '{2:.3f} mm'.format(size, reference_name, max(
+                  r.get('max_warp_difference', 0) for r in results)),
+              file=sys.stderr)
+    return results
+
+
+def parse_command_line(argv):
+    parser = argparse.ArgumentParser(
+        description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES,
+                        help='edge lengths of the synthetic images, in '
+                        'voxels (default: %(default)s)')
+    parser.add_argument('--backends', nargs='+',
+                        choices=sorted(registration_backends.BACKENDS),
+                        default=sorted(registration_backends.BACKENDS),
+                        help='backends to run (default: all)')
+    parser.add_argument('--output', metavar='FILE',
+                        help='write the results to FILE (JSON)')
+    return parser.parse_args(argv[1:])
+
+
+def main(argv=sys.argv):
+    args = parse_command_line(argv)
+    results = []
+    for size in args.sizes:
+        results += benchmark_size(size, args.backends)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'version': cortical_voluba.__version__,
+                'date': datetime.datetime.utcnow().replace(
+                    microsecond=0).isoformat(),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'cpu_count': os.cpu_count(),
+                'results': results,
+            }, f, indent=2)
+    if all('skipped' in result for result in results):
+        print('None of the backends could be run', file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
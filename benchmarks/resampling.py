@@ -0,0 +1,158 @@
+# Copyright 2020 CEA
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# This file is part of cortical-voluba.
+#
+# cortical-voluba is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# cortical-voluba is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License
+# for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with cortical-voluba. If not, see <https://www.gnu.org/licenses/>.
+
+"""Benchmark of the resampling with a composite displacement field.
+
+`cortical_voluba.displacement.resample_images` is timed on synthetic images
+of realistic sizes, in Fortran order like the images read by nibabel, e.g.::
+
+    python benchmarks/resampling.py --sizes 256 384 --output results.json
+
+The displacement field is a smooth deformation of about a voxel, sampled on a
+grid downsampled by 2 (as the deformation estimated by the registration). It
+covers either a cube of a quarter of the edge of the image (``local``, as
+for a cortical patch in a larger image), or the whole image (``global``).
+Each case is resampled block by block with the default sparse tolerance
+(``sparse``), and without tolerance (``dense blocks``: all the blocks that
+intersect the field are interpolated). With ``--single-pass``, the whole
+grid is also interpolated at once, as a reference (this needs about 100
+bytes per voxel).
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import sys
+import time
+
+import numpy
+
+import cortical_voluba
+from cortical_voluba import displacement
+
+
+DEFAULT_SIZES = [256, 384]
+
+FIELD_DOWNSAMPLING = 2
+"""Ratio of the voxel size of the displacement field to that of the image."""
+
+
+def make_image(size):
+    """Random 8-bit image, in Fortran order."""
+    rng = numpy.random.RandomState(0)
+    return numpy.asfortranarray(
+        rng.randint(0, 256, size=(size,) * 3).astype(numpy.uint8))
+
+
+def make_field(size, extent):
+    """Smooth displacement field of about a voxel.
+
+    :param str extent: ``'local'`` (a cube of a quarter of the edge of the
+           image, in its middle) or ``'global'`` (the whole image)
+    """
+    field_size = size // FIELD_DOWNSAMPLING
+    if extent == 'local':
+        field_size //= 4
+    x = numpy.linspace(0, numpy.pi, field_size, dtype=numpy.float32)
+    data = numpy.zeros((field_size,) * 3 + (3,), dtype=numpy.float32)
+    data[..., 2] = numpy.sin(x).reshape((-1, 1, 1))
+    data[..., 0] = 0.5 * numpy.sin(2 * x).reshape((1, -1, 1))
+    field_to_reference = numpy.diag([FIELD_DOWNSAMPLING] * 3 + [1.0])
+    if extent == 'local':
+        field_to_reference[:3, 3] = (size - field_size * FIELD_DOWNSAMPLING
+                                     ) // 2
+    return displacement.DisplacementField(data, field_to_reference,
+                                          numpy.eye(4), (size,) * 3)
+
+
+def resample_single_pass(image, field):
+    """Interpolate the whole grid at once."""
+    voxels = numpy.indices(image.shape).reshape((3, -1)).T
+    interpolation = displacement.LinearInterpolation(
+        voxels + field.interpolate(voxels), image.shape)
+    return interpolation(image).reshape(image.shape)
+
+
+def benchmark_size(size, single_pass):
+    image = make_image(size)
+    results = []
+    for extent in ('local', 'global'):
+        field = make_field(size, extent)
+        methods = [
+            ('sparse', lambda: displacement.resample_images([image], field)),
+            ('dense blocks', lambda: displacement.resample_images(
+                [image], field, tolerance=None)),
+        ]
+        if single_pass:
+            methods.append(('single pass',
+                            lambda: resample_single_pass(image, field)))
+        for method, function in methods:
+            start_time = time.perf_counter()
+            function()
+            wall_time = time.perf_counter() - start_time
+            result = {
+                'size': size,
+                'extent': extent,
+                'method': method,
+                'wall_time': wall_time,
+            }
+            print('{size}³ {extent:<6} {method:<12} {wall_time:8.3f} s '
+                  '({rate:.1f} Mvoxel/s)'.format(
+                      rate=size ** 3 / wall_time / 1e6, **result),
+                  file=sys.stderr)
+            results.append(result)
+    return results
+
+
+def parse_command_line(argv):
+    parser = argparse.ArgumentParser(
+        description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES,
+                        help='edge lengths of the synthetic images, in '
+                        'voxels (default: %(default)s)')
+    parser.add_argument('--single-pass', action='store_true',
+                        help='also interpolate the whole grid at once')
+    parser.add_argument('--output', metavar='FILE',
+                        help='write the results to FILE (JSON)')
+    return parser.parse_args(argv[1:])
+
+
+def main(argv=sys.argv):
+    args = parse_command_line(argv)
+    results = []
+    for size in args.sizes:
+        results += benchmark_size(size, args.single_pass)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'version': cortical_voluba.__version__,
+                'date': datetime.datetime.utcnow().replace(
+                    microsecond=0).isoformat(),
+                'python': platform.python_version(),
+                'numpy': numpy.__version__,
+                'platform': platform.platform(),
+                'cpu_count': os.cpu_count(),
+                'results': results,
+            }, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
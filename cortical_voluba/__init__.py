@@ -20,7 +20,6 @@
 """
 
 import datetime
-import importlib
 import logging
 import logging.config
 import os
@@ -53,6 +52,114 @@ class DefaultConfig:
     CORS_MAX_AGE = datetime.timedelta(minutes=10)
     # Set the full path to bv_env if it is not in the system PATH
     BV_ENV_PATH = 'bv_env'
+    # Set to True to run the BrainVISA commands through a persistent server
+    # that keeps the BrainVISA environment and the capsul / highres-cortex
+    # modules loaded between invocations (one server per worker process).
+    BV_PERSISTENT_SERVER = False
+    # Number of CPU threads that a task is allowed to use, e.g. for running
+    # independent nodes of the depth map pipeline in parallel. By default, all
+    # the CPUs available to the worker process are used.
+    WORKER_THREAD_BUDGET = None
+    # The segmentation is cropped to the bounding box of its non-background
+    # labels, plus this margin (in voxels), before the depth map is computed.
+    # Set to None to disable cropping.
+    SEGMENTATION_CROP_MARGIN = 5
+    # The registration is restricted to the non-zero support of the incoming
+    # depth map (and the corresponding region of the template), dilated by
+    # this margin in millimetres. Set to None to register the whole images.
+    REGISTRATION_CROP_MARGIN = 2.0
+    # The transformation matrix of alignment requests can be refined by a
+    # least-squares fit to the landmark pairs ('rigid' or 'affine'), before
+    # it is used to initialize the registration. The refinement is only done
+    # if there are clearly more landmarks than needed for the fit (see
+    # cortical_voluba.landmarks.select_refinement_model). Set to None to use
+    # the transformation matrix as is.
+    LANDMARK_AFFINE_REFINEMENT = None
+    # The alignment fails early if the RMS residual of the landmarks (in
+    # millimetres, after refinement) exceeds this value. Set to None to
+    # disable this check.
+    LANDMARK_MAX_RMS_RESIDUAL = None
+    # Engine that runs the registration and resampling: 'ants-cli' runs the
+    # ANTs command-line tools, 'antspy' runs ANTs in-process through ANTsPy
+    # (requires the antspyx package).
+    REGISTRATION_BACKEND = 'ants-cli'
+    # After the registration, the deformation is converted to a compact
+    # field of voxel displacements, which is used to resample images that
+    # have the same grid as the depth map without calling ANTs again.
+    COMPOSITE_DISPLACEMENT_FIELD = True
+    # Regions where the displacement is below this value (in voxels) are
+    # copied from the input image instead of being interpolated when
+    # resampling with the composite displacement field. Set to None to
+    # interpolate everywhere.
+    SPARSE_RESAMPLING_TOLERANCE = 1e-3
+    # Directory where the workers keep a cache of the images that they
+    # download from the image service (shared by the workers of a node).
+    # Set to None to disable the cache.
+    DOWNLOAD_CACHE_DIR = None
+    # Maximum total size of the download cache, in bytes
+    DOWNLOAD_CACHE_MAX_BYTES = 20 * 1024 ** 3
+    # Directory where the computation tasks keep their scratch directory
+    # and the checkpoints of their stages, so that a task that is retried (or
+    # delivered again after a restart of the worker) resumes from its last
+    # completed stage. It should be shared by all workers. Set to None to use
+    # a temporary directory (tasks then restart from scratch).
+    CHECKPOINT_DIR = None
+    # The checkpoints of tasks that have stopped without cleaning up (e.g.
+    # when the worker was killed) are removed after this duration without
+    # heartbeat from the task.
+    CHECKPOINT_TTL = datetime.timedelta(days=1)
+    # When a computation is submitted, the headers of its input images are
+    # downloaded from the image service to estimate the resources that the
+    # computation will need. Computations are rejected if an input image has
+    # more than MAX_INPUT_VOXELS voxels, or if the estimated peak memory is
+    # more than MAX_ESTIMATED_MEMORY bytes (None means no limit).
+    PROBE_INPUT_HEADERS = True
+    MAX_INPUT_VOXELS = None
+    MAX_ESTIMATED_MEMORY = None
+    # Computations are routed to Celery queues according to their estimated
+    # peak memory, so that small jobs are not stuck behind large ones, and
+    # large jobs run on workers that have enough memory. This is a list of
+    # (queue name, maximum memory in bytes) pairs, by increasing memory, e.g.
+    #     [('small', 4 * 1024 ** 3), ('large', 32 * 1024 ** 3),
+    #      ('huge', None)]
+    # Each queue must be consumed by a worker (celery worker --queues=...).
+    # Computations of unknown size are sent to the last queue. Set to None to
+    # send all tasks to the default queue.
+    COMPUTATION_QUEUES = None
+    # Path of an SQLite database where the workers record the resources used
+    # by each computation (see cortical_voluba.ledger), which are summarized
+    # by the /v0/job-statistics and /v0/queues endpoints. It must be
+    # accessible to the API and the workers, on a local file system. Set to
+    # None to disable.
+    JOB_LEDGER_PATH = None
+    # File where the spans of the traces of the computations are appended
+    # (JSON lines in the Zipkin v2 format, see cortical_voluba.tracing). It
+    # can be shared by the API and the workers. Set to None to disable.
+    TRACE_FILE = None
+    # Run the computation tasks under a sampling profiler, and save the
+    # profile along with the duration of the stages and the resource usage
+    # of the external commands (see cortical_voluba.profiling). With
+    # PROFILE_TASKS, every computation is profiled; with
+    # ALLOW_PROFILE_REQUESTS, the computations that are submitted with
+    # "profile": true are profiled.
+    PROFILE_TASKS = False
+    ALLOW_PROFILE_REQUESTS = False
+    # Directory where the profiles are saved. It must be shared by the API
+    # and the workers for the /v0/profiles endpoint to serve them. Set to
+    # None to use the 'profiles' sub-directory of the instance folder.
+    PROFILE_DIR = None
+    # Interval between two samples of the Python stacks, in seconds
+    PROFILE_SAMPLING_INTERVAL = 0.01
+    # Each profile is truncated to PROFILE_MAX_BYTES (the least frequent
+    # stacks are left out). The profiles are removed after PROFILE_TTL, or
+    # earlier (oldest first) if their total size exceeds
+    # PROFILE_MAX_TOTAL_BYTES.
+    PROFILE_MAX_BYTES = 10 * 1024 ** 2
+    PROFILE_MAX_TOTAL_BYTES = 1024 ** 3
+    PROFILE_TTL = datetime.timedelta(days=7)
+    # Set to True to enable the /v0/profiles endpoints, which let operators
+    # retrieve the profiles
+    ENABLE_PROFILE_ENDPOINT = False
     # Set to True to enable the /echo endpoint (for debugging)
     ENABLE_ECHO = False
     # Set up werkzeug.middleware.proxy_fix.ProxyFix with the provided keyword
@@ -131,6 +238,9 @@ def create_app(test_config=None):
         # load the test config if passed in
         app.config.from_mapping(test_config)
 
+    from . import tracing
+    tracing.configure(app.config.get('TRACE_FILE'))
+
     # ensure that the instance folder exists
     try:
         os.makedirs(app.instance_path)
@@ -166,18 +276,15 @@ def echo():
                         max_age=app.config['CORS_MAX_AGE'],
                         allow_headers=['Authorization', 'Content-Type'])
 
-    # Celery must be initialized before the tasks module is imported, i.e.
-    # before the API modules.
     with app.app_context():
         # We must instantiate a new Celery app each time a Flask app is
         # instantiated, because the Celery app and tasks are tied to the Flask
-        # app (they read from flask_app.config).
+        # app (they read from flask_app.config). The tasks are shared tasks,
+        # which are bound to the current Celery app when they are used, so
+        # there is no need to import the tasks module here (it is only needed
+        # by the worker).
         from . import celery
         celery.celery_app = celery.create_celery_app(app)
-        # Every time a new Celery app is instantiated, the tasks need to be
-        # re-created because they must use the correct app at import time.
-        from . import tasks
-        importlib.reload(tasks)
 
     if app.config['ENV'] == 'development':
         local_server = [
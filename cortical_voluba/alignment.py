@@ -21,10 +21,17 @@
 import nibabel
 import numpy
 import os.path
-import subprocess
 
 from flask import current_app
 
+from cortical_voluba import displacement
+from cortical_voluba import landmarks
+from cortical_voluba import output_types
+from cortical_voluba import registration_backends
+from cortical_voluba import registration_schedule
+from cortical_voluba import roi
+from cortical_voluba import tracing
+
 
 ITK_TO_NIFTI_COORDINATES = numpy.array(
     [[-1, 0, 0, 0],
@@ -34,10 +41,15 @@
 )
 NIFTI_TO_ITK_COORDINATES = ITK_TO_NIFTI_COORDINATES
 
+COMPOSITE_DISPLACEMENT_FILE_NAME = 'composite_displacement.npz'
 
 logger = logging.getLogger(__name__)
 
 
+class LandmarkMismatchError(ValueError):
+    """Raised when the landmark pairs cannot be fitted accurately."""
+
+
 def transform_points(points, matrix):
     points = numpy.atleast_2d(points)
     homogeneous_points = numpy.r_[points.T, numpy.ones((1, len(points)))]
@@ -62,14 +74,52 @@ def write_itk_affine_transform(mat, file_name):
         f.write("FixedParameters: 0 0 0\n")
 
 
+def get_registration_backend():
+    """Get an instance of the configured registration backend.
+
+    The backend is set by the ``REGISTRATION_BACKEND`` configuration value.
+    """
+    return registration_backends.get_backend(
+        current_app.config.get('REGISTRATION_BACKEND',
+                               registration_backends.DEFAULT_BACKEND))
+
+
+@tracing.traced('estimate deformation')
 def estimate_deformation(depth_map_path, template_depth_map_path,
                          transformation_matrix, landmark_pairs,
-                         work_dir):
+                         work_dir,
+                         preset=registration_schedule.DEFAULT_PRESET,
+                         backend=None):
+    """Estimate the deformation from the incoming depth map to the template.
+
+    The deformation fields are written into work_dir, for use by
+    `transform_image`.
+
+    :param list landmark_pairs: landmark pairs, as accepted by the API; the
+           pairs whose ``active`` field is false are ignored
+    :param str preset: name of the preset of the registration schedule (see
+           `cortical_voluba.registration_schedule.PRESETS`)
+    :param backend: registration backend (see
+           `cortical_voluba.registration_backends`), by default a new
+           instance of the configured backend (see
+           `get_registration_backend`). Pass the same instance to
+           `transform_image`, so that it can reuse the data that the backend
+           keeps in memory.
+    :returns: information about the registration: the schedule that was used
+              (``registration_schedule``), the transformation matrix after
+              refinement by the landmarks (``transformation_matrix``), and
+              the report of the landmark fit (``landmark_report``)
+    :rtype: dict
+    :raises LandmarkMismatchError: if the residual error of the landmarks
+            exceeds the ``LANDMARK_MAX_RMS_RESIDUAL`` configuration value
+    """
     incoming_to_template_affine = numpy.asarray(transformation_matrix)
     assert incoming_to_template_affine.shape == (4, 4)
     if numpy.any(incoming_to_template_affine[3] != [0, 0, 0, 1]):
         raise ValueError('The last row of the transformation matrix must be '
                          '[0, 0, 0, 1]')
+    landmark_pairs = [pair for pair in landmark_pairs or []
+                      if pair.get('active', True)]
     if landmark_pairs:
         # TODO amend the protocol to clarify the meaning of source/target wrt.
         # incoming/template
@@ -88,65 +138,297 @@ def estimate_deformation(depth_map_path, template_depth_map_path,
     logger.debug('Incoming points in template space:\n%s',
                  incoming_points_in_template_space)
 
+    landmark_report = None
+    refinement_model = current_app.config.get('LANDMARK_AFFINE_REFINEMENT')
+    if refinement_model and len(incoming_points) > 0:
+        incoming_to_template_affine, landmark_report = (
+            landmarks.refine_transformation(
+                incoming_points, template_points,
+                incoming_to_template_affine, model=refinement_model))
+        logger.info('Landmark fit (%s model): RMS residual %s mm before, '
+                    '%s mm after refinement, outliers: %s',
+                    landmark_report['model'],
+                    landmark_report['rms_residual_before'],
+                    landmark_report['rms_residual_after'],
+                    landmark_report['outliers'])
+        max_rms_residual = current_app.config.get('LANDMARK_MAX_RMS_RESIDUAL')
+        rms_residual = landmark_report['rms_residual_after']
+        if (max_rms_residual is not None and rms_residual is not None
+                and rms_residual > max_rms_residual):
+            raise LandmarkMismatchError(
+                'The landmarks are inconsistent: their RMS residual error is '
+                '{0:.2f} mm (maximum allowed: {1} mm)'
+                .format(rms_residual, max_rms_residual))
+
     template_to_incoming_affine = numpy.linalg.inv(incoming_to_template_affine)
     # TODO check if Nibabel behaves the same as ITK when the qform is missing
     incoming_nibabel = nibabel.load(depth_map_path)
     incoming_qform = incoming_nibabel.get_qform()
     incoming_voxel_size = incoming_nibabel.header.get_zooms()
 
+    affine_path = os.path.join(work_dir, 'template_to_incoming_affine.txt')
     write_itk_affine_transform(
         NIFTI_TO_ITK_COORDINATES
         @ incoming_qform
         @ numpy.diag([1 / vs for vs in incoming_voxel_size] + [1])
         @ template_to_incoming_affine
         @ ITK_TO_NIFTI_COORDINATES,
-        os.path.join(work_dir, 'template_to_incoming_affine.txt')
+        affine_path
     )
+    if backend is None:
+        backend = get_registration_backend()
     if current_app.config.get('DEBUG_ALIGNMENT'):
-        command = [
-            'antsApplyTransforms', '--verbose',
-            '--float',
-            '--input', depth_map_path,
-            '--reference-image', template_depth_map_path,
-            '--interpolation', 'Linear',
-            '--default-value', '0',
-            '--output', 'incoming_depth_map_in_template.nii.gz',
-            '--transform', 'template_to_incoming_affine.txt',
-        ]
-        logger.debug('Running %s with cwd=%s', command, work_dir)
-        subprocess.check_call(command, cwd=work_dir)
-
-    command = [
-        'antsRegistration',
-        '--verbose', '1',
-        '--float', '1',
-        '--dimensionality', '3',
-        '--initial-moving-transform', '[template_to_incoming_affine.txt,1]',
-        '--metric', 'MeanSquares[{0},{1}]'.format(depth_map_path,
-                                                  template_depth_map_path),
-        # TODO add landmark-based metric
-        '--transform', 'SyN[0.1,3,0]',
-        '--convergence', '[500x500x500,1e-6,10]',
-        '--shrink-factors', '4x2x1',
-        '--smoothing-sigmas', '2x1x0vox',
-        '--output', 'cortical',
-    ]
-    logger.debug('Running %s with cwd=%s', command, work_dir)
-    subprocess.check_call(command, cwd=work_dir)
-
-
-def transform_image(input_image_path, resampled_image_path, work_dir):
-    command = [
-        'antsApplyTransforms',
-        '--dimensionality', '3',
-        '--float', '1',
-        '--verbose', '1',
-        '--input', input_image_path,
-        '--reference-image', input_image_path,
-        '--interpolation', 'Linear',
-        '--default-value', '0',
-        '--output', resampled_image_path,
-        '--transform', 'cortical1InverseWarp.nii.gz',
-    ]
-    logger.debug('Running %s with cwd=%s', command, work_dir)
-    subprocess.check_call(command, cwd=work_dir)
+        backend.apply_transforms(
+            depth_map_path, template_depth_map_path,
+            os.path.join(work_dir, 'incoming_depth_map_in_template.nii.gz'),
+            [affine_path], work_dir=work_dir)
+
+    template_voxel_size = (
+        nibabel.load(template_depth_map_path).header.get_zooms())
+    downsampling_factors = registration_schedule.downsampling_factors(
+        incoming_voxel_size[:3], template_voxel_size[:3], preset)
+
+    crop_margin = current_app.config.get('REGISTRATION_CROP_MARGIN')
+    fixed_bbox = None
+    if crop_margin is not None:
+        with tracing.Span('crop to registration roi'):
+            fixed_path, moving_path, fixed_bbox = crop_to_registration_roi(
+                depth_map_path, template_depth_map_path,
+                incoming_to_template_affine, crop_margin, work_dir,
+                align_to=downsampling_factors)
+    else:
+        fixed_path, moving_path = depth_map_path, template_depth_map_path
+
+    # Shape of the grid on which the deformation fields are returned
+    full_shape = incoming_nibabel.shape[:3]
+    if any(f > 1 for f in downsampling_factors):
+        logger.info('Downsampling the incoming depth map by %s for '
+                    'registration', downsampling_factors)
+        with tracing.Span('downsample depth map'):
+            downsampled_img = roi.downsample_image(nibabel.load(fixed_path),
+                                                   downsampling_factors)
+            fixed_path = os.path.join(work_dir,
+                                      'incoming_depth_map_downsampled.nii.gz')
+            nibabel.save(downsampled_img, fixed_path)
+        full_shape = tuple(-(-n // f)
+                           for n, f in zip(full_shape, downsampling_factors))
+        if fixed_bbox is not None:
+            fixed_bbox = tuple(
+                slice(s.start // f, s.start // f + n)
+                for s, f, n in zip(fixed_bbox, downsampling_factors,
+                                   downsampled_img.shape))
+
+    schedule = registration_schedule.plan_schedule(
+        nibabel.load(fixed_path).shape, preset)
+    schedule['fixed_downsampling_factors'] = downsampling_factors
+    logger.info('Registration schedule: %s', schedule)
+
+    with tracing.Span('register', preset=preset):
+        backend.register(fixed_path, moving_path, affine_path, schedule,
+                         os.path.join(work_dir, 'cortical'),
+                         work_dir=work_dir)
+
+    if current_app.config.get('COMPOSITE_DISPLACEMENT_FIELD'):
+        # The composite field is computed on the grid of the registration
+        # (cropped and downsampled), which keeps it small.
+        with tracing.Span('compose displacement field'):
+            displacement_field = displacement.compose_displacement(
+                nibabel.load(os.path.join(work_dir,
+                                          'cortical1InverseWarp.nii.gz')),
+                incoming_qform, incoming_nibabel.shape)
+            displacement.save_displacement(
+                os.path.join(work_dir, COMPOSITE_DISPLACEMENT_FILE_NAME),
+                displacement_field)
+
+    if fixed_bbox is not None:
+        # The deformation fields are defined on the grid of the fixed image,
+        # assemble them back onto the full grid (zero displacement outside of
+        # the region of interest).
+        with tracing.Span('uncrop deformation fields'):
+            for warp_file_name in ('cortical1Warp.nii.gz',
+                                   'cortical1InverseWarp.nii.gz'):
+                warp_path = os.path.join(work_dir, warp_file_name)
+                full_warp = roi.uncrop_image(nibabel.load(warp_path),
+                                             fixed_bbox, full_shape)
+                nibabel.save(full_warp, warp_path)
+
+    return {
+        'registration_schedule': schedule,
+        'transformation_matrix': incoming_to_template_affine.tolist(),
+        'landmark_report': landmark_report,
+    }
+
+
+def crop_to_registration_roi(depth_map_path, template_depth_map_path,
+                             incoming_to_template_affine, margin, work_dir,
+                             align_to=None):
+    """Crop the registration inputs to the support of the depth map.
+
+    The fixed image (incoming depth map) is cropped to the bounding box of
+    its non-zero voxels. The moving image (template depth map) is cropped to
+    the bounding box of that region, mapped into template space by
+    incoming_to_template_affine. Both boxes are dilated by margin (in
+    millimetres). Cropping preserves the physical coordinates of the voxels,
+    so the initial transform remains valid.
+
+    If align_to is given, the start of the box of the fixed image is aligned
+    on a multiple of these factors (one per axis), so that the cropped image
+    can be downsampled consistently with the full image.
+
+    :returns: a tuple ``(fixed_path, moving_path, fixed_bbox)``, where
+              ``fixed_bbox`` is the bounding box of the fixed image in its
+              original grid, or None if the fixed image was not cropped
+    """
+    fixed_path, moving_path = depth_map_path, template_depth_map_path
+    incoming_img = nibabel.load(depth_map_path)
+    incoming_data = numpy.asanyarray(incoming_img.dataobj)
+    incoming_voxel_size = numpy.asarray(incoming_img.header.get_zooms()[:3])
+    support = numpy.nan_to_num(incoming_data) != 0
+    fixed_bbox = roi.support_bounding_box(support,
+                                          margin / incoming_voxel_size)
+    if fixed_bbox is None:
+        logger.warning('The incoming depth map is empty, the registration '
+                       'will not be restricted to a region of interest')
+        return fixed_path, moving_path, None
+    if align_to is not None:
+        fixed_bbox = tuple(slice(s.start - s.start % f, s.stop)
+                           for s, f in zip(fixed_bbox, align_to))
+    if roi.covers_whole_array(fixed_bbox, incoming_data.shape):
+        fixed_bbox = None
+    else:
+        fixed_path = os.path.join(work_dir, 'incoming_depth_map_roi.nii.gz')
+        nibabel.save(roi.crop_image(incoming_img, fixed_bbox), fixed_path)
+        logger.info('Registration restricted to %s voxels of the incoming '
+                    'depth map of shape %s',
+                    tuple(s.stop - s.start for s in fixed_bbox),
+                    incoming_data.shape)
+
+    # Corners of the fixed region, in the coordinates of the incoming image
+    # used by transformation_matrix (voxel indices scaled by voxel size).
+    bbox = fixed_bbox or tuple(slice(0, n) for n in incoming_data.shape[:3])
+    corners = numpy.array([[i, j, k]
+                           for i in (bbox[0].start - 0.5, bbox[0].stop - 0.5)
+                           for j in (bbox[1].start - 0.5, bbox[1].stop - 0.5)
+                           for k in (bbox[2].start - 0.5, bbox[2].stop - 0.5)])
+    template_img = nibabel.load(template_depth_map_path)
+    corners_in_template_voxels = transform_points(
+        corners * incoming_voxel_size,
+        numpy.linalg.inv(template_img.affine) @ incoming_to_template_affine)
+    template_voxel_size = numpy.asarray(template_img.header.get_zooms()[:3])
+    template_margin = numpy.ceil(margin / template_voxel_size).astype(int)
+    start = numpy.maximum(
+        numpy.floor(corners_in_template_voxels.min(axis=0)).astype(int)
+        - template_margin, 0)
+    stop = numpy.minimum(
+        numpy.ceil(corners_in_template_voxels.max(axis=0)).astype(int) + 1
+        + template_margin, template_img.shape[:3])
+    if numpy.any(stop <= start):
+        logger.warning('The incoming depth map does not overlap with the '
+                       'template, the template will not be cropped')
+        return fixed_path, moving_path, fixed_bbox
+    moving_bbox = tuple(slice(int(a), int(b)) for a, b in zip(start, stop))
+    if not roi.covers_whole_array(moving_bbox, template_img.shape):
+        moving_path = os.path.join(work_dir, 'template_depth_map_roi.nii.gz')
+        nibabel.save(roi.crop_image(template_img, moving_bbox), moving_path)
+        logger.info('Registration restricted to %s voxels of the template '
+                    'depth map of shape %s',
+                    tuple(s.stop - s.start for s in moving_bbox),
+                    template_img.shape)
+    return fixed_path, moving_path, fixed_bbox
+
+
+@tracing.traced('transform image')
+def transform_image(input_image_path, resampled_image_path, work_dir,
+                    output_data_type=output_types.DEFAULT_OUTPUT_DATA_TYPE,
+                    keep_scaling=True, backend=None):
+    """Resample an image with the deformation estimated in work_dir.
+
+    The composite displacement field is used if it was written by
+    `estimate_deformation` and the image has the same grid, otherwise the
+    resampling is done by the registration backend.
+
+    :param str output_data_type: ``'float32'``, or ``'input'`` to write the
+           output with the data type of the input image (see
+           `cast_to_input_data_type`), the default is
+           `cortical_voluba.output_types.DEFAULT_OUTPUT_DATA_TYPE`
+    :param bool keep_scaling: see `cast_to_input_data_type`
+    :param backend: registration backend, preferably the instance that was
+           passed to `estimate_deformation` (by default a new instance of the
+           configured backend)
+    """
+    input_img = nibabel.load(input_image_path)
+    resampled_img = None
+    composite_path = os.path.join(work_dir, COMPOSITE_DISPLACEMENT_FILE_NAME)
+    if os.path.exists(composite_path):
+        displacement_field, _ = displacement.load_displacement(
+            composite_path)
+        if (input_img.shape == displacement_field.reference_shape
+                and numpy.allclose(input_img.get_qform(),
+                                   displacement_field.reference_affine,
+                                   atol=1e-4)):
+            logger.info('Resampling %s with the composite displacement '
+                        'field', input_image_path)
+            with tracing.Span('resample with displacement field'):
+                resampled_data, = displacement.resample_images(
+                    [numpy.asanyarray(input_img.dataobj)],
+                    displacement_field,
+                    tolerance=current_app.config.get(
+                        'SPARSE_RESAMPLING_TOLERANCE'))
+            resampled_img = nibabel.Nifti1Image(resampled_data, None,
+                                                header=input_img.header)
+            resampled_img.set_data_dtype(numpy.float32)
+        else:
+            logger.info('The grid of %s differs from the grid of the '
+                        'composite displacement field, resampling with the '
+                        'registration backend', input_image_path)
+    if resampled_img is None:
+        if backend is None:
+            backend = get_registration_backend()
+        backend.apply_transforms(
+            input_image_path, input_image_path, resampled_image_path,
+            [os.path.join(work_dir, 'cortical1InverseWarp.nii.gz')],
+            work_dir=work_dir)
+        if output_data_type == 'float32':
+            return
+        resampled_img = nibabel.load(resampled_image_path)
+
+    if output_data_type == 'input':
+        resampled_img = cast_to_input_data_type(resampled_img, input_img,
+                                                keep_scaling=keep_scaling)
+    elif output_data_type not in output_types.OUTPUT_DATA_TYPES:
+        raise ValueError('invalid output_data_type {0!r}'
+                         .format(output_data_type))
+    with tracing.Span('save resampled image'):
+        nibabel.save(resampled_img, resampled_image_path)
+
+
+def cast_to_input_data_type(resampled_img, input_img, keep_scaling=True):
+    """Convert a resampled image to the data type of the input image.
+
+    For integer data types, the values are rounded to the nearest integer
+    and clamped to the range of the data type. If keep_scaling is True and
+    the input image has a scaling slope and intercept, the output is stored
+    with the same scaling; otherwise the values are stored without scaling.
+
+    :param nibabel.Nifti1Image resampled_img: resampled image (any data type)
+    :param nibabel.Nifti1Image input_img: image that was resampled
+    :rtype: nibabel.Nifti1Image
+    """
+    dtype = input_img.get_data_dtype()
+    data = numpy.asanyarray(resampled_img.dataobj)
+    # Nibabel moves the scaling from the header to the data proxy on loading
+    slope = float(getattr(input_img.dataobj, 'slope', 1.0))
+    inter = float(getattr(input_img.dataobj, 'inter', 0.0))
+    if not keep_scaling or (slope, inter) == (1.0, 0.0):
+        slope, inter = None, None
+    else:
+        data = (data - inter) / slope
+    if numpy.issubdtype(dtype, numpy.integer):
+        info = numpy.iinfo(dtype)
+        data = numpy.clip(numpy.rint(data), info.min, info.max)
+    header = resampled_img.header.copy()
+    header.set_data_dtype(dtype)
+    cast_img = nibabel.Nifti1Image(data.astype(dtype), None, header=header)
+    # The scaling must be set after creating the image, which resets it
+    cast_img.header.set_slope_inter(slope, inter)
+    return cast_img
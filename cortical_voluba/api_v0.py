@@ -16,18 +16,34 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with cortical-voluba. If not, see <https://www.gnu.org/licenses/>.
 
+import concurrent.futures
+import contextlib
 import logging
+import os.path
+import sqlite3
+import time
+import uuid
 
-from flask import jsonify, make_response, request, url_for
+import celery.states
+from flask import (current_app, g, jsonify, make_response, request,
+                   send_from_directory, url_for)
 import flask_smorest
 from flask_smorest import abort
 import marshmallow
 from marshmallow import Schema, fields
-from marshmallow.validate import Length
+from marshmallow.validate import Length, OneOf
 import requests
 
+from cortical_voluba import cost_model
 from cortical_voluba import image_service
-from cortical_voluba import tasks
+from cortical_voluba import ledger
+from cortical_voluba import output_types
+from cortical_voluba import profiling
+from cortical_voluba import registration_schedule
+from cortical_voluba import resource_estimates
+from cortical_voluba import task_stubs
+from cortical_voluba import tracing
+from cortical_voluba.celery import select_queue
 
 
 logger = logging.getLogger(__name__)
@@ -39,6 +55,37 @@
 
 EXAMPLE_IMAGE_SERVICE_URL = 'https://zam10143.zam.kfa-juelich.de/chumni/'
 
+DEFAULT_QUEUES = [('celery', None)]
+"""Queues that are used if `COMPUTATION_QUEUES` is not configured."""
+
+
+@bp.before_request
+def start_request_span():
+    """Trace the request, continuing the trace of the client if any."""
+    rule = request.url_rule.rule if request.url_rule else request.path
+    g.request_span = tracing.Span(
+        '{0} {1}'.format(request.method, rule),
+        parent=request.headers.get('traceparent'), kind='SERVER')
+    g.request_span.activate()
+
+
+@bp.after_request
+def tag_request_span(response):
+    request_span = g.get('request_span')
+    if request_span is not None:
+        request_span.set_tag('http.status_code', response.status_code)
+    return response
+
+
+@bp.teardown_request
+def finish_request_span(exception):
+    request_span = g.pop('request_span', None)
+    if request_span is not None:
+        if exception is not None:
+            request_span.set_tag('error', type(exception).__name__)
+        request_span.deactivate()
+        request_span.finish()
+
 
 class DepthMapComputationRequestSchema(Schema):
     class Meta:
@@ -55,6 +102,11 @@ class Meta:
                     'endpoint). This is the name of the segmentation Nifti '
                     'file, without trailing `.nii` or `.nii.gz`.',
     )
+    profile = fields.Boolean(
+        missing=False,
+        description='Run the computation under a profiler, for investigating '
+                    'its performance. Only accepted if the server allows it.',
+    )
 
 
 class AuthorizationHeadersSchema(Schema):
@@ -65,6 +117,24 @@ class AuthorizationHeadersSchema(Schema):
     )
 
 
+class ResourceEstimateSchema(Schema):
+    class Meta:
+        ordered = True
+    input_voxels = fields.Integer(
+        required=True,
+        description='Number of voxels of the largest input image.',
+    )
+    memory_bytes = fields.Integer(
+        required=True,
+        description='Estimated peak memory of the computation, in bytes.',
+    )
+    runtime_seconds = fields.Float(
+        required=True,
+        description='Estimated running time of the computation, in seconds '
+                    '(excluding the transfers and the waiting time).',
+    )
+
+
 class DepthMapComputationResponseSchema(Schema):
     status_polling_url = fields.Url(
         required=True,
@@ -72,6 +142,26 @@ class DepthMapComputationResponseSchema(Schema):
                     'computation. This URL is relative to the base URL of the '
                     'backend.',
     )
+    resource_estimate = fields.Nested(
+        ResourceEstimateSchema,
+        required=False, allow_none=True,
+        description='Resources that the computation is estimated to need, '
+                    'based on the headers of the input images. Null if the '
+                    'headers could not be read.',
+    )
+    estimated_start = fields.DateTime(
+        required=False, allow_none=True,
+        description='Predicted time (UTC) at which a worker will start the '
+                    'computation, based on the recent waiting times of its '
+                    'queue.',
+    )
+    estimated_completion = fields.DateTime(
+        required=False, allow_none=True,
+        description='Predicted time (UTC) at which the computation will be '
+                    'finished, based on the durations of past computations '
+                    'of similar size. Null if the size of the inputs is '
+                    'unknown.',
+    )
 
 
 class LandmarkPairSchema(Schema):
@@ -142,6 +232,24 @@ class Meta:
                     'depth map is unavailable and message contains an error '
                     'message',
     )
+    cancelled = fields.Boolean(
+        required=False,
+        description='Flag set to true if the computation was cancelled at '
+                    'the request of the user (in that case `finished` is '
+                    'also true).',
+    )
+    estimated_start = fields.DateTime(
+        required=False,
+        description='Time (UTC) at which the computation was started. '
+                    'Present only once the computation is running.',
+    )
+    estimated_completion = fields.DateTime(
+        required=False,
+        description='Predicted time (UTC) at which the computation will be '
+                    'finished, updated as its stages complete. Present only '
+                    'once the computation is running, if it can be '
+                    'predicted.',
+    )
 
 
 class DepthMapComputationTaskStatusResponseSchema(
@@ -191,6 +299,37 @@ class Meta:
                     'that `source_point` refers to the template volume, while '
                     '`target_point` refers to the incoming volume.',
     )
+    registration_preset = fields.String(
+        validate=OneOf(sorted(registration_schedule.PRESETS)),
+        missing=registration_schedule.DEFAULT_PRESET,
+        description='Trade-off between the speed and the quality of the '
+                    'non-linear registration: `fast` and `balanced` '
+                    'downsample the incoming depth map to the resolution of '
+                    'the template and use fewer iterations on large images, '
+                    '`quality` registers at the full resolution. The default, '
+                    '`standard`, uses the same fixed schedule as previous '
+                    'versions of the service, whatever the size of the '
+                    'images.',
+    )
+    output_data_type = fields.String(
+        validate=OneOf(output_types.OUTPUT_DATA_TYPES),
+        missing=output_types.DEFAULT_OUTPUT_DATA_TYPE,
+        description='Data type of the transformed image: `input` keeps the '
+                    'data type of the input image (values are rounded and '
+                    'clamped to its range), which makes the upload smaller; '
+                    '`float32` avoids any loss of precision.',
+    )
+    keep_scaling = fields.Boolean(
+        missing=True,
+        description='If the input image has a scaling slope and intercept, '
+                    'store the transformed image with the same scaling. '
+                    'Only used if `output_data_type` is `input`.',
+    )
+    profile = fields.Boolean(
+        missing=False,
+        description='Run the computation under a profiler, for investigating '
+                    'its performance. Only accepted if the server allows it.',
+    )
 
 
 class AlignmentComputationResponseSchema(Schema):
@@ -200,6 +339,20 @@ class AlignmentComputationResponseSchema(Schema):
                     'computation. This URL is relative to the base URL of the '
                     'backend.',
     )
+    resource_estimate = fields.Nested(
+        ResourceEstimateSchema,
+        required=False, allow_none=True,
+        description='Resources that the computation is estimated to need '
+                    '(see the depth map computation).',
+    )
+    estimated_start = fields.DateTime(
+        required=False, allow_none=True,
+        description='See the depth map computation.',
+    )
+    estimated_completion = fields.DateTime(
+        required=False, allow_none=True,
+        description='See the depth map computation.',
+    )
 
 
 class AlignmentComputationResultSchema(Schema):
@@ -232,7 +385,24 @@ class Meta:
                     'display the transformed image in the template space. It '
                     'is a 4×4 affine transformation matrix, in millimetres, '
                     'in the same format as returned by the `/least-squares` '
-                    'affine backend.',
+                    'affine backend. It can differ from the matrix of the '
+                    'request, because it is refined to fit the landmarks.',
+    )
+    registration_schedule = fields.Dict(
+        required=False,
+        description='The multi-resolution schedule that was used for the '
+                    'non-linear registration (preset, shrink factors, '
+                    'smoothing sigmas, iterations per level, and '
+                    'downsampling factors of the incoming depth map).',
+    )
+    landmark_report = fields.Dict(
+        required=False, allow_none=True,
+        description='Report of the least-squares fit of the landmark pairs '
+                    'that refined `transformation_matrix`: fitted `model`, '
+                    'indices of the `outliers`, residual distances (in '
+                    'millimetres) of each landmark before and after '
+                    'refinement, and their RMS values. Null if the '
+                    'transformation was not refined.',
     )
 
 
@@ -246,6 +416,213 @@ class AlignmentComputationTaskStatusResponseSchema(
     )
 
 
+class DepthMapAndAlignmentComputationRequestSchema(
+        AlignmentComputationRequestSchema):
+    class Meta:
+        ordered = True
+        # The depth map is computed from the segmentation
+        exclude = ('depth_map_name',)
+    segmentation_name = fields.String(
+        required=True,
+        description='The `name` under which the cortical segmentation of the '
+                    'image is known to the image service.',
+    )
+
+
+class DepthMapAndAlignmentComputationResponseSchema(Schema):
+    status_polling_url = fields.Url(
+        required=True,
+        description='A URL for polling the status of the computation. This '
+                    'URL is relative to the base URL of the backend.',
+    )
+    resource_estimate = fields.Nested(
+        ResourceEstimateSchema,
+        required=False, allow_none=True,
+        description='Resources that the computation is estimated to need '
+                    '(see the depth map computation).',
+    )
+    estimated_start = fields.DateTime(
+        required=False, allow_none=True,
+        description='See the depth map computation.',
+    )
+    estimated_completion = fields.DateTime(
+        required=False, allow_none=True,
+        description='See the depth map computation.',
+    )
+
+
+class DepthMapAndAlignmentComputationResultSchema(
+        AlignmentComputationResultSchema):
+    depth_map_name = fields.String(
+        required=True,
+        description='The `name` under which the depth map image was uploaded '
+                    'onto the image service.',
+    )
+    depth_map_neuroglancer_url = fields.Url(
+        required=True,
+        description='A URL that can be passed to Neuroglancer to display the '
+                    'depth map. It will include the Neuroglancer datasource '
+                    'prefix (i.e. `precomputed://`).',
+    )
+
+
+class DepthMapAndAlignmentComputationTaskStatusResponseSchema(
+        ComputationTaskStatusResponseSchema):
+    results = fields.Nested(
+        DepthMapAndAlignmentComputationResultSchema,
+        required=False,
+        description='Result of the computation. Present only if `finished` is '
+                    'true and `error` is false.',
+    )
+
+
+class ComputationCancellationResponseSchema(Schema):
+    status_polling_url = fields.Url(
+        required=True,
+        description='A URL for polling the status of the cancelled '
+                    'computation. This URL is relative to the base URL of the '
+                    'backend.',
+    )
+
+
+class QueueStatusSchema(Schema):
+    class Meta:
+        ordered = True
+    name = fields.String(
+        required=True,
+        description='Name of the Celery queue.',
+    )
+    max_memory_bytes = fields.Integer(
+        required=True, allow_none=True,
+        description='Maximum estimated memory of the computations that are '
+                    'sent to this queue (null if there is no maximum).',
+    )
+    wait_seconds = fields.Float(
+        required=True, allow_none=True,
+        description='Median time that the recent computations of this queue '
+                    'have waited before being started by a worker. Null if '
+                    'no computation of this queue has been recorded.',
+    )
+    recent_wait_seconds = fields.Dict(
+        keys=fields.String(), values=fields.Float(), allow_none=True,
+        description='Percentiles (`p50`, `p90`, `p99`) of the waiting time '
+                    'of the recent computations of this queue.',
+    )
+    last_wait_seconds = fields.Float(
+        allow_none=True,
+        description='Waiting time of the most recently finished computation '
+                    'of this queue.',
+    )
+    last_finished_at = fields.String(
+        allow_none=True,
+        description='Time (UTC) when the most recent computation of this '
+                    'queue finished, which tells how current the waiting '
+                    'times are.',
+    )
+    sample_count = fields.Integer(
+        required=True,
+        description='Number of recent computations that the waiting times '
+                    'are computed from.',
+    )
+    queue_depth = fields.Integer(
+        required=True,
+        description='Number of computations that have been sent to this '
+                    'queue and have not started yet.',
+    )
+
+
+class JobStatisticsQuerySchema(Schema):
+    job_type = fields.String(
+        validate=OneOf(['depth-map', 'alignment', 'depth-map-and-alignment']),
+        description='Only summarize the computations of this type.',
+    )
+    since = fields.DateTime(
+        description='Only summarize the computations that finished at or '
+                    'after this time (UTC).',
+    )
+    until = fields.DateTime(
+        description='Only summarize the computations that finished before '
+                    'this time (UTC).',
+    )
+
+
+class JobStatisticsSchema(Schema):
+    class Meta:
+        ordered = True
+    job_type = fields.String(required=True)
+    size_bucket = fields.String(
+        required=True,
+        description='Range of the number of voxels of the largest input '
+                    '(e.g. `1M-10M`), or `unknown`.',
+    )
+    count = fields.Integer(
+        required=True,
+        description='Number of finished computations (including failures).',
+    )
+    outcomes = fields.Dict(
+        keys=fields.String(), values=fields.Integer(), required=True,
+        description='Number of computations by outcome (`success`, '
+                    '`failure`, `cancelled`).',
+    )
+    queue_wait_seconds = fields.Dict(
+        keys=fields.String(), values=fields.Float(), allow_none=True,
+        description='Percentiles (`p50`, `p90`, `p99`) of the time spent '
+                    'waiting in the queue.',
+    )
+    total_seconds = fields.Dict(
+        keys=fields.String(), values=fields.Float(), allow_none=True,
+        description='Percentiles of the running time of the successful '
+                    'computations.',
+    )
+    stage_seconds = fields.Dict(
+        keys=fields.String(), values=fields.Dict(), required=True,
+        description='Percentiles of the running time of each stage of the '
+                    'successful computations.',
+    )
+    peak_memory_bytes = fields.Dict(
+        keys=fields.String(), values=fields.Float(), allow_none=True,
+        description='Percentiles of the peak memory of the successful '
+                    'computations (largest process).',
+    )
+    cache_hit_rate = fields.Float(
+        allow_none=True,
+        description='Fraction of the downloads that were served from the '
+                    'download cache of the workers.',
+    )
+
+
+class ProfileSchema(Schema):
+    class Meta:
+        ordered = True
+    task_id = fields.String(
+        required=True,
+        description='Id of the profiled computation.',
+    )
+    task_name = fields.String(allow_none=True)
+    job_type = fields.String(allow_none=True)
+    outcome = fields.String(
+        allow_none=True,
+        description='`success`, `failure`, or `cancelled`.',
+    )
+    saved_at = fields.String(
+        allow_none=True,
+        description='Time when the profile was saved (UTC).',
+    )
+    total_seconds = fields.Float(allow_none=True)
+    size_bytes = fields.Integer(required=True)
+    profile_url = fields.Url(
+        required=True,
+        description='URL of the sampled stacks, in the folded format of '
+                    'flame graph tools. This URL is relative to the base URL '
+                    'of the backend.',
+    )
+    report_url = fields.Url(
+        required=True,
+        description='URL of the JSON report (duration of the stages, '
+                    'resource usage of the external commands).',
+    )
+
+
 class ErrorResponseSchema(Schema):
     class Meta:
         ordered = True
@@ -289,21 +666,28 @@ def create_depth_map_computation(params):
             'errors': ['Missing Bearer token Authorization header'],
         }), 401
 
+    verify_profile_request(params)
     client = image_service.ImageServiceClient(image_service_base_url,
                                               auth=auth)
-    verify_image_on_image_service(client, segmentation_name, 'segmentation')
+    input_names = {'segmentation': segmentation_name}
+    with probe_input_headers(client, input_names) as header_probes:
+        verify_images_on_image_service(client, [
+            (segmentation_name, 'segmentation'),
+        ])
+        params['resource_estimate'] = estimate_computation_resources(
+            'depth-map', input_names, header_probes)
 
-    logger.debug('Submitting Celery job with params=%s', params)
-    task_result = tasks.depth_map_computation_task.delay(
-        params,
-        bearer_token=bearer_token
-    )
-    logger.debug('Submitted Celery job has id=%s', task_result.id)
+    task_result, predicted_times = submit_computation(
+        'depth-map', task_stubs.depth_map_computation_task, params,
+        bearer_token)
 
-    return jsonify({
+    response = {
         'status_polling_url': url_for('api_v0.depth_map_computation_status',
                                       computation_id=task_result.id),
-    }), 202
+        'resource_estimate': params['resource_estimate'],
+    }
+    response.update(predicted_times)
+    return jsonify(response), 202
 
 
 class DepthMapComputationPollPathSchema(Schema):
@@ -319,10 +703,30 @@ class DepthMapComputationPollPathSchema(Schema):
 def depth_map_computation_status(path_args, *, computation_id):
     """Poll the status of a depth map computation task."""
     assert computation_id == path_args['computation_id']
-    task_result = tasks.depth_map_computation_task.AsyncResult(computation_id)
+    task_result = task_stubs.depth_map_computation_task.AsyncResult(
+        computation_id)
     return make_computation_task_status_response(task_result)
 
 
+@bp.route('/depth-map-computation/<computation_id>', methods=['DELETE'])
+@bp.arguments(DepthMapComputationPollPathSchema, location='path')
+@bp.response(ErrorResponseSchema, code=409,
+             description='The computation has already finished')
+@bp.response(ComputationCancellationResponseSchema, code=202)
+def cancel_depth_map_computation(path_args, *, computation_id):
+    """Cancel a depth map computation task.
+
+    The computation is removed from the queue if it has not started yet,
+    otherwise the running processes are terminated. Polling the status of the
+    computation will then report it as cancelled.
+    """
+    assert computation_id == path_args['computation_id']
+    task_result = task_stubs.depth_map_computation_task.AsyncResult(
+        computation_id)
+    return cancel_computation_task(task_result,
+                                   'api_v0.depth_map_computation_status')
+
+
 @bp.route('/alignment-computation/', methods=['POST'])
 @bp.arguments(AlignmentComputationRequestSchema)
 @bp.doc(security=[{'chumni_auth': []}])
@@ -351,22 +755,29 @@ def create_alignment_computation(params):
             'errors': ['Missing Bearer token Authorization header'],
         }), 401
 
+    verify_profile_request(params)
     client = image_service.ImageServiceClient(image_service_base_url,
                                               auth=auth)
-    verify_image_on_image_service(client, image_name, 'image')
-    verify_image_on_image_service(client, depth_map_name, 'image')
+    input_names = {'image': image_name, 'depth_map': depth_map_name}
+    with probe_input_headers(client, input_names) as header_probes:
+        verify_images_on_image_service(client, [
+            (image_name, 'image'),
+            (depth_map_name, 'image'),
+        ])
+        params['resource_estimate'] = estimate_computation_resources(
+            'alignment', input_names, header_probes)
 
-    logger.debug('Submitting Celery job with params=%s', params)
-    task_result = tasks.alignment_computation_task.delay(
-        params,
-        bearer_token=bearer_token
-    )
-    logger.debug('Submitted Celery job has id=%s', task_result.id)
+    task_result, predicted_times = submit_computation(
+        'alignment', task_stubs.alignment_computation_task, params,
+        bearer_token)
 
-    return jsonify({
+    response = {
         'status_polling_url': url_for('api_v0.alignment_computation_status',
                                       computation_id=task_result.id),
-    }), 202
+        'resource_estimate': params['resource_estimate'],
+    }
+    response.update(predicted_times)
+    return jsonify(response), 202
 
 
 class AlignmentComputationPollPathSchema(Schema):
@@ -382,13 +793,157 @@ class AlignmentComputationPollPathSchema(Schema):
 def alignment_computation_status(path_args, *, computation_id):
     """Poll the status of a depth map computation task."""
     assert computation_id == path_args['computation_id']
-    task_result = tasks.alignment_computation_task.AsyncResult(computation_id)
+    task_result = task_stubs.alignment_computation_task.AsyncResult(
+        computation_id)
     return make_computation_task_status_response(task_result)
 
 
-def verify_image_on_image_service(client, image_name, expected_type='image'):
+@bp.route('/alignment-computation/<computation_id>', methods=['DELETE'])
+@bp.arguments(AlignmentComputationPollPathSchema, location='path')
+@bp.response(ErrorResponseSchema, code=409,
+             description='The computation has already finished')
+@bp.response(ComputationCancellationResponseSchema, code=202)
+def cancel_alignment_computation(path_args, *, computation_id):
+    """Cancel an alignment computation task.
+
+    The computation is removed from the queue if it has not started yet,
+    otherwise the running processes are terminated. Polling the status of the
+    computation will then report it as cancelled.
+    """
+    assert computation_id == path_args['computation_id']
+    task_result = task_stubs.alignment_computation_task.AsyncResult(
+        computation_id)
+    return cancel_computation_task(task_result,
+                                   'api_v0.alignment_computation_status')
+
+
+@bp.route('/depth-map-and-alignment-computation/', methods=['POST'])
+@bp.arguments(DepthMapAndAlignmentComputationRequestSchema)
+@bp.doc(security=[{'chumni_auth': []}])
+# The error responses come first, the schemas are only used for
+# documentation
+@bp.response(ErrorResponseSchema, code=400)
+@bp.response(ErrorResponseSchema, code=401)
+# Code 422 is raised by webargs for request validation errors
+@bp.response(ErrorResponseSchema, code=422,
+             description='Semantically invalid request')
+# The successful response must be the last response decorator, its schema
+# is used for serializing the response.
+@bp.response(DepthMapAndAlignmentComputationResponseSchema, code=202)
+def create_depth_map_and_alignment_computation(params):
+    """Compute the depth map and the alignment of a cortical patch.
+
+    This is equivalent to a depth map computation followed by an alignment
+    computation, but faster: the depth map is used for the alignment
+    directly by the worker, instead of being downloaded again from the image
+    service. The depth map is still uploaded to the image service, for
+    display.
+    """
+    image_service_base_url = params['image_service_base_url']
+    segmentation_name = params['segmentation_name']
+    image_name = params['image_name']
+    authorization_header = request.headers.get('Authorization')
+
+    if authorization_header and authorization_header.startswith('Bearer '):
+        bearer_token = authorization_header[len('Bearer '):]
+        auth = image_service.BearerTokenAuth(bearer_token)
+    else:
+        return jsonify({
+            'errors': ['Missing Bearer token Authorization header'],
+        }), 401
+
+    verify_profile_request(params)
+    client = image_service.ImageServiceClient(image_service_base_url,
+                                              auth=auth)
+    input_names = {'segmentation': segmentation_name, 'image': image_name}
+    with probe_input_headers(client, input_names) as header_probes:
+        verify_images_on_image_service(client, [
+            (segmentation_name, 'segmentation'),
+            (image_name, 'image'),
+        ])
+        params['resource_estimate'] = estimate_computation_resources(
+            'depth-map-and-alignment', input_names, header_probes)
+
+    task_result, predicted_times = submit_computation(
+        'depth-map-and-alignment',
+        task_stubs.depth_map_and_alignment_computation_task, params,
+        bearer_token)
+
+    response = {
+        'status_polling_url': url_for(
+            'api_v0.depth_map_and_alignment_computation_status',
+            computation_id=task_result.id),
+        'resource_estimate': params['resource_estimate'],
+    }
+    response.update(predicted_times)
+    return jsonify(response), 202
+
+
+class DepthMapAndAlignmentComputationPollPathSchema(Schema):
+    computation_id = fields.String(
+        required=True,
+        description='Computation id returned by '
+                    '/v0/depth-map-and-alignment-computation/',
+    )
+
+
+@bp.route('/depth-map-and-alignment-computation/<computation_id>',
+          methods=['GET'])
+@bp.arguments(DepthMapAndAlignmentComputationPollPathSchema, location='path')
+@bp.response(DepthMapAndAlignmentComputationTaskStatusResponseSchema,
+             code=200)
+def depth_map_and_alignment_computation_status(path_args, *,
+                                               computation_id):
+    """Poll the status of a depth map and alignment computation task."""
+    assert computation_id == path_args['computation_id']
+    task_result = (
+        task_stubs.depth_map_and_alignment_computation_task.AsyncResult(
+            computation_id))
+    return make_computation_task_status_response(task_result)
+
+
+@bp.route('/depth-map-and-alignment-computation/<computation_id>',
+          methods=['DELETE'])
+@bp.arguments(DepthMapAndAlignmentComputationPollPathSchema, location='path')
+@bp.response(ErrorResponseSchema, code=409,
+             description='The computation has already finished')
+@bp.response(ComputationCancellationResponseSchema, code=202)
+def cancel_depth_map_and_alignment_computation(path_args, *,
+                                               computation_id):
+    """Cancel a depth map and alignment computation task.
+
+    See the cancellation of depth map computations.
+    """
+    assert computation_id == path_args['computation_id']
+    task_result = (
+        task_stubs.depth_map_and_alignment_computation_task.AsyncResult(
+            computation_id))
+    return cancel_computation_task(
+        task_result, 'api_v0.depth_map_and_alignment_computation_status')
+
+
+def verify_profile_request(params):
+    """Reject the profiling requests if the server does not allow them."""
+    if (params.get('profile')
+            and not current_app.config.get('ALLOW_PROFILE_REQUESTS')):
+        abort(make_response(jsonify({
+            'errors': ['Profiling of computations is not allowed on this '
+                       'server'],
+        }), 400))
+
+
+@tracing.traced('verify images')
+def verify_images_on_image_service(client, expected_images):
+    """Verify that images exist on the image service, with the right type.
+
+    The listing of the images is fetched once for all the verifications. The
+    request is aborted with an error response if any verification fails.
+
+    :param client: `image_service.ImageServiceClient` on behalf of the user
+    :param expected_images: list of ``(image_name, expected_type)`` pairs
+    """
     try:
-        image_info = client.get_image_info(image_name)
+        images_by_name = client.list_images_by_name()
     except requests.HTTPError as e:
         if e.response.status_code == 401:
             abort(make_response(jsonify({
@@ -406,18 +961,318 @@ def verify_image_on_image_service(client, image_name, expected_type='image'):
             'errors': ['Cannot access the image service'],
         }), 500))
 
-    if image_info is None:
-        abort(make_response(jsonify({
-            'errors': ["Cannot find an image named '{0}' on the image service"
-                       .format(image_name)],
-        }), 400))
+    for image_name, expected_type in expected_images:
+        image_info = images_by_name.get(image_name)
+        if image_info is None:
+            abort(make_response(jsonify({
+                'errors': ["Cannot find an image named '{0}' on the image "
+                           "service".format(image_name)],
+            }), 400))
+
+        if (image_info['extra']['neuroglancer'].get('type', 'image')
+                != expected_type):
+            abort(make_response(jsonify({
+                'errors': ["The image named '{0}' is not of '{1}' type"
+                           .format(image_name, expected_type)],
+            }), 400))
+
+
+@bp.route('/job-statistics', methods=['GET'])
+@bp.arguments(JobStatisticsQuerySchema, location='query')
+@bp.response(ErrorResponseSchema, code=404,
+             description='The job ledger is not enabled')
+@bp.response(JobStatisticsSchema(many=True), code=200)
+def job_statistics(query):
+    """Summarize the resources used by past computations.
+
+    The computations recorded in the job ledger (see the `JOB_LEDGER_PATH`
+    configuration key) are grouped by job type and size of the inputs. The
+    percentiles of their durations and memory use can be compared between
+    two periods of time, e.g. before and after an upgrade.
+    """
+    ledger_path = current_app.config.get('JOB_LEDGER_PATH')
+    if not ledger_path:
+        return jsonify({
+            'errors': ['The job ledger is not enabled'],
+        }), 404
+    return jsonify(ledger.JobLedger(ledger_path).get_statistics(
+        job_type=query.get('job_type'),
+        since=query.get('since'),
+        until=query.get('until'),
+    )), 200
+
+
+@bp.route('/profiles/', methods=['GET'])
+@bp.response(ErrorResponseSchema, code=404,
+             description='The profile endpoints are not enabled')
+@bp.response(ProfileSchema(many=True), code=200)
+def list_profiles():
+    """List the profiles of the profiled computations.
+
+    Computations are profiled if the `PROFILE_TASKS` configuration key is
+    set, or if they are submitted with `profile` and the
+    `ALLOW_PROFILE_REQUESTS` configuration key is set. The most recent
+    profiles come first. These endpoints are meant for the operators of the
+    server, they must be enabled with `ENABLE_PROFILE_ENDPOINT`.
+    """
+    if not current_app.config.get('ENABLE_PROFILE_ENDPOINT'):
+        return jsonify({
+            'errors': ['The profile endpoints are not enabled'],
+        }), 404
+    profiles = profiling.list_profiles(profiling.get_profile_dir())
+    for profile in profiles:
+        profile['profile_url'] = url_for(
+            'api_v0.get_profile_artefact', task_id=profile['task_id'],
+            file_name=profiling.PROFILE_FILE_NAME)
+        profile['report_url'] = url_for(
+            'api_v0.get_profile_artefact', task_id=profile['task_id'],
+            file_name=profiling.REPORT_FILE_NAME)
+    return jsonify(profiles), 200
+
+
+@bp.route('/profiles/<task_id>/<file_name>', methods=['GET'])
+@bp.response(ErrorResponseSchema, code=404,
+             description='The profile does not exist, or the profile '
+                         'endpoints are not enabled')
+def get_profile_artefact(task_id, file_name):
+    """Download an artefact of a profiled computation.
+
+    See the listing of the profiles.
+    """
+    if not current_app.config.get('ENABLE_PROFILE_ENDPOINT'):
+        return jsonify({
+            'errors': ['The profile endpoints are not enabled'],
+        }), 404
+    if file_name not in profiling.ARTEFACT_FILE_NAMES:
+        return jsonify({
+            'errors': ['Unknown profile artefact {0!r}'.format(file_name)],
+        }), 404
+    # send_from_directory rejects the paths that are outside of the
+    # profile directory
+    return send_from_directory(
+        profiling.get_profile_dir(), os.path.join(task_id, file_name),
+        mimetype=('application/json'
+                  if file_name == profiling.REPORT_FILE_NAME
+                  else 'text/plain'))
+
+
+@bp.route('/queues', methods=['GET'])
+@bp.response(ErrorResponseSchema, code=404,
+             description='The job ledger is not enabled')
+@bp.response(QueueStatusSchema(many=True), code=200)
+def queue_status():
+    """Report the depth and recent waiting times of the computation queues.
+
+    The waiting times that the workers have recorded in the job ledger (see
+    the `JOB_LEDGER_PATH` configuration key) are summarized for each queue
+    (see the `COMPUTATION_QUEUES` configuration key), over the most recent
+    computations. The depth of each queue is the number of computations that
+    wait in it. The start of a computation is predicted from its position in
+    its queue, or from the recent waiting times if it is unknown.
+    """
+    ledger_path = current_app.config.get('JOB_LEDGER_PATH')
+    if not ledger_path:
+        return jsonify({
+            'errors': ['The job ledger is not enabled'],
+        }), 404
+    queues = current_app.config.get('COMPUTATION_QUEUES') or DEFAULT_QUEUES
+    job_ledger = ledger.JobLedger(ledger_path)
+    queue_names = [queue_name for queue_name, _ in queues]
+    queue_waits = job_ledger.get_queue_waits(queue_names,
+                                             cost_model.WAIT_HISTORY_LENGTH)
+    queue_depths = job_ledger.get_queue_depths(queue_names)
+    response = []
+    for queue_name, max_memory in queues:
+        waits = queue_waits[queue_name]
+        recent_wait_seconds = ledger.summarize(wait for _, wait in waits)
+        response.append({
+            'name': queue_name,
+            'max_memory_bytes': max_memory,
+            'wait_seconds': (recent_wait_seconds['p50']
+                             if recent_wait_seconds else None),
+            'recent_wait_seconds': recent_wait_seconds,
+            'last_wait_seconds': waits[0][1] if waits else None,
+            'last_finished_at': waits[0][0] if waits else None,
+            'sample_count': len(waits),
+            'queue_depth': queue_depths[queue_name],
+        })
+    return jsonify(response), 200
+
+
+@contextlib.contextmanager
+def probe_input_headers(client, input_names):
+    """Download the headers of the input images in the background.
+
+    Only the headers of the images are downloaded from the image service
+    (see `image_service.ImageServiceClient.download_nifti_header`). They are
+    downloaded concurrently with each other and with the verification of the
+    images (see `verify_images_on_image_service`), so that the submission of
+    a computation waits for a single round trip to the image service. The
+    downloads are finished when the context manager exits.
+
+    :param client: `image_service.ImageServiceClient` on behalf of the user
+    :param dict input_names: the names of the input images, indexed by role
+    :returns: a context manager that yields the futures of the headers,
+              indexed by role, or None if the PROBE_INPUT_HEADERS option is
+              disabled
+    """
+    if not current_app.config.get('PROBE_INPUT_HEADERS'):
+        yield None
+        return
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=len(input_names)) as executor:
+        yield {
+            role: executor.submit(tracing.wrap(client.download_nifti_header),
+                                  image_name)
+            for role, image_name in input_names.items()
+        }
 
-    if (image_info['extra']['neuroglancer'].get('type', 'image')
-            != expected_type):
+
+@tracing.traced('estimate resources')
+def estimate_computation_resources(computation, input_names, header_probes):
+    """Estimate the resources of a computation from its input headers.
+
+    The request is aborted with an error response if an input image, or the
+    estimated memory, exceeds the limits set in the configuration
+    (``MAX_INPUT_VOXELS`` and ``MAX_ESTIMATED_MEMORY``).
+
+    :param str computation: the type of computation (see
+           `resource_estimates.estimate_resources`)
+    :param dict input_names: the names of the input images, indexed by role
+    :param dict header_probes: the downloads of the headers, as returned by
+           `probe_input_headers`
+    :returns: the estimate, or None if the headers are not probed or a header
+              could not be read (the computation is then accepted, the worker
+              will report any error with the image)
+    :rtype: dict
+    """
+    if header_probes is None:
+        return None
+    headers = {}
+    for role, image_name in input_names.items():
+        try:
+            headers[role] = resource_estimates.parse_nifti_header(
+                header_probes[role].result())
+        except (requests.RequestException, ValueError):
+            logger.warning('Cannot read the header of %r, the resources of '
+                           'the computation are not estimated', image_name,
+                           exc_info=True)
+            return None
+
+    max_voxels = current_app.config.get('MAX_INPUT_VOXELS')
+    if max_voxels is not None:
+        for role, image_name in sorted(input_names.items()):
+            voxels = headers[role]['voxels'] * headers[role]['volumes']
+            if voxels > max_voxels:
+                abort(make_response(jsonify({
+                    'errors': ["The image named '{0}' is too large: {1} "
+                               "voxels (the maximum is {2})"
+                               .format(image_name, voxels, max_voxels)],
+                }), 400))
+
+    estimate = resource_estimates.estimate_resources(computation, headers)
+    max_memory = current_app.config.get('MAX_ESTIMATED_MEMORY')
+    if max_memory is not None and estimate['memory_bytes'] > max_memory:
         abort(make_response(jsonify({
-            'errors': ["The image named '{0}' is not of 'image' type"
-                       .format(image_name)],
+            'errors': ['The computation would need about {0:.1f} GiB of '
+                       'memory (the maximum is {1:.1f} GiB)'
+                       .format(estimate['memory_bytes'] / 1024 ** 3,
+                               max_memory / 1024 ** 3)],
         }), 400))
+    logger.debug('Estimated resources of the %s computation: %s',
+                 computation, estimate)
+    return estimate
+
+
+def submit_computation(computation, task_stub, params, bearer_token):
+    """Send a computation to its queue and predict its start and completion.
+
+    Unless the JOB_LEDGER_PATH option is not set, the computation is recorded
+    in the queue of the job ledger before it is sent, so that its position in
+    the queue is known until a worker starts it (see
+    `ledger.JobLedger.get_queued`).
+
+    :param str computation: the type of computation
+    :param task_stub: the `task_stubs.TaskStub` of the computation
+    :param dict params: the parameters of the computation, including its
+           ``resource_estimate``; the submission time is recorded in
+           ``submitted_at``
+    :returns: a tuple ``(task_result, predicted_times)``, where
+              predicted_times has the ``estimated_start`` and
+              ``estimated_completion`` times (see `cost_model.CostModel`)
+    """
+    queues = current_app.config.get('COMPUTATION_QUEUES') or DEFAULT_QUEUES
+    queue = select_queue(params['resource_estimate'], queues)
+    ledger_path = current_app.config.get('JOB_LEDGER_PATH')
+    params['submitted_at'] = time.time()
+    task_id = str(uuid.uuid4())
+    queued = None
+    if ledger_path:
+        job_ledger = ledger.JobLedger(ledger_path)
+        try:
+            job_ledger.record_queued(task_id, computation, queue,
+                                     params['submitted_at'],
+                                     params['resource_estimate'])
+            queued = job_ledger.get_queued(task_id)
+        except sqlite3.Error:
+            logger.warning('Cannot record the queued computation in the job '
+                           'ledger', exc_info=True)
+    logger.debug('Submitting Celery job with params=%s', params)
+    try:
+        task_result = task_stub.apply_async(
+            (params,), {'bearer_token': bearer_token}, task_id=task_id)
+    except Exception:
+        remove_queued_computation(task_id)
+        raise
+    logger.debug('Submitted Celery job has id=%s', task_result.id)
+
+    model = cost_model.get_cost_model(ledger_path)
+    predicted_times = model.predict_times(
+        computation, params['resource_estimate'], queue,
+        params['submitted_at'],
+        queue_position=queued['position'] if queued else None)
+    return task_result, predicted_times
+
+
+def remove_queued_computation(task_id):
+    """Remove a computation from the queue of the job ledger, if enabled."""
+    ledger_path = current_app.config.get('JOB_LEDGER_PATH')
+    if not ledger_path:
+        return
+    try:
+        ledger.JobLedger(ledger_path).remove_queued(task_id)
+    except sqlite3.Error:
+        logger.warning('Cannot remove the queued computation from the job '
+                       'ledger', exc_info=True)
+
+
+def predict_queued_times(task_id):
+    """Predict the start and completion times of a queued computation.
+
+    The prediction is updated from the current position of the computation
+    in its queue (see `submit_computation`).
+
+    :returns: a dictionary with the ``estimated_start`` and
+              ``estimated_completion`` times, empty if the computation is not
+              recorded in the queue of the job ledger
+    :rtype: dict
+    """
+    ledger_path = current_app.config.get('JOB_LEDGER_PATH')
+    if not ledger_path:
+        return {}
+    try:
+        queued = ledger.JobLedger(ledger_path).get_queued(task_id)
+    except sqlite3.Error:
+        logger.warning('Cannot read the queued computation from the job '
+                       'ledger', exc_info=True)
+        return {}
+    if queued is None:
+        return {}
+    model = cost_model.get_cost_model(ledger_path)
+    return model.predict_times(queued['job_type'],
+                               queued['resource_estimate'], queued['queue'],
+                               time.time(),
+                               queue_position=queued['position'])
 
 
 def make_computation_task_status_response(task_result):
@@ -432,6 +1287,18 @@ def make_computation_task_status_response(task_result):
             'finished': False,
             'message': state_message,
         }
+        if isinstance(task_result.result, dict):
+            for key in ('estimated_start', 'estimated_completion'):
+                if key in task_result.result:
+                    result[key] = task_result.result[key]
+        elif task_result.state == celery.states.PENDING:
+            result.update(predict_queued_times(task_result.id))
+    elif task_result.state == celery.states.REVOKED:
+        result = {
+            'finished': True,
+            'message': 'CANCELLED',
+            'cancelled': True,
+        }
     elif task_result.successful():
         result = {
             'finished': True,
@@ -447,6 +1314,22 @@ def make_computation_task_status_response(task_result):
     return make_response(jsonify(result), 200)
 
 
+def cancel_computation_task(task_result, status_endpoint):
+    if task_result.ready():
+        return jsonify({
+            'errors': ['The computation has already finished'],
+        }), 409
+    logger.info('Revoking Celery job with id=%s', task_result.id)
+    # SIGTERM gives the task a chance to terminate its subprocesses and to
+    # clean up its scratch directory (see cortical_voluba.processes).
+    task_result.revoke(terminate=True, signal='SIGTERM')
+    remove_queued_computation(task_result.id)
+    return jsonify({
+        'status_polling_url': url_for(status_endpoint,
+                                      computation_id=task_result.id),
+    }), 202
+
+
 @bp.route('/worker-health', methods=['GET'])
 @bp.response(ErrorResponseSchema, code=500)
 @bp.response(code=200)
@@ -466,7 +1349,7 @@ def worker_health():
     this check fails, a 500 HTTP status will be returned along with a
     descriptive error message.
     """
-    async_result = tasks.worker_health_task.delay()
+    async_result = task_stubs.worker_health_task.delay()
     result = async_result.get()
     if result:
         return '', 200
@@ -0,0 +1,178 @@
+# Copyright 2020 CEA
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# This file is part of cortical-voluba.
+#
+# cortical-voluba is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# cortical-voluba is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License
+# for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with cortical-voluba. If not, see <https://www.gnu.org/licenses/>.
+
+"""Persistent execution server for commands of the BrainVISA environment.
+
+Every invocation of ``bv_env`` sets up the BrainVISA environment, and every
+``bv_env python -m capsul.run`` starts a new interpreter that has to import
+capsul and highres-cortex before doing any actual work. For small inputs this
+startup overhead is a large fraction of the runtime of the depth map
+computation.
+
+`BrainVisaServer` keeps a long-lived helper process running in the BrainVISA
+environment (see `cortical_voluba.bv_server_main`), which executes each
+command in a forked child process. The helper is restarted if it dies, and it
+exits by itself when the worker process that started it goes away.
+"""
+
+import atexit
+import json
+import logging
+import os.path
+import select
+import subprocess
+import threading
+import time
+
+from cortical_voluba import processes
+
+
+logger = logging.getLogger(__name__)
+
+SERVER_SCRIPT_PATH = os.path.join(os.path.dirname(__file__),
+                                  'bv_server_main.py')
+
+STARTUP_TIMEOUT = 300
+"""Maximum time (in seconds) allowed for the server to become ready."""
+
+
+class BrainVisaServerError(RuntimeError):
+    """Raised when the BrainVISA server cannot process a request."""
+
+
+class BrainVisaServer:
+    """Client to a persistent server running in the BrainVISA environment.
+
+    The server is started lazily by the first call to `check_call`.
+
+    :param str bv_env_path: path to the ``bv_env`` executable
+    :param dict env: environment variables of the server process
+    """
+    def __init__(self, bv_env_path, env=None):
+        self.bv_env_path = bv_env_path
+        self.env = env
+        self._process = None
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return '<BrainVisaServer: {0} (pid={1})>'.format(
+            self.bv_env_path,
+            self._process.pid if self._process else None)
+
+    def is_running(self):
+        return self._process is not None and self._process.poll() is None
+
+    def start(self):
+        """Start the server and wait until it is ready."""
+        command = [self.bv_env_path, 'python', SERVER_SCRIPT_PATH]
+        logger.info('Starting the BrainVISA server: %s', command)
+        start_time = time.monotonic()
+        self._process = subprocess.Popen(
+            command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            env=self.env, start_new_session=True, universal_newlines=True)
+        try:
+            reply = self._read_reply(timeout=STARTUP_TIMEOUT)
+        except BaseException:
+            self.stop()
+            raise
+        if not reply.get('ready'):
+            self.stop()
+            raise BrainVisaServerError(
+                'unexpected answer from the server: {0!r}'.format(reply))
+        logger.info('The BrainVISA server (pid %d) is ready after %.1f s',
+                    self._process.pid, time.monotonic() - start_time)
+
+    def stop(self):
+        """Stop the server and all the commands that it is running."""
+        if self._process is None:
+            return
+        logger.info('Stopping the BrainVISA server (pid %d)',
+                    self._process.pid)
+        processes.terminate_process_group(self._process)
+        self._process.stdin.close()
+        self._process.stdout.close()
+        self._process = None
+
+    def check_call(self, command, cwd=None):
+        """Run a command in the BrainVISA environment.
+
+        The command is given without the ``bv_env`` prefix. Commands of the
+        form ``python -m module ...`` and ``python script.py ...`` are run
+        by the pre-loaded interpreter, other commands are executed directly.
+
+        If the call is interrupted by an exception (e.g.
+        `processes.TaskCancelledError`), the server is stopped along with the
+        running command, and it will be restarted by the next call.
+
+        :raises subprocess.CalledProcessError: if the command exits with a
+                non-zero status
+        :raises BrainVisaServerError: if the server dies while running the
+                command
+        """
+        request = json.dumps({'argv': list(command), 'cwd': cwd}) + '\n'
+        with self._lock:
+            if not self.is_running():
+                if self._process is not None:
+                    logger.warning('The BrainVISA server has died (exit '
+                                   'status %s), restarting it',
+                                   self._process.returncode)
+                    self.stop()
+                self.start()
+            try:
+                self._process.stdin.write(request)
+                self._process.stdin.flush()
+                reply = self._read_reply()
+            except BaseException:
+                self.stop()
+                raise
+        returncode = reply['returncode']
+        if returncode:
+            raise subprocess.CalledProcessError(returncode, command)
+
+    def _read_reply(self, timeout=None):
+        stdout = self._process.stdout
+        if timeout is not None:
+            ready, _, _ = select.select([stdout], [], [], timeout)
+            if not ready:
+                raise BrainVisaServerError(
+                    'no answer from the server after {0} s'.format(timeout))
+        line = stdout.readline()
+        if not line:
+            raise BrainVisaServerError(
+                'the server has exited unexpectedly (exit status {0})'
+                .format(self._process.wait()))
+        return json.loads(line)
+
+
+_servers = {}
+
+
+def get_server(bv_env_path, env=None):
+    """Get the BrainVISA server of the current process.
+
+    A single server is kept per process and per ``bv_env_path``, it is
+    stopped when the process exits.
+    """
+    key = (os.getpid(), bv_env_path)
+    try:
+        return _servers[key]
+    except KeyError:
+        server = BrainVisaServer(bv_env_path, env=env)
+        _servers[key] = server
+        atexit.register(server.stop)
+        return server
@@ -0,0 +1,130 @@
+# Copyright 2020 CEA
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# This file is part of cortical-voluba.
+#
+# cortical-voluba is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# cortical-voluba is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License
+# for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with cortical-voluba. If not, see <https://www.gnu.org/licenses/>.
+
+"""Execution server that runs inside of the BrainVISA environment.
+
+This script is run as ``bv_env python bv_server_main.py`` by
+`cortical_voluba.bv_server`. It is executed by the Python interpreter of
+BrainVISA, so it must only use the standard library, and stay compatible with
+Python 2.7.
+
+The heavy modules are imported once at startup, then every request is
+executed in a forked child process, so that requests are isolated from each
+other while benefitting from the pre-loaded environment.
+
+The protocol is line-based JSON: the server writes ``{"ready": true}`` once
+it has started, then reads one request per line on its standard input, e.g.
+``{"argv": ["python", "-m", "capsul.run", ...], "cwd": "/tmp"}``, and
+answers each of them with ``{"returncode": 0}``. The standard output of the
+commands is redirected to the standard error of the server.
+"""
+
+import json
+import os
+import runpy
+import sys
+import traceback
+
+
+PRELOADED_MODULES = [
+    'capsul.api',
+    'highres_cortex.capsul',
+    'soma.aims',
+]
+
+
+def preload_modules():
+    for module_name in PRELOADED_MODULES:
+        try:
+            __import__(module_name)
+        except Exception:
+            sys.stderr.write('bv_server: cannot pre-load {0}\n'
+                             .format(module_name))
+            traceback.print_exc()
+
+
+def run_child(argv, cwd, protocol_fd):
+    """Execute a request in the (freshly forked) child process."""
+    exit_code = 1
+    try:
+        os.close(protocol_fd)
+        devnull_fd = os.open(os.devnull, os.O_RDONLY)
+        os.dup2(devnull_fd, 0)
+        os.close(devnull_fd)
+        if cwd:
+            os.chdir(cwd)
+        if argv[0] == 'python' and len(argv) >= 3 and argv[1] == '-m':
+            sys.argv = [argv[2]] + argv[3:]
+            runpy.run_module(argv[2], run_name='__main__', alter_sys=True)
+        elif argv[0] == 'python' and len(argv) >= 2:
+            sys.argv = argv[1:]
+            runpy.run_path(argv[1], run_name='__main__')
+        else:
+            os.execvp(argv[0], argv)
+        exit_code = 0
+    except SystemExit as exc:
+        if exc.code is None:
+            exit_code = 0
+        elif isinstance(exc.code, int):
+            exit_code = exc.code
+        else:
+            sys.stderr.write('{0}\n'.format(exc.code))
+            exit_code = 1
+    except BaseException:
+        traceback.print_exc()
+    finally:
+        try:
+            sys.stdout.flush()
+            sys.stderr.flush()
+        finally:
+            os._exit(exit_code)
+
+
+def serve(protocol_file):
+    protocol_file.write(json.dumps({'ready': True}) + '\n')
+    protocol_file.flush()
+    while True:
+        line = sys.stdin.readline()
+        if not line:
+            # The client has gone away
+            return
+        request = json.loads(line)
+        pid = os.fork()
+        if pid == 0:
+            run_child(request['argv'], request.get('cwd'),
+                      protocol_file.fileno())
+        _, status = os.waitpid(pid, 0)
+        if os.WIFEXITED(status):
+            returncode = os.WEXITSTATUS(status)
+        else:
+            returncode = -os.WTERMSIG(status)
+        protocol_file.write(json.dumps({'returncode': returncode}) + '\n')
+        protocol_file.flush()
+
+
+def main():
+    # Keep the original standard output for the protocol, and send the
+    # output of the commands to the standard error.
+    protocol_file = os.fdopen(os.dup(1), 'w')
+    os.dup2(2, 1)
+    preload_modules()
+    serve(protocol_file)
+
+
+if __name__ == '__main__':
+    main()
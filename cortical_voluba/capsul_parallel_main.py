@@ -0,0 +1,232 @@
+# Copyright 2020 CEA
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# This file is part of cortical-voluba.
+#
+# cortical-voluba is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# cortical-voluba is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License
+# for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with cortical-voluba. If not, see <https://www.gnu.org/licenses/>.
+
+"""Run a capsul pipeline with its independent nodes executed in parallel.
+
+This script is a replacement for ``python -m capsul.run`` that runs inside of
+the BrainVISA environment, e.g.::
+
+    bv_env python capsul_parallel_main.py --processes 4 \\
+        --timings timings.json highres_cortex.capsul.isovolume \\
+        classif=classif.nii.gz equivolumetric_depth=depth.nii.gz
+
+The pipeline is converted to a soma-workflow graph of jobs with capsul, then
+the jobs are executed by a local pool of processes, as soon as the jobs that
+they depend on are finished. The duration of each job is written to a JSON
+file. If the pipeline cannot be converted to a workflow, it is run
+sequentially by ``capsul.run``.
+
+It is executed by the Python interpreter of BrainVISA, so it must only use
+the standard library (in addition to capsul and soma-workflow), and stay
+compatible with Python 2.7.
+"""
+
+import argparse
+import ast
+import json
+import logging
+import os
+import runpy
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+
+logger = logging.getLogger('capsul_parallel')
+
+POLL_INTERVAL = 0.05
+
+
+class JobFailedError(Exception):
+    pass
+
+
+def parse_parameter_value(value):
+    try:
+        return ast.literal_eval(value)
+    except (ValueError, SyntaxError):
+        return value
+
+
+def substitute_temporary_paths(command, temporary_dir, paths_cache):
+    """Replace the soma-workflow TemporaryPath objects by actual paths."""
+    substituted = []
+    for arg in command:
+        if isinstance(arg, (list, tuple)):
+            arg = str([str(a) for a in substitute_temporary_paths(
+                arg, temporary_dir, paths_cache)])
+        elif hasattr(arg, 'is_directory') and hasattr(arg, 'suffix'):
+            # soma_workflow.client.TemporaryPath
+            if id(arg) not in paths_cache:
+                path = os.path.join(
+                    temporary_dir,
+                    'tmp{0}{1}'.format(len(paths_cache), arg.suffix or ''))
+                if arg.is_directory:
+                    os.mkdir(path)
+                paths_cache[id(arg)] = path
+            arg = paths_cache[id(arg)]
+        substituted.append(arg)
+    return substituted
+
+
+def job_name(job, index):
+    return getattr(job, 'name', None) or 'job_{0}'.format(index)
+
+
+def run_jobs(jobs, dependencies, max_processes, temporary_dir):
+    """Execute a graph of jobs with at most max_processes at the same time.
+
+    :param list jobs: objects with a ``command`` attribute (list of str)
+    :param list dependencies: pairs ``(job_a, job_b)`` meaning that job_b
+           can only start after job_a has completed successfully
+    :returns: the timings of each job, indexed by job name
+    :rtype: dict
+    """
+    remaining_deps = dict((id(job), set()) for job in jobs)
+    dependents = dict((id(job), []) for job in jobs)
+    for job_a, job_b in dependencies:
+        remaining_deps[id(job_b)].add(id(job_a))
+        dependents[id(job_a)].append(job_b)
+    indices = dict((id(job), i) for i, job in enumerate(jobs))
+    ready = [job for job in jobs if not remaining_deps[id(job)]]
+    running = {}
+    timings = {}
+    paths_cache = {}
+    start_time = time.time()
+
+    def finish(job):
+        for dependent in dependents[id(job)]:
+            remaining_deps[id(dependent)].discard(id(job))
+            if not remaining_deps[id(dependent)]:
+                ready.append(dependent)
+
+    try:
+        while ready or running:
+            while ready and len(running) < max_processes:
+                job = ready.pop(0)
+                name = job_name(job, indices[id(job)])
+                command = getattr(job, 'command', None)
+                if not command:
+                    # Barrier jobs have no command
+                    finish(job)
+                    continue
+                command = substitute_temporary_paths(command, temporary_dir,
+                                                     paths_cache)
+                env = None
+                if getattr(job, 'env', None):
+                    env = dict(os.environ)
+                    env.update(job.env)
+                logger.info('Starting %s: %s', name, command)
+                process = subprocess.Popen(command, env=env)
+                running[process] = (job, name, time.time())
+            time.sleep(POLL_INTERVAL)
+            for process in list(running):
+                if process.poll() is None:
+                    continue
+                job, name, job_start = running.pop(process)
+                now = time.time()
+                timings[name] = {
+                    'start': round(job_start - start_time, 3),
+                    'duration': round(now - job_start, 3),
+                    'returncode': process.returncode,
+                }
+                if process.returncode != 0:
+                    raise JobFailedError('{0} exited with status {1}'
+                                         .format(name, process.returncode))
+                finish(job)
+    finally:
+        for process in running:
+            process.terminate()
+        for process in running:
+            process.wait()
+    return timings
+
+
+def run_pipeline_in_parallel(process_name, parameters, max_processes,
+                             temporary_dir):
+    from capsul.api import get_process_instance
+    from capsul.pipeline.pipeline_workflow import workflow_from_pipeline
+
+    pipeline = get_process_instance(process_name)
+    for name, value in parameters:
+        setattr(pipeline, name, value)
+    workflow = workflow_from_pipeline(pipeline)
+    return run_jobs(list(workflow.jobs), list(workflow.dependencies),
+                    max_processes, temporary_dir)
+
+
+def run_pipeline_sequentially(process_name, raw_parameters):
+    sys.argv = ['capsul.run', process_name] + raw_parameters
+    try:
+        runpy.run_module('capsul.run', run_name='__main__', alter_sys=True)
+    except SystemExit as exc:
+        if exc.code:
+            raise
+
+
+def main(argv=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--processes', type=int, default=1,
+                        help='maximum number of jobs running in parallel')
+    parser.add_argument('--timings', help='output JSON file for the timings '
+                        'of each job')
+    parser.add_argument('process_name')
+    parser.add_argument('parameters', nargs='*', metavar='name=value')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+
+    parameters = []
+    for parameter in args.parameters:
+        name, _, value = parameter.partition('=')
+        parameters.append((name, parse_parameter_value(value)))
+
+    start_time = time.time()
+    timings = None
+    temporary_dir = tempfile.mkdtemp(prefix='capsul_parallel_')
+    try:
+        try:
+            timings = run_pipeline_in_parallel(
+                args.process_name, parameters, max(args.processes, 1),
+                temporary_dir)
+        except JobFailedError:
+            raise
+        except Exception:
+            logger.exception('Cannot run the pipeline in parallel, falling '
+                             'back to sequential execution by capsul.run')
+            run_pipeline_sequentially(args.process_name, args.parameters)
+            timings = {args.process_name: {
+                'start': 0.0,
+                'duration': round(time.time() - start_time, 3),
+                'returncode': 0,
+            }}
+    except JobFailedError as exc:
+        logger.error('%s', exc)
+        return 1
+    finally:
+        shutil.rmtree(temporary_dir, ignore_errors=True)
+
+    if args.timings:
+        with open(args.timings, 'w') as f:
+            json.dump(timings, f)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -17,33 +17,119 @@
 # along with cortical-voluba. If not, see <https://www.gnu.org/licenses/>.
 
 from celery import Celery
+import celery.exceptions
+import celery.signals
+import celery.states
 from flask import current_app
 
 from . import create_app as create_flask_app
+from . import processes
+from . import tracing
 
 
 __all__ = ['create_celery_app']
 
+COMPUTATION_TASKS = (
+    'cortical_voluba.tasks.depth_map_computation_task',
+    'cortical_voluba.tasks.alignment_computation_task',
+    'cortical_voluba.tasks.depth_map_and_alignment_computation_task',
+)
+"""Names of the tasks that are routed according to their size."""
+
+
+def select_queue(resource_estimate, queues):
+    """Select the queue of a computation according to its estimated memory.
+
+    :param dict resource_estimate: the estimated resources of the computation
+           (see `cortical_voluba.resource_estimates`), or None if unknown
+    :param queues: list of ``(queue_name, max_memory_bytes)`` pairs, by
+           increasing memory (the memory of the last queue can be None)
+    :returns: the name of the first queue that can accommodate the
+              computation. Computations of unknown size, or too large for all
+              the queues, are sent to the last queue.
+    :rtype: str
+    """
+    if resource_estimate is not None:
+        for queue_name, max_memory in queues:
+            if (max_memory is None
+                    or resource_estimate['memory_bytes'] <= max_memory):
+                return queue_name
+    return queues[-1][0]
+
+
+def create_computation_router(queues):
+    """Create a Celery router that sends computations to sized queues.
+
+    The router uses the resource estimate that the API records in the
+    parameters of the computation when it is submitted. Other tasks are sent
+    to the default queue.
+
+    :param queues: see `select_queue`
+    """
+    def route_computation(name, args, kwargs, options, task=None, **kw):
+        if name not in COMPUTATION_TASKS or not args:
+            return None
+        params = args[0]
+        return {'queue': select_queue(params.get('resource_estimate'),
+                                      queues)}
+    return route_computation
+
 
 def create_celery_app(flask_app):
     """Initialize the Celery instance in the global variable 'celery_app'."""
     app = Celery(
         flask_app.import_name,
         backend=flask_app.config['CELERY_RESULT_BACKEND'],
-        broker=flask_app.config['CELERY_BROKER_URL']
+        broker=flask_app.config['CELERY_BROKER_URL'],
+        # The tasks module (and its heavy dependencies) is only imported by
+        # the worker, the API dispatches tasks by name (see task_stubs).
+        include=['cortical_voluba.tasks'],
     )
     app.conf.update(flask_app.config)
+    queues = flask_app.config.get('COMPUTATION_QUEUES')
+    if queues:
+        # The old setting names are used, because they cannot be mixed with
+        # the new ones (CELERY_BROKER_URL is used in the Flask config).
+        app.conf['CELERY_ROUTES'] = (create_computation_router(queues),)
+        # Small tasks (e.g. health checks) go to the queue of small jobs
+        app.conf['CELERY_DEFAULT_QUEUE'] = queues[0][0]
 
     class ContextTask(app.Task):
         def __call__(self, *args, **kwargs):
-            with flask_app.app_context():
-                return self.run(*args, **kwargs)
+            with flask_app.app_context(), tracing.Span(
+                    'run ' + self.name.rsplit('.', 1)[-1],
+                    parent=get_request_traceparent(self.request),
+                    kind='CONSUMER', task_id=self.request.id):
+                try:
+                    with processes.cancellable():
+                        return self.run(*args, **kwargs)
+                except processes.TaskCancelledError:
+                    # The worker has already marked the task as revoked, make
+                    # sure that this state is not overwritten by a failure.
+                    self.update_state(state=celery.states.REVOKED, meta={
+                        'message': 'cancelled',
+                    })
+                    raise celery.exceptions.Ignore()
 
     app.Task = ContextTask
 
     return app
 
 
+def get_request_traceparent(request):
+    """Get the trace context that was sent with a task (see task_stubs)."""
+    # Custom message headers are exposed as attributes of the request by the
+    # worker, but in the headers attribute when a task is applied eagerly.
+    return (getattr(request, 'traceparent', None)
+            or (request.headers or {}).get('traceparent'))
+
+
+@celery.signals.worker_init.connect
+def set_worker_service_name(**kwargs):
+    # The pool processes of the worker inherit the service name
+    tracing.set_service_name(tracing.DEFAULT_SERVICE_NAME + '-worker')
+
+
 celery_app = None
 
 # If current_app is defined, it means that the Flask app already exists, so
@@ -0,0 +1,230 @@
+# Copyright 2020 CEA
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# This file is part of cortical-voluba.
+#
+# cortical-voluba is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# cortical-voluba is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License
+# for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with cortical-voluba. If not, see <https://www.gnu.org/licenses/>.
+
+"""Checkpoints of the stages of long-running tasks.
+
+A task is divided into stages (downloading the inputs, computing the depth
+map, running the registration, uploading the results...). The scratch
+directory of the task is kept in a shared location, named after the id of
+the Celery task, along with a record of the stages that have completed and
+of their return values (``checkpoints.json``). When the task is run again
+with the same id, i.e. when Celery retries it or redelivers it after a
+worker restart, the completed stages are skipped.
+
+The return values of the stages must be JSON-serializable (tuples are
+restored as lists). The checkpoints are removed when the task finishes,
+unless it is going to be retried. While the task runs, it keeps a heartbeat
+file up to date (see `Heartbeat`): the checkpoints of tasks that have
+stopped without cleaning up (e.g. when the worker was killed) are removed
+by `remove_expired` after a configurable duration without heartbeat.
+"""
+
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from cortical_voluba import tracing
+
+
+logger = logging.getLogger(__name__)
+
+CHECKPOINT_FILE_NAME = 'checkpoints.json'
+HEARTBEAT_FILE_NAME = 'heartbeat'
+HEARTBEAT_INTERVAL = 60
+"""Time between two updates of the heartbeat file, in seconds."""
+
+
+class Checkpoints:
+    """Record of the completed stages of a task.
+
+    :param str work_dir: the scratch directory of the task, where the
+           checkpoints are stored (it is created if needed)
+    :param bool persistent: if False, nothing is written to disk (the task
+           cannot be resumed)
+
+    The durations of the stages that are run (not skipped) by this instance
+    are recorded in the `durations` dictionary, in seconds, and the time of
+    the last completion in `last_completion_time` (POSIX timestamp). The
+    durations of the stages that were completed by a previous run of the
+    task are restored in `restored_durations`.
+    """
+    def __init__(self, work_dir, persistent=True):
+        self.work_dir = work_dir
+        self.persistent = persistent
+        self._lock = threading.Lock()
+        self._completed = {}
+        self.durations = {}
+        self.restored_durations = {}
+        self.last_completion_time = None
+        os.makedirs(work_dir, exist_ok=True)
+        if persistent:
+            try:
+                with open(self._path) as f:
+                    saved = json.load(f)
+                self._completed = dict(saved['results'])
+                self.restored_durations = dict(saved['seconds'])
+            except FileNotFoundError:
+                pass
+            except (ValueError, KeyError, TypeError):
+                logger.warning('Ignoring corrupt checkpoints in %s',
+                               work_dir)
+                self._completed = {}
+                self.restored_durations = {}
+        if self._completed:
+            logger.info('Resuming the task from %s, completed stages: %s',
+                        work_dir, ', '.join(self._completed))
+
+    def __repr__(self):
+        return '<Checkpoints: {0}>'.format(self.work_dir)
+
+    @property
+    def _path(self):
+        return os.path.join(self.work_dir, CHECKPOINT_FILE_NAME)
+
+    def is_completed(self, stage):
+        with self._lock:
+            return stage in self._completed
+
+    def get_results(self):
+        """Get the return values of the completed stages, indexed by stage."""
+        with self._lock:
+            return dict(self._completed)
+
+    def get_durations(self):
+        """Get the durations of all completed stages, indexed by stage.
+
+        This includes the stages that were completed by a previous run of the
+        task (see `restored_durations`).
+        """
+        with self._lock:
+            return dict(self.restored_durations, **self.durations)
+
+    def run(self, stage, function, *args, **kwargs):
+        """Run a stage, unless it has already completed.
+
+        This method can be called concurrently from several threads.
+
+        :param str stage: unique name of the stage within the task
+        :returns: the return value of function, or its recorded value if the
+                  stage had already completed
+        """
+        with self._lock:
+            if stage in self._completed:
+                logger.info('Skipping the completed stage %r', stage)
+                return self._completed[stage]
+        start_time = time.monotonic()
+        with tracing.Span('stage ' + stage):
+            result = function(*args, **kwargs)
+        with self._lock:
+            self.durations[stage] = time.monotonic() - start_time
+            self.last_completion_time = time.time()
+            self._completed[stage] = result
+            self._save()
+        return result
+
+    def _save(self):
+        if not self.persistent:
+            return
+        fd, temp_path = tempfile.mkstemp(dir=self.work_dir, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump({
+                'results': self._completed,
+                'seconds': dict(self.restored_durations, **self.durations),
+            }, f)
+        os.replace(temp_path, self._path)
+
+    def remove(self):
+        """Remove the scratch directory, along with the checkpoints."""
+        shutil.rmtree(self.work_dir)
+
+
+class Heartbeat:
+    """Keep the heartbeat file of a running task up to date.
+
+    The file is touched every `interval` seconds by a background thread, as
+    long as the context manager is active. `remove_expired` measures the age
+    of the scratch directories from their heartbeat, so the directory of a
+    running task is not removed, however long its stages take.
+
+    :param str work_dir: the scratch directory of the task
+    :param float interval: time between two updates, in seconds
+    """
+    def __init__(self, work_dir, interval=HEARTBEAT_INTERVAL):
+        self.path = os.path.join(work_dir, HEARTBEAT_FILE_NAME)
+        self.interval = interval
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run,
+                                        name='checkpoints heartbeat',
+                                        daemon=True)
+
+    def __enter__(self):
+        self._beat()
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stopped.set()
+        self._thread.join()
+
+    def _beat(self):
+        try:
+            with open(self.path, 'a'):
+                os.utime(self.path)
+        except OSError:
+            logger.warning('Cannot update the heartbeat %s', self.path,
+                           exc_info=True)
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self._beat()
+
+
+def remove_expired(checkpoint_dir, max_age):
+    """Remove the scratch directories that have not been used for a while.
+
+    :param str checkpoint_dir: directory that contains the scratch
+           directories of the tasks
+    :param float max_age: age in seconds, measured from the last heartbeat
+           of the task (see `Heartbeat`) or from its last checkpoint
+    """
+    try:
+        entries = os.listdir(checkpoint_dir)
+    except FileNotFoundError:
+        return
+    limit = time.time() - max_age
+    for entry in entries:
+        path = os.path.join(checkpoint_dir, entry)
+        if not os.path.isdir(path):
+            continue
+        times = []
+        for file_name in (HEARTBEAT_FILE_NAME, CHECKPOINT_FILE_NAME):
+            try:
+                times.append(os.stat(os.path.join(path, file_name)).st_mtime)
+            except OSError:
+                pass
+        try:
+            last_use = max(times) if times else os.stat(path).st_mtime
+        except OSError:  # removed concurrently
+            continue
+        if last_use < limit:
+            logger.info('Removing the expired checkpoints in %s', path)
+            shutil.rmtree(path, ignore_errors=True)
@@ -0,0 +1,250 @@
+# Copyright 2020 CEA
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# This file is part of cortical-voluba.
+#
+# cortical-voluba is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# cortical-voluba is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License
+# for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with cortical-voluba. If not, see <https://www.gnu.org/licenses/>.
+
+
+"""Prediction of the start and completion times of the computations.
+
+The duration of each stage of a computation is predicted from the number of
+voxels of its inputs, by a linear model fitted on the recent history of the
+job ledger (see `cortical_voluba.ledger`). The time that a computation will
+wait before it starts is predicted from its position in its queue: each
+computation ahead of it is assumed to take the median running time of the
+recent computations of the queue. If the position is not known, the median
+of the recent waiting times in the queue is used instead.
+
+Without enough history, the running time is taken from the coarse estimate
+of `cortical_voluba.resource_estimates`, and no waiting time is assumed.
+"""
+
+import datetime
+import logging
+import sqlite3
+import statistics
+import threading
+import time
+
+from cortical_voluba import ledger
+
+
+logger = logging.getLogger(__name__)
+
+HISTORY_LENGTH = 500
+"""Number of recent successful computations used for fitting the model."""
+
+MIN_SAMPLES = 3
+"""Minimum number of samples for fitting a linear model of a stage."""
+
+WAIT_HISTORY_LENGTH = 20
+"""Number of recent computations used for predicting the waiting time.
+
+This applies to the waiting times, and to the running times that are
+multiplied by the position in the queue.
+"""
+
+MODEL_CACHE_SECONDS = 60
+"""The model is fitted again after this duration (in seconds)."""
+
+_cached_models = {}
+_cache_lock = threading.Lock()
+
+
+def format_time(timestamp):
+    """Format a POSIX timestamp as ISO 8601 in UTC (second precision)."""
+    utc_time = datetime.datetime.utcfromtimestamp(round(timestamp))
+    return utc_time.isoformat() + 'Z'
+
+
+def fit_linear(samples):
+    """Fit ``seconds = intercept + slope * voxels`` by least squares.
+
+    :param list samples: list of ``(voxels, seconds)`` pairs
+    :returns: ``(intercept, slope)``; the slope is 0 (i.e. the mean duration
+              is used) if the voxel counts do not vary
+    """
+    mean_voxels = statistics.mean(v for v, _ in samples)
+    mean_seconds = statistics.mean(s for _, s in samples)
+    variance = sum((v - mean_voxels) ** 2 for v, _ in samples)
+    if variance == 0:
+        return mean_seconds, 0.0
+    slope = sum((v - mean_voxels) * (s - mean_seconds)
+                for v, s in samples) / variance
+    return mean_seconds - slope * mean_voxels, slope
+
+
+class CostModel:
+    """Model of the duration of the stages of the computations.
+
+    :param list records: the recent successful computations, as returned by
+           `ledger.JobLedger.get_history` (most recent first)
+    """
+    def __init__(self, records=()):
+        samples = {}
+        waits = {}
+        runtimes = {}
+        for record in records:
+            if record['queue_wait_seconds'] is not None:
+                waits.setdefault(record['queue'], []).append(
+                    record['queue_wait_seconds'])
+            if record.get('total_seconds') is not None:
+                runtimes.setdefault(record['queue'], []).append(
+                    record['total_seconds'])
+            if record['input_voxels'] is None:
+                continue
+            for stage, seconds in record['stage_seconds'].items():
+                samples.setdefault(record['job_type'], {}).setdefault(
+                    stage, []).append((record['input_voxels'], seconds))
+        self.stage_models = {
+            job_type: {stage: fit_linear(stage_samples)
+                       for stage, stage_samples in stages.items()
+                       if len(stage_samples) >= MIN_SAMPLES}
+            for job_type, stages in samples.items()
+        }
+        self.queue_waits = {
+            queue: statistics.median(queue_waits[:WAIT_HISTORY_LENGTH])
+            for queue, queue_waits in waits.items()
+        }
+        self.queue_runtimes = {
+            queue: statistics.median(queue_runtimes[:WAIT_HISTORY_LENGTH])
+            for queue, queue_runtimes in runtimes.items()
+        }
+
+    def predict_stages(self, job_type, input_voxels):
+        """Predict the duration of each stage of a computation.
+
+        :returns: the predicted durations in seconds, indexed by stage
+                  (empty if there is not enough history)
+        :rtype: dict
+        """
+        if input_voxels is None:
+            return {}
+        return {
+            stage: max(intercept + slope * input_voxels, 0.0)
+            for stage, (intercept, slope)
+            in self.stage_models.get(job_type, {}).items()
+        }
+
+    def predict_wait(self, queue, queue_position=None):
+        """Predict the waiting time in a queue, in seconds (0 if unknown).
+
+        :param int queue_position: number of computations ahead in the queue,
+               or None if unknown
+        """
+        if queue_position is not None and queue in self.queue_runtimes:
+            return queue_position * self.queue_runtimes[queue]
+        return self.queue_waits.get(queue, 0.0)
+
+    def predict_times(self, job_type, resource_estimate, queue, now,
+                      queue_position=None):
+        """Predict the start and completion times of a queued computation.
+
+        :param dict resource_estimate: the estimate recorded at submission
+               (see `cortical_voluba.resource_estimates`), or None
+        :param float now: POSIX timestamp of the prediction (the submission
+               time, for a new computation)
+        :param int queue_position: number of computations ahead in the queue
+               (see `cortical_voluba.ledger.JobLedger.get_queued`), or None
+               if unknown
+        :returns: a dictionary with the ``estimated_start`` and
+                  ``estimated_completion`` times (ISO 8601, or None)
+        """
+        start = now + self.predict_wait(queue, queue_position)
+        runtime = predict_runtime(self, job_type, resource_estimate)
+        return {
+            'estimated_start': format_time(start),
+            'estimated_completion': (format_time(start + runtime)
+                                     if runtime is not None else None),
+        }
+
+
+def predict_runtime(model, job_type, resource_estimate):
+    """Predict the total running time of a computation (None if unknown)."""
+    if resource_estimate is None:
+        return None
+    stages = model.predict_stages(job_type,
+                                  resource_estimate.get('input_voxels'))
+    if stages:
+        return sum(stages.values())
+    return resource_estimate.get('runtime_seconds')
+
+
+class ProgressEstimate:
+    """Running estimate of the completion time of a computation.
+
+    The remaining time is the predicted duration of the stages that have not
+    completed yet, counted from the completion of the last stage.
+
+    :param model: the `CostModel`
+    :param str job_type: the type of the computation
+    :param dict resource_estimate: the estimate recorded at submission
+    :param task_checkpoints: the `cortical_voluba.checkpoints.Checkpoints` of
+           the running computation
+    """
+    def __init__(self, model, job_type, resource_estimate, task_checkpoints):
+        self.started_at = time.time()
+        self.task_checkpoints = task_checkpoints
+        input_voxels = (resource_estimate or {}).get('input_voxels')
+        self.predicted_stages = model.predict_stages(job_type, input_voxels)
+        if not self.predicted_stages:
+            runtime = predict_runtime(model, job_type, resource_estimate)
+            # The whole computation is considered as a single stage
+            self.predicted_stages = ({None: runtime} if runtime is not None
+                                     else {})
+
+    def get_times(self):
+        """Get the start time and the estimated completion time.
+
+        :returns: a dictionary with the ``estimated_start`` (the actual start
+                  time) and ``estimated_completion`` times, in ISO 8601
+        """
+        times = {'estimated_start': format_time(self.started_at)}
+        if not self.predicted_stages:
+            return times
+        completed = self.task_checkpoints.get_results()
+        remaining = sum(seconds
+                        for stage, seconds in self.predicted_stages.items()
+                        if stage not in completed)
+        last_completion = max(self.started_at,
+                              self.task_checkpoints.last_completion_time
+                              or 0)
+        times['estimated_completion'] = format_time(
+            max(last_completion + remaining, time.time()))
+        return times
+
+
+def get_cost_model(ledger_path):
+    """Get the cost model fitted on a job ledger, refreshed periodically.
+
+    :param str ledger_path: path of the job ledger, or None
+    :rtype: CostModel
+    """
+    if not ledger_path:
+        return CostModel()
+    with _cache_lock:
+        cached = _cached_models.get(ledger_path)
+        if cached and time.monotonic() - cached[0] < MODEL_CACHE_SECONDS:
+            return cached[1]
+    try:
+        records = ledger.JobLedger(ledger_path).get_history(HISTORY_LENGTH)
+    except sqlite3.Error:
+        logger.warning('Cannot read the job ledger %s', ledger_path,
+                       exc_info=True)
+        records = []
+    model = CostModel(records)
+    with _cache_lock:
+        _cached_models[ledger_path] = (time.monotonic(), model)
+    return model
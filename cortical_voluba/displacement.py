@@ -0,0 +1,366 @@
+# Copyright 2020 CEA
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# This file is part of cortical-voluba.
+#
+# cortical-voluba is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# cortical-voluba is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License
+# for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with cortical-voluba. If not, see <https://www.gnu.org/licenses/>.
+
+"""Composite voxel displacement fields for fast resampling.
+
+The deformation estimated by ANTs is a displacement field in physical (LPS)
+coordinates, defined on its own grid (which can be cropped or downsampled
+with respect to the images). Resampling an image with it requires mapping
+every voxel to physical space, interpolating the displacement, and mapping
+the result back to voxel indices.
+
+`compose_displacement` folds all of these steps into a single field of
+displacements expressed in voxels of a reference grid: the voxel ``v`` of
+the resampled image takes the value of the input image at the continuous
+voxel index ``v + d(v)``. Such a field can be applied to any number of images
+on the same grid by one vectorized linear interpolation
+(`resample_images`), which is skipped in the regions where the displacement
+is negligible.
+
+The composite field is not sampled on the reference grid, but on the grid of
+the deformation estimated by ANTs (`DisplacementField`), which is usually
+downsampled, and is cropped to the region where the displacement is not
+zero. Its size is further bounded by `MAX_FIELD_VOXELS`. The displacements
+of the reference voxels are interpolated block by block during the
+resampling, so the field of the whole reference grid is never held in
+memory.
+
+The composite field is stored in a compressed NumPy archive (``.npz``). The
+displacements are stored as float16 when this is accurate enough: float16
+has an 11-bit significand, so the rounding error is at most 2**-11 (about
+0.05%) of the displacement, e.g. less than 1/64 voxel for displacements
+smaller than 32 voxels. The actual maximum error is computed when writing
+the file and stored along with the field; if it exceeds
+`MAX_QUANTIZATION_ERROR` the field is stored as float32 instead.
+"""
+
+import itertools
+import logging
+
+import numpy
+
+from cortical_voluba import roi
+
+
+logger = logging.getLogger(__name__)
+
+MAX_QUANTIZATION_ERROR = 0.05
+"""Maximum rounding error (in voxels) allowed for storing as float16."""
+
+CHUNK_SIZE = 2 ** 20
+"""Number of voxels that are processed at once (limits memory usage)."""
+
+MAX_FIELD_VOXELS = 2 ** 22
+"""Maximum number of voxels of the grid of a composite displacement field.
+
+Larger fields are subsampled, which bounds the size of the stored field (24
+MiB uncompressed as float16) regardless of the size of the reference grid.
+"""
+
+BLOCK_SHAPE = (32, 32, 32)
+"""Shape of the blocks processed at once by `resample_images`."""
+
+SPARSE_TOLERANCE = 1e-3
+"""Default displacement (in voxels) below which a block is simply copied."""
+
+# The displacement fields of ITK are in LPS coordinates, NIfTI uses RAS
+LPS_TO_RAS = numpy.array([-1, -1, 1])
+
+
+class LinearInterpolation:
+    """Weights of a trilinear interpolation at arbitrary points.
+
+    The weights are computed once, so that several images with the same
+    grid can be interpolated at the same points cheaply. As in ITK, points
+    that are less than half a voxel away from the grid are interpolated with
+    the edge values, points farther away get the default value.
+
+    Only the bounding box of the neighbours of the points (`window`) is read
+    from the images, so the cost of an interpolation does not depend on the
+    size of the images, whatever their memory layout.
+
+    :param coords: continuous voxel indices, array of shape (N, 3)
+    :param shape: shape of the grid of the images to interpolate
+    """
+    def __init__(self, coords, shape):
+        shape = numpy.asarray(shape[:3])
+        self.shape = tuple(int(n) for n in shape)
+        self.outside = ~numpy.all((coords >= -0.5)
+                                  & (coords <= shape - 0.5), axis=1)
+        clipped = numpy.clip(coords, 0, shape - 1)
+        base = numpy.minimum(numpy.floor(clipped).astype(numpy.intp),
+                             numpy.maximum(shape - 2, 0))
+        frac = clipped - base
+        if len(base):
+            start = base.min(axis=0)
+            stop = numpy.minimum(base.max(axis=0) + 2, shape)
+        else:
+            start = numpy.zeros(3, dtype=numpy.intp)
+            stop = numpy.minimum(shape, 1)
+        self.window = tuple(slice(int(a), int(b))
+                            for a, b in zip(start, stop))
+        window_shape = stop - start
+        strides = (window_shape[1] * window_shape[2], window_shape[2], 1)
+        # Flat offsets and weights of the two neighbours along each axis
+        axis_offsets = []
+        axis_weights = []
+        for axis in range(3):
+            lower = base[:, axis] - start[axis]
+            upper = numpy.minimum(base[:, axis] + 1,
+                                  shape[axis] - 1) - start[axis]
+            axis_offsets.append((lower * strides[axis],
+                                 upper * strides[axis]))
+            axis_frac = frac[:, axis].astype(numpy.float32)
+            axis_weights.append((1 - axis_frac, axis_frac))
+        self.indices = []
+        self.weights = []
+        for corner in itertools.product((0, 1), repeat=3):
+            self.indices.append(axis_offsets[0][corner[0]]
+                                + axis_offsets[1][corner[1]]
+                                + axis_offsets[2][corner[2]])
+            self.weights.append(axis_weights[0][corner[0]]
+                                * axis_weights[1][corner[1]]
+                                * axis_weights[2][corner[2]])
+
+    def __call__(self, data, default_value=0):
+        """Interpolate an array whose first 3 dimensions match the grid."""
+        window_data = data[self.window]
+        flat_data = window_data.reshape((-1,) + data.shape[3:])
+        extra_dims = (numpy.newaxis,) * (data.ndim - 3)
+        result = sum(weights[(Ellipsis,) + extra_dims] * flat_data[indices]
+                     for indices, weights in zip(self.indices, self.weights))
+        result[self.outside] = default_value
+        return result
+
+
+def _transform(matrix, points):
+    return points @ matrix[:3, :3].T + matrix[:3, 3]
+
+
+class DisplacementField:
+    """Voxel displacements of a reference grid, sampled on a coarser grid.
+
+    The displacements are zero outside of the field grid.
+
+    :param displacement: displacements in voxels of the reference grid,
+           array of shape (X, Y, Z, 3) sampled on the field grid
+    :param field_to_reference: affine that maps the voxel indices of the
+           field grid to voxel indices of the reference grid
+    :param reference_affine: voxel-to-RAS affine of the reference grid
+    :param reference_shape: shape of the reference grid
+    """
+    def __init__(self, displacement, field_to_reference, reference_affine,
+                 reference_shape):
+        self.displacement = displacement
+        self.field_to_reference = numpy.asarray(field_to_reference,
+                                                dtype=float)
+        self.reference_affine = numpy.asarray(reference_affine, dtype=float)
+        self.reference_shape = tuple(int(n) for n in reference_shape[:3])
+        self._interpolated_data = None
+        self._reference_to_field = None
+
+    def __repr__(self):
+        return '<DisplacementField: {0} samples for a grid of {1}>'.format(
+            self.displacement.shape[:3], self.reference_shape)
+
+    def get_reference_bounding_box(self):
+        """Get the region of the reference grid where the field is defined.
+
+        :returns: a bounding box (tuple of slices) that contains all the
+                  reference voxels whose displacement can be non-zero
+        """
+        # Points up to one voxel of the field grid away from its edges are
+        # affected by the interpolation
+        corners = numpy.array([[i, j, k]
+                               for i in (-1, self.displacement.shape[0])
+                               for j in (-1, self.displacement.shape[1])
+                               for k in (-1, self.displacement.shape[2])])
+        reference_corners = _transform(self.field_to_reference, corners)
+        start = numpy.maximum(
+            numpy.floor(reference_corners.min(axis=0)).astype(int), 0)
+        stop = numpy.minimum(
+            numpy.ceil(reference_corners.max(axis=0)).astype(int) + 1,
+            self.reference_shape)
+        return tuple(slice(int(a), int(max(a, b)))
+                     for a, b in zip(start, stop))
+
+    def interpolate(self, voxels):
+        """Interpolate the displacements of reference voxels.
+
+        :param voxels: voxel indices of the reference grid, array of shape
+               (N, 3)
+        :returns: the displacements, float32 array of shape (N, 3)
+        """
+        if self._interpolated_data is None:
+            self._interpolated_data = self.displacement.astype(numpy.float32)
+            self._reference_to_field = numpy.linalg.inv(
+                self.field_to_reference)
+        interpolation = LinearInterpolation(
+            _transform(self._reference_to_field, voxels),
+            self.displacement.shape)
+        return interpolation(self._interpolated_data)
+
+
+def compose_displacement(warp_img, reference_affine, reference_shape,
+                         max_voxels=MAX_FIELD_VOXELS):
+    """Convert an ITK displacement field to voxel displacements.
+
+    The displacements are sampled on the grid of warp_img, cropped to the
+    region where they are not zero, and subsampled if this region has more
+    than max_voxels voxels.
+
+    :param nibabel.Nifti1Image warp_img: ITK displacement field, of shape
+           (X, Y, Z, 1, 3), as written by antsRegistration
+    :param reference_affine: voxel-to-RAS affine of the reference grid
+    :param reference_shape: shape of the reference grid
+    :param int max_voxels: maximum number of voxels of the field grid
+    :rtype: DisplacementField
+    """
+    warp_data = numpy.asanyarray(warp_img.dataobj, dtype=numpy.float32)
+    warp_data = warp_data.reshape(warp_data.shape[:3] + (3,))
+    field_to_reference = numpy.linalg.inv(reference_affine) @ (
+        warp_img.get_qform())
+
+    # A margin of one voxel of zero displacement is kept around the support,
+    # so that the interpolated displacement vanishes at the edges.
+    bbox = roi.support_bounding_box(numpy.any(warp_data != 0, axis=-1),
+                                    margin=1)
+    if bbox is None:
+        bbox = (slice(0, 1),) * 3
+    warp_data = warp_data[bbox]
+    field_to_reference = field_to_reference @ roi.bounding_box_shift(bbox)
+
+    num_voxels = int(numpy.prod(warp_data.shape[:3]))
+    if num_voxels > max_voxels:
+        step = int(numpy.ceil((num_voxels / max_voxels) ** (1 / 3)))
+        logger.warning('Subsampling the composite displacement field of '
+                       'shape %s by %d', warp_data.shape[:3], step)
+        warp_data = warp_data[::step, ::step, ::step]
+        field_to_reference = field_to_reference @ numpy.diag(
+            [step, step, step, 1])
+
+    # The displacement is linear in the physical displacement, so it can be
+    # converted to reference voxels on the grid of the warp.
+    ras_to_reference_voxel = numpy.linalg.inv(reference_affine)[:3, :3]
+    displacement = ((warp_data * LPS_TO_RAS) @ ras_to_reference_voxel.T)
+    return DisplacementField(displacement.astype(numpy.float32),
+                             field_to_reference, reference_affine,
+                             reference_shape)
+
+
+def save_displacement(path, field):
+    """Write a composite displacement field (see the module documentation).
+
+    :param DisplacementField field: the composite displacement field
+    :returns: the maximum rounding error of the stored displacements
+    :rtype: float
+    """
+    displacement = field.displacement
+    stored = displacement.astype(numpy.float16)
+    max_error = float(numpy.max(numpy.abs(
+        stored.astype(numpy.float32) - displacement), initial=0))
+    if not numpy.isfinite(max_error) or max_error > MAX_QUANTIZATION_ERROR:
+        stored = displacement.astype(numpy.float32)
+        max_error = 0.0
+    logger.info('Writing the composite displacement field of shape %s to %s '
+                'as %s (maximum rounding error: %g voxel)',
+                stored.shape[:3], path, stored.dtype, max_error)
+    with open(path, 'wb') as f:
+        numpy.savez_compressed(f, displacement=stored,
+                               field_to_reference=field.field_to_reference,
+                               reference_affine=field.reference_affine,
+                               reference_shape=field.reference_shape,
+                               max_error=max_error)
+    return max_error
+
+
+def load_displacement(path):
+    """Read a composite displacement field.
+
+    :returns: a tuple ``(field, max_error)``, where field is a
+              `DisplacementField`
+    """
+    with numpy.load(path) as archive:
+        return (DisplacementField(archive['displacement'],
+                                  archive['field_to_reference'],
+                                  archive['reference_affine'],
+                                  archive['reference_shape']),
+                float(archive['max_error']))
+
+
+def _blocks(shape, block_shape):
+    """Iterate over the blocks of a grid, as tuples of slices."""
+    ranges = [range(0, n, b) for n, b in zip(shape, block_shape)]
+    for starts in itertools.product(*ranges):
+        yield tuple(slice(start, min(start + b, n))
+                    for start, b, n in zip(starts, block_shape, shape))
+
+
+def _intersects(block, bbox):
+    return all(s.start < b.stop and b.start < s.stop
+               for s, b in zip(block, bbox))
+
+
+def resample_images(images, field, default_value=0,
+                    tolerance=SPARSE_TOLERANCE):
+    """Resample images with a composite displacement field.
+
+    The reference grid is processed by blocks of `BLOCK_SHAPE` voxels, whose
+    displacements are interpolated from the field. Blocks where all
+    displacements are smaller than tolerance (in voxels) are copied from the
+    input images without interpolation, which is much faster: the
+    deformation is usually restricted to a small region around the
+    cortical patch.
+
+    :param list images: arrays whose first 3 dimensions have the shape of the
+           reference grid of the displacement field
+    :param DisplacementField field: the composite displacement field
+    :param tolerance: displacement below which the interpolation is skipped,
+           or None to interpolate everywhere
+    :returns: the resampled images, as float32 arrays
+    :rtype: list of numpy.ndarray
+    """
+    shape = field.reference_shape
+    field_bbox = field.get_reference_bounding_box()
+    results = [numpy.empty(shape + image.shape[3:], dtype=numpy.float32)
+               for image in images]
+    num_blocks = num_copied_blocks = 0
+    for block in _blocks(shape, BLOCK_SHAPE):
+        num_blocks += 1
+        block_displacement = None
+        if _intersects(block, field_bbox):
+            block_shape = tuple(s.stop - s.start for s in block)
+            voxels = (numpy.indices(block_shape).reshape((3, -1)).T
+                      + [s.start for s in block])
+            block_displacement = field.interpolate(voxels)
+            if (tolerance is not None and numpy.max(
+                    numpy.abs(block_displacement)) <= tolerance):
+                block_displacement = None
+        if block_displacement is None:
+            num_copied_blocks += 1
+            for image, result in zip(images, results):
+                result[block] = image[block]
+            continue
+        interpolation = LinearInterpolation(voxels + block_displacement,
+                                            shape)
+        for image, result in zip(images, results):
+            result[block] = interpolation(image, default_value).reshape(
+                block_shape + image.shape[3:])
+    logger.debug('Resampling: %d blocks out of %d were copied without '
+                 'interpolation', num_copied_blocks, num_blocks)
+    return results
@@ -0,0 +1,251 @@
+# Copyright 2020 CEA
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# This file is part of cortical-voluba.
+#
+# cortical-voluba is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# cortical-voluba is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License
+# for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with cortical-voluba. If not, see <https://www.gnu.org/licenses/>.
+
+"""Worker-local cache of the images downloaded from the image service.
+
+The same images are often downloaded many times in a row, e.g. when an
+alignment is re-run after adjusting the landmarks. `DownloadCache` keeps the
+downloaded files in a directory of the worker node, bounded in total size,
+and evicts the least recently used files first.
+
+Cached files are always revalidated with the image service by a conditional
+request (``If-None-Match`` / ``If-Modified-Since``). If the image service does
+not send validators (``ETag`` / ``Last-Modified``), the cached file is used
+if the ``Content-Length`` of the response matches its size, and the body of
+the response is not read. As every request reaches the image service with
+the credentials of the user, the cache never serves an image that the user
+is not allowed to download.
+
+The cache can be shared by concurrent tasks, in the same process or in
+different processes: each entry is protected by a file lock, so concurrent
+downloads of the same image are serialized (the second task gets a cache
+hit). Hit/miss counters are kept in ``stats.json`` in the cache directory.
+"""
+
+import contextlib
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+
+logger = logging.getLogger(__name__)
+
+_COPY_CHUNK_SIZE = 1024 * 1024
+
+
+class DownloadCache:
+    """Size-bounded LRU cache of downloaded files.
+
+    :param str cache_dir: directory where the cached files are stored (it is
+           created if needed)
+    :param int max_bytes: maximum total size of the cached files
+    """
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def __repr__(self):
+        return '<DownloadCache: {0} (max {1} bytes)>'.format(
+            self.cache_dir, self.max_bytes)
+
+    def _entry_path(self, url, suffix):
+        key = hashlib.sha256(url.encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, key + suffix)
+
+    @contextlib.contextmanager
+    def _locked(self, lock_path, operation=fcntl.LOCK_EX):
+        fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, operation)
+            yield
+        finally:
+            os.close(fd)  # also releases the lock
+
+    def download(self, url, output_file, get):
+        """Download a file through the cache.
+
+        :param str url: URL of the file, used as the key of the cache
+        :param io.IOBase output_file: binary-mode file object to which the
+               file will be written
+        :param get: callable that performs a streamed GET request on url, it
+               must accept a dictionary of additional headers as its only
+               argument and return a `requests.Response`
+        :returns: True if the file was served from the cache
+        :rtype: bool
+        :raises requests.RequestException: for HTTP or communication errors
+        """
+        data_path = self._entry_path(url, '.data')
+        metadata_path = self._entry_path(url, '.json')
+        with self._locked(self._entry_path(url, '.lock')):
+            metadata = self._read_metadata(data_path, metadata_path)
+            headers = {}
+            if metadata:
+                if metadata.get('etag'):
+                    headers['If-None-Match'] = metadata['etag']
+                if metadata.get('last_modified'):
+                    headers['If-Modified-Since'] = metadata['last_modified']
+            r = get(headers)
+            try:
+                hit = metadata is not None and self._is_fresh(r, metadata)
+                if not hit:
+                    r.raise_for_status()
+                    size = self._store(r, data_path, output_file)
+                    metadata = {
+                        'url': url,
+                        'etag': r.headers.get('ETag'),
+                        'last_modified': r.headers.get('Last-Modified'),
+                        'size': size,
+                    }
+                    self._write_json(metadata_path, metadata)
+            finally:
+                r.close()
+            if hit:
+                with open(data_path, 'rb') as f:
+                    shutil.copyfileobj(f, output_file, _COPY_CHUNK_SIZE)
+                # The modification time of the metadata records the last use
+                os.utime(metadata_path)
+        if hit:
+            logger.info('Download cache hit for %s (%d bytes saved)',
+                        url, metadata['size'])
+        else:
+            logger.info('Download cache miss for %s (%d bytes downloaded)',
+                        url, metadata['size'])
+        self._update_stats(hit, metadata['size'])
+        self.evict()
+        return hit
+
+    @staticmethod
+    def _is_fresh(response, metadata):
+        if response.status_code == 304:
+            return True
+        if (response.status_code == 200
+                and not metadata.get('etag')
+                and not metadata.get('last_modified')
+                and not response.headers.get('ETag')
+                and not response.headers.get('Last-Modified')):
+            content_length = response.headers.get('Content-Length')
+            return (content_length is not None
+                    and int(content_length) == metadata['size'])
+        return False
+
+    def _store(self, response, data_path, output_file):
+        """Write the body of response both to output_file and to the cache."""
+        size = 0
+        fd, temp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as cache_file:
+                for chunk in response.iter_content(_COPY_CHUNK_SIZE):
+                    output_file.write(chunk)
+                    cache_file.write(chunk)
+                    size += len(chunk)
+            os.replace(temp_path, data_path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+        return size
+
+    def _read_metadata(self, data_path, metadata_path):
+        if not os.path.exists(data_path):
+            return None
+        try:
+            with open(metadata_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write_json(self, path, data):
+        fd, temp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
+        os.replace(temp_path, path)
+
+    def _update_stats(self, hit, size):
+        stats_path = os.path.join(self.cache_dir, 'stats.json')
+        with self._locked(os.path.join(self.cache_dir, 'stats.lock')):
+            stats = self.get_stats()
+            if hit:
+                stats['hits'] += 1
+                stats['bytes_saved'] += size
+            else:
+                stats['misses'] += 1
+                stats['bytes_downloaded'] += size
+            self._write_json(stats_path, stats)
+
+    def get_stats(self):
+        """Get the counters of the cache.
+
+        :returns: a dictionary with the number of ``hits`` and ``misses``,
+                  and the number of ``bytes_saved`` and ``bytes_downloaded``
+        :rtype: dict
+        """
+        stats = {
+            'hits': 0,
+            'misses': 0,
+            'bytes_saved': 0,
+            'bytes_downloaded': 0,
+        }
+        try:
+            with open(os.path.join(self.cache_dir, 'stats.json')) as f:
+                stats.update(json.load(f))
+        except (OSError, ValueError):
+            pass
+        return stats
+
+    def evict(self):
+        """Remove the least recently used files until the size is bounded.
+
+        Files that are in use by another task are left alone.
+        """
+        with self._locked(os.path.join(self.cache_dir, 'evict.lock')):
+            entries = []
+            for file_name in os.listdir(self.cache_dir):
+                if not file_name.endswith('.data'):
+                    continue
+                data_path = os.path.join(self.cache_dir, file_name)
+                base_path = data_path[:-len('.data')]
+                try:
+                    size = os.stat(data_path).st_size
+                except OSError:  # removed concurrently
+                    continue
+                try:
+                    last_use = os.stat(base_path + '.json').st_mtime
+                except OSError:
+                    last_use = 0
+                entries.append((last_use, size, base_path))
+            total_size = sum(size for _, size, _ in entries)
+            for last_use, size, base_path in sorted(entries):
+                if total_size <= self.max_bytes:
+                    break
+                try:
+                    with self._locked(base_path + '.lock',
+                                      fcntl.LOCK_EX | fcntl.LOCK_NB):
+                        for suffix in ('.data', '.json'):
+                            with contextlib.suppress(FileNotFoundError):
+                                os.unlink(base_path + suffix)
+                except BlockingIOError:
+                    continue
+                logger.debug('Evicted %s from the download cache (%d bytes, '
+                             'last used %s)', base_path, size,
+                             time.ctime(last_use))
+                total_size -= size
@@ -0,0 +1,438 @@
+# Copyright 2020 CEA
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# This file is part of cortical-voluba.
+#
+# cortical-voluba is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# cortical-voluba is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License
+# for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with cortical-voluba. If not, see <https://www.gnu.org/licenses/>.
+
+"""Local stand-in for the Chumni image service.
+
+This server implements the endpoints of the image service that are used by
+`cortical_voluba.image_service.LowLevelImageServiceClient` (``/list``,
+``/upload``, ``/preflight``, ``/download/...`` and the deletion of
+``/nifti/...``), with an emulation of real network conditions:
+
+- a latency added to every response;
+- a bandwidth limit on the transfers (in both directions);
+- a random fraction of requests that fail with an HTTP error;
+- ``Range`` requests and conditional requests (``ETag`` /
+  ``Last-Modified``) on downloads.
+
+The images are stored as files in a directory, which can be populated
+beforehand (files named ``<name>.nii`` or ``<name>.nii.gz``). No
+authentication is performed, unless ``require_auth`` is set (then any
+``Authorization`` header is accepted).
+
+Run it as a standalone server (e.g. as a service of docker-compose, with the
+image built from ``Dockerfile.flask``)::
+
+    python -m cortical_voluba.fake_image_service --port 8081 \\
+        --storage /data --latency 0.05 --bandwidth 10e6
+
+or in a background thread of the current process (e.g. from tests or
+benchmarks), see `serve_in_background`. The network conditions can be changed
+while the server is running by posting JSON to the ``/_fake/config``
+endpoint, e.g. ``{"error_rate": 0.5}``.
+"""
+
+import argparse
+import contextlib
+import datetime
+import gzip
+import hashlib
+import io
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import flask
+from flask import abort, jsonify, request
+import werkzeug.serving
+
+from cortical_voluba.image_service import strip_nii_extension
+
+
+DEFAULT_CONDITIONS = {
+    'latency': 0.0,
+    'bandwidth': None,
+    'error_rate': 0.0,
+    'error_status': 503,
+    'require_auth': False,
+}
+"""Default network conditions (latency in seconds, bandwidth in bytes/s)."""
+
+_CHUNK_SIZE = 64 * 1024
+
+
+class Throttle:
+    """Limit the rate of a transfer to bandwidth (bytes per second)."""
+    def __init__(self, bandwidth):
+        self.bandwidth = bandwidth
+        self.start_time = time.monotonic()
+        self.transferred = 0
+
+    def __call__(self, num_bytes):
+        """Account for num_bytes, sleeping as needed to honour the limit."""
+        self.transferred += num_bytes
+        if self.bandwidth:
+            delay = (self.start_time + self.transferred / self.bandwidth
+                     - time.monotonic())
+            if delay > 0:
+                time.sleep(delay)
+
+
+def _image_id(name):
+    return hashlib.sha1(name.encode('utf-8')).hexdigest()[:16]
+
+
+class ImageStore:
+    """Images stored as Nifti files in a directory.
+
+    A JSON sidecar file (``<name>.json``) records the attributes of the
+    uploaded images that are not contained in the file itself.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self.lock = threading.Lock()
+
+    def _path(self, file_name):
+        return os.path.join(self.directory, file_name)
+
+    def find(self, name):
+        """Path to the file of an image, or None if it does not exist."""
+        for suffix in ('.nii.gz', '.nii'):
+            path = self._path(name + suffix)
+            if os.path.isfile(path):
+                return path
+        return None
+
+    def names(self):
+        return sorted({strip_nii_extension(file_name)
+                       for file_name in os.listdir(self.directory)
+                       if strip_nii_extension(file_name)})
+
+    def find_by_id(self, image_id, name):
+        if image_id == _image_id(name):
+            return self.find(name)
+        return None
+
+    def entry(self, name):
+        """``UserDatasetEntry`` describing an image."""
+        path = self.find(name)
+        stat = os.stat(path)
+        try:
+            with open(self._path(name + '.json')) as f:
+                attributes = json.load(f)
+        except (OSError, ValueError):
+            attributes = {}
+        extra = self.nifti_extra(os.path.basename(path), stat.st_size,
+                                 attributes.get('segmentation', False))
+        extra['uploaded'] = datetime.datetime.utcfromtimestamp(
+            stat.st_mtime).isoformat() + 'Z'
+        return {
+            'extra': extra,
+            'links': {
+                'normalized': '/nifti/{0}/{1}'.format(_image_id(name), name),
+            },
+            'name': name,
+            'visibility': 'private',
+        }
+
+    @staticmethod
+    def nifti_extra(file_name, file_size, segmentation):
+        """``NiftiExtra`` structure, as returned by an upload."""
+        return {
+            'data': {},
+            'fileName': file_name,
+            'fileSize': file_size,
+            'neuroglancer': {
+                'type': 'segmentation' if segmentation else 'image',
+            },
+            'nifti': {},
+            'warnings': [],
+        }
+
+    def store(self, file_name, fileobj, segmentation, throttle):
+        name = strip_nii_extension(file_name)
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            while True:
+                chunk = fileobj.read(_CHUNK_SIZE)
+                if not chunk:
+                    break
+                throttle(len(chunk))
+                f.write(chunk)
+        with self.lock:
+            if self.find(name):
+                os.unlink(temp_path)
+                return None
+            os.replace(temp_path, self._path(file_name))
+            with open(self._path(name + '.json'), 'w') as f:
+                json.dump({'segmentation': segmentation}, f)
+        return self.nifti_extra(file_name, os.path.getsize(
+            self._path(file_name)), segmentation)
+
+    def delete(self, name):
+        with self.lock:
+            for suffix in ('.nii.gz', '.nii', '.json'):
+                with contextlib.suppress(FileNotFoundError):
+                    os.unlink(self._path(name + suffix))
+
+
+def create_app(storage_dir, **conditions):
+    """Create the Flask application of the fake image service.
+
+    :param str storage_dir: directory where the images are stored
+    :param conditions: network conditions, see `DEFAULT_CONDITIONS`
+    """
+    unknown = set(conditions) - set(DEFAULT_CONDITIONS)
+    if unknown:
+        raise TypeError('unknown network conditions: {0}'
+                        .format(', '.join(sorted(unknown))))
+    app = flask.Flask(__name__)
+    app.config['FAKE_CONDITIONS'] = dict(DEFAULT_CONDITIONS, **conditions)
+    store = ImageStore(storage_dir)
+
+    def current_conditions():
+        return app.config['FAKE_CONDITIONS']
+
+    def throttle():
+        return Throttle(current_conditions()['bandwidth'])
+
+    @app.before_request
+    def emulate_network():
+        if request.path.startswith('/_fake/'):
+            return
+        if current_conditions()['latency']:
+            time.sleep(current_conditions()['latency'])
+        if random.random() < current_conditions()['error_rate']:
+            abort(current_conditions()['error_status'])
+        if (current_conditions()['require_auth']
+                and 'Authorization' not in request.headers):
+            abort(401)
+
+    @app.route('/_fake/config', methods=['GET', 'POST'])
+    def fake_config():
+        if request.method == 'POST':
+            new_conditions = request.get_json(force=True)
+            unknown = set(new_conditions) - set(DEFAULT_CONDITIONS)
+            if unknown:
+                return jsonify({'errors': ['unknown network conditions: '
+                                           + ', '.join(sorted(unknown))]}), 400
+            current_conditions().update(new_conditions)
+        return jsonify(current_conditions())
+
+    @app.route('/list')
+    def list_images():
+        return jsonify([store.entry(name) for name in store.names()])
+
+    def receive_upload(preflight):
+        uploaded_file = request.files.get('image')
+        if uploaded_file is None:
+            abort(400)
+        file_name = os.path.basename(uploaded_file.filename or '')
+        if not strip_nii_extension(file_name):
+            abort(400)
+        if store.find(strip_nii_extension(file_name)):
+            abort(409)
+        segmentation = (request.headers.get('X-CHUNMA-SEGMENTATION')
+                        == 'true')
+        if preflight:
+            throttle()(len(uploaded_file.read()))
+            extra = store.nifti_extra(file_name, int(request.headers.get(
+                'X-CHUNMA-FILESIZE', 0)), segmentation)
+            del extra['data']
+            return jsonify(extra)
+        extra = store.store(file_name, uploaded_file.stream, segmentation,
+                            throttle())
+        if extra is None:
+            abort(409)
+        return jsonify(extra)
+
+    @app.route('/upload', methods=['POST'])
+    def upload():
+        return receive_upload(preflight=False)
+
+    @app.route('/preflight', methods=['POST'])
+    def preflight():
+        return receive_upload(preflight=True)
+
+    @app.route('/nifti/<image_id>/<name>', methods=['DELETE'])
+    def delete(image_id, name):
+        if store.find_by_id(image_id, name) is None:
+            abort(404)
+        store.delete(name)
+        return '', 204
+
+    @app.route('/download/<file_name>')
+    def download(file_name):
+        if file_name.endswith('.nii.gz'):
+            # Only available if the image was uploaded compressed
+            path = store.find(file_name[:-len('.nii.gz')])
+            if path is None or not path.endswith('.nii.gz'):
+                abort(404)
+            return send_data(path, file_name)
+        elif file_name.endswith('.nii'):
+            path = store.find(file_name[:-len('.nii')])
+            if path is None:
+                abort(404)
+            return send_data(path, file_name,
+                             decompress=path.endswith('.gz'))
+        else:
+            path = store.find(file_name)
+            if path is None:
+                abort(404)
+            return send_data(path, os.path.basename(path),
+                             attachment=True)
+
+    def send_data(path, file_name, decompress=False, attachment=False):
+        stat = os.stat(path)
+        etag = '{0}-{1}-{2}'.format(int(stat.st_mtime_ns), stat.st_size,
+                                    int(decompress))
+        if decompress:
+            with gzip.open(path, 'rb') as f:
+                data = f.read()
+            length = len(data)
+
+            def open_data():
+                return io.BytesIO(data)
+        else:
+            length = stat.st_size
+
+            def open_data():
+                return open(path, 'rb')
+
+        response = flask.Response(mimetype='application/octet-stream')
+        response.set_etag(etag)
+        response.last_modified = datetime.datetime.utcfromtimestamp(
+            int(stat.st_mtime))
+        response.accept_ranges = 'bytes'
+        if attachment:
+            response.headers['Content-Disposition'] = (
+                'attachment; filename="{0}"'.format(file_name))
+        if (request.if_none_match.contains(etag)
+                or (not request.if_none_match
+                    and request.if_modified_since is not None
+                    and response.last_modified
+                    <= request.if_modified_since.replace(tzinfo=None))):
+            response.status_code = 304
+            return response
+        start, stop = 0, length
+        if request.range is not None:
+            byte_range = request.range.range_for_length(length)
+            if byte_range is None:
+                response.status_code = 416
+                response.headers['Content-Range'] = 'bytes */{0}'.format(
+                    length)
+                return response
+            start, stop = byte_range
+            response.status_code = 206
+            response.content_range = request.range.make_content_range(
+                length)
+        response.content_length = stop - start
+        transfer_throttle = throttle()
+
+        def generate():
+            with open_data() as f:
+                f.seek(start)
+                remaining = stop - start
+                while remaining > 0:
+                    chunk = f.read(min(_CHUNK_SIZE, remaining))
+                    if not chunk:
+                        break
+                    remaining -= len(chunk)
+                    transfer_throttle(len(chunk))
+                    yield chunk
+        response.response = generate()
+        return response
+
+    return app
+
+
+class _QuietRequestHandler(werkzeug.serving.WSGIRequestHandler):
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+@contextlib.contextmanager
+def serve_in_background(app, host='127.0.0.1', port=0):
+    """Run a server for app in a background thread.
+
+    The requests are not logged.
+
+    :returns: a context manager that yields the base URL of the server
+    """
+    server = werkzeug.serving.make_server(
+        host, port, app, threaded=True, request_handler=_QuietRequestHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield 'http://{0}:{1}/'.format(host, server.server_port)
+    finally:
+        server.shutdown()
+        thread.join()
+
+
+def parse_command_line(argv):
+    parser = argparse.ArgumentParser(
+        description=__doc__.split('\n\n')[0])
+    parser.add_argument('--host', default='127.0.0.1',
+                        help='interface to listen on (default: %(default)s)')
+    parser.add_argument('--port', type=int, default=8081,
+                        help='port to listen on (default: %(default)s)')
+    parser.add_argument('--storage',
+                        help='directory where the images are stored '
+                        '(default: a temporary directory)')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='latency added to each response, in seconds')
+    parser.add_argument('--bandwidth', type=float,
+                        help='maximum transfer rate, in bytes per second')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='fraction of requests that fail')
+    parser.add_argument('--error-status', type=int, default=503,
+                        help='HTTP status of the failed requests '
+                        '(default: %(default)s)')
+    parser.add_argument('--require-auth', action='store_true',
+                        help='reject requests without an Authorization '
+                        'header')
+    return parser.parse_args(argv[1:])
+
+
+def main(argv=sys.argv):
+    args = parse_command_line(argv)
+    storage_dir = args.storage or tempfile.mkdtemp(prefix='fake_chumni_')
+    os.makedirs(storage_dir, exist_ok=True)
+    app = create_app(storage_dir,
+                     latency=args.latency,
+                     bandwidth=args.bandwidth,
+                     error_rate=args.error_rate,
+                     error_status=args.error_status,
+                     require_auth=args.require_auth)
+    print('Serving the images of {0}'.format(storage_dir), file=sys.stderr)
+    try:
+        werkzeug.serving.run_simple(args.host, args.port, app,
+                                    threaded=True)
+    finally:
+        if not args.storage:
+            shutil.rmtree(storage_dir)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -27,6 +27,7 @@
 import cgi
 import gzip
 import os
+import zlib
 from urllib.parse import urljoin
 
 import requests
@@ -36,6 +37,12 @@
 PREFLIGHT_DATA_LENGTH = 2048  # first 2kiB of Nifti are enough to read header
 """Number of bytes sent for a preflight request."""
 
+NIFTI_HEADER_LENGTH = 540  # size of a NIfTI-2 header (NIfTI-1: 348 bytes)
+"""Number of bytes of uncompressed data returned by a header download."""
+
+HEADER_PROBE_LENGTH = 8192
+"""Number of bytes requested from the server for downloading a header."""
+
 # By default we let requests choose the best chunk size.
 _DOWNLOAD_CHUNK_SIZE = None
 
@@ -94,13 +101,16 @@ class LowLevelImageServiceClient:
            `BearerTokenAuth`).
     :param float timeout: timeout (in seconds) used for all HTTP calls to the
            image service
+    :param download_cache: optional cache of the downloaded images (see
+           `cortical_voluba.download_cache.DownloadCache`)
     """
-    def __init__(self, base_url, auth=None, timeout=10):
+    def __init__(self, base_url, auth=None, timeout=10, download_cache=None):
         self.base_url = base_url
         if self.base_url[-1] != '/':
             self.base_url += '/'
         self.auth = auth
         self.timeout = timeout
+        self.download_cache = download_cache
 
     def list_images(self):
         """List the images contained in the image service.
@@ -194,13 +204,11 @@ def download_nifti(self, name, output_file):
         :param str name: the name of the image on the image service
         :param io.IOBase image_file: a binary-mode file object to which the
                uncompressed Nifti data will be written
+        :returns: True if the image was served from the download cache
         :raises requests.RequestException: for HTTP or communication errors
         """
-        r = requests.get(self.base_url + 'download/' + name + '.nii',
-                         auth=self.auth, stream=True, timeout=self.timeout)
-        r.raise_for_status()
-        for chunk in r.iter_content(_DOWNLOAD_CHUNK_SIZE):
-            output_file.write(chunk)
+        return self._download(self.base_url + 'download/' + name + '.nii',
+                              output_file)
 
     def download_compressed_nifti(self, name, output_file):
         """Download the image as compressed Nifti.
@@ -208,19 +216,79 @@ def download_compressed_nifti(self, name, output_file):
         :param str name: the name of the image on the image service
         :param io.IOBase image_file: a binary-mode file object to which the
                gzip-compressed Nifti data will be written
+        :returns: True if the image was served from the download cache
         :raises requests.RequestException: for HTTP or communication errors
         """
-        r = requests.get(self.base_url + 'download/' + name + '.nii.gz',
-                         auth=self.auth, stream=True, timeout=self.timeout)
-        if r.status_code == 404:
+        try:
+            return self._download(
+                self.base_url + 'download/' + name + '.nii.gz', output_file)
+        except requests.HTTPError as exc:
+            if exc.response is None or exc.response.status_code != 404:
+                raise
             # As of 2019-06-06 the server only provides this endpoint if the
             # file was uploaded as compressed Nifti.
-            self.download_nifti(name,
-                                gzip.GzipFile(fileobj=output_file, mode='wb'))
-        else:
+            return self.download_nifti(
+                name, gzip.GzipFile(fileobj=output_file, mode='wb'))
+
+    def download_nifti_header(self, name):
+        """Download the beginning of the image, enough to read its header.
+
+        Only the first bytes of the image are requested (with a ``Range``
+        header). In case the server ignores the range, the transfer is
+        interrupted as soon as enough data have been received.
+
+        :param str name: the name of the image on the image service
+        :returns: the first `NIFTI_HEADER_LENGTH` bytes of the uncompressed
+                  Nifti data (or less if the file is shorter)
+        :rtype: bytes
+        :raises requests.RequestException: for HTTP or communication errors
+        :raises ValueError: if the compressed data cannot be decompressed
+        """
+        try:
+            return self._download_head(
+                self.base_url + 'download/' + name + '.nii.gz',
+                compressed=True)
+        except requests.HTTPError as exc:
+            if exc.response is None or exc.response.status_code != 404:
+                raise
+            # See download_compressed_nifti
+            return self._download_head(
+                self.base_url + 'download/' + name + '.nii',
+                compressed=False)
+
+    def _download_head(self, url, compressed):
+        headers = {'Range': 'bytes=0-{0}'.format(HEADER_PROBE_LENGTH - 1)}
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        data = b''
+        with requests.get(url, headers=headers, auth=self.auth, stream=True,
+                          timeout=self.timeout) as r:
             r.raise_for_status()
-            for chunk in r.iter_content(_DOWNLOAD_CHUNK_SIZE):
-                output_file.write(chunk)
+            for chunk in r.iter_content(1024):
+                if compressed:
+                    try:
+                        chunk = decompressor.decompress(chunk)
+                    except zlib.error as exc:
+                        raise ValueError('invalid gzip data') from exc
+                data += chunk
+                if len(data) >= NIFTI_HEADER_LENGTH:
+                    break
+        return data[:NIFTI_HEADER_LENGTH]
+
+    def _download(self, url, output_file):
+        """Download a file, through the download cache if there is one.
+
+        :returns: True if the file was served from the cache
+        """
+        def get(headers):
+            return requests.get(url, headers=headers, auth=self.auth,
+                                stream=True, timeout=self.timeout)
+        if self.download_cache is not None:
+            return self.download_cache.download(url, output_file, get)
+        r = get({})
+        r.raise_for_status()
+        for chunk in r.iter_content(_DOWNLOAD_CHUNK_SIZE):
+            output_file.write(chunk)
+        return False
 
     def download_original_file(self, name, output_file):
         """Download the image in its original Nifti format (compressed or not).
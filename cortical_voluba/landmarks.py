@@ -0,0 +1,220 @@
+# Copyright 2020 CEA
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# This file is part of cortical-voluba.
+#
+# cortical-voluba is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# cortical-voluba is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License
+# for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with cortical-voluba. If not, see <https://www.gnu.org/licenses/>.
+
+"""Least-squares fitting of linear transformations to pairs of landmarks.
+
+The fits are used to refine the affine transformation that initializes the
+non-linear registration, and to report on the consistency of the landmarks
+before the (lengthy) registration is started.
+
+All points are given as arrays of shape ``(N, 3)``, transformations as 4×4
+affine matrices that map source points onto target points.
+"""
+
+import logging
+
+import numpy
+
+
+logger = logging.getLogger(__name__)
+
+DEGREES_OF_FREEDOM = {
+    'rigid': 6,
+    'affine': 12,
+}
+
+MIN_POINTS = {
+    model: -(-2 * dof // 3) for model, dof in DEGREES_OF_FREEDOM.items()
+}
+"""Minimum number of landmark pairs for fitting each kind of model.
+
+Each landmark pair gives 3 equations, at least twice as many equations as
+degrees of freedom are required. With fewer landmarks the fit is (nearly)
+exact, so the residuals cannot reveal the erroneous landmarks.
+"""
+
+OUTLIER_FACTOR = 3.0
+"""Residuals larger than this many times the median residual are outliers."""
+
+MIN_OUTLIER_RESIDUAL = 0.1
+"""Residuals (in millimetres) below which a point is never an outlier."""
+
+
+def fit_rigid(source_points, target_points):
+    """Fit a rigid transformation (rotation and translation).
+
+    This is the closed-form solution of Kabsch / Umeyama, based on the
+    singular value decomposition of the cross-covariance of the points.
+    """
+    source_centroid = source_points.mean(axis=0)
+    target_centroid = target_points.mean(axis=0)
+    covariance = ((target_points - target_centroid).T
+                  @ (source_points - source_centroid))
+    u, _, vt = numpy.linalg.svd(covariance)
+    # Prevent reflections
+    correction = numpy.diag([1, 1, numpy.sign(numpy.linalg.det(u @ vt))])
+    rotation = u @ correction @ vt
+    matrix = numpy.eye(4)
+    matrix[:3, :3] = rotation
+    matrix[:3, 3] = target_centroid - rotation @ source_centroid
+    return matrix
+
+
+def fit_affine(source_points, target_points):
+    """Fit a general affine transformation by linear least squares."""
+    homogeneous_source = numpy.c_[source_points,
+                                  numpy.ones(len(source_points))]
+    solution, _, rank, _ = numpy.linalg.lstsq(homogeneous_source,
+                                              target_points, rcond=None)
+    if rank < 4:
+        raise numpy.linalg.LinAlgError('the landmarks are coplanar')
+    matrix = numpy.eye(4)
+    matrix[:3, :] = solution.T
+    return matrix
+
+
+FIT_FUNCTIONS = {
+    'rigid': fit_rigid,
+    'affine': fit_affine,
+}
+
+
+def residuals(source_points, target_points, matrix):
+    """Euclidean distance between the transformed source and the target."""
+    transformed = source_points @ matrix[:3, :3].T + matrix[:3, 3]
+    return numpy.linalg.norm(transformed - target_points, axis=1)
+
+
+def fit_with_outlier_rejection(source_points, target_points, model='affine'):
+    """Fit a transformation, iteratively discarding outlier landmarks.
+
+    At each iteration, the landmark with the largest residual is discarded if
+    that residual is larger than `OUTLIER_FACTOR` times the median residual
+    (and larger than `MIN_OUTLIER_RESIDUAL`), as long as enough landmarks
+    remain to fit the model.
+
+    The affine model falls back to the rigid model if there are not enough
+    landmarks, or if they are coplanar.
+
+    :param source_points: array of shape (N, 3)
+    :param target_points: array of shape (N, 3)
+    :param str model: either ``'rigid'`` or ``'affine'``
+    :returns: a tuple ``(matrix, model, inliers)``, where inliers is a boolean
+              array of shape (N,); matrix is None if the landmarks are not
+              sufficient to fit any model
+    """
+    source_points = numpy.asarray(source_points, dtype=float)
+    target_points = numpy.asarray(target_points, dtype=float)
+    inliers = numpy.ones(len(source_points), dtype=bool)
+    if model == 'affine' and len(source_points) < MIN_POINTS['affine']:
+        model = 'rigid'
+    if len(source_points) < MIN_POINTS[model]:
+        return None, None, inliers
+    while True:
+        try:
+            matrix = FIT_FUNCTIONS[model](source_points[inliers],
+                                          target_points[inliers])
+        except numpy.linalg.LinAlgError:
+            assert model == 'affine'
+            logger.info('Cannot fit an affine model to the landmarks, '
+                        'falling back to a rigid model')
+            model = 'rigid'
+            continue
+        if numpy.count_nonzero(inliers) <= MIN_POINTS[model]:
+            break
+        inlier_residuals = residuals(source_points[inliers],
+                                     target_points[inliers], matrix)
+        worst = numpy.argmax(inlier_residuals)
+        threshold = max(OUTLIER_FACTOR * numpy.median(inlier_residuals),
+                        MIN_OUTLIER_RESIDUAL)
+        if inlier_residuals[worst] <= threshold:
+            break
+        inliers[numpy.flatnonzero(inliers)[worst]] = False
+    return matrix, model, inliers
+
+
+def select_refinement_model(num_points, model):
+    """Select the model of the refinement for a number of landmarks.
+
+    The refinement requires at least one landmark more than `MIN_POINTS`,
+    so that an outlier can be rejected. The affine model falls back to the
+    rigid model if there are not enough landmarks.
+
+    :returns: the name of the model, or None if there are not enough
+              landmarks for any model
+    """
+    candidates = [model, 'rigid'] if model == 'affine' else [model]
+    for candidate in candidates:
+        if num_points > MIN_POINTS[candidate]:
+            return candidate
+    return None
+
+
+def refine_transformation(incoming_points, template_points,
+                          incoming_to_template_affine, model='affine'):
+    """Refine an affine transformation to best fit pairs of landmarks.
+
+    A correction is fitted in template space, between the incoming points
+    mapped by incoming_to_template_affine and the template points. The
+    refined transformation is the composition of that correction with
+    incoming_to_template_affine. If there are not enough landmarks (see
+    `select_refinement_model`), the transformation is not changed.
+
+    :returns: a tuple ``(refined_affine, report)``, where report is a
+              JSON-serializable dictionary that describes the fit, including
+              the residuals (in millimetres) of each landmark before and after
+              the refinement
+    """
+    incoming_points = numpy.asarray(incoming_points, dtype=float)
+    template_points = numpy.asarray(template_points, dtype=float)
+    incoming_to_template_affine = numpy.asarray(incoming_to_template_affine)
+    mapped_points = (incoming_points @ incoming_to_template_affine[:3, :3].T
+                     + incoming_to_template_affine[:3, 3])
+    model = select_refinement_model(len(incoming_points), model)
+    if model is None:
+        logger.info('Not enough landmarks (%d) for refining the '
+                    'transformation', len(incoming_points))
+        correction, fitted_model = None, None
+        inliers = numpy.ones(len(incoming_points), dtype=bool)
+    else:
+        correction, fitted_model, inliers = fit_with_outlier_rejection(
+            mapped_points, template_points, model)
+    if correction is None:
+        refined_affine = incoming_to_template_affine
+        correction = numpy.eye(4)
+    else:
+        refined_affine = correction @ incoming_to_template_affine
+    residuals_before = residuals(mapped_points, template_points,
+                                 numpy.eye(4))
+    residuals_after = residuals(mapped_points, template_points, correction)
+    report = {
+        'model': fitted_model,
+        'num_landmarks': len(incoming_points),
+        'outliers': numpy.flatnonzero(~inliers).tolist(),
+        'residuals_before': residuals_before.tolist(),
+        'residuals_after': residuals_after.tolist(),
+        'rms_residual_before': _rms(residuals_before),
+        'rms_residual_after': _rms(residuals_after[inliers]),
+    }
+    return refined_affine, report
+
+
+def _rms(values):
+    if len(values) == 0:
+        return None
+    return float(numpy.sqrt(numpy.mean(numpy.square(values))))
@@ -0,0 +1,434 @@
+# Copyright 2020 CEA
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# This file is part of cortical-voluba.
+#
+# cortical-voluba is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# cortical-voluba is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License
+# for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with cortical-voluba. If not, see <https://www.gnu.org/licenses/>.
+
+
+"""Historical record of the computations, for capacity planning.
+
+Each computation task appends a compact record to an SQLite database when it
+finishes: job type, size of the inputs, cost-relevant parameters, outcome,
+time spent in the queue, duration of each stage, peak memory, and use of the
+download cache. `JobLedger.get_statistics` summarizes the records by job type
+and size bucket, so that the effect of an upgrade of the external tools
+(ANTs, highres-cortex) can be seen by comparing two periods of time.
+
+The computations that wait in a queue are also tracked: the API records each
+submitted computation, and the worker removes it when it starts the
+computation. This gives the position of a waiting computation in its queue
+(see `JobLedger.get_queued`).
+
+The database is written by the workers and the API, it must be on a file
+system that supports the locking of SQLite (i.e. not on NFS).
+"""
+
+import datetime
+import json
+import logging
+import sqlite3
+import time
+
+
+logger = logging.getLogger(__name__)
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    task_id TEXT,
+    job_type TEXT NOT NULL,
+    finished_at TEXT NOT NULL,
+    outcome TEXT NOT NULL,
+    attempt INTEGER NOT NULL DEFAULT 0,
+    input_voxels INTEGER,
+    parameters TEXT,
+    queue TEXT,
+    queue_wait_seconds REAL,
+    total_seconds REAL,
+    stage_seconds TEXT,
+    peak_memory_bytes INTEGER,
+    cache_hits INTEGER,
+    downloads INTEGER
+);
+CREATE INDEX IF NOT EXISTS jobs_finished_at ON jobs (finished_at);
+CREATE TABLE IF NOT EXISTS queued (
+    task_id TEXT PRIMARY KEY,
+    job_type TEXT NOT NULL,
+    queue TEXT NOT NULL,
+    submitted_at REAL NOT NULL,
+    resource_estimate TEXT
+);
+'''
+
+SIZE_BUCKETS = [
+    (10 ** 6, '<1M'),
+    (10 ** 7, '1M-10M'),
+    (10 ** 8, '10M-100M'),
+    (10 ** 9, '100M-1G'),
+    (None, '>1G'),
+]
+"""Size buckets of the statistics, by number of input voxels."""
+
+PERCENTILES = (50, 90, 99)
+
+QUEUED_MAX_AGE = 24 * 3600
+"""Age (in seconds) after which a queued computation is ignored.
+
+A queued computation is removed when a worker starts it or when it is
+cancelled through the API. A computation that is lost in between (e.g.
+purged from the broker) would otherwise stay ahead of the others forever.
+"""
+
+RECORDED_PARAMETERS = ('registration_preset', 'output_data_type',
+                       'keep_scaling')
+"""Parameters of the computations that are recorded in the ledger.
+
+The names of the images are not recorded, only the parameters that have an
+influence on the cost of the computation.
+"""
+
+
+def get_size_bucket(input_voxels):
+    """Get the label of the size bucket for a number of input voxels."""
+    if input_voxels is None:
+        return 'unknown'
+    for max_voxels, label in SIZE_BUCKETS:
+        if max_voxels is None or input_voxels < max_voxels:
+            return label
+
+
+def percentile(sorted_values, q):
+    """Compute a percentile by linear interpolation between the values.
+
+    :param list sorted_values: non-empty list of values in increasing order
+    :param float q: the percentile, between 0 and 100
+    """
+    position = (len(sorted_values) - 1) * q / 100
+    lower = int(position)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    fraction = position - lower
+    return (sorted_values[lower] * (1 - fraction)
+            + sorted_values[upper] * fraction)
+
+
+def summarize(values):
+    """Summarize a list of values by their percentiles (None if empty)."""
+    values = sorted(v for v in values if v is not None)
+    if not values:
+        return None
+    return {'p{0}'.format(q): percentile(values, q) for q in PERCENTILES}
+
+
+def _to_utc_naive(dt):
+    # The times are recorded as naive UTC times
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return dt
+
+
+class JobLedger:
+    """SQLite database of the finished computations.
+
+    :param str path: path of the database file (it is created if needed, on
+           the first record)
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def __repr__(self):
+        return '<JobLedger: {0}>'.format(self.path)
+
+    def _connect(self, read_only=False):
+        if read_only:
+            # Raises sqlite3.OperationalError if the database does not exist
+            return sqlite3.connect('file:{0}?mode=ro'.format(self.path),
+                                   uri=True, timeout=30)
+        connection = sqlite3.connect(self.path, timeout=30)
+        # Readers do not block the writers (and vice versa) in WAL mode
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.executescript(_SCHEMA)
+        return connection
+
+    def record(self, job_type, outcome, task_id=None, attempt=0,
+               input_voxels=None, parameters=None, queue=None,
+               queue_wait_seconds=None, total_seconds=None,
+               stage_seconds=None, peak_memory_bytes=None, cache_hits=None,
+               downloads=None):
+        """Append the record of a finished computation.
+
+        :param str job_type: the type of computation (e.g. ``'alignment'``)
+        :param str outcome: ``'success'``, ``'failure'``, or ``'cancelled'``
+        :param int attempt: number of previous attempts (retries) of the task
+        :param dict parameters: the parameters of the computation, only the
+               `RECORDED_PARAMETERS` are kept
+        :param dict stage_seconds: durations of the stages, in seconds
+        """
+        if parameters is not None:
+            parameters = {key: parameters[key] for key in RECORDED_PARAMETERS
+                          if key in parameters}
+        connection = self._connect()
+        try:
+            with connection:
+                connection.execute(
+                    'INSERT INTO jobs VALUES '
+                    '(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', (
+                        task_id,
+                        job_type,
+                        datetime.datetime.utcnow().isoformat(),
+                        outcome,
+                        attempt,
+                        input_voxels,
+                        json.dumps(parameters),
+                        queue,
+                        queue_wait_seconds,
+                        total_seconds,
+                        json.dumps(stage_seconds or {}),
+                        peak_memory_bytes,
+                        cache_hits,
+                        downloads,
+                    ))
+        finally:
+            connection.close()
+
+    def record_queued(self, task_id, job_type, queue, submitted_at,
+                      resource_estimate=None):
+        """Record a computation that has been sent to a queue.
+
+        :param str queue: the name of the queue
+        :param float submitted_at: POSIX timestamp of the submission
+        :param dict resource_estimate: the estimate recorded at submission
+               (see `cortical_voluba.resource_estimates`), or None
+        """
+        connection = self._connect()
+        try:
+            with connection:
+                connection.execute(
+                    'INSERT OR REPLACE INTO queued VALUES (?, ?, ?, ?, ?)',
+                    (task_id, job_type, queue, submitted_at,
+                     json.dumps(resource_estimate)))
+        finally:
+            connection.close()
+
+    def remove_queued(self, task_id):
+        """Remove a computation that has started or has been cancelled.
+
+        The queued computations older than `QUEUED_MAX_AGE` are removed at
+        the same time.
+        """
+        connection = self._connect()
+        try:
+            with connection:
+                connection.execute(
+                    'DELETE FROM queued WHERE task_id = ? OR submitted_at < ?',
+                    (task_id, time.time() - QUEUED_MAX_AGE))
+        finally:
+            connection.close()
+
+    def get_queued(self, task_id):
+        """Get a computation that waits in its queue.
+
+        :returns: a dictionary with the keys ``job_type``, ``queue``,
+                  ``submitted_at``, ``resource_estimate``, and ``position``
+                  (the number of computations that were submitted to the same
+                  queue before it and have not started yet), or None if the
+                  computation is not queued
+        :rtype: dict
+        """
+        try:
+            connection = self._connect(read_only=True)
+        except sqlite3.OperationalError:
+            return None
+        min_submitted_at = time.time() - QUEUED_MAX_AGE
+        try:
+            row = connection.execute(
+                'SELECT job_type, queue, submitted_at, resource_estimate '
+                'FROM queued WHERE task_id = ? AND submitted_at >= ?',
+                (task_id, min_submitted_at),
+            ).fetchone()
+            if row is None:
+                return None
+            position, = connection.execute(
+                'SELECT COUNT(*) FROM queued WHERE queue = ? '
+                'AND submitted_at >= ? AND (submitted_at < ? '
+                'OR (submitted_at = ? AND task_id < ?))',
+                (row[1], min_submitted_at, row[2], row[2], task_id),
+            ).fetchone()
+        except sqlite3.OperationalError:
+            # The table is created when the first computation is queued
+            return None
+        finally:
+            connection.close()
+        return {
+            'job_type': row[0],
+            'queue': row[1],
+            'submitted_at': row[2],
+            'resource_estimate': json.loads(row[3]),
+            'position': position,
+        }
+
+    def get_queue_depths(self, queues):
+        """Get the number of computations that wait in each queue.
+
+        :param list queues: names of the queues
+        :returns: a dictionary that maps each queue name to its number of
+                  queued computations
+        :rtype: dict
+        """
+        depths = {queue: 0 for queue in queues}
+        try:
+            connection = self._connect(read_only=True)
+        except sqlite3.OperationalError:
+            return depths
+        try:
+            for queue, depth in connection.execute(
+                    'SELECT queue, COUNT(*) FROM queued '
+                    'WHERE submitted_at >= ? GROUP BY queue',
+                    (time.time() - QUEUED_MAX_AGE,)):
+                if queue in depths:
+                    depths[queue] = depth
+        except sqlite3.OperationalError:
+            # The table is created when the first computation is queued
+            pass
+        finally:
+            connection.close()
+        return depths
+
+    def get_history(self, limit):
+        """Get the most recent successful computations.
+
+        :param int limit: maximum number of records
+        :returns: a list of dictionaries with the keys ``job_type``,
+                  ``input_voxels``, ``queue``, ``queue_wait_seconds``,
+                  ``total_seconds`` and ``stage_seconds``, most recent first
+        :rtype: list
+        """
+        try:
+            connection = self._connect(read_only=True)
+        except sqlite3.OperationalError:
+            return []
+        try:
+            rows = connection.execute(
+                'SELECT job_type, input_voxels, queue, queue_wait_seconds, '
+                'total_seconds, stage_seconds FROM jobs WHERE outcome = ? '
+                'ORDER BY finished_at DESC LIMIT ?', ('success', limit),
+            ).fetchall()
+        finally:
+            connection.close()
+        return [{
+            'job_type': row[0],
+            'input_voxels': row[1],
+            'queue': row[2],
+            'queue_wait_seconds': row[3],
+            'total_seconds': row[4],
+            'stage_seconds': json.loads(row[5]),
+        } for row in rows]
+
+    def get_queue_waits(self, queues, limit):
+        """Get the recent waiting times of the computations in queues.
+
+        :param list queues: names of the queues
+        :param int limit: maximum number of waits per queue
+        :returns: a dictionary that maps each queue name to a list of
+                  ``(finished_at, queue_wait_seconds)`` tuples, most recent
+                  first, where finished_at is an ISO 8601 UTC time
+        :rtype: dict
+        """
+        waits = {queue: [] for queue in queues}
+        try:
+            connection = self._connect(read_only=True)
+        except sqlite3.OperationalError:
+            return waits
+        try:
+            for queue in queues:
+                waits[queue] = [tuple(row) for row in connection.execute(
+                    'SELECT finished_at, queue_wait_seconds FROM jobs '
+                    'WHERE queue = ? AND queue_wait_seconds IS NOT NULL '
+                    'ORDER BY finished_at DESC LIMIT ?', (queue, limit),
+                )]
+        finally:
+            connection.close()
+        return waits
+
+    def get_statistics(self, job_type=None, since=None, until=None):
+        """Summarize the records by job type and size bucket.
+
+        The durations and memory are summarized over the successful jobs
+        only.
+
+        :param str job_type: only summarize the jobs of this type
+        :param datetime.datetime since: only summarize the jobs that have
+               finished at or after this time (UTC)
+        :param datetime.datetime until: only summarize the jobs that have
+               finished before this time (UTC)
+        :returns: a list of dictionaries, one per job type and size bucket
+        :rtype: list
+        """
+        conditions = []
+        arguments = []
+        if job_type is not None:
+            conditions.append('job_type = ?')
+            arguments.append(job_type)
+        if since is not None:
+            conditions.append('finished_at >= ?')
+            arguments.append(_to_utc_naive(since).isoformat())
+        if until is not None:
+            conditions.append('finished_at < ?')
+            arguments.append(_to_utc_naive(until).isoformat())
+        query = ('SELECT job_type, input_voxels, outcome, queue_wait_seconds, '
+                 'total_seconds, stage_seconds, peak_memory_bytes, '
+                 'cache_hits, downloads FROM jobs')
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        try:
+            connection = self._connect(read_only=True)
+        except sqlite3.OperationalError:
+            logger.info('The job ledger %s does not exist yet', self.path)
+            return []
+        try:
+            rows = connection.execute(query, arguments).fetchall()
+        finally:
+            connection.close()
+
+        groups = {}
+        for row in rows:
+            key = (row[0], get_size_bucket(row[1]))
+            groups.setdefault(key, []).append(row)
+        bucket_order = [label for _, label in SIZE_BUCKETS] + ['unknown']
+        statistics = []
+        for job_type, size_bucket in sorted(
+                groups, key=lambda k: (k[0], bucket_order.index(k[1]))):
+            group = groups[(job_type, size_bucket)]
+            outcomes = {}
+            for row in group:
+                outcomes[row[2]] = outcomes.get(row[2], 0) + 1
+            successes = [row for row in group if row[2] == 'success']
+            stage_seconds = {}
+            for row in successes:
+                for stage, seconds in json.loads(row[5]).items():
+                    stage_seconds.setdefault(stage, []).append(seconds)
+            downloads = sum(row[8] or 0 for row in group)
+            statistics.append({
+                'job_type': job_type,
+                'size_bucket': size_bucket,
+                'count': len(group),
+                'outcomes': outcomes,
+                'queue_wait_seconds': summarize(row[3] for row in group),
+                'total_seconds': summarize(row[4] for row in successes),
+                'stage_seconds': {stage: summarize(values)
+                                  for stage, values in stage_seconds.items()},
+                'peak_memory_bytes': summarize(row[6] for row in successes),
+                'cache_hit_rate': (sum(row[7] or 0 for row in group)
+                                   / downloads if downloads else None),
+            })
+        return statistics
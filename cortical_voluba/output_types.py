@@ -0,0 +1,34 @@
+# Copyright 2020 CEA
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# This file is part of cortical-voluba.
+#
+# cortical-voluba is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# cortical-voluba is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License
+# for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with cortical-voluba. If not, see <https://www.gnu.org/licenses/>.
+
+"""Data types of the images written by the resampling.
+
+This module has no dependencies beyond the standard library, so that the API
+can validate the ``output_data_type`` parameter without importing the worker
+code (see `cortical_voluba.alignment.transform_image`).
+"""
+
+OUTPUT_DATA_TYPES = ('input', 'float32')
+"""Accepted values of the output data type.
+
+``input`` keeps the data type of the input image (see
+`cortical_voluba.alignment.cast_to_input_data_type`), ``float32`` avoids any
+loss of precision.
+"""
+
+DEFAULT_OUTPUT_DATA_TYPE = 'input'
@@ -0,0 +1,193 @@
+# Copyright 2020 CEA
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# This file is part of cortical-voluba.
+#
+# cortical-voluba is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# cortical-voluba is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License
+# for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with cortical-voluba. If not, see <https://www.gnu.org/licenses/>.
+
+"""Management of the external processes launched by the worker tasks.
+
+The external tools (``bv_env``, capsul, ANTs) are each started in their own
+process group, so that the whole tree of processes that they spawn can be
+terminated at once when a computation is cancelled.
+"""
+
+import contextlib
+import logging
+import os
+import signal
+import subprocess
+import threading
+import time
+
+from cortical_voluba import tracing
+
+
+logger = logging.getLogger(__name__)
+
+TERMINATION_GRACE_PERIOD = 10
+"""Time (in seconds) given to a process group to exit after SIGTERM."""
+
+# Lists that collect the resource usage of the commands (see record_usage)
+_usage_records = []
+_usage_lock = threading.Lock()
+
+
+class TaskCancelledError(Exception):
+    """Raised within a task when its cancellation has been requested."""
+
+
+def terminate_process_group(process, grace_period=TERMINATION_GRACE_PERIOD):
+    """Terminate a process that was started in its own process group.
+
+    SIGTERM is first sent to the whole process group, which is then killed
+    with SIGKILL if the leader has not exited after ``grace_period`` seconds.
+
+    :param subprocess.Popen process: a process started with
+           ``start_new_session=True``
+    :param float grace_period: time given to the process to exit cleanly
+    """
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+    except ProcessLookupError:
+        return
+    try:
+        process.wait(grace_period)
+    except subprocess.TimeoutExpired:
+        logger.warning('Process %d did not exit after SIGTERM, killing it',
+                       process.pid)
+    # Also get rid of any grandchildren that ignored SIGTERM.
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+    process.wait()
+
+
+def check_call(command, **kwargs):
+    """Run a command in a new process group and wait for it to complete.
+
+    This is a replacement for `subprocess.check_call`. If waiting is
+    interrupted by an exception (typically `TaskCancelledError`), the whole
+    process group of the command is terminated before the exception is
+    propagated. The resource usage of the command is reported to the
+    active `record_usage` blocks.
+
+    :raises subprocess.CalledProcessError: if the command exits with a
+            non-zero status
+    """
+    with tracing.Span('process ' + os.path.basename(command[0])) as span:
+        process = subprocess.Popen(command, start_new_session=True, **kwargs)
+        start_time = time.monotonic()
+        try:
+            _, status, rusage = os.wait4(process.pid, 0)
+        except BaseException:
+            logger.info('Terminating process %d (%s)', process.pid,
+                        command[0])
+            terminate_process_group(process)
+            raise
+        span.set_tag('max_rss_bytes', rusage.ru_maxrss * 1024)
+        span.set_tag('cpu_seconds', rusage.ru_utime + rusage.ru_stime)
+    if os.WIFSIGNALED(status):
+        returncode = -os.WTERMSIG(status)
+    else:
+        returncode = os.WEXITSTATUS(status)
+    # The process has been reaped, do not let Popen wait for it again
+    process.returncode = returncode
+    usage = {
+        'command': os.path.basename(command[0]),
+        'wall_seconds': time.monotonic() - start_time,
+        'user_seconds': rusage.ru_utime,
+        'system_seconds': rusage.ru_stime,
+        'max_rss_bytes': rusage.ru_maxrss * 1024,  # in KiB on Linux
+    }
+    with _usage_lock:
+        for records in _usage_records:
+            records.append(usage)
+    if returncode:
+        raise subprocess.CalledProcessError(returncode, command)
+
+
+@contextlib.contextmanager
+def record_usage():
+    """Collect the resource usage of the commands run by `check_call`.
+
+    The usage of the commands that terminate within the block is collected,
+    including those that are run by other threads of the process.
+
+    :returns: a context manager that yields a list, to which a dictionary is
+              appended for each command (with the keys ``command``,
+              ``wall_seconds``, ``user_seconds``, ``system_seconds``, and
+              ``max_rss_bytes``)
+    """
+    records = []
+    with _usage_lock:
+        _usage_records.append(records)
+    try:
+        yield records
+    finally:
+        with _usage_lock:
+            _usage_records.remove(records)
+
+
+def reset_peak_rss():
+    """Reset the peak resident memory of the current process.
+
+    This is supported by Linux since version 4.0, elsewhere it does nothing.
+    """
+    with contextlib.suppress(OSError):
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+
+
+def get_peak_rss():
+    """Get the peak resident memory of the current process, in bytes.
+
+    :returns: the peak since the last call to `reset_peak_rss`, or None if
+              the information is not available (it is read from /proc).
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024  # given in kB
+    except OSError:
+        pass
+    return None
+
+
+@contextlib.contextmanager
+def cancellable():
+    """Raise `TaskCancelledError` if SIGTERM is received within this block.
+
+    Celery sends SIGTERM to the pool process that runs a task when the task
+    is revoked with ``terminate=True``. Turning the signal into an exception
+    lets the task terminate its subprocesses and clean up its scratch
+    directory before giving control back to Celery.
+
+    Signal handlers can only be installed from the main thread, elsewhere
+    this context manager does nothing.
+    """
+    if threading.current_thread() is not threading.main_thread():
+        yield
+        return
+
+    def handle_sigterm(signum, frame):
+        raise TaskCancelledError()
+
+    previous_handler = signal.signal(signal.SIGTERM, handle_sigterm)
+    try:
+        yield
+    finally:
+        signal.signal(signal.SIGTERM, previous_handler)
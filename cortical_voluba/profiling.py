@@ -0,0 +1,275 @@
+# Copyright 2020 CEA
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# This file is part of cortical-voluba.
+#
+# cortical-voluba is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# cortical-voluba is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License
+# for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with cortical-voluba. If not, see <https://www.gnu.org/licenses/>.
+
+
+"""Opt-in profiling of the computation tasks.
+
+When profiling is enabled for a computation (see `is_enabled`), the task runs
+under `SamplingProfiler`, which periodically samples the Python stacks of all
+the threads of the worker process. This shows where the time goes on the
+Python side (decompression, downloads and uploads, loading of images), which
+complements the resource usage of the external commands.
+
+The artefacts of each profiled task are saved in a sub-directory of the
+profile directory (see `get_profile_dir`), named after the id of the task:
+
+- ``profile.folded``: the sampled stacks in the folded format, one stack per
+  line with its number of samples, which can be rendered with flame graph
+  tools (e.g. ``flamegraph.pl`` or speedscope);
+- ``report.json``: the duration of the stages, the resource usage of the
+  external commands, and the peak memory of the task.
+
+The profiles are removed after a configurable duration, or earlier if their
+total size exceeds a limit (see `remove_expired`).
+"""
+
+import collections
+import datetime
+import json
+import logging
+import os
+import shutil
+import sys
+import threading
+import time
+
+from flask import current_app
+
+
+logger = logging.getLogger(__name__)
+
+PROFILE_FILE_NAME = 'profile.folded'
+REPORT_FILE_NAME = 'report.json'
+ARTEFACT_FILE_NAMES = (PROFILE_FILE_NAME, REPORT_FILE_NAME)
+
+# Deeper stacks are truncated to their outermost frames
+MAX_STACK_DEPTH = 128
+
+
+def is_enabled(params):
+    """Test if a computation must be profiled.
+
+    :param dict params: the parameters of the computation, where ``profile``
+           is set if profiling was requested with the computation
+    """
+    return bool(current_app.config.get('PROFILE_TASKS')
+                or (current_app.config.get('ALLOW_PROFILE_REQUESTS')
+                    and params.get('profile')))
+
+
+def get_profile_dir():
+    """Get the directory of the profiles (PROFILE_DIR)."""
+    return (current_app.config.get('PROFILE_DIR')
+            or os.path.join(current_app.instance_path, 'profiles'))
+
+
+def _frame_label(frame):
+    code = frame.f_code
+    return '{0} ({1}:{2})'.format(code.co_name,
+                                  os.path.basename(code.co_filename),
+                                  code.co_firstlineno)
+
+
+def fold_stack(frame, thread_name):
+    """Represent the stack of a thread as a line of the folded format.
+
+    The frames are named after their function, and listed from the outermost
+    to the innermost, after the name of the thread.
+    """
+    labels = []
+    while frame is not None:
+        labels.append(_frame_label(frame))
+        frame = frame.f_back
+    labels.append(thread_name)
+    labels.reverse()
+    return ';'.join(labels[:MAX_STACK_DEPTH])
+
+
+class SamplingProfiler:
+    """Statistical profiler of the Python code of the current process.
+
+    A background thread samples the stacks of all the other threads at a
+    regular interval, which has a small and predictable overhead, unlike
+    deterministic profilers (`cProfile`). The threads that are waiting (e.g.
+    for a subprocess or a network transfer) are sampled too, so the profile
+    shows the wall-clock time.
+
+    :param float interval: interval between two samples, in seconds
+    """
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.stack_counts = collections.Counter()
+        self.sample_count = 0
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run,
+                                        name='SamplingProfiler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        self._thread.join()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def _run(self):
+        own_ident = threading.get_ident()
+        while not self._stop_event.wait(self.interval):
+            thread_names = {thread.ident: thread.name
+                            for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own_ident:
+                    continue
+                thread_name = thread_names.get(ident, 'thread-{0}'
+                                               .format(ident))
+                self.stack_counts[fold_stack(frame, thread_name)] += 1
+            self.sample_count += 1
+
+    def write_folded(self, f, max_bytes=None):
+        """Write the sampled stacks in the folded format.
+
+        :param f: text file opened for writing
+        :param int max_bytes: if set, the least frequent stacks are left out
+               so that the output does not exceed this size
+        :returns: True if the output was truncated
+        """
+        written_bytes = 0
+        for stack, count in self.stack_counts.most_common():
+            line = '{0} {1}\n'.format(stack, count)
+            line_bytes = len(line.encode('utf-8'))
+            if (max_bytes is not None
+                    and written_bytes + line_bytes > max_bytes):
+                return True
+            f.write(line)
+            written_bytes += line_bytes
+        return False
+
+
+def save_profile(profile_dir, task_id, profiler, report, max_bytes=None):
+    """Save the artefacts of a profiled task.
+
+    :param str profile_dir: the profile directory (see `get_profile_dir`)
+    :param str task_id: id of the task, used as the name of its directory
+    :param SamplingProfiler profiler: the stopped profiler of the task
+    :param dict report: JSON-serializable information about the task (stage
+           durations, resource usage...), which is completed with the
+           sampling information
+    :param int max_bytes: maximum size of the profile
+    :returns: the directory of the artefacts
+    """
+    task_dir = os.path.join(profile_dir, task_id)
+    os.makedirs(task_dir, exist_ok=True)
+    with open(os.path.join(task_dir, PROFILE_FILE_NAME), 'w') as f:
+        truncated = profiler.write_folded(f, max_bytes=max_bytes)
+    if truncated:
+        logger.warning('The profile of task %s was truncated to %d bytes',
+                       task_id, max_bytes)
+    report = dict(
+        report,
+        task_id=task_id,
+        saved_at=datetime.datetime.utcnow().replace(
+            microsecond=0).isoformat(),
+        sampling_interval=profiler.interval,
+        sample_count=profiler.sample_count,
+        profile_truncated=truncated,
+    )
+    with open(os.path.join(task_dir, REPORT_FILE_NAME), 'w') as f:
+        json.dump(report, f, indent=2)
+    return task_dir
+
+
+def _get_size(path):
+    size = 0
+    for entry in os.scandir(path):
+        if entry.is_file():
+            size += entry.stat().st_size
+    return size
+
+
+def list_profiles(profile_dir):
+    """List the saved profiles, the most recent first.
+
+    :returns: a list of dictionaries, with the keys ``task_id``,
+              ``task_name``, ``job_type``, ``outcome``, ``saved_at``,
+              ``total_seconds``, and ``size_bytes`` (the values are None if
+              the report cannot be read)
+    """
+    profiles = []
+    try:
+        entries = list(os.scandir(profile_dir))
+    except FileNotFoundError:
+        return profiles
+    for entry in entries:
+        if not entry.is_dir():
+            continue
+        try:
+            with open(os.path.join(entry.path, REPORT_FILE_NAME)) as f:
+                report = json.load(f)
+            size_bytes = _get_size(entry.path)
+        except FileNotFoundError:  # being saved or removed concurrently
+            continue
+        except ValueError:
+            report = {}
+        profile = {key: report.get(key) for key in (
+            'task_name', 'job_type', 'outcome', 'saved_at', 'total_seconds')}
+        profile['task_id'] = entry.name
+        profile['size_bytes'] = size_bytes
+        profiles.append(profile)
+    profiles.sort(key=lambda profile: profile['saved_at'] or '',
+                  reverse=True)
+    return profiles
+
+
+def remove_expired(profile_dir, max_age, max_total_bytes=None):
+    """Enforce the retention policy of the profiles.
+
+    :param str profile_dir: the profile directory
+    :param float max_age: the profiles older than this age (in seconds) are
+           removed
+    :param int max_total_bytes: if set, the oldest profiles are removed
+           until the total size of the profiles is below this limit
+    """
+    try:
+        entries = [entry for entry in os.scandir(profile_dir)
+                   if entry.is_dir()]
+    except FileNotFoundError:
+        return
+    limit = time.time() - max_age
+    profiles = []
+    for entry in entries:
+        try:
+            profiles.append((entry.stat().st_mtime, _get_size(entry.path),
+                             entry.path))
+        except OSError:  # removed concurrently
+            continue
+    profiles.sort()
+    total_bytes = sum(size for _, size, _ in profiles)
+    for mtime, size, path in profiles:
+        if (mtime >= limit and (max_total_bytes is None
+                                or total_bytes <= max_total_bytes)):
+            break
+        logger.info('Removing the expired profile in %s', path)
+        shutil.rmtree(path, ignore_errors=True)
+        total_bytes -= size
@@ -0,0 +1,277 @@
+# Copyright 2020 CEA
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# This file is part of cortical-voluba.
+#
+# cortical-voluba is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# cortical-voluba is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License
+# for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with cortical-voluba. If not, see <https://www.gnu.org/licenses/>.
+
+"""Engines that run the ANTs registration and resampling.
+
+Two backends are available, they are selected by the
+``REGISTRATION_BACKEND`` configuration value:
+
+``ants-cli``
+    Runs the ``antsRegistration`` and ``antsApplyTransforms`` command-line
+    tools in a subprocess. This is the default.
+
+``antspy``
+    Runs ANTs in-process through the public API of ANTsPy (the optional
+    ``antspyx`` package, installed by the ``antspy`` extra). This saves the
+    startup of a process, and an instance of the backend keeps the images
+    and transforms that it has used in memory, so that the resampling that
+    follows a registration does not read them again. Note that a
+    cancellation request only takes effect after ANTs returns control to
+    Python.
+
+Both backends run the same SyN registration with the same metric and
+iterations. ANTsPy derives the shrink factors and smoothing of the levels
+from their number, in the same way as
+`cortical_voluba.registration_schedule.plan_schedule`, but it applies its own
+convergence criterion, so the deformations can differ slightly between the
+backends. The deformation fields of the registration are always written to
+``<output_prefix>1Warp.nii.gz`` and ``<output_prefix>1InverseWarp.nii.gz``.
+"""
+
+import logging
+import os
+import re
+import shutil
+
+from cortical_voluba import processes
+from cortical_voluba import registration_schedule
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BACKEND = 'ants-cli'
+
+# A transform of the ANTs command line that is used inverted
+_INVERTED_TRANSFORM_RE = re.compile(r'^\[(.*),\s*1\s*\]$')
+
+
+def registration_arguments(fixed, moving, initial_moving_transform, schedule,
+                           output_prefix):
+    """Arguments of antsRegistration for the non-linear registration.
+
+    :param fixed: fixed image (incoming depth map)
+    :param moving: moving image (template depth map)
+    :param str initial_moving_transform: path to an ITK affine transform file
+           from the moving to the fixed image, it is used inverted.
+    :param dict schedule: schedule of the registration (see
+           `cortical_voluba.registration_schedule.plan_schedule`)
+    :param str output_prefix: prefix of the output transform files
+    """
+    return [
+        '--verbose', '1',
+        '--float', '1',
+        '--dimensionality', '3',
+        '--initial-moving-transform',
+        '[{0},1]'.format(initial_moving_transform),
+        '--metric', 'MeanSquares[{0},{1}]'.format(fixed, moving),
+        # TODO add landmark-based metric
+        '--transform', 'SyN[0.1,3,0]',
+    ] + registration_schedule.to_ants_arguments(schedule) + [
+        '--output', output_prefix,
+    ]
+
+
+def apply_transforms_arguments(input_image, reference_image, output_image,
+                               transforms, default_value=0):
+    """Arguments of antsApplyTransforms for a linear resampling.
+
+    :param list transforms: transform files, in the order of the ANTs
+           command line (i.e. the last transform is applied first)
+    """
+    arguments = [
+        '--dimensionality', '3',
+        '--float', '1',
+        '--verbose', '1',
+        '--input', input_image,
+        '--reference-image', reference_image,
+        '--interpolation', 'Linear',
+        '--default-value', str(default_value),
+        '--output', output_image,
+    ]
+    for transform in transforms:
+        arguments += ['--transform', transform]
+    return arguments
+
+
+class RegistrationBackend:
+    """Interface of the registration backends."""
+    name = None
+
+    def register(self, fixed_path, moving_path, initial_moving_transform,
+                 schedule, output_prefix, work_dir):
+        """Estimate the deformation of the moving image onto the fixed image.
+
+        See `registration_arguments` for the meaning of the parameters.
+        """
+        raise NotImplementedError
+
+    def apply_transforms(self, input_path, reference_path, output_path,
+                         transforms, work_dir):
+        """Resample an image onto the grid of the reference image.
+
+        See `apply_transforms_arguments` for the meaning of the parameters.
+        """
+        raise NotImplementedError
+
+
+class AntsCliBackend(RegistrationBackend):
+    """Run the ANTs command-line tools in a subprocess."""
+    name = 'ants-cli'
+
+    def register(self, fixed_path, moving_path, initial_moving_transform,
+                 schedule, output_prefix, work_dir):
+        command = ['antsRegistration'] + registration_arguments(
+            fixed_path, moving_path, initial_moving_transform, schedule,
+            output_prefix)
+        logger.debug('Running %s with cwd=%s', command, work_dir)
+        processes.check_call(command, cwd=work_dir)
+
+    def apply_transforms(self, input_path, reference_path, output_path,
+                         transforms, work_dir):
+        command = ['antsApplyTransforms'] + apply_transforms_arguments(
+            input_path, reference_path, output_path, transforms)
+        logger.debug('Running %s with cwd=%s', command, work_dir)
+        processes.check_call(command, cwd=work_dir)
+
+
+class AntsPyBackend(RegistrationBackend):
+    """Run ANTs in-process, through the public API of ANTsPy.
+
+    The images and transforms are kept in memory by the instance, for as long
+    as it lives: use the same instance for the registration and the
+    resampling of a task, and a new instance for each task. They are
+    identified by the path, modification time and size of their file, so a
+    file that is rewritten between two calls is read again.
+    """
+    name = 'antspy'
+
+    def __init__(self):
+        try:
+            import ants
+        except ImportError as exc:
+            raise RuntimeError('The antspy registration backend requires '
+                               'the antspyx package') from exc
+        self._ants = ants
+        self._images = {}
+        self._transforms = {}
+
+    @staticmethod
+    def _file_key(path):
+        stat = os.stat(path)
+        return (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+
+    def _read_image(self, path):
+        key = self._file_key(path)
+        if key not in self._images:
+            self._images[key] = self._ants.image_read(path)
+        return self._images[key]
+
+    def _read_transform(self, transform):
+        """Read a transform given as on the ANTs command line."""
+        match = _INVERTED_TRANSFORM_RE.match(transform)
+        path = match.group(1) if match else transform
+        key = self._file_key(path) + (bool(match),)
+        if key not in self._transforms:
+            if path.endswith(('.nii', '.nii.gz')):
+                if match:
+                    raise ValueError('a displacement field cannot be used '
+                                     'inverted: {0}'.format(transform))
+                ants_transform = self._ants.transform_from_displacement_field(
+                    self._ants.image_read(path))
+            else:
+                ants_transform = self._ants.read_transform(path)
+                if match:
+                    ants_transform = ants_transform.invert()
+            self._transforms[key] = ants_transform
+        return self._transforms[key]
+
+    def register(self, fixed_path, moving_path, initial_moving_transform,
+                 schedule, output_prefix, work_dir):
+        ants = self._ants
+        # ANTsPy cannot invert the initial transform on the fly (it is used
+        # inverted by the command-line backend), so it is inverted here.
+        inverse_transform_path = os.path.join(
+            work_dir, 'initial_moving_transform_inverse.txt')
+        ants.write_transform(
+            self._read_transform('[{0},1]'.format(initial_moving_transform)),
+            inverse_transform_path)
+        logger.debug('Running the registration in-process with schedule %s',
+                     schedule)
+        result = ants.registration(
+            fixed=self._read_image(fixed_path),
+            moving=self._read_image(moving_path),
+            type_of_transform='SyNOnly',
+            initial_transform=[inverse_transform_path],
+            outprefix=output_prefix,
+            syn_metric='meansquares',
+            # Same as SyN[0.1,3,0] on the command line
+            grad_step=0.1,
+            flow_sigma=3,
+            total_sigma=0,
+            reg_iterations=tuple(schedule['iterations']),
+        )
+        # The names of the outputs depend on the version of ANTsPy
+        forward_warps = [path for path in result['fwdtransforms']
+                         if path.endswith('Warp.nii.gz')
+                         and not path.endswith('InverseWarp.nii.gz')]
+        inverse_warps = [path for path in result['invtransforms']
+                         if path.endswith('InverseWarp.nii.gz')]
+        if len(forward_warps) != 1 or len(inverse_warps) != 1:
+            raise RuntimeError('Unexpected outputs of the ANTsPy '
+                               'registration: {0}'.format(result))
+        for warp_path, suffix in ((forward_warps[0], '1Warp.nii.gz'),
+                                  (inverse_warps[0], '1InverseWarp.nii.gz')):
+            if warp_path != output_prefix + suffix:
+                shutil.move(warp_path, output_prefix + suffix)
+            # Keep the deformation in memory for the resampling
+            self._read_transform(output_prefix + suffix)
+
+    def apply_transforms(self, input_path, reference_path, output_path,
+                         transforms, work_dir):
+        ants = self._ants
+        logger.debug('Running the resampling in-process with transforms %s',
+                     transforms)
+        # Like on the command line, the last transform is applied first
+        transform = ants.compose_ants_transforms(
+            [self._read_transform(transform) for transform in transforms])
+        output_image = ants.apply_ants_transform_to_image(
+            transform,
+            self._read_image(input_path),
+            self._read_image(reference_path),
+            interpolation='linear',
+        )
+        ants.image_write(output_image, output_path)
+
+
+BACKENDS = {
+    AntsCliBackend.name: AntsCliBackend,
+    AntsPyBackend.name: AntsPyBackend,
+}
+
+
+def get_backend(name=DEFAULT_BACKEND):
+    """Get the registration backend of the given name.
+
+    :raises ValueError: if there is no backend of that name
+    """
+    try:
+        backend_class = BACKENDS[name]
+    except KeyError:
+        raise ValueError('unknown registration backend {0!r} (valid '
+                         'backends: {1})'.format(name, ', '.join(BACKENDS)))
+    return backend_class()
@@ -0,0 +1,175 @@
+# Copyright 2020 CEA
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# This file is part of cortical-voluba.
+#
+# cortical-voluba is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# cortical-voluba is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License
+# for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with cortical-voluba. If not, see <https://www.gnu.org/licenses/>.
+
+"""Planning of the multi-resolution schedule of the registration.
+
+The schedule (number of pyramid levels, shrink factors, smoothing and
+iteration caps) is chosen from the size and voxel spacing of the images,
+according to a named preset that trades speed for quality. The default
+preset (``standard``) reproduces the fixed schedule of the original
+registration, regardless of the size of the images.
+
+This module has no dependencies beyond the standard library, so that the API
+can validate preset names without importing the worker code.
+"""
+
+import math
+import re
+
+
+PRESETS = {
+    'fast': {
+        'max_iterations': 100,
+        'min_iterations': 10,
+        'convergence_threshold': 1e-5,
+        'convergence_window': 5,
+        'min_levels': 1,
+        'max_levels': 4,
+        'min_level_size': 32,
+        'downsample_to_template': True,
+    },
+    'balanced': {
+        'max_iterations': 500,
+        'min_iterations': 20,
+        'convergence_threshold': 1e-6,
+        'convergence_window': 10,
+        'min_levels': 1,
+        'max_levels': 4,
+        'min_level_size': 24,
+        'downsample_to_template': True,
+    },
+    'quality': {
+        'max_iterations': 500,
+        'min_iterations': 100,
+        'convergence_threshold': 1e-6,
+        'convergence_window': 10,
+        'min_levels': 1,
+        'max_levels': 5,
+        'min_level_size': 16,
+        'downsample_to_template': False,
+    },
+    'standard': {
+        'max_iterations': 500,
+        'min_iterations': 500,
+        'convergence_threshold': 1e-6,
+        'convergence_window': 10,
+        'min_levels': 3,
+        'max_levels': 3,
+        'min_level_size': 1,
+        'downsample_to_template': False,
+    },
+}
+"""Parameters of the named presets of the registration schedule."""
+
+DEFAULT_PRESET = 'standard'
+
+REFERENCE_VOXEL_COUNT = 128 ** 3
+"""Number of voxels above which the iterations of a level are capped.
+
+A level that has n times more voxels than this reference gets n times fewer
+iterations (but at least the ``min_iterations`` of the preset).
+"""
+
+DOWNSAMPLING_TOLERANCE = 1.5
+"""Minimum ratio of template to image spacing that triggers downsampling."""
+
+
+def downsampling_factors(fixed_voxel_size, template_voxel_size,
+                         preset=DEFAULT_PRESET):
+    """Integer factors for pre-downsampling the fixed image.
+
+    The fixed image is downsampled (by block averaging) to approximately the
+    resolution of the template if it is much finer, because the registration
+    cannot recover details finer than the template anyway.
+
+    :param fixed_voxel_size: voxel size of the fixed image (3 values)
+    :param template_voxel_size: voxel size of the template (3 values)
+    :param str preset: name of the preset
+    :returns: one downsampling factor per axis (1 means no downsampling)
+    :rtype: list of int
+    """
+    if not PRESETS[preset]['downsample_to_template']:
+        return [1, 1, 1]
+    template_spacing = min(template_voxel_size)
+    factors = []
+    for spacing in fixed_voxel_size:
+        ratio = template_spacing / spacing
+        if ratio >= DOWNSAMPLING_TOLERANCE:
+            factors.append(int(math.floor(ratio)))
+        else:
+            factors.append(1)
+    return factors
+
+
+def plan_schedule(fixed_shape, preset=DEFAULT_PRESET):
+    """Plan the multi-resolution schedule of the registration.
+
+    :param fixed_shape: shape of the fixed image, as it is passed to the
+           registration (i.e. after cropping and downsampling)
+    :param str preset: name of the preset
+    :returns: a JSON-serializable dictionary describing the schedule (see
+              `to_ants_arguments`)
+    :rtype: dict
+    """
+    params = PRESETS[preset]
+    fixed_shape = [int(n) for n in fixed_shape[:3]]
+    smallest_dim = min(fixed_shape)
+    num_levels = 1 + int(math.floor(
+        math.log2(max(smallest_dim / params['min_level_size'], 1))))
+    num_levels = max(params['min_levels'],
+                     min(num_levels, params['max_levels']))
+    shrink_factors = [2 ** level for level in reversed(range(num_levels))]
+    smoothing_sigmas = [level for level in reversed(range(num_levels))]
+    iterations = []
+    for shrink_factor in shrink_factors:
+        level_voxel_count = 1
+        for n in fixed_shape:
+            level_voxel_count *= max(n // shrink_factor, 1)
+        capped = int(params['max_iterations'] * REFERENCE_VOXEL_COUNT
+                     / level_voxel_count)
+        iterations.append(max(params['min_iterations'],
+                              min(params['max_iterations'], capped)))
+    return {
+        'preset': preset,
+        'fixed_shape': fixed_shape,
+        'iterations': iterations,
+        'convergence_threshold': params['convergence_threshold'],
+        'convergence_window': params['convergence_window'],
+        'shrink_factors': shrink_factors,
+        'smoothing_sigmas': smoothing_sigmas,
+    }
+
+
+def _format_float(value):
+    """Format a number without leading zeros in the exponent (1e-6)."""
+    return re.sub(r'e([+-]?)0+(?=\d)', r'e\1', '{0:g}'.format(value))
+
+
+def to_ants_arguments(schedule):
+    """Convert a schedule to arguments of antsRegistration."""
+    return [
+        '--convergence', '[{0},{1},{2}]'.format(
+            'x'.join(str(i) for i in schedule['iterations']),
+            _format_float(schedule['convergence_threshold']),
+            schedule['convergence_window'],
+        ),
+        '--shrink-factors',
+        'x'.join(str(f) for f in schedule['shrink_factors']),
+        '--smoothing-sigmas',
+        'x'.join(str(s) for s in schedule['smoothing_sigmas']) + 'vox',
+    ]
@@ -0,0 +1,146 @@
+# Copyright 2020 CEA
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# This file is part of cortical-voluba.
+#
+# cortical-voluba is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# cortical-voluba is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License
+# for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with cortical-voluba. If not, see <https://www.gnu.org/licenses/>.
+
+
+"""Estimation of the resources needed by a computation.
+
+The estimation is based only on the header of the input images (their
+dimensions and data type), so that oversized inputs can be rejected when the
+computation is submitted, without downloading the images.
+
+The costs per voxel are coarse upper bounds, set by hand. They have not been
+measured with the real toolchain (BrainVISA, highres-cortex and ANTs): the
+pipeline benchmark (``benchmarks/pipeline.py``) replaces these tools with
+stand-ins, so it cannot be used to calibrate them.
+"""
+
+import struct
+
+
+NIFTI1_HEADER_SIZE = 348
+NIFTI2_HEADER_SIZE = 540
+
+DEPTH_MAP_BYTES_PER_VOXEL = 64
+"""Peak memory of the depth map computation (highres-cortex)."""
+DEPTH_MAP_SECONDS_PER_MEGAVOXEL = 4.0
+"""Running time of the depth map computation."""
+REGISTRATION_BYTES_PER_VOXEL = 48
+"""Peak memory of the registration of the depth map to the template."""
+REGISTRATION_SECONDS_PER_MEGAVOXEL = 2.0
+"""Running time of the registration of the depth map to the template."""
+RESAMPLING_BYTES_PER_VOXEL = 12
+"""Peak memory of the resampling, in addition to the image data."""
+RESAMPLING_SECONDS_PER_MEGAVOXEL = 0.5
+"""Running time of the resampling of the image."""
+
+
+class InvalidHeaderError(ValueError):
+    """The data do not start with a valid NIfTI header."""
+
+
+def parse_nifti_header(data):
+    """Read the dimensions and data type from a NIfTI-1 or NIfTI-2 header.
+
+    :param bytes data: the beginning of the uncompressed image file
+    :returns: a dictionary with the keys ``shape`` (list of the dimensions),
+              ``voxels`` (number of voxels of a 3D volume), ``volumes``
+              (number of volumes) and ``bytes_per_voxel``
+    :rtype: dict
+    :raises InvalidHeaderError: if data do not start with a valid header
+    """
+    if len(data) < NIFTI1_HEADER_SIZE:
+        raise InvalidHeaderError('the header is truncated')
+    for endianness in '<>':
+        sizeof_hdr, = struct.unpack_from(endianness + 'i', data, 0)
+        if sizeof_hdr == NIFTI1_HEADER_SIZE:
+            dim = struct.unpack_from(endianness + '8h', data, 40)
+            bitpix, = struct.unpack_from(endianness + 'h', data, 72)
+            break
+        elif sizeof_hdr == NIFTI2_HEADER_SIZE:
+            if len(data) < NIFTI2_HEADER_SIZE:
+                raise InvalidHeaderError('the header is truncated')
+            bitpix, = struct.unpack_from(endianness + 'h', data, 14)
+            dim = struct.unpack_from(endianness + '8q', data, 16)
+            break
+    else:
+        raise InvalidHeaderError('the data do not start with a NIfTI header')
+
+    ndim = dim[0]
+    if not 1 <= ndim <= 7:
+        raise InvalidHeaderError('invalid number of dimensions: {0}'
+                                 .format(ndim))
+    shape = list(dim[1:ndim + 1])
+    if any(n < 1 for n in shape):
+        raise InvalidHeaderError('invalid dimensions: {0}'.format(shape))
+    if bitpix <= 0 or bitpix % 8 not in (0, 1):
+        raise InvalidHeaderError('invalid bitpix: {0}'.format(bitpix))
+
+    voxels = 1
+    for n in shape[:3]:
+        voxels *= n
+    volumes = 1
+    for n in shape[3:]:
+        volumes *= n
+    return {
+        'shape': shape,
+        'voxels': voxels,
+        'volumes': volumes,
+        'bytes_per_voxel': max(bitpix // 8, 1),
+    }
+
+
+def estimate_resources(computation, inputs):
+    """Estimate the memory and time needed by a computation.
+
+    :param str computation: ``'depth-map'``, ``'alignment'``, or
+           ``'depth-map-and-alignment'``
+    :param dict inputs: the headers of the input images, as returned by
+           `parse_nifti_header`, indexed by role (``'segmentation'``,
+           ``'depth_map'``, ``'image'``)
+    :returns: a dictionary with the keys ``input_voxels`` (the largest
+              number of voxels of an input), ``memory_bytes`` (peak memory)
+              and ``runtime_seconds``
+    :rtype: dict
+    """
+    stages = []  # list of (memory_bytes, runtime_seconds)
+    if computation in ('depth-map', 'depth-map-and-alignment'):
+        voxels = inputs['segmentation']['voxels']
+        stages.append((voxels * DEPTH_MAP_BYTES_PER_VOXEL,
+                       voxels * 1e-6 * DEPTH_MAP_SECONDS_PER_MEGAVOXEL))
+    if computation in ('alignment', 'depth-map-and-alignment'):
+        # The computed depth map has the grid of the segmentation
+        if computation == 'alignment':
+            voxels = inputs['depth_map']['voxels']
+        else:
+            voxels = inputs['segmentation']['voxels']
+        stages.append((voxels * REGISTRATION_BYTES_PER_VOXEL,
+                       voxels * 1e-6 * REGISTRATION_SECONDS_PER_MEGAVOXEL))
+        image = inputs['image']
+        image_voxels = image['voxels'] * image['volumes']
+        stages.append((image_voxels * (image['bytes_per_voxel']
+                                       + RESAMPLING_BYTES_PER_VOXEL),
+                       image_voxels * 1e-6 * RESAMPLING_SECONDS_PER_MEGAVOXEL))
+    if not stages:
+        raise ValueError('unknown computation {0!r}'.format(computation))
+    return {
+        'input_voxels': max(header['voxels'] * header['volumes']
+                            for header in inputs.values()),
+        'memory_bytes': max(memory for memory, runtime in stages),
+        'runtime_seconds': round(sum(runtime for memory, runtime in stages),
+                                 1),
+    }
@@ -0,0 +1,208 @@
+# Copyright 2020 CEA
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# This file is part of cortical-voluba.
+#
+# cortical-voluba is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# cortical-voluba is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License
+# for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with cortical-voluba. If not, see <https://www.gnu.org/licenses/>.
+
+"""Restriction of the processing to a region of interest.
+
+Cortical patches usually occupy a small part of their field of view. The
+functions of this module crop images to the bounding box of their support, so
+that the cost of the processing scales with the size of the patch, and embed
+the results back into the original voxel grid.
+
+Bounding boxes are represented as tuples of `slice` objects, which can be
+used directly to index NumPy arrays.
+"""
+
+import logging
+
+import nibabel
+import numpy
+
+
+logger = logging.getLogger(__name__)
+
+
+def support_bounding_box(mask, margin=0):
+    """Compute the bounding box of the non-zero voxels of a 3D array.
+
+    :param numpy.ndarray mask: 3D array
+    :param margin: number of voxels added on each side of the box, either a
+           scalar or one value per axis (the box is clipped to the array)
+    :returns: the bounding box, or None if mask contains no non-zero voxel
+    :rtype: tuple of slice
+    """
+    margin = numpy.broadcast_to(numpy.ceil(margin).astype(int), (3,))
+    bbox = []
+    for axis in range(3):
+        other_axes = tuple(a for a in range(mask.ndim) if a != axis)
+        profile = numpy.any(mask, axis=other_axes)
+        indices = numpy.flatnonzero(profile)
+        if len(indices) == 0:
+            return None
+        start = max(indices[0] - margin[axis], 0)
+        stop = min(indices[-1] + 1 + margin[axis], mask.shape[axis])
+        bbox.append(slice(int(start), int(stop)))
+    return tuple(bbox)
+
+
+def covers_whole_array(bbox, shape):
+    return all(s.start == 0 and s.stop == n for s, n in zip(bbox, shape))
+
+
+def bounding_box_shift(bbox):
+    """Affine that maps voxel indices of a crop to the uncropped grid."""
+    shift = numpy.eye(4)
+    shift[:3, 3] = [s.start for s in bbox]
+    return shift
+
+
+def crop_image(img, bbox):
+    """Crop a Nifti image to a bounding box, keeping its position in space.
+
+    Both the qform and the sform of the image are updated.
+
+    :param nibabel.Nifti1Image img: input image
+    :param tuple bbox: bounding box (tuple of 3 slices)
+    :rtype: nibabel.Nifti1Image
+    """
+    # Slicing the data proxy avoids loading the whole image when possible
+    data = numpy.asanyarray(img.dataobj[bbox])
+    return _with_shifted_affines(img, data, bounding_box_shift(bbox))
+
+
+def uncrop_image(cropped_img, bbox, shape, fill_value=0):
+    """Embed a cropped image back into its original grid.
+
+    This is the inverse of `crop_image`: voxels outside of the bounding box
+    are set to fill_value.
+
+    :param nibabel.Nifti1Image cropped_img: the cropped image
+    :param tuple bbox: bounding box that was used for cropping
+    :param tuple shape: the 3D shape of the original grid
+    :rtype: nibabel.Nifti1Image
+    """
+    cropped_data = numpy.asanyarray(cropped_img.dataobj)
+    data = numpy.full(tuple(shape[:3]) + cropped_data.shape[3:], fill_value,
+                      dtype=cropped_data.dtype)
+    data[bbox] = cropped_data
+    return _with_shifted_affines(cropped_img, data,
+                                 numpy.linalg.inv(bounding_box_shift(bbox)))
+
+
+def _with_shifted_affines(img, data, shift):
+    header = img.header.copy()
+    # The transformations are shifted even if their code is 0, because some
+    # readers use the qform regardless of its code.
+    qform_code = int(header['qform_code'])
+    sform_code = int(header['sform_code'])
+    qform = header.get_qform() @ shift
+    sform = header.get_sform() @ shift
+    new_img = nibabel.Nifti1Image(data, None, header=header)
+    new_img.set_qform(qform, code=qform_code)
+    new_img.set_sform(sform, code=sform_code)
+    return new_img
+
+
+def downsample_image(img, factors):
+    """Downsample a 3D image by averaging blocks of voxels.
+
+    The last blocks along each axis are padded by repeating the edge voxels.
+    The voxel (i, j, k) of the output image is the average of the input voxels
+    from ``(i * factors[0], j * factors[1], k * factors[2])`` (included) to
+    ``((i + 1) * factors[0], ...)`` (excluded), and the affine
+    transformations are adjusted accordingly.
+
+    :param nibabel.Nifti1Image img: input image
+    :param factors: integer downsampling factor for each of the 3 axes
+    :rtype: nibabel.Nifti1Image
+    """
+    data = numpy.asanyarray(img.dataobj)
+    factors = [int(f) for f in factors]
+    padded_shape = [-(-n // f) * f for n, f in zip(data.shape, factors)]
+    data = numpy.pad(data, [(0, p - n)
+                            for p, n in zip(padded_shape, data.shape[:3])],
+                     mode='edge')
+    blocks = data.reshape(padded_shape[0] // factors[0], factors[0],
+                          padded_shape[1] // factors[1], factors[1],
+                          padded_shape[2] // factors[2], factors[2])
+    downsampled = blocks.mean(axis=(1, 3, 5)).astype(numpy.float32)
+    scaling = numpy.diag(factors + [1]).astype(float)
+    scaling[:3, 3] = [(f - 1) / 2 for f in factors]
+    new_img = _with_shifted_affines(img, downsampled, scaling)
+    new_img.set_data_dtype(numpy.float32)
+    return new_img
+
+
+def crop_to_labels(input_path, output_path, margin):
+    """Crop a label volume to the bounding box of non-background labels.
+
+    :param str input_path: path to the input label volume (Nifti)
+    :param str output_path: path where the cropped volume is written
+    :param margin: number of voxels added around the labels
+    :returns: the bounding box, or None if cropping would not reduce the size
+              of the volume (in which case nothing is written)
+    :rtype: tuple of slice
+    """
+    img = nibabel.load(input_path)
+    data = numpy.asanyarray(img.dataobj)
+    bbox = support_bounding_box(data != 0, margin)
+    if bbox is None or covers_whole_array(bbox, data.shape):
+        return None
+    logger.info('Cropping %s from shape %s to %s', input_path,
+                data.shape[:3], tuple(s.stop - s.start for s in bbox))
+    nibabel.save(crop_image(img, bbox), output_path)
+    return bbox
+
+
+def background_value(values_img, labels_img):
+    """Estimate the value taken by a result image far from the labels.
+
+    The most common value found on the faces of the volume, among voxels that
+    have the background label (0), is returned (0 if there is none).
+    """
+    values = numpy.asanyarray(values_img.dataobj)
+    labels = numpy.asanyarray(labels_img.dataobj)
+    faces = numpy.zeros(labels.shape[:3], dtype=bool)
+    faces[[0, -1], :, :] = True
+    faces[:, [0, -1], :] = True
+    faces[:, :, [0, -1]] = True
+    candidates = values[faces & (labels == 0)]
+    if candidates.size == 0:
+        return 0
+    unique_values, counts = numpy.unique(candidates, return_counts=True)
+    return unique_values[numpy.argmax(counts)]
+
+
+def uncrop_result(cropped_result_path, cropped_labels_path, reference_path,
+                  output_path, bbox):
+    """Embed a result computed on a cropped label volume into the full grid.
+
+    :param str cropped_result_path: result computed on the cropped labels
+    :param str cropped_labels_path: cropped label volume (written by
+           `crop_to_labels`)
+    :param str reference_path: the original (uncropped) label volume
+    :param str output_path: path where the uncropped result is written
+    :param tuple bbox: bounding box returned by `crop_to_labels`
+    """
+    cropped_result = nibabel.load(cropped_result_path)
+    fill_value = background_value(cropped_result,
+                                  nibabel.load(cropped_labels_path))
+    shape = nibabel.load(reference_path).shape
+    logger.info('Embedding %s into the original grid of shape %s '
+                '(fill value: %s)', cropped_result_path, shape, fill_value)
+    nibabel.save(uncrop_image(cropped_result, bbox, shape, fill_value),
+                 output_path)
@@ -0,0 +1,77 @@
+# Copyright 2020 CEA
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# This file is part of cortical-voluba.
+#
+# cortical-voluba is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# cortical-voluba is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License
+# for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with cortical-voluba. If not, see <https://www.gnu.org/licenses/>.
+
+"""Lightweight stand-ins for the Celery tasks, for use by the API.
+
+The implementation of the tasks (`cortical_voluba.tasks`) pulls in the whole
+worker code path and its numerical dependencies. The API only needs to submit
+tasks and query their results, which can be done by task name using the stubs
+defined in this module.
+"""
+
+from cortical_voluba import celery
+from cortical_voluba import tracing
+
+
+class TaskStub:
+    """Submit and query a Celery task by name.
+
+    Only the subset of the `celery.Task` interface that is used by the API is
+    provided.
+
+    :param str name: the fully qualified name of the task, as registered by
+           the worker
+    """
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return '<TaskStub: {0}>'.format(self.name)
+
+    def delay(self, *args, **kwargs):
+        """Submit the task, see `celery.Task.delay`."""
+        return self.apply_async(args, kwargs)
+
+    def apply_async(self, args=None, kwargs=None, **options):
+        """Submit the task, see `celery.Task.apply_async`.
+
+        The trace context of the caller is sent in the ``traceparent``
+        header of the message (see `cortical_voluba.tracing`).
+        """
+        with tracing.Span('send ' + self.name.rsplit('.', 1)[-1],
+                          kind='PRODUCER') as span:
+            headers = dict(options.pop('headers', None) or {},
+                           traceparent=span.traceparent)
+            result = celery.celery_app.send_task(self.name, args, kwargs,
+                                                 headers=headers, **options)
+            span.set_tag('task_id', result.id)
+            return result
+
+    def AsyncResult(self, task_id):
+        """Get the result of a previously submitted task."""
+        return celery.celery_app.AsyncResult(task_id, task_name=self.name)
+
+
+depth_map_computation_task = TaskStub(
+    'cortical_voluba.tasks.depth_map_computation_task')
+alignment_computation_task = TaskStub(
+    'cortical_voluba.tasks.alignment_computation_task')
+depth_map_and_alignment_computation_task = TaskStub(
+    'cortical_voluba.tasks.depth_map_and_alignment_computation_task')
+worker_health_task = TaskStub(
+    'cortical_voluba.tasks.worker_health_task')
@@ -16,25 +16,200 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with cortical-voluba. If not, see <https://www.gnu.org/licenses/>.
 
+import concurrent.futures
+import contextlib
 import datetime
+import json
 import os.path
 import tempfile
-import shutil
-import subprocess
 import sys
+import time
 from urllib.parse import urljoin
 
+from celery import shared_task
 import celery.utils.log
 from flask import current_app
 import requests
 from werkzeug.utils import secure_filename
 
 from cortical_voluba import alignment
-from cortical_voluba.celery import celery_app
+from cortical_voluba import bv_server
+from cortical_voluba import capsul_parallel_main
+from cortical_voluba import checkpoints
+from cortical_voluba import cost_model
+from cortical_voluba import download_cache
 from cortical_voluba import image_service
+from cortical_voluba import ledger
+from cortical_voluba import output_types
+from cortical_voluba import processes
+from cortical_voluba import profiling
+from cortical_voluba import registration_schedule
+from cortical_voluba import roi
+from cortical_voluba import tracing
 
 logger = celery.utils.log.get_task_logger(__name__)
 
+# Options of the computation tasks. The message is only acknowledged when the
+# task has finished, so that a task that was interrupted by a restart of the
+# worker is delivered again. Transient network errors are retried with an
+# exponential backoff. In both cases the task resumes from its checkpoints
+# (see get_checkpoints).
+COMPUTATION_TASK_OPTIONS = {
+    'bind': True,
+    'acks_late': True,
+    'autoretry_for': (requests.ConnectionError, requests.Timeout),
+    'retry_backoff': True,
+    'retry_kwargs': {'max_retries': 3},
+}
+
+
+def log_queue_wait(task, params):
+    """Log the time that a computation has waited in its queue.
+
+    :param task: the bound Celery task
+    :param dict params: the parameters of the computation, where the API
+           records the submission time (``submitted_at``)
+    :returns: the name of the queue and the waiting time in seconds (None if
+              unknown, in particular when the task is retried)
+    :rtype: tuple
+    """
+    queue = (task.request.delivery_info or {}).get('routing_key')
+    submitted_at = params.get('submitted_at')
+    if submitted_at is None or task.request.retries:
+        return queue, None
+    now = time.time()
+    wait_seconds = max(now - submitted_at, 0)
+    tracing.record_span('queue wait', submitted_at, now, queue=queue)
+    logger.info('Computation started after waiting %.1f s in queue %s',
+                wait_seconds, queue)
+    return queue, wait_seconds
+
+
+@contextlib.contextmanager
+def track_job(task, job_type, params, task_checkpoints):
+    """Track the progress of a computation and record it when it finishes.
+
+    While the computation runs, the progress reports (see `report_progress`)
+    include its estimated completion time (see `cortical_voluba.cost_model`).
+    Unless the JOB_LEDGER_PATH option is not set, the computation is removed
+    from the queue of the job ledger when it starts, and recorded in the job
+    ledger when it finishes. If profiling is enabled for the
+    computation (see `cortical_voluba.profiling.is_enabled`), it runs under a
+    sampling profiler, whose artefacts are saved when it finishes. An error
+    in writing the ledger or the profile is logged, it does not affect the
+    task.
+
+    :param task: the bound Celery task
+    :param str job_type: the type of computation (see
+           `cortical_voluba.resource_estimates.estimate_resources`)
+    :param dict params: the parameters of the computation
+    :param task_checkpoints: the `cortical_voluba.checkpoints.Checkpoints` of
+           the task, which records the duration of the stages
+    """
+    queue, queue_wait_seconds = log_queue_wait(task, params)
+    ledger_path = current_app.config.get('JOB_LEDGER_PATH')
+    if ledger_path:
+        try:
+            ledger.JobLedger(ledger_path).remove_queued(task.request.id)
+        except Exception:
+            logger.exception('Cannot remove the job from the queue of the '
+                             'ledger')
+    task.request.progress_estimate = cost_model.ProgressEstimate(
+        cost_model.get_cost_model(ledger_path), job_type,
+        params.get('resource_estimate'), task_checkpoints)
+    profiler = None
+    if profiling.is_enabled(params):
+        profiler = profiling.SamplingProfiler(
+            current_app.config.get('PROFILE_SAMPLING_INTERVAL'))
+        profiler.start()
+    processes.reset_peak_rss()
+    start_time = time.monotonic()
+    outcome = 'failure'
+    with processes.record_usage() as usage:
+        try:
+            yield
+            outcome = 'success'
+        except processes.TaskCancelledError:
+            outcome = 'cancelled'
+            raise
+        finally:
+            task.request.progress_estimate = None
+            total_seconds = time.monotonic() - start_time
+            peak_memory = max([processes.get_peak_rss() or 0]
+                              + [u['max_rss_bytes'] for u in usage])
+            if profiler is not None:
+                profiler.stop()
+                save_profile(task, job_type, outcome, profiler, {
+                    'total_seconds': total_seconds,
+                    'stage_seconds': dict(task_checkpoints.durations),
+                    'processes': usage,
+                    'peak_memory_bytes': peak_memory or None,
+                })
+            if ledger_path:
+                # A resumed task skips the stages that were completed by its
+                # previous attempts, their durations count towards the job.
+                stage_seconds = task_checkpoints.get_durations()
+                job_seconds = total_seconds + sum(
+                    task_checkpoints.restored_durations.values())
+                download_results = [
+                    result for stage, result
+                    in task_checkpoints.get_results().items()
+                    if stage.startswith('download ')
+                ]
+                resource_estimate = params.get('resource_estimate') or {}
+                try:
+                    ledger.JobLedger(ledger_path).record(
+                        job_type, outcome,
+                        task_id=task.request.id,
+                        attempt=task.request.retries or 0,
+                        input_voxels=resource_estimate.get('input_voxels'),
+                        parameters=params,
+                        queue=queue,
+                        queue_wait_seconds=queue_wait_seconds,
+                        total_seconds=job_seconds,
+                        stage_seconds=stage_seconds,
+                        peak_memory_bytes=peak_memory or None,
+                        cache_hits=download_results.count(True),
+                        downloads=len(download_results),
+                    )
+                except Exception:
+                    logger.exception('Cannot record the job in the ledger')
+
+
+def save_profile(task, job_type, outcome, profiler, report):
+    """Save the artefacts of a profiled computation.
+
+    The expired profiles are removed at the same time (see the PROFILE_TTL
+    and PROFILE_MAX_TOTAL_BYTES options).
+    """
+    profile_dir = profiling.get_profile_dir()
+    try:
+        task_dir = profiling.save_profile(
+            profile_dir, task.request.id, profiler,
+            dict(report, task_name=task.name, job_type=job_type,
+                 outcome=outcome, attempt=task.request.retries or 0),
+            max_bytes=current_app.config.get('PROFILE_MAX_BYTES'))
+        logger.info('Saved the profile of the computation in %s', task_dir)
+        profiling.remove_expired(
+            profile_dir,
+            current_app.config['PROFILE_TTL'].total_seconds(),
+            current_app.config.get('PROFILE_MAX_TOTAL_BYTES'))
+    except Exception:
+        logger.exception('Cannot save the profile of the computation')
+
+
+def report_progress(task, message, **meta):
+    """Report the progress of a task, with its estimated completion time.
+
+    :param task: the bound Celery task
+    :param str message: the status message
+    :param meta: other metadata of the progress report
+    """
+    progress_estimate = getattr(task.request, 'progress_estimate', None)
+    if progress_estimate is not None:
+        meta.update(progress_estimate.get_times())
+    task.update_state(state='PROGRESS', meta=dict(message=message, **meta))
+
 
 def datetime_now_str():
     return datetime.datetime.utcnow().replace(microsecond=0).isoformat()
@@ -67,113 +242,344 @@ def escape_virtual_env(env):
         return env
 
 
-@celery_app.task(bind=True)
-def depth_map_computation_task(self, params, *, bearer_token):
-    work_dir = tempfile.mkdtemp(prefix='depth_map_')
+def get_thread_budget():
+    """Number of CPU threads that a task is allowed to use."""
+    budget = current_app.config.get('WORKER_THREAD_BUDGET')
+    if budget:
+        return budget
     try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:  # os.sched_getaffinity is not available on macOS
+        return os.cpu_count() or 1
+
+
+def get_image_service_client(base_url, bearer_token):
+    """Get a client to the image service, on behalf of the user.
+
+    The downloads go through the worker-local cache if the DOWNLOAD_CACHE_DIR
+    option is set.
+    """
+    cache = None
+    cache_dir = current_app.config.get('DOWNLOAD_CACHE_DIR')
+    if cache_dir:
+        cache = download_cache.DownloadCache(
+            cache_dir, current_app.config['DOWNLOAD_CACHE_MAX_BYTES'])
+    return image_service.ImageServiceClient(
+        base_url, auth=image_service.BearerTokenAuth(bearer_token),
+        download_cache=cache)
+
+
+def will_be_retried(task, exc):
+    """Tell whether Celery will retry a task that has raised an exception.
+
+    :param task: the bound Celery task (see COMPUTATION_TASK_OPTIONS)
+    :param exc: the exception raised by the task
+    """
+    max_retries = getattr(task, 'retry_kwargs', {}).get('max_retries',
+                                                        task.max_retries)
+    return (isinstance(exc, getattr(task, 'autoretry_for', ()))
+            and (max_retries is None or task.request.retries < max_retries))
+
+
+@contextlib.contextmanager
+def get_checkpoints(task, prefix):
+    """Get the scratch directory and checkpoints of a task.
+
+    If the CHECKPOINT_DIR option is set, the scratch directory is named
+    after the id of the task in that directory, so that a task that is run
+    again resumes from its last checkpoint (see `cortical_voluba.checkpoints`).
+    It is kept if the task is going to be retried (see `will_be_retried`) or
+    if it is interrupted by the worker shutting down (the task is then
+    delivered again), and removed otherwise. The directories of tasks that
+    have stopped without cleaning up are removed after CHECKPOINT_TTL
+    without heartbeat.
+
+    Otherwise, a temporary directory is used, which is always removed.
+
+    :returns: a context manager that yields a
+              `cortical_voluba.checkpoints.Checkpoints`
+    """
+    checkpoint_dir = current_app.config.get('CHECKPOINT_DIR')
+    task_id = task.request.id
+    if checkpoint_dir and task_id:
+        checkpoints.remove_expired(
+            checkpoint_dir,
+            current_app.config['CHECKPOINT_TTL'].total_seconds())
+        task_checkpoints = checkpoints.Checkpoints(
+            os.path.join(checkpoint_dir, prefix + secure_filename(task_id)))
+        try:
+            with checkpoints.Heartbeat(task_checkpoints.work_dir):
+                yield task_checkpoints
+        except Exception as exc:
+            if not will_be_retried(task, exc):
+                task_checkpoints.remove()
+            raise
+        task_checkpoints.remove()
+    else:
+        task_checkpoints = checkpoints.Checkpoints(
+            tempfile.mkdtemp(prefix=prefix), persistent=False)
+        try:
+            yield task_checkpoints
+        finally:
+            task_checkpoints.remove()
+
+
+def download_image(task, client, image_name, image_path, message):
+    """Download an image to the scratch directory.
+
+    :returns: True if the image was served from the download cache
+    """
+    report_progress(task, message)
+    logger.info('%s to %s', message, image_path)
+    with open(image_path, 'wb') as f:
+        return client.download_compressed_nifti(image_name, f)
+
+
+def run_in_bv_env(command):
+    """Run a command in the BrainVISA environment.
+
+    The command is run through the persistent BrainVISA server of this worker
+    process if the BV_PERSISTENT_SERVER option is set, otherwise it is run
+    with ``bv_env``.
+    """
+    bv_env_path = current_app.config['BV_ENV_PATH']
+    system_env = escape_virtual_env(os.environ)
+    if current_app.config.get('BV_PERSISTENT_SERVER'):
+        server = bv_server.get_server(bv_env_path, env=system_env)
+        logger.debug('Running %s in %r', command, server)
+        with tracing.Span('bv_server ' + command[0]):
+            server.check_call(command)
+    else:
+        command = [bv_env_path] + command
+        logger.debug('Running %s', command)
+        processes.check_call(command, env=system_env)
+
+
+def compute_depth_map(task, segmentation_path, depth_map_path, work_dir):
+    """Compute the equivolumetric depth map from a cortical segmentation.
+
+    :param task: the running task, used for reporting progress
+    :param str depth_map_path: output path, must end with
+           ``-equivolumetric-depth.nii.gz``
+    :returns: the durations of the nodes of the pipeline (or None)
+    :rtype: dict
+    """
+    base_path = depth_map_path[:-len('-equivolumetric-depth.nii.gz')]
+    segmentation_S16_path = base_path + '_S16.nii.gz'
+
+    # The depth map is computed on the bounding box of the labelled
+    # region, then embedded back into the original grid.
+    crop_margin = current_app.config.get('SEGMENTATION_CROP_MARGIN')
+    crop_bbox = None
+    if crop_margin is not None:
+        report_progress(task, 'cropping segmentation')
+        segmentation_cropped_path = base_path + '_cropped.nii.gz'
+        crop_bbox = roi.crop_to_labels(
+            segmentation_path, segmentation_cropped_path, crop_margin)
+    if crop_bbox is not None:
+        pipeline_input_path = segmentation_cropped_path
+        pipeline_depth_map_path = (base_path
+                                   + '_cropped-equivolumetric-depth.nii.gz')
+    else:
+        pipeline_input_path = segmentation_path
+        pipeline_depth_map_path = depth_map_path
+
+    report_progress(task, 'converting segmentation')
+    command = ['AimsFileConvert',
+               '--type', 'S16',
+               '--input', pipeline_input_path,
+               '--output', segmentation_S16_path]
+    run_in_bv_env(command)
+
+    report_progress(task, 'computing the depth map')
+    logger.info('computing the depth map into %s', pipeline_depth_map_path)
+    pipeline_args = ['highres_cortex.capsul.isovolume',
+                     'classif=' + segmentation_S16_path,
+                     'verbosity=1',
+                     'equivolumetric_depth=' + pipeline_depth_map_path]
+    max_processes = get_thread_budget()
+    if max_processes > 1:
+        timings_path = os.path.join(work_dir, 'node_timings.json')
+        command = ['python', capsul_parallel_main.__file__,
+                   '--processes', str(max_processes),
+                   '--timings', timings_path] + pipeline_args
+        run_in_bv_env(command)
+        with open(timings_path) as f:
+            node_timings = json.load(f)
+    else:
+        command = ['python', '-m', 'capsul.run'] + pipeline_args
+        run_in_bv_env(command)
+        node_timings = None
+    logger.info('Durations of the pipeline nodes: %s', node_timings)
+
+    report_progress(task, 'Removing NaNs and clamping depth values',
+                    node_timings=node_timings)
+    logger.info('Removing NaNs and clamping depth values in %s',
+                pipeline_depth_map_path)
+    command = ['AimsRemoveNaN',
+               '-np', '--value', '0.5',
+               '-i', pipeline_depth_map_path,
+               '-o', pipeline_depth_map_path]
+    run_in_bv_env(command)
+    command = ['AimsThreshold',
+               '-m', 'be', '--clip',
+               '-t', '0',
+               '-u', '1',
+               '--input', pipeline_depth_map_path,
+               '--output', pipeline_depth_map_path]
+    run_in_bv_env(command)
+
+    if crop_bbox is not None:
+        report_progress(task, 'restoring the original field of view',
+                        node_timings=node_timings)
+        roi.uncrop_result(pipeline_depth_map_path,
+                          segmentation_cropped_path,
+                          segmentation_path,
+                          depth_map_path,
+                          crop_bbox)
+    return node_timings
+
+
+def get_neuroglancer_url(client, image_name):
+    """Neuroglancer URL of an image of the image service (or None)."""
+    try:
+        image_info = client.get_image_info(image_name)
+        if image_info:
+            return 'precomputed://' + urljoin(
+                client.base_url,  # guaranteed to have trailing slash
+                image_info['links']['normalized'].lstrip('/')
+            )
+    except Exception:
+        logger.exception('Failed to retrieve Neuroglancer URL of the '
+                         'image named %s', image_name)
+    return None
+
+
+def upload_depth_map(client, depth_map_path, segmentation_basename):
+    """Upload a depth map to the image service.
+
+    :returns: a tuple ``(depth_map_name, depth_map_neuroglancer_url)``
+    """
+    logger.info('uploading the depth map')
+    depth_map_filename = (
+        segmentation_basename + '-equivolumetric-depth.nii.gz'
+    )
+    try:
+        with open(depth_map_path, 'rb') as f:
+            client.preflight_image(f, file_name=depth_map_filename)
+    except requests.HTTPError as e:
+        if e.response.status_code == 409:
+            depth_map_filename = (
+                segmentation_basename + '-equivolumetric-depth-'
+                + datetime_now_str() + '.nii.gz'
+            )
+        else:
+            raise
+    with open(depth_map_path, 'rb') as f:
+        depth_map_name, _ = client.upload_image_and_get_name(
+            f, file_name=depth_map_filename)
+    return depth_map_name, get_neuroglancer_url(client, depth_map_name)
+
+
+def align_image(task, task_checkpoints, params, image_path, depth_map_path):
+    """Estimate the deformation from the depth map and resample the image.
+
+    The registration and the resampling are run as separate stages of
+    task_checkpoints, with the same instance of the registration backend.
+
+    :param task: the running task, used for reporting progress
+    :param dict params: parameters of the alignment request
+    :returns: a tuple ``(resampled_image_path, registration_info)``, see
+              `cortical_voluba.alignment.estimate_deformation` for the latter
+    """
+    work_dir = task_checkpoints.work_dir
+    backend = alignment.get_registration_backend()
+    report_progress(task, 'computing alignment')
+    registration_info = task_checkpoints.run(
+        'registration',
+        alignment.estimate_deformation,
+        depth_map_path,
+        current_app.config['TEMPLATE_EQUIVOLUMETRIC_DEPTH'],
+        params['transformation_matrix'],
+        params['landmark_pairs'],
+        work_dir=work_dir,
+        preset=params.get('registration_preset',
+                          registration_schedule.DEFAULT_PRESET),
+        backend=backend,
+    )
+
+    report_progress(task, 'resampling the image')
+    resampled_image_path = (
+        depth_map_path[:-len('.nii.gz')] + '-resampled.nii.gz')
+    task_checkpoints.run(
+        'resampling',
+        alignment.transform_image,
+        image_path, resampled_image_path, work_dir=work_dir,
+        output_data_type=params.get('output_data_type',
+                                    output_types.DEFAULT_OUTPUT_DATA_TYPE),
+        keep_scaling=params.get('keep_scaling', True),
+        backend=backend)
+    return resampled_image_path, registration_info
+
+
+def upload_transformed_image(client, resampled_image_path, image_basename):
+    """Upload a transformed image to the image service.
+
+    :returns: a tuple ``(image_name, image_neuroglancer_url)``
+    """
+    logger.info('uploading the resampled image')
+    resampled_image_filename = (
+        image_basename + '-transformed-'
+        + datetime_now_str() + '.nii.gz'
+    )
+    with open(resampled_image_path, 'rb') as f:
+        resampled_image_name, _ = client.upload_image_and_get_name(
+            f, file_name=resampled_image_filename)
+    return (resampled_image_name,
+            get_neuroglancer_url(client, resampled_image_name))
+
+
+def alignment_results(registration_info, transformed_image_name,
+                      transformed_image_neuroglancer_url):
+    return {
+        'transformed_image_name': transformed_image_name,
+        'transformed_image_neuroglancer_url':
+        transformed_image_neuroglancer_url,
+        'transformation_matrix': registration_info['transformation_matrix'],
+        'registration_schedule': registration_info['registration_schedule'],
+        'landmark_report': registration_info['landmark_report'],
+    }
+
+
+@shared_task(**COMPUTATION_TASK_OPTIONS)
+def depth_map_computation_task(self, params, *, bearer_token):
+    with get_checkpoints(self, 'depth_map_') as task_checkpoints, \
+            track_job(self, 'depth-map', params, task_checkpoints):
+        work_dir = task_checkpoints.work_dir
         segmentation_name = params['segmentation_name']
-        auth = image_service.BearerTokenAuth(bearer_token)
-        client = image_service.ImageServiceClient(
-            params['image_service_base_url'], auth=auth)
+        client = get_image_service_client(params['image_service_base_url'],
+                                          bearer_token)
         segmentation_basename = secure_filename(segmentation_name)
         segmentation_path = os.path.join(
             work_dir, segmentation_basename + '.nii.gz')
-        segmentation_S16_path = os.path.join(
-            work_dir, segmentation_basename + '_S16.nii.gz')
         depth_map_path = os.path.join(
             work_dir,
             segmentation_basename + '-equivolumetric-depth.nii.gz'
         )
 
-        self.update_state(state='PROGRESS', meta={
-            'message': 'downloading segmentation',
-        })
-        logger.info('downloading segmentation to %s', segmentation_path)
-        with open(segmentation_path, 'wb') as f:
-            client.download_compressed_nifti(segmentation_name, f)
-
-        self.update_state(state='PROGRESS', meta={
-            'message': 'converting segmentation',
-        })
-        system_env = escape_virtual_env(os.environ)
-        command = [current_app.config['BV_ENV_PATH'],
-                   'AimsFileConvert',
-                   '--type', 'S16',
-                   '--input', segmentation_path,
-                   '--output', segmentation_S16_path]
-        logger.debug('Running %s', command)
-        subprocess.check_call(command, env=system_env)
-
-        self.update_state(state='PROGRESS', meta={
-            'message': 'computing the depth map',
-        })
-        logger.info('computing the depth map into %s', depth_map_path)
-        command = [current_app.config['BV_ENV_PATH'],
-                   'python', '-m', 'capsul.run',
-                   'highres_cortex.capsul.isovolume',
-                   'classif=' + segmentation_S16_path,
-                   'verbosity=1',
-                   'equivolumetric_depth=' + depth_map_path]
-        logger.debug('Running %s', command)
-        subprocess.check_call(command, env=system_env)
-
-        self.update_state(state='PROGRESS', meta={
-            'message': 'Removing NaNs and clamping depth values',
-        })
-        logger.info('Removing NaNs and clamping depth values in %s',
-                    depth_map_path)
-        command = [current_app.config['BV_ENV_PATH'],
-                   'AimsRemoveNaN',
-                   '-np', '--value', '0.5',
-                   '-i', depth_map_path,
-                   '-o', depth_map_path]
-        logger.debug('Running %s', command)
-        subprocess.check_call(command, env=system_env)
-        command = [current_app.config['BV_ENV_PATH'],
-                   'AimsThreshold',
-                   '-m', 'be', '--clip',
-                   '-t', '0',
-                   '-u', '1',
-                   '--input', depth_map_path,
-                   '--output', depth_map_path]
-        logger.debug('Running %s', command)
-        subprocess.check_call(command, env=system_env)
+        task_checkpoints.run(
+            'download segmentation', download_image, self, client,
+            segmentation_name, segmentation_path, 'downloading segmentation')
 
-        self.update_state(state='PROGRESS', meta={
-            'message': 'uploading the depth map',
-        })
-        logger.info('uploading the depth map')
-        depth_map_filename = (
-            segmentation_basename + '-equivolumetric-depth.nii.gz'
-        )
-        try:
-            with open(depth_map_path, 'rb') as f:
-                client.preflight_image(f, file_name=depth_map_filename)
-        except requests.HTTPError as e:
-            if e.response.status_code == 409:
-                depth_map_filename = (
-                    segmentation_basename + '-equivolumetric-depth-'
-                    + datetime_now_str() + '.nii.gz'
-                )
-            else:
-                raise
-        with open(depth_map_path, 'rb') as f:
-            depth_map_name, _ = client.upload_image_and_get_name(
-                f, file_name=depth_map_filename)
+        node_timings = task_checkpoints.run(
+            'depth map', compute_depth_map,
+            self, segmentation_path, depth_map_path, work_dir)
 
-        try:
-            depth_map_info = client.get_image_info(depth_map_name)
-            if depth_map_info:
-                depth_map_neuroglancer_url = (
-                    'precomputed://' + urljoin(
-                        client.base_url,  # guaranteed to have trailing slash
-                        depth_map_info['links']['normalized'].lstrip('/')
-                    )
-                )
-        except Exception:
-            logger.exception('Failed to retrieve Neuroglancer URL of the '
-                             'depth map named %s', depth_map_name)
-            depth_map_neuroglancer_url = None
+        report_progress(self, 'uploading the depth map',
+                        node_timings=node_timings)
+        depth_map_name, depth_map_neuroglancer_url = task_checkpoints.run(
+            'upload depth map', upload_depth_map,
+            client, depth_map_path, segmentation_basename)
 
         return {
             'message': 'success',
@@ -182,20 +588,19 @@ def depth_map_computation_task(self, params, *, bearer_token):
                 'depth_map_name': depth_map_name,
                 'depth_map_neuroglancer_url': depth_map_neuroglancer_url,
             },
+            'node_timings': node_timings,
         }
-    finally:
-        shutil.rmtree(work_dir)
 
 
-@celery_app.task(bind=True)
+@shared_task(**COMPUTATION_TASK_OPTIONS)
 def alignment_computation_task(self, params, *, bearer_token):
-    work_dir = tempfile.mkdtemp(prefix='alignment_')
-    try:
+    with get_checkpoints(self, 'alignment_') as task_checkpoints, \
+            track_job(self, 'alignment', params, task_checkpoints):
+        work_dir = task_checkpoints.work_dir
         image_name = params['image_name']
         depth_map_name = params['depth_map_name']
-        auth = image_service.BearerTokenAuth(bearer_token)
-        client = image_service.ImageServiceClient(
-            params['image_service_base_url'], auth=auth)
+        client = get_image_service_client(params['image_service_base_url'],
+                                          bearer_token)
         image_basename = secure_filename(image_name)
         depth_map_basename = secure_filename(depth_map_name)
         image_path = os.path.join(
@@ -203,79 +608,118 @@ def alignment_computation_task(self, params, *, bearer_token):
         depth_map_path = os.path.join(
             work_dir, depth_map_basename + '.nii.gz')
 
-        self.update_state(state='PROGRESS', meta={
-            'message': 'downloading depth map',
-        })
-        logger.info('downloading depth map to %s', depth_map_path)
-        with open(depth_map_path, 'wb') as f:
-            client.download_compressed_nifti(depth_map_name, f)
-
-        self.update_state(state='PROGRESS', meta={
-            'message': 'downloading image',
-        })
-        logger.info('downloading image to %s', image_path)
-        with open(image_path, 'wb') as f:
-            client.download_compressed_nifti(image_name, f)
-
-        self.update_state(state='PROGRESS', meta={
-            'message': 'computing alignment',
-        })
-        alignment.estimate_deformation(
-            depth_map_path,
-            current_app.config['TEMPLATE_EQUIVOLUMETRIC_DEPTH'],
-            params['transformation_matrix'],
-            params['landmark_pairs'],
-            work_dir=work_dir,
-        )
+        task_checkpoints.run(
+            'download depth map', download_image, self, client,
+            depth_map_name, depth_map_path, 'downloading depth map')
+        task_checkpoints.run(
+            'download image', download_image, self, client,
+            image_name, image_path, 'downloading image')
 
-        self.update_state(state='PROGRESS', meta={
-            'message': 'resampling the image',
-        })
-        resampled_image_path = os.path.join(
-            work_dir, depth_map_basename + '-resampled.nii.gz')
-        alignment.transform_image(image_path, resampled_image_path,
-                                  work_dir=work_dir)
-
-        self.update_state(state='PROGRESS', meta={
-            'message': 'uploading the resampled image',
-        })
-        logger.info('uploading the resampled image')
-        resampled_image_filename = (
-            image_basename + '-transformed-'
-            + datetime_now_str() + '.nii.gz'
-        )
-        with open(resampled_image_path, 'rb') as f:
-            resampled_image_name, _ = client.upload_image_and_get_name(
-                f, file_name=resampled_image_filename)
+        resampled_image_path, registration_info = align_image(
+            self, task_checkpoints, params, image_path, depth_map_path)
 
-        try:
-            resampled_image_info = client.get_image_info(resampled_image_name)
-            if resampled_image_info:
-                resampled_image_neuroglancer_url = (
-                    'precomputed://' + urljoin(
-                        client.base_url,  # guaranteed to have trailing slash
-                        resampled_image_info['links']['normalized'].lstrip('/')
-                    )
-                )
-        except Exception:
-            logger.exception('Failed to retrieve Neuroglancer URL of the '
-                             'depth map named %s', resampled_image_name)
-            resampled_image_neuroglancer_url = None
+        report_progress(self, 'uploading the resampled image')
+        transformed_image = task_checkpoints.run(
+            'upload transformed image', upload_transformed_image,
+            client, resampled_image_path, image_basename)
 
+        results = {'image_service_base_url': client.base_url}
+        results.update(alignment_results(registration_info,
+                                         *transformed_image))
         return {
             'message': 'success',
-            'results': {
-                'image_service_base_url': client.base_url,
-                'transformed_image_name': resampled_image_name,
-                'transformed_image_neuroglancer_url':
-                resampled_image_neuroglancer_url,
-                'transformation_matrix': params['transformation_matrix'],
-            },
+            'results': results,
         }
-    finally:
-        shutil.rmtree(work_dir)
 
 
-@celery_app.task
+@shared_task(**COMPUTATION_TASK_OPTIONS)
+def depth_map_and_alignment_computation_task(self, params, *, bearer_token):
+    """Compute the depth map, then the alignment, in a single task.
+
+    The depth map is fed to the registration directly from the scratch
+    directory. It is uploaded to the image service (for display only) in a
+    background thread, concurrently with the alignment. The task does not
+    return before the upload has finished, even if the alignment fails.
+    """
+    with get_checkpoints(self, 'depth_map_and_alignment_') \
+            as task_checkpoints, \
+            track_job(self, 'depth-map-and-alignment', params,
+                      task_checkpoints):
+        upload_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        depth_map_upload = None
+        try:
+            work_dir = task_checkpoints.work_dir
+            segmentation_name = params['segmentation_name']
+            image_name = params['image_name']
+            client = get_image_service_client(params['image_service_base_url'],
+                                              bearer_token)
+            segmentation_basename = secure_filename(segmentation_name)
+            image_basename = secure_filename(image_name)
+            segmentation_path = os.path.join(
+                work_dir, segmentation_basename + '.nii.gz')
+            depth_map_path = os.path.join(
+                work_dir,
+                segmentation_basename + '-equivolumetric-depth.nii.gz'
+            )
+            image_path = os.path.join(
+                work_dir, image_basename + '.nii.gz')
+
+            task_checkpoints.run(
+                'download segmentation', download_image, self, client,
+                segmentation_name, segmentation_path,
+                'downloading segmentation')
+            task_checkpoints.run(
+                'download image', download_image, self, client,
+                image_name, image_path, 'downloading image')
+
+            node_timings = task_checkpoints.run(
+                'depth map', compute_depth_map,
+                self, segmentation_path, depth_map_path, work_dir)
+
+            depth_map_upload = upload_executor.submit(
+                tracing.wrap(task_checkpoints.run),
+                'upload depth map', upload_depth_map,
+                client, depth_map_path, segmentation_basename)
+
+            resampled_image_path, registration_info = align_image(
+                self, task_checkpoints, params, image_path, depth_map_path)
+
+            report_progress(self, 'uploading the resampled image')
+            transformed_image = task_checkpoints.run(
+                'upload transformed image', upload_transformed_image,
+                client, resampled_image_path, image_basename)
+
+            report_progress(self, 'uploading the depth map')
+            depth_map_name, depth_map_neuroglancer_url = (
+                depth_map_upload.result())
+
+            results = {
+                'image_service_base_url': client.base_url,
+                'depth_map_name': depth_map_name,
+                'depth_map_neuroglancer_url': depth_map_neuroglancer_url,
+            }
+            results.update(alignment_results(registration_info,
+                                             *transformed_image))
+            return {
+                'message': 'success',
+                'results': results,
+                'node_timings': node_timings,
+            }
+        except BaseException as exc:
+            # The upload reads the depth map from the scratch directory,
+            # which is removed when the task finishes. It cannot be
+            # interrupted once started, so wait for it to finish.
+            if (depth_map_upload is not None
+                    and not depth_map_upload.cancel()):
+                upload_error = depth_map_upload.exception()
+                if upload_error is not None and upload_error is not exc:
+                    logger.error('The upload of the depth map has failed',
+                                 exc_info=upload_error)
+            raise
+        finally:
+            upload_executor.shutdown()
+
+
+@shared_task
 def worker_health_task():
     return os.path.isfile(current_app.config['TEMPLATE_EQUIVOLUMETRIC_DEPTH'])
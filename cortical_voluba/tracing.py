@@ -0,0 +1,262 @@
+# Copyright 2020 CEA
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# This file is part of cortical-voluba.
+#
+# cortical-voluba is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# cortical-voluba is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License
+# for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with cortical-voluba. If not, see <https://www.gnu.org/licenses/>.
+
+
+"""Tracing of the computations across the API, the broker and the workers.
+
+A trace follows one computation from the API request that submits it, through
+its waiting time in the queue, to the stages and external processes run by
+the worker. The trace context is propagated in the `W3C Trace Context`_
+format: it is read from the ``traceparent`` header of incoming API requests
+(if any), passed to the worker in the ``traceparent`` header of the Celery
+message, and can be passed to other processes with `current_traceparent`.
+
+Finished spans are appended to a file (see `configure`) as JSON lines in the
+`Zipkin v2`_ format, so that a trace can be displayed by any tool that reads
+this format (e.g. by posting the spans of a trace to a Zipkin collector).
+Spans are only written if a file is configured, but the trace context is
+always propagated.
+
+.. _W3C Trace Context: https://www.w3.org/TR/trace-context/
+.. _Zipkin v2: https://zipkin.io/zipkin-api/
+"""
+
+import functools
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SERVICE_NAME = 'cortical-voluba'
+
+_TRACEPARENT_RE = re.compile(
+    r'^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$')
+
+_config = {
+    'trace_file': None,
+    'service_name': DEFAULT_SERVICE_NAME,
+}
+_write_lock = threading.Lock()
+_local = threading.local()
+
+
+def configure(trace_file):
+    """Configure the export of the spans of this process.
+
+    :param str trace_file: path of the file where the finished spans are
+           appended, or None to disable the export
+    """
+    _config['trace_file'] = trace_file
+
+
+def set_service_name(service_name):
+    """Set the name of the service that is attached to the spans.
+
+    This distinguishes the spans of the API from those of the workers.
+    """
+    _config['service_name'] = service_name
+
+
+def _random_id(num_bytes):
+    return os.urandom(num_bytes).hex()
+
+
+def parse_traceparent(traceparent):
+    """Parse a ``traceparent`` header.
+
+    :returns: a tuple ``(trace_id, parent_id)``, or None if the header is
+              missing or invalid
+    """
+    if not traceparent:
+        return None
+    match = _TRACEPARENT_RE.match(traceparent.strip().lower())
+    if not match or match.group(1) == '0' * 32 or match.group(2) == '0' * 16:
+        return None
+    return match.group(1), match.group(2)
+
+
+def _get_stack():
+    try:
+        return _local.stack
+    except AttributeError:
+        _local.stack = []
+        return _local.stack
+
+
+def current_span():
+    """Get the active span of the current thread (None if there is none)."""
+    stack = _get_stack()
+    return stack[-1] if stack else None
+
+
+def current_traceparent():
+    """Get the ``traceparent`` header for propagating the active span."""
+    span = current_span()
+    return span.traceparent if span is not None else None
+
+
+class Span:
+    """A timed operation within a trace.
+
+    A span is usually used as a context manager, which makes it the active
+    span of the current thread (the parent of the spans started within the
+    block), and finishes it at the end of the block.
+
+    :param str name: name of the operation
+    :param parent: the parent span, or a ``traceparent`` header; by default
+           the active span of the current thread is used, and a new trace is
+           started if there is none
+    :param str kind: ``'SERVER'``, ``'CLIENT'``, ``'PRODUCER'``, or
+           ``'CONSUMER'`` for spans that cross process boundaries
+    :param float start_time: POSIX timestamp of the start (default: now)
+    :param tags: string annotations of the span
+    """
+    def __init__(self, name, parent=None, kind=None, start_time=None,
+                 **tags):
+        if parent is None:
+            parent = current_span()
+        if isinstance(parent, Span):
+            parent = (parent.trace_id, parent.span_id)
+        elif parent is not None:
+            parent = parse_traceparent(parent)
+        if parent is None:
+            self.trace_id, self.parent_id = _random_id(16), None
+        else:
+            self.trace_id, self.parent_id = parent
+        self.span_id = _random_id(8)
+        self.name = name
+        self.kind = kind
+        self.start_time = time.time() if start_time is None else start_time
+        self.end_time = None
+        self.tags = {}
+        for key, value in tags.items():
+            self.set_tag(key, value)
+
+    def __repr__(self):
+        return '<Span {0!r}: {1}>'.format(self.name, self.traceparent)
+
+    @property
+    def traceparent(self):
+        """The ``traceparent`` header that designates this span."""
+        return '00-{0}-{1}-01'.format(self.trace_id, self.span_id)
+
+    def set_tag(self, key, value):
+        self.tags[key] = str(value)
+
+    def activate(self):
+        """Make this span the active span of the current thread."""
+        _get_stack().append(self)
+
+    def deactivate(self):
+        stack = _get_stack()
+        if self in stack:
+            stack.remove(self)
+
+    def finish(self, end_time=None):
+        """Record the end of the span, and export it."""
+        if self.end_time is not None:
+            return
+        self.end_time = time.time() if end_time is None else end_time
+        _export(self)
+
+    def __enter__(self):
+        self.activate()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.set_tag('error', exc_type.__name__)
+        self.deactivate()
+        self.finish()
+
+    def to_zipkin(self):
+        """Represent the span in the Zipkin v2 JSON format."""
+        span = {
+            'traceId': self.trace_id,
+            'id': self.span_id,
+            'name': self.name,
+            'timestamp': int(self.start_time * 1e6),
+            'duration': max(int((self.end_time - self.start_time) * 1e6), 1),
+            'localEndpoint': {'serviceName': _config['service_name']},
+        }
+        if self.parent_id is not None:
+            span['parentId'] = self.parent_id
+        if self.kind is not None:
+            span['kind'] = self.kind
+        if self.tags:
+            span['tags'] = self.tags
+        return span
+
+
+def record_span(name, start_time, end_time, parent=None, **tags):
+    """Record an operation that has already finished (e.g. a queue wait)."""
+    finished_span = Span(name, parent=parent, start_time=start_time, **tags)
+    finished_span.finish(end_time=end_time)
+    return finished_span
+
+
+def traced(name):
+    """Decorate a function, so that each of its calls is run in a span."""
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with Span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def wrap(function):
+    """Run a function in the trace context of the caller (e.g. in a thread).
+
+    :returns: a function that activates the current span of the caller while
+              it runs function
+    """
+    parent = current_span()
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if parent is None:
+            return function(*args, **kwargs)
+        parent.activate()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            parent.deactivate()
+    return wrapper
+
+
+def _export(finished_span):
+    trace_file = _config['trace_file']
+    if not trace_file:
+        return
+    line = json.dumps(finished_span.to_zipkin()) + '\n'
+    try:
+        with _write_lock:
+            # Each span is appended with a single write, so that the files
+            # of concurrent processes are not interleaved.
+            with open(trace_file, 'a') as f:
+                f.write(line)
+    except OSError:
+        logger.warning('Cannot write the span to %s', trace_file,
+                       exc_info=True)
@@ -90,6 +90,7 @@ def find_version(*file_paths):
             "tox",
         ],
         "tests": tests_require,
+        "antspy": ["antspyx"],
     },
     setup_requires=pytest_runner,
     tests_require=tests_require,
@@ -0,0 +1,326 @@
+# Copyright 2020 CEA
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# This file is part of cortical-voluba.
+#
+# cortical-voluba is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# cortical-voluba is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License
+# for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with cortical-voluba. If not, see <https://www.gnu.org/licenses/>.
+
+import os.path
+
+import nibabel
+import numpy
+import pytest
+
+from cortical_voluba import alignment
+from cortical_voluba import displacement
+from cortical_voluba import processes
+
+
+def test_transform_points():
+    matrix = numpy.array([[2, 0, 0, 1],
+                          [0, 1, 0, 0],
+                          [0, 0, 1, -1],
+                          [0, 0, 0, 1]])
+    numpy.testing.assert_allclose(
+        alignment.transform_points([[0, 0, 0], [1, 2, 3]], matrix),
+        [[1, 0, -1], [3, 2, 2]])
+
+
+def test_crop_to_registration_roi(tmp_path):
+    incoming = numpy.zeros((50, 40, 30), dtype=numpy.float32)
+    incoming[10:20, 10:15, 5:10] = 0.5
+    incoming_path = str(tmp_path / 'incoming.nii.gz')
+    nibabel.save(nibabel.Nifti1Image(incoming, numpy.diag([0.5, 0.5, 1, 1])),
+                 incoming_path)
+    template = numpy.ones((100, 100, 100), dtype=numpy.float32)
+    template_affine = numpy.diag([1., 1., 1., 1.])
+    template_affine[:3, 3] = [-50, -50, -50]
+    template_path = str(tmp_path / 'template.nii.gz')
+    nibabel.save(nibabel.Nifti1Image(template, template_affine),
+                 template_path)
+    # translation of the incoming volume into template space
+    incoming_to_template = numpy.eye(4)
+    incoming_to_template[:3, 3] = [10, 20, 30]
+
+    fixed_path, moving_path, fixed_bbox = (
+        alignment.crop_to_registration_roi(
+            incoming_path, template_path, incoming_to_template,
+            margin=1.0, work_dir=str(tmp_path)))
+
+    assert fixed_bbox == (slice(8, 22), slice(8, 17), slice(4, 11))
+    fixed_img = nibabel.load(fixed_path)
+    assert fixed_img.shape == (14, 9, 7)
+    numpy.testing.assert_allclose(fixed_img.affine[:3, 3], [4, 4, 4])
+
+    moving_img = nibabel.load(moving_path)
+    # The incoming region spans [4, 11) x [4, 8.5) x [4, 11) mm in scaled
+    # voxel coordinates, i.e. [14, 21) x [24, 28.5) x [34, 41) mm in template
+    # space, plus a margin of 1 mm.
+    bbox_min = moving_img.affine[:3, 3]
+    bbox_max = bbox_min + numpy.asarray(moving_img.shape) - 1
+    assert numpy.all(bbox_min <= [13, 23, 33])
+    assert numpy.all(bbox_min >= [10, 20, 30])
+    assert numpy.all(bbox_max >= [21, 28.5, 41])
+    assert numpy.all(bbox_max <= [25, 33, 45])
+
+
+def test_crop_to_registration_roi_empty(tmp_path):
+    incoming_path = str(tmp_path / 'incoming.nii.gz')
+    nibabel.save(nibabel.Nifti1Image(numpy.zeros((5, 5, 5)), numpy.eye(4)),
+                 incoming_path)
+    ret = alignment.crop_to_registration_roi(
+        incoming_path, 'template.nii.gz', numpy.eye(4),
+        margin=1.0, work_dir=str(tmp_path))
+    assert ret == (incoming_path, 'template.nii.gz', None)
+
+
+def fake_ants_registration(command, cwd):
+    """Write constant deformation fields on the grid of the fixed image."""
+    assert command[0] == 'antsRegistration'
+    metric = command[command.index('--metric') + 1]
+    fixed_path = metric[len('MeanSquares['):].split(',')[0]
+    output_prefix = command[command.index('--output') + 1]
+    fixed_img = nibabel.load(fixed_path)
+    warp = nibabel.Nifti1Image(
+        numpy.ones(fixed_img.shape[:3] + (1, 3), dtype=numpy.float32),
+        fixed_img.affine)
+    warp.header.set_intent('vector')
+    for suffix in ('1Warp.nii.gz', '1InverseWarp.nii.gz'):
+        nibabel.save(warp, os.path.join(cwd, output_prefix + suffix))
+
+
+def test_estimate_deformation_roi(flask_app, tmp_path, monkeypatch):
+    incoming = numpy.zeros((20, 20, 20), dtype=numpy.float32)
+    incoming[5:10, 5:10, 5:10] = 1
+    incoming_path = str(tmp_path / 'incoming.nii.gz')
+    nibabel.save(nibabel.Nifti1Image(incoming, numpy.eye(4)), incoming_path)
+    template_path = str(tmp_path / 'template.nii.gz')
+    nibabel.save(nibabel.Nifti1Image(numpy.ones((30, 30, 30)), numpy.eye(4)),
+                 template_path)
+    monkeypatch.setattr(processes, 'check_call',
+                        fake_ants_registration)
+    flask_app.config['REGISTRATION_CROP_MARGIN'] = 1.0
+
+    with flask_app.app_context():
+        alignment.estimate_deformation(incoming_path, template_path,
+                                       numpy.eye(4).tolist(), [],
+                                       work_dir=str(tmp_path))
+
+    warp_img = nibabel.load(str(tmp_path / 'cortical1InverseWarp.nii.gz'))
+    assert warp_img.shape == (20, 20, 20, 1, 3)
+    numpy.testing.assert_allclose(warp_img.affine, numpy.eye(4))
+    assert warp_img.header.get_intent()[0] == 'vector'
+    warp = numpy.asanyarray(warp_img.dataobj)
+    assert numpy.all(warp[4:11, 4:11, 4:11] == 1)
+    assert numpy.sum(warp != 0) == 7 * 7 * 7 * 3
+
+
+def test_estimate_deformation_downsampling(flask_app, tmp_path, monkeypatch):
+    # Incoming image with 0.25 mm voxels, template with 1 mm voxels
+    incoming = numpy.zeros((41, 40, 40), dtype=numpy.float32)
+    incoming[10:30, 10:30, 10:30] = 1
+    incoming_path = str(tmp_path / 'incoming.nii.gz')
+    nibabel.save(nibabel.Nifti1Image(incoming, numpy.diag([.25] * 3 + [1])),
+                 incoming_path)
+    template_path = str(tmp_path / 'template.nii.gz')
+    nibabel.save(nibabel.Nifti1Image(numpy.ones((30, 30, 30)), numpy.eye(4)),
+                 template_path)
+    monkeypatch.setattr(processes, 'check_call',
+                        fake_ants_registration)
+    flask_app.config['REGISTRATION_CROP_MARGIN'] = 1.0
+
+    with flask_app.app_context():
+        info = alignment.estimate_deformation(
+            incoming_path, template_path,
+            numpy.eye(4).tolist(), [],
+            work_dir=str(tmp_path), preset='balanced')
+
+    schedule = info['registration_schedule']
+    assert schedule['preset'] == 'balanced'
+    assert schedule['fixed_downsampling_factors'] == [4, 4, 4]
+    # The warp is returned on the downsampled full grid
+    warp_img = nibabel.load(str(tmp_path / 'cortical1InverseWarp.nii.gz'))
+    assert warp_img.shape == (11, 10, 10, 1, 3)
+    numpy.testing.assert_allclose(warp_img.affine,
+                                  [[1, 0, 0, .375],
+                                   [0, 1, 0, .375],
+                                   [0, 0, 1, .375],
+                                   [0, 0, 0, 1]])
+    warp = numpy.asanyarray(warp_img.dataobj)
+    assert numpy.all(warp[2:8, 2:8, 2:8] == 1)
+    assert warp[0, 0, 0, 0, 0] == 0
+
+
+def test_estimate_deformation_inconsistent_landmarks(flask_app, tmp_path,
+                                                     monkeypatch):
+    def check_call_mock(command, cwd):
+        raise AssertionError('the registration must not be run')
+    monkeypatch.setattr(processes, 'check_call', check_call_mock)
+    flask_app.config['LANDMARK_AFFINE_REFINEMENT'] = 'affine'
+    flask_app.config['LANDMARK_MAX_RMS_RESIDUAL'] = 1.0
+    incoming_path = str(tmp_path / 'incoming.nii.gz')
+    nibabel.save(nibabel.Nifti1Image(numpy.ones((5, 5, 5)), numpy.eye(4)),
+                 incoming_path)
+    # Points that are not related by any affine transformation
+    landmark_pairs = [
+        {'source_point': [0, 0, 0], 'target_point': [0, 0, 0]},
+        {'source_point': [10, 0, 0], 'target_point': [-10, 0, 0]},
+        {'source_point': [0, 10, 0], 'target_point': [0, 0, 0]},
+        {'source_point': [-10, 0, 0], 'target_point': [-10, 0, 0]},
+        {'source_point': [0, 0, 10], 'target_point': [0, 0, 10]},
+    ]
+    with flask_app.app_context():
+        with pytest.raises(alignment.LandmarkMismatchError):
+            alignment.estimate_deformation(incoming_path, 'template.nii.gz',
+                                           numpy.eye(4).tolist(),
+                                           landmark_pairs,
+                                           work_dir=str(tmp_path))
+
+
+def test_estimate_deformation_few_landmarks_keep_matrix(flask_app, tmp_path,
+                                                        monkeypatch):
+    incoming = numpy.zeros((20, 20, 20), dtype=numpy.float32)
+    incoming[5:10, 5:10, 5:10] = 1
+    incoming_path = str(tmp_path / 'incoming.nii.gz')
+    nibabel.save(nibabel.Nifti1Image(incoming, numpy.eye(4)), incoming_path)
+    template_path = str(tmp_path / 'template.nii.gz')
+    nibabel.save(nibabel.Nifti1Image(numpy.ones((30, 30, 30)), numpy.eye(4)),
+                 template_path)
+    monkeypatch.setattr(processes, 'check_call', fake_ants_registration)
+    flask_app.config['LANDMARK_AFFINE_REFINEMENT'] = 'affine'
+    transformation_matrix = [[1, 0, 0, 2],
+                             [0, 1, 0, 0],
+                             [0, 0, 1, 0],
+                             [0, 0, 0, 1]]
+    # Four landmarks that agree with the matrix, except a gross outlier
+    landmark_pairs = [
+        {'source_point': [2, 0, 0], 'target_point': [0, 0, 0]},
+        {'source_point': [12, 0, 0], 'target_point': [10, 0, 0]},
+        {'source_point': [2, 10, 0], 'target_point': [0, 10, 0]},
+        {'source_point': [40, -30, 10], 'target_point': [0, 0, 10]},
+    ]
+    with flask_app.app_context():
+        info = alignment.estimate_deformation(
+            incoming_path, template_path, transformation_matrix,
+            landmark_pairs, work_dir=str(tmp_path))
+    assert info['transformation_matrix'] == transformation_matrix
+    assert info['landmark_report']['model'] is None
+
+
+def test_estimate_deformation_inactive_landmarks(flask_app, tmp_path,
+                                                 monkeypatch):
+    incoming = numpy.zeros((20, 20, 20), dtype=numpy.float32)
+    incoming[5:10, 5:10, 5:10] = 1
+    incoming_path = str(tmp_path / 'incoming.nii.gz')
+    nibabel.save(nibabel.Nifti1Image(incoming, numpy.eye(4)), incoming_path)
+    template_path = str(tmp_path / 'template.nii.gz')
+    nibabel.save(nibabel.Nifti1Image(numpy.ones((30, 30, 30)), numpy.eye(4)),
+                 template_path)
+    monkeypatch.setattr(processes, 'check_call', fake_ants_registration)
+    flask_app.config['LANDMARK_AFFINE_REFINEMENT'] = 'affine'
+    flask_app.config['LANDMARK_MAX_RMS_RESIDUAL'] = 1.0
+    transformation_matrix = [[1, 0, 0, 2],
+                             [0, 1, 0, 0],
+                             [0, 0, 1, 0],
+                             [0, 0, 0, 1]]
+    rng = numpy.random.RandomState(0)
+    incoming_points = rng.uniform(0, 20, size=(9, 3))
+    landmark_pairs = [
+        {'source_point': (point + [2, 0, 0]).tolist(),
+         'target_point': point.tolist()}
+        for point in incoming_points
+    ]
+    # A gross outlier that has been disabled by the user
+    landmark_pairs.append({'source_point': [40, -30, 10],
+                           'target_point': [0, 0, 10],
+                           'active': False})
+    with flask_app.app_context():
+        info = alignment.estimate_deformation(
+            incoming_path, template_path, transformation_matrix,
+            landmark_pairs, work_dir=str(tmp_path))
+    numpy.testing.assert_allclose(info['transformation_matrix'],
+                                  transformation_matrix, atol=1e-8)
+    report = info['landmark_report']
+    assert report['model'] == 'affine'
+    assert report['num_landmarks'] == 9
+    assert report['outliers'] == []
+
+
+def test_transform_image_composite(flask_app, tmp_path, monkeypatch):
+    def check_call_mock(command, cwd):
+        raise AssertionError('ANTs must not be called')
+    monkeypatch.setattr(processes, 'check_call', check_call_mock)
+    affine = numpy.diag([0.5, 0.5, 0.5, 1])
+    image = numpy.arange(6 * 7 * 8, dtype=numpy.int16).reshape((6, 7, 8))
+    image_path = str(tmp_path / 'image.nii.gz')
+    image_img = nibabel.Nifti1Image(image, affine)
+    image_img.set_qform(affine, code=1)
+    nibabel.save(image_img, image_path)
+    field = numpy.zeros((6, 7, 8, 3), dtype=numpy.float32)
+    field[..., 0] = 1
+    displacement.save_displacement(
+        str(tmp_path / alignment.COMPOSITE_DISPLACEMENT_FILE_NAME),
+        displacement.DisplacementField(field, numpy.eye(4), affine,
+                                       field.shape[:3]))
+
+    output_path = str(tmp_path / 'resampled.nii.gz')
+    with flask_app.app_context():
+        alignment.transform_image(image_path, output_path,
+                                  work_dir=str(tmp_path))
+    resampled_img = nibabel.load(output_path)
+    numpy.testing.assert_allclose(resampled_img.affine, affine)
+    resampled = numpy.asanyarray(resampled_img.dataobj)
+    numpy.testing.assert_allclose(resampled[:5], image[1:])
+
+
+def test_transform_image_preserve_data_type(flask_app, tmp_path):
+    affine = numpy.eye(4)
+    image = numpy.array([0, 10, 20, 250], dtype=numpy.uint8).reshape(
+        (4, 1, 1))
+    image_img = nibabel.Nifti1Image(image, affine)
+    image_img.set_qform(affine, code=1)
+    image_img.header.set_slope_inter(2.0, -10.0)
+    image_path = str(tmp_path / 'image.nii.gz')
+    nibabel.save(image_img, image_path)
+    field = numpy.zeros((4, 1, 1, 3), dtype=numpy.float32)
+    field[:, 0, 0, 0] = [0.25, 0.5, 0, 0]
+    displacement.save_displacement(
+        str(tmp_path / alignment.COMPOSITE_DISPLACEMENT_FILE_NAME),
+        displacement.DisplacementField(field, numpy.eye(4), affine,
+                                       field.shape[:3]))
+
+    output_path = str(tmp_path / 'resampled.nii.gz')
+    # The data type of the input is preserved by default
+    with flask_app.app_context():
+        alignment.transform_image(image_path, output_path,
+                                  work_dir=str(tmp_path))
+    resampled_img = nibabel.load(output_path)
+    assert resampled_img.get_data_dtype() == numpy.uint8
+    assert resampled_img.dataobj.slope == 2.0
+    assert resampled_img.dataobj.inter == -10.0
+    numpy.testing.assert_array_equal(
+        numpy.asanyarray(resampled_img.dataobj.get_unscaled()).ravel(),
+        [2, 15, 20, 250])
+
+    with flask_app.app_context():
+        alignment.transform_image(image_path, output_path,
+                                  work_dir=str(tmp_path),
+                                  output_data_type='input',
+                                  keep_scaling=False)
+    resampled_img = nibabel.load(output_path)
+    assert resampled_img.get_data_dtype() == numpy.uint8
+    # Scaled values are clamped to the range of uint8
+    numpy.testing.assert_array_equal(
+        numpy.asanyarray(resampled_img.dataobj).ravel(),
+        [0, 20, 30, 255])
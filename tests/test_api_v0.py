@@ -17,14 +17,17 @@
 # along with cortical-voluba. If not, see <https://www.gnu.org/licenses/>.
 
 import copy
+import datetime
+import time
 
 import celery.app.base
+import celery.app.control
 import celery.backends.base
 import celery.result
 import pytest
 import requests
 
-from testdata import DUMMY_IMAGE_LIST
+from testdata import DUMMY_IMAGE_LIST, make_nifti_header_gz
 
 
 @pytest.fixture(autouse=True)
@@ -52,8 +55,15 @@ def set_get_return_value(self, return_value):
     return ResultMocker()
 
 
+def mock_image_headers(requests_mock, shape=(10, 20, 30)):
+    for name in ('seg', 'img', 'depthmap'):
+        requests_mock.get('http://h.test/b/download/{0}.nii.gz'.format(name),
+                          content=make_nifti_header_gz(shape))
+
+
 def test_create_depth_map_computation(flask_client, requests_mock):
     requests_mock.get('http://h.test/b/list', json=DUMMY_IMAGE_LIST)
+    mock_image_headers(requests_mock)
 
     # Well-behaved request
     response = flask_client.post(
@@ -65,6 +75,101 @@ def test_create_depth_map_computation(flask_client, requests_mock):
         },)
     assert response.status_code == 202
     assert 'dummy_id_for_' in response.json['status_polling_url']
+    assert response.json['resource_estimate']['input_voxels'] == 6000
+    assert response.json['resource_estimate']['memory_bytes'] > 0
+    assert response.json['resource_estimate']['runtime_seconds'] >= 0
+    # Without history, the running time is taken from the resource estimate
+    assert response.json['estimated_start'] is not None
+    assert response.json['estimated_completion'] is not None
+
+
+def test_create_computation_predicted_times(flask_app, flask_client,
+                                            requests_mock, tmp_path):
+    from cortical_voluba import ledger
+    flask_app.config['JOB_LEDGER_PATH'] = str(tmp_path / 'ledger.sqlite')
+    job_ledger = ledger.JobLedger(flask_app.config['JOB_LEDGER_PATH'])
+    for n in range(1, 6):
+        job_ledger.record('depth-map', 'success', input_voxels=n * 1000,
+                          queue='celery', queue_wait_seconds=600,
+                          stage_seconds={'depth map': 3600 * n / 6})
+    requests_mock.get('http://h.test/b/list', json=DUMMY_IMAGE_LIST)
+    mock_image_headers(requests_mock)
+
+    response = flask_client.post(
+        '/v0/depth-map-computation/',
+        headers={'Authorization': 'Bearer test'},
+        json={
+            'image_service_base_url': 'http://h.test/b/',
+            'segmentation_name': 'seg',
+        },)
+    assert response.status_code == 202
+    start = datetime.datetime.strptime(response.json['estimated_start'],
+                                       '%Y-%m-%dT%H:%M:%SZ')
+    completion = datetime.datetime.strptime(
+        response.json['estimated_completion'], '%Y-%m-%dT%H:%M:%SZ')
+    # The 6000 input voxels are predicted to take one hour
+    assert (completion - start).total_seconds() == 3600
+    assert abs((start - datetime.datetime.utcnow()).total_seconds()
+               - 600) < 5
+
+
+def test_create_computation_resource_limits(flask_app, flask_client,
+                                            requests_mock):
+    requests_mock.get('http://h.test/b/list', json=DUMMY_IMAGE_LIST)
+    mock_image_headers(requests_mock, shape=(1000, 1000, 1000))
+    request = {
+        'image_service_base_url': 'http://h.test/b/',
+        'segmentation_name': 'seg',
+    }
+
+    flask_app.config['MAX_INPUT_VOXELS'] = 10 ** 8
+    response = flask_client.post('/v0/depth-map-computation/',
+                                 headers={'Authorization': 'Bearer test'},
+                                 json=request)
+    assert response.status_code == 400
+    assert 'too large' in response.json['errors'][0]
+
+    flask_app.config['MAX_INPUT_VOXELS'] = None
+    flask_app.config['MAX_ESTIMATED_MEMORY'] = 16 * 1024 ** 3
+    response = flask_client.post('/v0/depth-map-computation/',
+                                 headers={'Authorization': 'Bearer test'},
+                                 json=request)
+    assert response.status_code == 400
+    assert 'GiB of memory' in response.json['errors'][0]
+
+    flask_app.config['MAX_ESTIMATED_MEMORY'] = 1024 ** 4
+    response = flask_client.post('/v0/depth-map-computation/',
+                                 headers={'Authorization': 'Bearer test'},
+                                 json=request)
+    assert response.status_code == 202
+    assert response.json['resource_estimate']['input_voxels'] == 10 ** 9
+
+
+def test_create_computation_unreadable_header(flask_app, flask_client,
+                                              requests_mock):
+    flask_app.config['MAX_INPUT_VOXELS'] = 1
+    requests_mock.get('http://h.test/b/list', json=DUMMY_IMAGE_LIST)
+    request = {
+        'image_service_base_url': 'http://h.test/b/',
+        'segmentation_name': 'seg',
+    }
+
+    # The computation is accepted without an estimate
+    requests_mock.get('http://h.test/b/download/seg.nii.gz',
+                      content=b'not a gzip file')
+    response = flask_client.post('/v0/depth-map-computation/',
+                                 headers={'Authorization': 'Bearer test'},
+                                 json=request)
+    assert response.status_code == 202
+    assert response.json['resource_estimate'] is None
+
+    requests_mock.get('http://h.test/b/download/seg.nii.gz',
+                      exc=requests.ConnectionError)
+    response = flask_client.post('/v0/depth-map-computation/',
+                                 headers={'Authorization': 'Bearer test'},
+                                 json=request)
+    assert response.status_code == 202
+    assert response.json['resource_estimate'] is None
 
 
 def test_create_depth_map_computation_request_errors(
@@ -181,6 +286,7 @@ def test_create_depth_map_computation_image_service_errors(
 
 def test_create_alignment_computation(flask_client, requests_mock):
     requests_mock.get('http://h.test/b/list', json=DUMMY_IMAGE_LIST)
+    mock_image_headers(requests_mock)
 
     # Well-behaved request
     response = flask_client.post(
@@ -189,6 +295,37 @@ def test_create_alignment_computation(flask_client, requests_mock):
         json=TEST_ALIGNMENT_REQUEST)
     assert response.status_code == 202
     assert 'dummy_id_for_' in response.json['status_polling_url']
+    assert response.json['resource_estimate']['input_voxels'] == 6000
+    # Both images are verified with a single listing of the image service
+    assert [r.path for r in requests_mock.request_history].count(
+        '/b/list') == 1
+
+
+def test_create_depth_map_and_alignment_computation(flask_client,
+                                                    requests_mock):
+    requests_mock.get('http://h.test/b/list', json=DUMMY_IMAGE_LIST)
+    mock_image_headers(requests_mock)
+    request = copy.deepcopy(TEST_ALIGNMENT_REQUEST)
+    del request['depth_map_name']
+    request['segmentation_name'] = 'seg'
+
+    response = flask_client.post(
+        '/v0/depth-map-and-alignment-computation/',
+        headers={'Authorization': 'Bearer test'},
+        json=request)
+    assert response.status_code == 202
+    assert 'dummy_id_for_' in response.json['status_polling_url']
+    assert ('depth_map_and_alignment_computation_task'
+            in response.json['status_polling_url'])
+
+    # The segmentation must be a segmentation
+    request['segmentation_name'] = 'img'
+    response = flask_client.post(
+        '/v0/depth-map-and-alignment-computation/',
+        headers={'Authorization': 'Bearer test'},
+        json=request)
+    assert response.status_code == 400
+    assert 'errors' in response.json
 
 
 def test_create_alignment_computation_request_errors(
@@ -302,7 +439,8 @@ def delete(self, key):
         del self._store[key]
 
 
-@pytest.mark.parametrize('computation_type', ['depth-map', 'alignment'])
+@pytest.mark.parametrize('computation_type', [
+    'depth-map', 'alignment', 'depth-map-and-alignment'])
 def test_computation_status(monkeypatch, flask_client, computation_type):
     from cortical_voluba.celery import celery_app
     mock_backend = MockBackend(celery_app)
@@ -327,6 +465,8 @@ def test_computation_status(monkeypatch, flask_client, computation_type):
 
     mock_backend.store_result('dummy_id', {
         'message': 'toto',
+        'estimated_start': '2020-01-01T10:00:00Z',
+        'estimated_completion': '2020-01-01T10:05:00Z',
     }, 'PROGRESS')
     response = flask_client.get(endpoint_url)
     assert response.status_code == 200
@@ -334,6 +474,7 @@ def test_computation_status(monkeypatch, flask_client, computation_type):
     assert 'toto' in response.json['message']
     assert 'error' not in response.json
     assert 'results' not in response.json
+    assert response.json['estimated_completion'] == '2020-01-01T10:05:00Z'
 
     mock_backend.mark_as_retry('dummy_id', None)
     response = flask_client.get(endpoint_url)
@@ -365,6 +506,71 @@ def test_computation_status(monkeypatch, flask_client, computation_type):
     assert 'error' not in response.json
 
 
+def test_queued_computation_status(monkeypatch, flask_app, flask_client,
+                                   requests_mock, tmp_path):
+    from cortical_voluba import ledger
+    from cortical_voluba.celery import celery_app
+    monkeypatch.setattr(celery_app, 'backend', MockBackend(celery_app))
+    monkeypatch.setattr(celery.app.control.Control, 'revoke',
+                        lambda *args, **kwargs: None)
+    flask_app.config['JOB_LEDGER_PATH'] = str(tmp_path / 'ledger.sqlite')
+    job_ledger = ledger.JobLedger(flask_app.config['JOB_LEDGER_PATH'])
+    for n in range(1, 6):
+        job_ledger.record('depth-map', 'success', input_voxels=1000,
+                          queue='celery', queue_wait_seconds=10,
+                          total_seconds=600,
+                          stage_seconds={'depth map': 600})
+    requests_mock.get('http://h.test/b/list', json=DUMMY_IMAGE_LIST)
+    mock_image_headers(requests_mock)
+
+    # The submitted computations are queued in the ledger
+    for _ in range(2):
+        response = flask_client.post(
+            '/v0/depth-map-computation/',
+            headers={'Authorization': 'Bearer test'},
+            json={
+                'image_service_base_url': 'http://h.test/b/',
+                'segmentation_name': 'seg',
+            },)
+        assert response.status_code == 202
+    assert job_ledger.get_queue_depths(['celery']) == {'celery': 2}
+    submission_start = datetime.datetime.strptime(
+        response.json['estimated_start'], '%Y-%m-%dT%H:%M:%SZ')
+    assert abs((submission_start - datetime.datetime.utcnow())
+               .total_seconds() - 600) < 5
+
+    def get_estimated_start(computation_id):
+        response = flask_client.get(
+            '/v0/depth-map-computation/' + computation_id)
+        assert response.status_code == 200
+        assert response.json['finished'] is False
+        if 'estimated_start' not in response.json:
+            return None
+        return datetime.datetime.strptime(
+            response.json['estimated_start'], '%Y-%m-%dT%H:%M:%SZ')
+
+    # Two computations at different positions in the queue
+    now = time.time()
+    job_ledger.record_queued('first', 'depth-map', 'celery', now - 20)
+    job_ledger.record_queued('second', 'depth-map', 'celery', now - 10)
+    first_start = get_estimated_start('first')
+    second_start = get_estimated_start('second')
+    assert abs((first_start - datetime.datetime.utcnow())
+               .total_seconds()) < 5
+    # The second computation waits for the first one
+    assert (second_start - first_start).total_seconds() == pytest.approx(
+        600, abs=2)
+    # Not recorded in the queue
+    assert get_estimated_start('unknown') is None
+
+    # A cancelled computation leaves the queue
+    response = flask_client.delete('/v0/depth-map-computation/first')
+    assert response.status_code == 202
+    assert get_estimated_start('first') is None
+    assert (get_estimated_start('second') - second_start).total_seconds() \
+        == pytest.approx(-600, abs=2)
+
+
 def test_worker_health(flask_client, prevent_async_celery):
     prevent_async_celery.set_get_return_value(True)
     response = flask_client.get('/v0/worker-health')
@@ -374,3 +580,157 @@ def test_worker_health(flask_client, prevent_async_celery):
     response = flask_client.get('/v0/worker-health')
     assert response.status_code == 500
     assert 'message' in response.json
+
+
+@pytest.mark.parametrize('computation_type', [
+    'depth-map', 'alignment', 'depth-map-and-alignment'])
+def test_cancel_computation(monkeypatch, flask_client, computation_type):
+    from cortical_voluba.celery import celery_app
+    mock_backend = MockBackend(celery_app)
+    monkeypatch.setattr(celery_app, 'backend', mock_backend)
+    revoked = []
+
+    def mock_revoke(self, task_id, **kwargs):
+        revoked.append((task_id, kwargs))
+    monkeypatch.setattr(celery.app.control.Control, 'revoke', mock_revoke)
+    endpoint_url = '/v0/{0}-computation/dummy_id'.format(computation_type)
+
+    mock_backend.store_result('dummy_id', {
+        'message': 'toto',
+    }, 'PROGRESS')
+    response = flask_client.delete(endpoint_url)
+    assert response.status_code == 202
+    assert 'dummy_id' in response.json['status_polling_url']
+    assert len(revoked) == 1
+    assert revoked[0][0] == 'dummy_id'
+    assert revoked[0][1]['terminate'] is True
+
+    mock_backend.mark_as_revoked('dummy_id')
+    response = flask_client.get(endpoint_url)
+    assert response.status_code == 200
+    assert response.json['finished'] is True
+    assert response.json['cancelled'] is True
+    assert response.json['message'] == 'CANCELLED'
+    assert 'error' not in response.json
+    assert 'results' not in response.json
+
+    # A finished computation cannot be cancelled
+    mock_backend.mark_as_done('dummy_id', {
+        'message': 'success',
+        'results': 'placeholder',
+    })
+    response = flask_client.delete(endpoint_url)
+    assert response.status_code == 409
+    assert 'errors' in response.json
+    assert len(revoked) == 1
+
+
+def test_queue_status(flask_app, flask_client, tmp_path):
+    flask_app.config['COMPUTATION_QUEUES'] = [('small', 1024), ('huge', None)]
+    response = flask_client.get('/v0/queues')
+    assert response.status_code == 404
+
+    from cortical_voluba import ledger
+    flask_app.config['JOB_LEDGER_PATH'] = str(tmp_path / 'ledger.sqlite')
+    job_ledger = ledger.JobLedger(flask_app.config['JOB_LEDGER_PATH'])
+    for wait in (1.0, 3.0, 2.0):
+        job_ledger.record('depth-map', 'success', queue='small',
+                          queue_wait_seconds=wait)
+    # Failed computations waited in the queue too
+    job_ledger.record('depth-map', 'failure', queue='small',
+                      queue_wait_seconds=4.0)
+    job_ledger.record('depth-map', 'success', queue='small')
+    response = flask_client.get('/v0/queues')
+    assert response.status_code == 200
+    assert [q['name'] for q in response.json] == ['small', 'huge']
+    assert response.json[0]['max_memory_bytes'] == 1024
+    assert response.json[0]['wait_seconds'] == 2.5
+    assert response.json[0]['last_wait_seconds'] == 4.0
+    assert response.json[0]['last_finished_at'] is not None
+    assert response.json[0]['sample_count'] == 4
+    assert response.json[0]['queue_depth'] == 0
+    # No computation has been recorded for this queue
+    assert response.json[1]['max_memory_bytes'] is None
+    assert response.json[1]['wait_seconds'] is None
+    assert response.json[1]['sample_count'] == 0
+
+    job_ledger.record_queued('a', 'depth-map', 'huge', time.time())
+    response = flask_client.get('/v0/queues')
+    assert [q['queue_depth'] for q in response.json] == [0, 1]
+
+
+def test_job_statistics(flask_app, flask_client, tmp_path):
+    response = flask_client.get('/v0/job-statistics')
+    assert response.status_code == 404
+
+    from cortical_voluba import ledger
+    flask_app.config['JOB_LEDGER_PATH'] = str(tmp_path / 'ledger.sqlite')
+    ledger.JobLedger(flask_app.config['JOB_LEDGER_PATH']).record(
+        'depth-map', 'success', input_voxels=1000, total_seconds=12.0)
+    response = flask_client.get('/v0/job-statistics?job_type=depth-map')
+    assert response.status_code == 200
+    assert len(response.json) == 1
+    assert response.json[0]['total_seconds']['p50'] == 12.0
+
+    response = flask_client.get(
+        '/v0/job-statistics?since=2100-01-01T00:00:00Z')
+    assert response.status_code == 200
+    assert response.json == []
+
+
+def test_profile_requests(flask_app, flask_client, requests_mock):
+    requests_mock.get('http://h.test/b/list', json=DUMMY_IMAGE_LIST)
+    mock_image_headers(requests_mock)
+    request = {
+        'image_service_base_url': 'http://h.test/b/',
+        'segmentation_name': 'seg',
+        'profile': True,
+    }
+    response = flask_client.post(
+        '/v0/depth-map-computation/',
+        headers={'Authorization': 'Bearer test'},
+        json=request)
+    assert response.status_code == 400
+
+    flask_app.config['ALLOW_PROFILE_REQUESTS'] = True
+    response = flask_client.post(
+        '/v0/depth-map-computation/',
+        headers={'Authorization': 'Bearer test'},
+        json=request)
+    assert response.status_code == 202
+
+
+def test_profile_endpoints(flask_app, flask_client, tmp_path):
+    from cortical_voluba import profiling
+    response = flask_client.get('/v0/profiles/')
+    assert response.status_code == 404
+
+    flask_app.config['ENABLE_PROFILE_ENDPOINT'] = True
+    flask_app.config['PROFILE_DIR'] = str(tmp_path)
+    response = flask_client.get('/v0/profiles/')
+    assert response.status_code == 200
+    assert response.json == []
+
+    profiler = profiling.SamplingProfiler()
+    profiler.stack_counts['MainThread;f (a.py:1)'] = 3
+    profiling.save_profile(str(tmp_path), 'task-id', profiler,
+                           {'job_type': 'depth-map'})
+    response = flask_client.get('/v0/profiles/')
+    assert response.status_code == 200
+    assert len(response.json) == 1
+    assert response.json[0]['task_id'] == 'task-id'
+    assert response.json[0]['job_type'] == 'depth-map'
+
+    response = flask_client.get(response.json[0]['profile_url'])
+    assert response.status_code == 200
+    assert response.data == b'MainThread;f (a.py:1) 3\n'
+    response = flask_client.get('/v0/profiles/task-id/report.json')
+    assert response.status_code == 200
+    assert response.json['task_id'] == 'task-id'
+
+    assert flask_client.get(
+        '/v0/profiles/task-id/checkpoints.json').status_code == 404
+    assert flask_client.get(
+        '/v0/profiles/other-id/report.json').status_code == 404
+    assert flask_client.get(
+        '/v0/profiles/..%2F..%2Fetc/report.json').status_code == 404
@@ -0,0 +1,97 @@
+# Copyright 2020 CEA
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# This file is part of cortical-voluba.
+#
+# cortical-voluba is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# cortical-voluba is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License
+# for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with cortical-voluba. If not, see <https://www.gnu.org/licenses/>.
+
+import json
+import os.path
+import shutil
+import subprocess
+import sys
+
+import pytest
+
+
+BENCHMARKS_DIR = os.path.join(os.path.dirname(__file__), os.pardir,
+                              'benchmarks')
+
+
+def run_benchmark(script_name, *args):
+    env = dict(os.environ)
+    # Make sure that the tested version of cortical_voluba is used
+    env['PYTHONPATH'] = os.pathsep.join(
+        [os.path.join(os.path.dirname(__file__), os.pardir)]
+        + [p for p in env.get('PYTHONPATH', '').split(os.pathsep) if p])
+    subprocess.check_call([sys.executable,
+                           os.path.join(BENCHMARKS_DIR, script_name)]
+                          + list(args), env=env)
+
+
+pytestmark = pytest.mark.skipif(not os.path.isdir(BENCHMARKS_DIR),
+                                reason='the benchmarks are not available')
+
+
+def test_pipeline_benchmark(tmp_path):
+    """Run the pipeline benchmark on tiny volumes, as a smoke test."""
+    output_path = str(tmp_path / 'results.json')
+    run_benchmark('pipeline.py', '--sizes', '16', '--output', output_path)
+    run_benchmark('pipeline.py', '--sizes', '16', '--compare', output_path,
+                  '--fake-image-service', '--latency', '0.01',
+                  '--threshold', '1000')
+    with open(output_path) as f:
+        results = json.load(f)
+    assert [r['task'] for r in results['results']] == [
+        'depth_map_computation_task', 'alignment_computation_task']
+    stages = [s['name'] for s in results['results'][1]['stages']]
+    assert 'registration' in stages
+    assert 'resampling' in stages
+
+
+def test_api_load_test(tmp_path):
+    output_path = str(tmp_path / 'results.json')
+    run_benchmark('api_load.py', '--server', 'werkzeug', '--duration', '1',
+                  '--concurrency', '2', '--image-service-latency', '0',
+                  '--output', output_path)
+    with open(output_path) as f:
+        results = json.load(f)
+    assert results['endpoints']['all']['requests'] > 0
+    assert results['endpoints']['all']['error_rate'] == 0
+
+
+def test_api_load_test_submit_latency(tmp_path):
+    """Submitting a computation takes one round trip to the image service."""
+    output_path = str(tmp_path / 'results.json')
+    # The exit status is non-zero if the latency bound is exceeded
+    run_benchmark('api_load.py', '--server', 'werkzeug', '--duration', '2',
+                  '--concurrency', '2', '--image-service-latency', '0.1',
+                  '--mix', 'alignment=1,depth-map-and-alignment=1',
+                  '--output', output_path)
+    with open(output_path) as f:
+        results = json.load(f)
+    assert results['max_submit_latency'] == pytest.approx(0.2)
+    assert results['endpoints']['POST /v0/alignment-computation/'][
+        'error_rate'] == 0
+
+
+@pytest.mark.skipif(shutil.which('antsRegistration') is None,
+                    reason='the ANTs command-line tools are not installed')
+def test_registration_backends_benchmark(tmp_path):
+    output_path = str(tmp_path / 'results.json')
+    run_benchmark('registration_backends.py', '--sizes', '20',
+                  '--backends', 'ants-cli', '--output', output_path)
+    with open(output_path) as f:
+        results = json.load(f)
+    assert results['results'][0]['registration_time'] > 0
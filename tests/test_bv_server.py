@@ -0,0 +1,104 @@
+# Copyright 2020 CEA
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# This file is part of cortical-voluba.
+#
+# cortical-voluba is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# cortical-voluba is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License
+# for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with cortical-voluba. If not, see <https://www.gnu.org/licenses/>.
+
+import json
+import os
+import signal
+import subprocess
+import sys
+
+import pytest
+
+from cortical_voluba import bv_server
+
+
+@pytest.fixture
+def fake_bv_env(tmp_path):
+    """A stand-in for bv_env that runs 'python' as the current interpreter."""
+    path = tmp_path / 'bv_env'
+    path.write_text(
+        '#! /bin/sh\n'
+        'if [ "$1" = python ]; then shift; exec "{0}" "$@"; fi\n'
+        'exec "$@"\n'.format(sys.executable)
+    )
+    path.chmod(0o755)
+    return str(path)
+
+
+@pytest.fixture
+def server(fake_bv_env):
+    server = bv_server.BrainVisaServer(fake_bv_env)
+    yield server
+    server.stop()
+
+
+def test_python_module(server, tmp_path):
+    input_path = tmp_path / 'in.json'
+    output_path = tmp_path / 'out.json'
+    input_path.write_text('{"a": 1}')
+    server.check_call(['python', '-m', 'json.tool',
+                       str(input_path), str(output_path)])
+    assert json.loads(output_path.read_text()) == {'a': 1}
+    pid = server._process.pid
+
+    # The same server is reused for the next command
+    output_path.unlink()
+    server.check_call(['python', '-m', 'json.tool',
+                       str(input_path), str(output_path)])
+    assert output_path.exists()
+    assert server._process.pid == pid
+
+
+def test_python_script(server, tmp_path):
+    script_path = tmp_path / 'script.py'
+    script_path.write_text(
+        'import os, sys\n'
+        'open(sys.argv[1], "w").write(os.getcwd())\n'
+        'sys.exit(int(sys.argv[2]))\n'
+    )
+    output_path = tmp_path / 'cwd.txt'
+    server.check_call(['python', str(script_path), str(output_path), '0'],
+                      cwd=str(tmp_path))
+    assert output_path.read_text() == str(tmp_path)
+    with pytest.raises(subprocess.CalledProcessError) as excinfo:
+        server.check_call(['python', str(script_path), str(output_path),
+                           '3'])
+    assert excinfo.value.returncode == 3
+
+
+def test_executable(server, tmp_path):
+    server.check_call(['touch', str(tmp_path / 'toto')])
+    assert (tmp_path / 'toto').exists()
+    with pytest.raises(subprocess.CalledProcessError):
+        server.check_call(['false'])
+
+
+def test_restart_on_failure(server, tmp_path):
+    server.check_call(['true'])
+    old_pid = server._process.pid
+    os.kill(old_pid, signal.SIGKILL)
+    server._process.wait()
+    server.check_call(['touch', str(tmp_path / 'toto')])
+    assert (tmp_path / 'toto').exists()
+    assert server._process.pid != old_pid
+
+
+def test_get_server(fake_bv_env):
+    server = bv_server.get_server(fake_bv_env)
+    assert bv_server.get_server(fake_bv_env) is server
+    assert not server.is_running()
@@ -0,0 +1,92 @@
+# Copyright 2020 CEA
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# This file is part of cortical-voluba.
+#
+# cortical-voluba is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# cortical-voluba is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License
+# for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with cortical-voluba. If not, see <https://www.gnu.org/licenses/>.
+
+import sys
+
+import pytest
+
+from cortical_voluba import capsul_parallel_main
+
+
+class Job:
+    def __init__(self, name, command):
+        self.name = name
+        self.command = command
+
+
+class TemporaryPath:
+    def __init__(self, suffix):
+        self.is_directory = False
+        self.suffix = suffix
+
+
+def sleep_job(name, duration, *extra):
+    return Job(name, [sys.executable, '-c',
+                      'import sys, time; time.sleep(float(sys.argv[1]))',
+                      str(duration)] + list(extra))
+
+
+def test_run_jobs_parallel(tmp_path):
+    a = sleep_job('a', 0.5)
+    b = sleep_job('b', 0.5)
+    barrier = Job('barrier', [])
+    c = sleep_job('c', 0)
+    timings = capsul_parallel_main.run_jobs(
+        [a, b, barrier, c], [(a, barrier), (b, barrier), (barrier, c)],
+        max_processes=2, temporary_dir=str(tmp_path))
+    assert set(timings) == {'a', 'b', 'c'}
+    # a and b are independent so they run concurrently
+    assert timings['b']['start'] < timings['a']['start'] + 0.4
+    assert timings['c']['start'] >= (timings['a']['start']
+                                     + timings['a']['duration'])
+    assert timings['c']['start'] >= (timings['b']['start']
+                                     + timings['b']['duration'])
+
+
+def test_run_jobs_sequential(tmp_path):
+    a = sleep_job('a', 0.2)
+    b = sleep_job('b', 0.2)
+    timings = capsul_parallel_main.run_jobs(
+        [a, b], [], max_processes=1, temporary_dir=str(tmp_path))
+    assert timings['b']['start'] >= timings['a']['duration']
+
+
+def test_run_jobs_failure(tmp_path):
+    a = Job('a', [sys.executable, '-c', 'raise SystemExit(2)'])
+    b = sleep_job('b', 0)
+    with pytest.raises(capsul_parallel_main.JobFailedError):
+        capsul_parallel_main.run_jobs([a, b], [(a, b)], max_processes=2,
+                                      temporary_dir=str(tmp_path))
+
+
+def test_substitute_temporary_paths(tmp_path):
+    tmp = TemporaryPath('.nii.gz')
+    cache = {}
+    command = capsul_parallel_main.substitute_temporary_paths(
+        ['cmd', tmp, ['x', tmp]], str(tmp_path), cache)
+    assert command[1].startswith(str(tmp_path))
+    assert command[1].endswith('.nii.gz')
+    assert command[2] == str(['x', command[1]])
+    assert capsul_parallel_main.substitute_temporary_paths(
+        [tmp], str(tmp_path), cache) == [command[1]]
+
+
+def test_parse_parameter_value():
+    assert capsul_parallel_main.parse_parameter_value('1') == 1
+    assert (capsul_parallel_main.parse_parameter_value('/a/b.nii.gz')
+            == '/a/b.nii.gz')
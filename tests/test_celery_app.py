@@ -33,3 +33,41 @@ def test_instantiate_celery_app_outside_of_flask():
 def test_instantiate_celery_app_in_flask():
     import cortical_voluba.celery
     assert cortical_voluba.celery.celery_app is not None
+
+
+def test_select_queue():
+    from cortical_voluba.celery import select_queue
+    queues = [('small', 1000), ('large', 10000), ('huge', None)]
+    assert select_queue({'memory_bytes': 10}, queues) == 'small'
+    assert select_queue({'memory_bytes': 1000}, queues) == 'small'
+    assert select_queue({'memory_bytes': 1001}, queues) == 'large'
+    assert select_queue({'memory_bytes': 10 ** 9}, queues) == 'huge'
+    assert select_queue(None, queues) == 'huge'
+    # Too large for all queues
+    assert select_queue({'memory_bytes': 10 ** 9}, queues[:2]) == 'large'
+
+
+def test_computation_routing():
+    import cortical_voluba
+    import cortical_voluba.celery
+    cortical_voluba.create_app(test_config={
+        'TESTING': True,
+        'CELERY_BROKER_URL': 'disabled://',
+        'CELERY_RESULT_BACKEND': 'disabled://',
+        'COMPUTATION_QUEUES': [('small', 1000), ('huge', None)],
+    })
+    celery_app = cortical_voluba.celery.celery_app
+    router = celery_app.amqp.router
+
+    def route(name, params):
+        return router.route({}, name, (params,), {})['queue'].name
+
+    assert route('cortical_voluba.tasks.alignment_computation_task',
+                 {'resource_estimate': {'memory_bytes': 10}}) == 'small'
+    assert route('cortical_voluba.tasks.depth_map_computation_task',
+                 {'resource_estimate': {'memory_bytes': 10000}}) == 'huge'
+    assert route('cortical_voluba.tasks.alignment_computation_task',
+                 {}) == 'huge'
+    # Other tasks go to the default queue
+    assert router.route({}, 'cortical_voluba.tasks.worker_health_task',
+                        (), {})['queue'].name == 'small'
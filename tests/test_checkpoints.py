@@ -0,0 +1,95 @@
+# Copyright 2020 CEA
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# This file is part of cortical-voluba.
+#
+# cortical-voluba is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# cortical-voluba is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License
+# for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with cortical-voluba. If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import time
+from unittest.mock import Mock
+
+import pytest
+
+from cortical_voluba import checkpoints
+
+
+def test_checkpoints_resume(tmp_path):
+    work_dir = str(tmp_path / 'task')
+    stage = Mock(return_value=('name', 'url'))
+    failing_stage = Mock(side_effect=RuntimeError)
+    task_checkpoints = checkpoints.Checkpoints(work_dir)
+    assert task_checkpoints.run('stage', stage, 1, x=2) == ('name', 'url')
+    with pytest.raises(RuntimeError):
+        task_checkpoints.run('failing stage', failing_stage)
+    stage.assert_called_once_with(1, x=2)
+
+    resumed_checkpoints = checkpoints.Checkpoints(work_dir)
+    assert resumed_checkpoints.is_completed('stage')
+    assert not resumed_checkpoints.is_completed('failing stage')
+    assert resumed_checkpoints.run('stage', stage, 1, x=2) == ['name', 'url']
+    assert stage.call_count == 1
+    assert resumed_checkpoints.durations == {}
+    assert set(resumed_checkpoints.restored_durations) == {'stage'}
+    assert resumed_checkpoints.get_durations() == (
+        task_checkpoints.durations)
+
+    resumed_checkpoints.remove()
+    assert not os.path.exists(work_dir)
+
+
+def test_checkpoints_not_persistent(tmp_path):
+    work_dir = str(tmp_path / 'task')
+    task_checkpoints = checkpoints.Checkpoints(work_dir, persistent=False)
+    task_checkpoints.run('stage', lambda: 1)
+    assert task_checkpoints.is_completed('stage')
+    assert os.listdir(work_dir) == []
+    assert not checkpoints.Checkpoints(work_dir).is_completed('stage')
+
+
+def test_remove_expired(tmp_path):
+    old_checkpoints = checkpoints.Checkpoints(str(tmp_path / 'old'))
+    old_checkpoints.run('stage', lambda: None)
+    one_day_ago = time.time() - 86400
+    os.utime(os.path.join(old_checkpoints.work_dir,
+                          checkpoints.CHECKPOINT_FILE_NAME),
+             (one_day_ago, one_day_ago))
+    recent_checkpoints = checkpoints.Checkpoints(str(tmp_path / 'recent'))
+    recent_checkpoints.run('stage', lambda: None)
+    checkpoints.remove_expired(str(tmp_path), 3600)
+    assert sorted(os.listdir(str(tmp_path))) == ['recent']
+    checkpoints.remove_expired(str(tmp_path / 'nonexistent'), 3600)
+
+
+def test_remove_expired_heartbeat(tmp_path):
+    task_checkpoints = checkpoints.Checkpoints(str(tmp_path / 'running'))
+    task_checkpoints.run('stage', lambda: None)
+    one_day_ago = time.time() - 86400
+    os.utime(os.path.join(task_checkpoints.work_dir,
+                          checkpoints.CHECKPOINT_FILE_NAME),
+             (one_day_ago, one_day_ago))
+    with checkpoints.Heartbeat(task_checkpoints.work_dir, interval=0.01):
+        checkpoints.remove_expired(str(tmp_path), 3600)
+    assert os.listdir(str(tmp_path)) == ['running']
+
+
+def test_heartbeat(tmp_path):
+    heartbeat_path = str(tmp_path / checkpoints.HEARTBEAT_FILE_NAME)
+    with checkpoints.Heartbeat(str(tmp_path), interval=0.01):
+        os.utime(heartbeat_path, (0, 0))
+        deadline = time.time() + 5
+        while (os.stat(heartbeat_path).st_mtime == 0
+               and time.time() < deadline):
+            time.sleep(0.01)
+    assert os.stat(heartbeat_path).st_mtime > 0
@@ -0,0 +1,141 @@
+# Copyright 2020 CEA
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# This file is part of cortical-voluba.
+#
+# cortical-voluba is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# cortical-voluba is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License
+# for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with cortical-voluba. If not, see <https://www.gnu.org/licenses/>.
+
+
+import datetime
+
+import pytest
+
+from cortical_voluba import checkpoints
+from cortical_voluba import cost_model
+from cortical_voluba import ledger
+
+
+def parse_time(time_str):
+    return datetime.datetime.strptime(time_str, '%Y-%m-%dT%H:%M:%SZ')
+
+
+def make_records(count=10):
+    return [{
+        'job_type': 'depth-map',
+        'input_voxels': n * 10 ** 6,
+        'queue': 'small',
+        'queue_wait_seconds': 30.0,
+        'stage_seconds': {'download segmentation': 1.0,
+                          'depth map': 10.0 * n},
+    } for n in range(1, count + 1)]
+
+
+def test_fit_linear():
+    assert cost_model.fit_linear([(1, 3), (2, 5), (3, 7)]) == (
+        pytest.approx(1), pytest.approx(2))
+    assert cost_model.fit_linear([(1, 3), (1, 5)]) == (4, 0)
+
+
+def test_cost_model():
+    model = cost_model.CostModel(make_records())
+    stages = model.predict_stages('depth-map', 20 * 10 ** 6)
+    assert stages['download segmentation'] == pytest.approx(1)
+    assert stages['depth map'] == pytest.approx(200)
+    assert model.predict_stages('alignment', 10 ** 6) == {}
+    assert model.predict_stages('depth-map', None) == {}
+    assert model.predict_wait('small') == 30
+    assert model.predict_wait('huge') == 0
+
+    times = model.predict_times('depth-map', {'input_voxels': 10 ** 6},
+                                'small', now=0)
+    assert times == {
+        'estimated_start': '1970-01-01T00:00:30Z',
+        'estimated_completion': '1970-01-01T00:00:41Z',
+    }
+
+    # Fallback on the coarse estimate, no stages are known
+    times = model.predict_times('alignment', {'input_voxels': 10 ** 6,
+                                              'runtime_seconds': 60},
+                                'small', now=0)
+    assert times['estimated_completion'] == '1970-01-01T00:01:30Z'
+    times = model.predict_times('alignment', None, 'small', now=0)
+    assert times['estimated_completion'] is None
+
+    # Too few samples to fit a model
+    model = cost_model.CostModel(make_records(count=2))
+    assert model.predict_stages('depth-map', 10 ** 6) == {}
+
+
+def test_cost_model_queue_position():
+    records = make_records()
+    for record in records:
+        record['total_seconds'] = 60.0
+    model = cost_model.CostModel(records)
+    # The computations ahead each take the median running time
+    assert model.predict_wait('small', queue_position=0) == 0
+    assert model.predict_wait('small', queue_position=3) == 180
+    # Unknown position, or no running time recorded for the queue
+    assert model.predict_wait('small') == 30
+    assert model.predict_wait('huge', queue_position=3) == 0
+
+    first = model.predict_times('depth-map', {'input_voxels': 10 ** 6},
+                                'small', now=0, queue_position=0)
+    third = model.predict_times('depth-map', {'input_voxels': 10 ** 6},
+                                'small', now=0, queue_position=2)
+    assert first == {
+        'estimated_start': '1970-01-01T00:00:00Z',
+        'estimated_completion': '1970-01-01T00:00:11Z',
+    }
+    assert third == {
+        'estimated_start': '1970-01-01T00:02:00Z',
+        'estimated_completion': '1970-01-01T00:02:11Z',
+    }
+
+
+def test_progress_estimate(tmp_path):
+    model = cost_model.CostModel(make_records())
+    task_checkpoints = checkpoints.Checkpoints(str(tmp_path))
+    progress = cost_model.ProgressEstimate(
+        model, 'depth-map', {'input_voxels': 10 ** 8}, task_checkpoints)
+    times = progress.get_times()
+    start = parse_time(times['estimated_start'])
+    completion = parse_time(times['estimated_completion'])
+    assert (completion - start).total_seconds() == pytest.approx(1001, abs=2)
+
+    task_checkpoints.run('download segmentation', lambda: None)
+    times = progress.get_times()
+    completion = parse_time(times['estimated_completion'])
+    assert (completion - start).total_seconds() == pytest.approx(1000, abs=2)
+
+    progress = cost_model.ProgressEstimate(model, 'depth-map', None,
+                                           task_checkpoints)
+    assert 'estimated_completion' not in progress.get_times()
+
+
+def test_get_cost_model(tmp_path, monkeypatch):
+    assert cost_model.get_cost_model(None).stage_models == {}
+    ledger_path = str(tmp_path / 'ledger.sqlite')
+    job_ledger = ledger.JobLedger(ledger_path)
+    for record in make_records():
+        job_ledger.record(record.pop('job_type'), 'success', **record)
+    job_ledger.record('depth-map', 'failure', input_voxels=10 ** 6,
+                      stage_seconds={'depth map': 1000})
+
+    model = cost_model.get_cost_model(ledger_path)
+    assert model.predict_stages('depth-map', 10 ** 6)['depth map'] == (
+        pytest.approx(10))
+    # The model is cached
+    assert cost_model.get_cost_model(ledger_path) is model
+    monkeypatch.setattr(cost_model, 'MODEL_CACHE_SECONDS', 0)
+    assert cost_model.get_cost_model(ledger_path) is not model
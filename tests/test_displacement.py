@@ -0,0 +1,232 @@
+# Copyright 2020 CEA
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# This file is part of cortical-voluba.
+#
+# cortical-voluba is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# cortical-voluba is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License
+# for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with cortical-voluba. If not, see <https://www.gnu.org/licenses/>.
+
+import time
+
+import nibabel
+import numpy
+
+from cortical_voluba import displacement
+
+
+def test_linear_interpolation():
+    grid = numpy.mgrid[0:4, 0:5, 0:6].astype(float)
+    data = 2 * grid[0] + 3 * grid[1] - grid[2]
+    coords = numpy.array([[0, 0, 0],
+                          [1.5, 2.25, 3.75],
+                          [3.4, 4.4, 5.4],  # within half a voxel: clamped
+                          [-0.6, 0, 0]])    # outside
+    interpolation = displacement.LinearInterpolation(coords, data.shape)
+    result = interpolation(data, default_value=-1)
+    numpy.testing.assert_allclose(result, [0, 6.0, 6 + 12 - 5, -1])
+    # Multi-channel images are interpolated channel-wise
+    channels = interpolation(numpy.stack([data, -data], axis=-1))
+    numpy.testing.assert_allclose(channels[1], [6.0, -6.0])
+
+
+def test_linear_interpolation_reads_a_window():
+    # The interpolation must only read the neighbourhood of the points: the
+    # image is a virtual array that would not fit in memory if copied.
+    image = numpy.broadcast_to(numpy.float32(3), (2 ** 14,) * 3)
+    coords = numpy.indices((32, 32, 32)).reshape((3, -1)).T + [100.5, 7, 9]
+    interpolation = displacement.LinearInterpolation(coords, image.shape)
+    assert interpolation.window == (slice(100, 133), slice(7, 40),
+                                    slice(9, 42))
+    numpy.testing.assert_allclose(interpolation(image), 3)
+
+
+def identity_field(displacement_data, reference_affine=numpy.eye(4)):
+    return displacement.DisplacementField(
+        displacement_data, numpy.eye(4), reference_affine,
+        displacement_data.shape[:3])
+
+
+def test_compose_displacement():
+    affine = numpy.diag([2, 2, 2, 1.])
+    # Translation by +1 mm along L (i.e. -1 mm along R) and +4 mm along S
+    warp = numpy.zeros((5, 5, 5, 1, 3), dtype=numpy.float32)
+    warp[..., 0] = 1
+    warp[..., 2] = 4
+    warp_img = nibabel.Nifti1Image(warp, affine)
+    field = displacement.compose_displacement(warp_img, affine, (5, 5, 5))
+    assert field.displacement.shape == (5, 5, 5, 3)
+    assert field.reference_shape == (5, 5, 5)
+    numpy.testing.assert_allclose(field.interpolate(numpy.array([[2, 2, 2]])),
+                                  [[-0.5, 0, 2]])
+
+    # On a reference grid with a finer resolution
+    reference_affine = numpy.diag([1, 1, 1, 1.])
+    field = displacement.compose_displacement(warp_img, reference_affine,
+                                              (10, 10, 10))
+    assert field.displacement.shape == (5, 5, 5, 3)
+    numpy.testing.assert_allclose(
+        field.interpolate(numpy.array([[3, 5, 7], [4.5, 5, 5]])),
+        [[-1, 0, 4], [-1, 0, 4]])
+
+
+def test_compose_displacement_cropped():
+    affine = numpy.diag([2, 2, 2, 1.])
+    warp = numpy.zeros((20, 20, 20, 1, 3), dtype=numpy.float32)
+    warp[8:10, 9, 10, 0, 2] = 2
+    warp_img = nibabel.Nifti1Image(warp, affine)
+    field = displacement.compose_displacement(warp_img, affine,
+                                              (20, 20, 20))
+    # Cropped to the support, with a margin of one voxel
+    assert field.displacement.shape == (4, 3, 3, 3)
+    assert field.get_reference_bounding_box() == (
+        slice(6, 12), slice(7, 12), slice(8, 13))
+    numpy.testing.assert_allclose(
+        field.interpolate(numpy.array([[8, 9, 10], [0, 0, 0], [9, 9, 12]])),
+        [[0, 0, 1], [0, 0, 0], [0, 0, 0]])
+
+
+def test_composite_displacement_size_is_bounded(tmp_path):
+    # A large reference grid (2000**3 voxels) with a small deformed region
+    reference_shape = (2000, 2000, 2000)
+    reference_affine = numpy.diag([0.1, 0.1, 0.1, 1])
+    warp = numpy.zeros((64, 64, 64, 1, 3), dtype=numpy.float32)
+    warp[16:48, 16:48, 16:48, 0, :] = numpy.random.RandomState(0).uniform(
+        -1, 1, size=(32, 32, 32, 3))
+    warp_img = nibabel.Nifti1Image(warp, numpy.diag([3.2, 3.2, 3.2, 1]))
+    field = displacement.compose_displacement(warp_img, reference_affine,
+                                              reference_shape)
+    assert field.displacement.shape == (34, 34, 34, 3)
+    path = tmp_path / 'displacement.npz'
+    displacement.save_displacement(str(path), field)
+    assert path.stat().st_size < 34 ** 3 * 3 * 2 + 4096
+
+    # The field grid is subsampled to respect the maximum number of voxels
+    field = displacement.compose_displacement(
+        warp_img, reference_affine, reference_shape, max_voxels=20 ** 3)
+    assert numpy.prod(field.displacement.shape[:3]) <= 20 ** 3
+    numpy.testing.assert_allclose(field.field_to_reference[:3, :3],
+                                  numpy.diag([64, 64, 64]))
+
+
+def test_save_load_displacement(tmp_path):
+    affine = numpy.diag([2, 2, 2, 1.])
+    field = identity_field(numpy.random.RandomState(0).uniform(
+        -10, 10, size=(4, 4, 4, 3)).astype(numpy.float32), affine)
+    path = str(tmp_path / 'displacement.npz')
+    max_error = displacement.save_displacement(path, field)
+    assert 0 < max_error <= 10 * 2 ** -11
+    loaded, loaded_error = displacement.load_displacement(path)
+    assert loaded.displacement.dtype == numpy.float16
+    assert numpy.max(numpy.abs(loaded.displacement - field.displacement)) \
+        <= max_error
+    numpy.testing.assert_array_equal(loaded.reference_affine, affine)
+    numpy.testing.assert_array_equal(loaded.field_to_reference, numpy.eye(4))
+    assert loaded.reference_shape == (4, 4, 4)
+    assert loaded_error == max_error
+
+    # Large displacements cannot be stored accurately as float16
+    field.displacement *= 1000
+    displacement.save_displacement(path, field)
+    loaded, loaded_error = displacement.load_displacement(path)
+    assert loaded.displacement.dtype == numpy.float32
+    assert loaded_error == 0
+
+
+def test_resample_images():
+    image = numpy.arange(60, dtype=numpy.float32).reshape((3, 4, 5))
+    field = numpy.zeros((3, 4, 5, 3), dtype=numpy.float32)
+    field[..., 2] = 1
+    resampled, resampled_twice = displacement.resample_images(
+        [image, 2 * image], identity_field(field))
+    numpy.testing.assert_allclose(resampled[:, :, :4], image[:, :, 1:])
+    assert numpy.all(resampled[:, :, 4] == 0)  # outside of the image
+    numpy.testing.assert_allclose(resampled_twice, 2 * resampled)
+
+
+def test_resample_images_sparse(monkeypatch):
+    monkeypatch.setattr(displacement, 'BLOCK_SHAPE', (4, 4, 4))
+    image = numpy.random.RandomState(0).uniform(size=(8, 8, 10))
+    field = numpy.zeros((8, 8, 10, 3), dtype=numpy.float32)
+    field[5, 6, 7] = [0.5, -0.5, 0.25]
+    field[1, 1, 1] = [1e-4, 0, 0]
+    sparse, = displacement.resample_images([image], identity_field(field))
+    dense, = displacement.resample_images([image], identity_field(field),
+                                          tolerance=None)
+    numpy.testing.assert_allclose(sparse[4:, 4:, 4:8], dense[4:, 4:, 4:8])
+    assert sparse[5, 6, 7] != image[5, 6, 7]
+    # The blocks with negligible displacements are copied
+    numpy.testing.assert_array_equal(sparse[:4, :4, :4],
+                                     image[:4, :4, :4].astype(numpy.float32))
+    numpy.testing.assert_allclose(sparse, dense, atol=1e-3)
+
+
+def test_resample_images_with_subsampled_field(monkeypatch):
+    monkeypatch.setattr(displacement, 'BLOCK_SHAPE', (4, 4, 4))
+    image = numpy.random.RandomState(0).uniform(
+        size=(16, 16, 16)).astype(numpy.float32)
+    # Uniform displacement of one voxel along the last axis, sampled every
+    # 4 voxels in the region [4, 12] of the reference grid
+    field_to_reference = numpy.diag([4, 4, 4, 1.])
+    field_to_reference[:3, 3] = 4
+    field = displacement.DisplacementField(
+        numpy.tile([0, 0, 1.], (3, 3, 3, 1)).astype(numpy.float32),
+        field_to_reference, numpy.eye(4), (16, 16, 16))
+    resampled, = displacement.resample_images([image], field)
+    numpy.testing.assert_allclose(resampled[4:12, 4:12, 4:12],
+                                  image[4:12, 4:12, 5:13])
+    # Far from the field, the image is copied
+    numpy.testing.assert_array_equal(resampled[:2], image[:2])
+
+
+def test_resample_images_fortran_order():
+    # Images are read by nibabel in Fortran order
+    image = numpy.asfortranarray(
+        numpy.arange(40 * 50 * 60, dtype=numpy.float32).reshape((40, 50, 60)))
+    field_data = numpy.zeros((40, 50, 60, 3), dtype=numpy.float32)
+    field_data[10:30, 10:40, 10:50] = [0.5, -0.25, 1]
+    field = identity_field(field_data)
+    fortran_result, = displacement.resample_images([image], field)
+    contiguous_result, = displacement.resample_images(
+        [numpy.ascontiguousarray(image)], field)
+    numpy.testing.assert_array_equal(fortran_result, contiguous_result)
+    numpy.testing.assert_allclose(fortran_result[20, 20, 20],
+                                  image[20, 20, 20] + 0.5 * 3000 - 0.25 * 60
+                                  + 1, rtol=1e-6)
+
+
+def test_resample_images_cost_does_not_depend_on_image_size():
+    # The cost of resampling a deformed region must not depend on the size
+    # of the whole image (in Fortran order, as read by nibabel)
+    field_data = numpy.zeros((32, 32, 32, 3), dtype=numpy.float32)
+    field_data[..., 2] = numpy.sin(
+        numpy.linspace(0, numpy.pi, 32)).reshape((-1, 1, 1))
+    field_to_reference = numpy.diag([2., 2., 2., 1.])
+    field_to_reference[:3, 3] = 32
+
+    def timed_resampling(size):
+        shape = (size, size, size)
+        x, y, z = numpy.ogrid[:size, :size, :size]
+        image = numpy.asfortranarray(
+            ((x + 3 * y + 7 * z) % 251).astype(numpy.float32))
+        field = displacement.DisplacementField(
+            field_data, field_to_reference, numpy.eye(4), shape)
+        start_time = time.perf_counter()
+        result, = displacement.resample_images([image], field)
+        return image, result, time.perf_counter() - start_time
+    _, small_result, small_time = timed_resampling(128)
+    image, result, large_time = timed_resampling(256)
+    assert large_time < 1.5 * small_time + 0.3
+    # The deformed region is the same, the rest of the image is copied
+    numpy.testing.assert_array_equal(result[:96, :96, :96],
+                                     small_result[:96, :96, :96])
+    numpy.testing.assert_array_equal(result[128:], image[128:])
@@ -0,0 +1,100 @@
+# Copyright 2020 CEA
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# This file is part of cortical-voluba.
+#
+# cortical-voluba is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# cortical-voluba is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License
+# for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with cortical-voluba. If not, see <https://www.gnu.org/licenses/>.
+
+import io
+import os
+import time
+
+import pytest
+import requests
+
+from cortical_voluba.download_cache import DownloadCache
+from cortical_voluba.image_service import ImageServiceClient
+
+
+URL = 'http://h.test/b/download/imagename.nii'
+
+
+def test_download_cache_etag(tmp_path, requests_mock):
+    cache = DownloadCache(str(tmp_path), 1024)
+    client = ImageServiceClient('http://h.test/b/', download_cache=cache)
+    requests_mock.get(URL, [
+        {'content': b'data', 'headers': {'ETag': '"v1"'}},
+        {'status_code': 304},
+        {'content': b'new data', 'headers': {'ETag': '"v2"'}},
+    ])
+    for expected_data in (b'data', b'data', b'new data'):
+        output_file = io.BytesIO()
+        client.download_nifti('imagename', output_file)
+        assert output_file.getvalue() == expected_data
+    assert 'If-None-Match' not in requests_mock.request_history[0].headers
+    assert requests_mock.request_history[1].headers['If-None-Match'] == '"v1"'
+    assert cache.get_stats() == {
+        'hits': 1,
+        'misses': 2,
+        'bytes_saved': 4,
+        'bytes_downloaded': 12,
+    }
+
+
+def test_download_cache_content_length(tmp_path, requests_mock):
+    cache = DownloadCache(str(tmp_path), 1024)
+    client = ImageServiceClient('http://h.test/b/', download_cache=cache)
+    requests_mock.get(URL, content=b'data', headers={'Content-Length': '4'})
+    client.download_nifti('imagename', io.BytesIO())
+    output_file = io.BytesIO()
+    assert cache.download(URL, output_file,
+                          lambda headers: requests.get(URL, stream=True))
+    assert output_file.getvalue() == b'data'
+    requests_mock.get(URL, content=b'other', headers={'Content-Length': '5'})
+    output_file = io.BytesIO()
+    assert not cache.download(URL, output_file,
+                              lambda headers: requests.get(URL, stream=True))
+    assert output_file.getvalue() == b'other'
+
+
+def test_download_cache_error(tmp_path, requests_mock):
+    cache = DownloadCache(str(tmp_path), 1024)
+    client = ImageServiceClient('http://h.test/b/', download_cache=cache)
+    requests_mock.get(URL, content=b'data', headers={'ETag': '"v1"'})
+    client.download_nifti('imagename', io.BytesIO())
+    # A cached image is not served if the user has lost access to it
+    requests_mock.get(URL, status_code=403)
+    with pytest.raises(requests.HTTPError):
+        client.download_nifti('imagename', io.BytesIO())
+
+
+def test_download_cache_eviction(tmp_path, requests_mock):
+    cache = DownloadCache(str(tmp_path), 10)
+    client = ImageServiceClient('http://h.test/b/', download_cache=cache)
+    for name in ('a', 'b', 'c'):
+        requests_mock.get('http://h.test/b/download/' + name + '.nii',
+                          content=b'12345', headers={'ETag': '"v1"'})
+        client.download_nifti(name, io.BytesIO())
+        # Make sure that the last use times are distinct
+        time.sleep(0.01)
+    data_files = [f for f in os.listdir(str(tmp_path))
+                  if f.endswith('.data')]
+    assert len(data_files) == 2
+    # The least recently used image was evicted
+    output_file = io.BytesIO()
+    assert not cache.download(
+        'http://h.test/b/download/a.nii', output_file,
+        lambda headers: requests.get('http://h.test/b/download/a.nii',
+                                     headers=headers, stream=True))
+    assert 'If-None-Match' not in requests_mock.last_request.headers
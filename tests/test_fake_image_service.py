@@ -0,0 +1,107 @@
+# Copyright 2020 CEA
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# This file is part of cortical-voluba.
+#
+# cortical-voluba is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# cortical-voluba is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License
+# for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with cortical-voluba. If not, see <https://www.gnu.org/licenses/>.
+
+import gzip
+import io
+import time
+
+import pytest
+import requests
+
+from testdata import DUMMY_NIFTI_GZ
+from cortical_voluba import fake_image_service
+from cortical_voluba.download_cache import DownloadCache
+from cortical_voluba.image_service import ImageServiceClient
+
+
+@pytest.fixture
+def fake_server(tmp_path):
+    app = fake_image_service.create_app(str(tmp_path))
+    with fake_image_service.serve_in_background(app) as base_url:
+        yield app, base_url
+
+
+def test_upload_download_delete(fake_server):
+    _, base_url = fake_server
+    client = ImageServiceClient(base_url)
+    name, extra = client.upload_image_and_get_name(
+        io.BytesIO(DUMMY_NIFTI_GZ), file_name='img.nii.gz')
+    assert name == 'img'
+    assert extra['fileName'] == 'img.nii.gz'
+    with pytest.raises(requests.HTTPError) as exc_info:
+        client.preflight_image(io.BytesIO(DUMMY_NIFTI_GZ),
+                               file_name='img.nii.gz')
+    assert exc_info.value.response.status_code == 409
+    assert client.get_image_info('img')['extra']['neuroglancer'] == {
+        'type': 'image'}
+
+    output_file = io.BytesIO()
+    client.download_compressed_nifti('img', output_file)
+    assert output_file.getvalue() == DUMMY_NIFTI_GZ
+    output_file = io.BytesIO()
+    client.download_nifti('img', output_file)
+    assert output_file.getvalue() == gzip.decompress(DUMMY_NIFTI_GZ)
+    assert client.download_original_file('img', io.BytesIO()) == 'img.nii.gz'
+
+    client.delete_image_by_name('img')
+    assert client.list_images() == []
+
+
+def test_range_and_conditional_requests(fake_server, tmp_path):
+    _, base_url = fake_server
+    client = ImageServiceClient(base_url)
+    client.upload_image(io.BytesIO(DUMMY_NIFTI_GZ), file_name='img.nii.gz')
+    url = base_url + 'download/img.nii.gz'
+    r = requests.get(url, headers={'Range': 'bytes=10-19'})
+    assert r.status_code == 206
+    assert r.content == DUMMY_NIFTI_GZ[10:20]
+    assert r.headers['Content-Range'] == 'bytes 10-19/{0}'.format(
+        len(DUMMY_NIFTI_GZ))
+    r = requests.get(url, headers={'If-None-Match': r.headers['ETag']})
+    assert r.status_code == 304
+
+    cache = DownloadCache(str(tmp_path / 'cache'), 2 ** 20)
+    cached_client = ImageServiceClient(base_url, download_cache=cache)
+    for _ in range(2):
+        output_file = io.BytesIO()
+        cached_client.download_compressed_nifti('img', output_file)
+        assert output_file.getvalue() == DUMMY_NIFTI_GZ
+    assert cache.get_stats()['hits'] == 1
+
+
+def test_network_conditions(fake_server):
+    app, base_url = fake_server
+    client = ImageServiceClient(base_url)
+    client.upload_image(io.BytesIO(DUMMY_NIFTI_GZ), file_name='img.nii.gz')
+
+    requests.post(base_url + '_fake/config', json={
+        'latency': 0.1,
+        'bandwidth': len(DUMMY_NIFTI_GZ) / 0.2,
+    }).raise_for_status()
+    start_time = time.monotonic()
+    client.download_compressed_nifti('img', io.BytesIO())
+    assert time.monotonic() - start_time >= 0.25
+
+    app.config['FAKE_CONDITIONS'].update(latency=0, bandwidth=None,
+                                         error_rate=1, error_status=502)
+    with pytest.raises(requests.HTTPError) as exc_info:
+        client.list_images()
+    assert exc_info.value.response.status_code == 502
+
+    r = requests.post(base_url + '_fake/config', json={'nonexistent': 1})
+    assert r.status_code == 400
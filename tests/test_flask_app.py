@@ -17,6 +17,9 @@
 # along with cortical-voluba. If not, see <https://www.gnu.org/licenses/>.
 
 import datetime
+import os.path
+import subprocess
+import sys
 
 import cortical_voluba
 
@@ -31,6 +34,23 @@ def test_wsgi_app():
     assert application is not None
 
 
+def test_app_does_not_import_worker_code():
+    # Run in a separate interpreter, because other tests import the tasks
+    source_dir = os.path.dirname(os.path.dirname(cortical_voluba.__file__))
+    code = (
+        'import sys\n'
+        'import cortical_voluba.wsgi\n'
+        'heavy = ["cortical_voluba.tasks", "nibabel", "numpy"]\n'
+        'print(" ".join(m for m in heavy if m in sys.modules))\n'
+    )
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [source_dir] + sys.path)
+    output = subprocess.check_output([sys.executable, '-c', code], env=env,
+                                     universal_newlines=True)
+    assert output.strip() == ''
+
+
 def test_root_route(flask_client):
     response = flask_client.get('/')
     assert response.status_code == 302
@@ -151,6 +151,28 @@ def test_download_compressed_nifti(requests_mock, monkeypatch):
     assert gzip.decompress(buf.getvalue()) == b'Nifti contents'
 
 
+def test_download_nifti_header(requests_mock):
+    client = ImageServiceClient('http://h.test/b/')
+    contents = bytes(range(256)) * 16
+    requests_mock.get('http://h.test/b/download/imagename.nii.gz',
+                      content=gzip.compress(contents))
+    header = client.download_nifti_header('imagename')
+    assert header == contents[:image_service.NIFTI_HEADER_LENGTH]
+    assert (requests_mock.last_request.headers['Range']
+            == 'bytes=0-{0}'.format(image_service.HEADER_PROBE_LENGTH - 1))
+
+    requests_mock.get('http://h.test/b/download/imagename.nii.gz',
+                      status_code=404)
+    requests_mock.get('http://h.test/b/download/imagename.nii',
+                      content=b'short')
+    assert client.download_nifti_header('imagename') == b'short'
+
+    requests_mock.get('http://h.test/b/download/imagename.nii.gz',
+                      content=b'not gzip')
+    with pytest.raises(ValueError):
+        client.download_nifti_header('imagename')
+
+
 def test_download_original_file(requests_mock, monkeypatch):
     # Work around a bug in requests_mock (hangs forever if chunk_size=None).
     monkeypatch.setattr(image_service, '_DOWNLOAD_CHUNK_SIZE', 4096)
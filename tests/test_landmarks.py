@@ -0,0 +1,123 @@
+# Copyright 2020 CEA
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# This file is part of cortical-voluba.
+#
+# cortical-voluba is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# cortical-voluba is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License
+# for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with cortical-voluba. If not, see <https://www.gnu.org/licenses/>.
+
+import numpy
+import pytest
+
+from cortical_voluba import landmarks
+
+
+ROTATION_Z = numpy.array([[0, -1, 0, 10],
+                          [1, 0, 0, -5],
+                          [0, 0, 1, 2],
+                          [0, 0, 0, 1]], dtype=float)
+
+AFFINE = numpy.array([[1.1, 0.1, 0, 10],
+                      [0, 0.9, 0.2, -5],
+                      [0.05, 0, 1.2, 2],
+                      [0, 0, 0, 1]])
+
+
+def apply(matrix, points):
+    return points @ matrix[:3, :3].T + matrix[:3, 3]
+
+
+def random_points(n, seed=0):
+    return numpy.random.RandomState(seed).uniform(-20, 20, size=(n, 3))
+
+
+@pytest.mark.parametrize('model,matrix', [
+    ('rigid', ROTATION_Z),
+    ('affine', AFFINE),
+])
+def test_fit_exact(model, matrix):
+    source = random_points(6)
+    target = apply(matrix, source)
+    fitted = landmarks.FIT_FUNCTIONS[model](source, target)
+    numpy.testing.assert_allclose(fitted, matrix, atol=1e-10)
+
+
+def test_fit_affine_coplanar():
+    source = random_points(6)
+    source[:, 2] = 0
+    with pytest.raises(numpy.linalg.LinAlgError):
+        landmarks.fit_affine(source, source)
+
+
+def test_fit_with_outlier_rejection():
+    source = random_points(10)
+    target = apply(AFFINE, source)
+    target[3] += [5, 0, 0]
+    matrix, model, inliers = landmarks.fit_with_outlier_rejection(
+        source, target, 'affine')
+    assert model == 'affine'
+    assert list(numpy.flatnonzero(~inliers)) == [3]
+    numpy.testing.assert_allclose(matrix, AFFINE, atol=1e-8)
+
+
+def test_fit_with_too_few_points():
+    source = random_points(6)
+    target = apply(ROTATION_Z, source)
+    matrix, model, inliers = landmarks.fit_with_outlier_rejection(
+        source, target, 'affine')
+    assert model == 'rigid'
+    numpy.testing.assert_allclose(matrix, ROTATION_Z, atol=1e-10)
+
+    matrix, model, inliers = landmarks.fit_with_outlier_rejection(
+        source[:3], target[:3], 'affine')
+    assert matrix is None
+    assert model is None
+
+
+def test_select_refinement_model():
+    assert landmarks.MIN_POINTS == {'rigid': 4, 'affine': 8}
+    assert landmarks.select_refinement_model(9, 'affine') == 'affine'
+    assert landmarks.select_refinement_model(8, 'affine') == 'rigid'
+    assert landmarks.select_refinement_model(5, 'rigid') == 'rigid'
+    assert landmarks.select_refinement_model(4, 'affine') is None
+    assert landmarks.select_refinement_model(4, 'rigid') is None
+
+
+def test_refine_transformation():
+    incoming = random_points(10)
+    template = apply(AFFINE, incoming)
+    initial = numpy.eye(4)
+    initial[:3, 3] = [9, -4, 1]
+    refined, report = landmarks.refine_transformation(
+        incoming, template, initial, model='affine')
+    numpy.testing.assert_allclose(refined, AFFINE, atol=1e-8)
+    assert report['model'] == 'affine'
+    assert report['num_landmarks'] == 10
+    assert report['outliers'] == []
+    assert report['rms_residual_before'] > 1
+    assert report['rms_residual_after'] < 1e-8
+    assert len(report['residuals_after']) == 10
+
+
+def test_refine_transformation_too_few_landmarks():
+    # The minimum number of landmarks, with a gross outlier: an exact fit
+    # would follow the outlier, so the transformation is kept as is.
+    incoming = random_points(4)
+    template = apply(AFFINE, incoming)
+    template[2] += [50, 0, 0]
+    refined, report = landmarks.refine_transformation(
+        incoming, template, AFFINE, model='affine')
+    numpy.testing.assert_array_equal(refined, AFFINE)
+    assert report['model'] is None
+    assert report['outliers'] == []
+    assert report['residuals_after'] == report['residuals_before']
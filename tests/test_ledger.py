@@ -0,0 +1,116 @@
+# Copyright 2020 CEA
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# This file is part of cortical-voluba.
+#
+# cortical-voluba is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# cortical-voluba is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License
+# for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with cortical-voluba. If not, see <https://www.gnu.org/licenses/>.
+
+
+import datetime
+import time
+
+import pytest
+
+from cortical_voluba import ledger
+
+
+def test_percentile():
+    assert ledger.percentile([1], 50) == 1
+    assert ledger.percentile([1, 2, 3], 50) == 2
+    assert ledger.percentile([0, 10], 90) == pytest.approx(9)
+    assert ledger.summarize([]) is None
+    assert ledger.summarize([None, 3]) == {'p50': 3, 'p90': 3, 'p99': 3}
+
+
+def test_get_size_bucket():
+    assert ledger.get_size_bucket(None) == 'unknown'
+    assert ledger.get_size_bucket(1000) == '<1M'
+    assert ledger.get_size_bucket(10 ** 6) == '1M-10M'
+    assert ledger.get_size_bucket(10 ** 12) == '>1G'
+
+
+def test_job_ledger(tmp_path):
+    job_ledger = ledger.JobLedger(str(tmp_path / 'ledger.sqlite'))
+    assert job_ledger.get_statistics() == []
+
+    for seconds in range(1, 11):
+        job_ledger.record(
+            'alignment', 'success', input_voxels=5 * 10 ** 6,
+            parameters={'registration_preset': 'fast', 'image_name': 'x'},
+            queue='small', queue_wait_seconds=1.0, total_seconds=seconds,
+            stage_seconds={'registration': seconds / 2},
+            peak_memory_bytes=1000, cache_hits=1, downloads=2)
+    job_ledger.record('alignment', 'failure', input_voxels=5 * 10 ** 6,
+                      total_seconds=1000)
+    job_ledger.record('alignment', 'success', input_voxels=100)
+    job_ledger.record('depth-map', 'cancelled')
+
+    statistics = job_ledger.get_statistics()
+    assert [(s['job_type'], s['size_bucket']) for s in statistics] == [
+        ('alignment', '<1M'),
+        ('alignment', '1M-10M'),
+        ('depth-map', 'unknown'),
+    ]
+    medium = statistics[1]
+    assert medium['count'] == 11
+    assert medium['outcomes'] == {'success': 10, 'failure': 1}
+    # The failures are not included in the durations
+    assert medium['total_seconds']['p50'] == pytest.approx(5.5)
+    assert medium['total_seconds']['p90'] == pytest.approx(9.1)
+    assert medium['stage_seconds']['registration']['p50'] == pytest.approx(
+        2.75)
+    assert medium['peak_memory_bytes']['p50'] == 1000
+    assert medium['cache_hit_rate'] == 0.5
+    assert statistics[2]['total_seconds'] is None
+
+    assert len(job_ledger.get_statistics(job_type='depth-map')) == 1
+    now = datetime.datetime.now(datetime.timezone.utc)
+    assert job_ledger.get_statistics(
+        until=now - datetime.timedelta(hours=1)) == []
+    assert len(job_ledger.get_statistics(
+        since=now - datetime.timedelta(hours=1))) == 3
+
+
+def test_queued_computations(tmp_path):
+    job_ledger = ledger.JobLedger(str(tmp_path / 'ledger.sqlite'))
+    assert job_ledger.get_queued('a') is None
+    assert job_ledger.get_queue_depths(['small']) == {'small': 0}
+
+    now = time.time()
+    job_ledger.record_queued('a', 'alignment', 'small', now - 30,
+                             {'input_voxels': 1000})
+    job_ledger.record_queued('b', 'depth-map', 'small', now - 20)
+    job_ledger.record_queued('c', 'depth-map', 'huge', now - 10)
+    # Lost computation, submitted too long ago
+    job_ledger.record_queued('d', 'depth-map', 'small',
+                             now - ledger.QUEUED_MAX_AGE - 10)
+    assert job_ledger.get_queued('a') == {
+        'job_type': 'alignment',
+        'queue': 'small',
+        'submitted_at': pytest.approx(now - 30),
+        'resource_estimate': {'input_voxels': 1000},
+        'position': 0,
+    }
+    assert job_ledger.get_queued('b')['position'] == 1
+    assert job_ledger.get_queued('b')['resource_estimate'] is None
+    assert job_ledger.get_queued('c')['position'] == 0
+    assert job_ledger.get_queued('d') is None
+    assert job_ledger.get_queue_depths(['small', 'huge', 'other']) == {
+        'small': 2, 'huge': 1, 'other': 0}
+
+    # The computation has started
+    job_ledger.remove_queued('a')
+    assert job_ledger.get_queued('a') is None
+    assert job_ledger.get_queued('b')['position'] == 0
+    assert job_ledger.get_queue_depths(['small']) == {'small': 1}
@@ -0,0 +1,98 @@
+# Copyright 2020 CEA
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# This file is part of cortical-voluba.
+#
+# cortical-voluba is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# cortical-voluba is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License
+# for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with cortical-voluba. If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+from cortical_voluba import processes
+
+
+def test_check_call():
+    processes.check_call([sys.executable, '-c', 'pass'])
+    with pytest.raises(subprocess.CalledProcessError):
+        processes.check_call([sys.executable, '-c',
+                              'import sys; sys.exit(3)'])
+
+
+def test_cancellable_terminates_process_tree(tmp_path):
+    pid_file = tmp_path / 'grandchild.pid'
+    # The child spawns a grandchild that outlives it unless the whole
+    # process group is killed.
+    script = (
+        'import subprocess, sys, time\n'
+        'p = subprocess.Popen([sys.executable, "-c", '
+        '"import time; time.sleep(60)"])\n'
+        'open({0!r}, "w").write(str(p.pid))\n'
+        'time.sleep(60)\n'
+    ).format(str(pid_file))
+
+    def send_sigterm():
+        while not pid_file.exists() or not pid_file.read_text():
+            time.sleep(0.05)
+        os.kill(os.getpid(), signal.SIGTERM)
+
+    previous_handler = signal.getsignal(signal.SIGTERM)
+    threading.Thread(target=send_sigterm, daemon=True).start()
+    start_time = time.monotonic()
+    with pytest.raises(processes.TaskCancelledError):
+        with processes.cancellable():
+            processes.check_call([sys.executable, '-c', script])
+    assert time.monotonic() - start_time < 30
+
+    grandchild_pid = int(pid_file.read_text())
+    for _ in range(100):
+        try:
+            os.kill(grandchild_pid, 0)
+        except ProcessLookupError:
+            break
+        time.sleep(0.05)
+    else:
+        pytest.fail('the grandchild process was not terminated')
+
+    assert signal.getsignal(signal.SIGTERM) == previous_handler
+
+
+def test_record_usage():
+    with processes.record_usage() as usage:
+        processes.check_call([sys.executable, '-c',
+                              'b = bytearray(50 * 1024 * 1024)'])
+        with pytest.raises(subprocess.CalledProcessError) as excinfo:
+            processes.check_call([sys.executable, '-c',
+                                  'import os; os.kill(os.getpid(), 9)'])
+        assert excinfo.value.returncode == -9
+    processes.check_call([sys.executable, '-c', 'pass'])
+    assert len(usage) == 2
+    assert usage[0]['command'] == os.path.basename(sys.executable)
+    assert usage[0]['max_rss_bytes'] > 50 * 1024 * 1024
+    assert usage[0]['wall_seconds'] > 0
+
+
+def test_peak_rss():
+    processes.reset_peak_rss()
+    peak_rss = processes.get_peak_rss()
+    if peak_rss is None:
+        pytest.skip('/proc/self/status is not available')
+    data = bytearray(100 * 1024 * 1024)
+    assert processes.get_peak_rss() >= peak_rss + 50 * 1024 * 1024
+    del data
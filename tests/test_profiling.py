@@ -0,0 +1,100 @@
+# Copyright 2020 CEA
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# This file is part of cortical-voluba.
+#
+# cortical-voluba is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# cortical-voluba is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License
+# for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with cortical-voluba. If not, see <https://www.gnu.org/licenses/>.
+
+
+import io
+import json
+import os
+import time
+
+from cortical_voluba import profiling
+
+
+def busy_function(duration):
+    end_time = time.monotonic() + duration
+    while time.monotonic() < end_time:
+        pass
+
+
+def test_sampling_profiler():
+    with profiling.SamplingProfiler(interval=0.001) as profiler:
+        busy_function(0.1)
+    assert profiler.sample_count > 0
+    stacks = [stack for stack in profiler.stack_counts
+              if 'busy_function (test_profiling.py:' in stack]
+    assert stacks
+    assert stacks[0].startswith('MainThread;')
+
+    f = io.StringIO()
+    assert profiler.write_folded(f) is False
+    lines = f.getvalue().splitlines()
+    assert len(lines) == len(profiler.stack_counts)
+    assert sum(int(line.rsplit(' ', 1)[1]) for line in lines) \
+        == sum(profiler.stack_counts.values())
+
+    # The least frequent stacks are left out
+    f = io.StringIO()
+    max_bytes = len(lines[0]) + 1
+    profiler.stack_counts['x;y'] = 0
+    assert profiler.write_folded(f, max_bytes=max_bytes) is True
+    assert len(f.getvalue()) <= max_bytes
+
+
+def test_save_and_list_profiles(tmp_path):
+    profile_dir = str(tmp_path)
+    assert profiling.list_profiles(profile_dir) == []
+    profiler = profiling.SamplingProfiler()
+    profiler.stack_counts['MainThread;f (a.py:1)'] = 3
+    profiler.sample_count = 3
+    task_dir = profiling.save_profile(
+        profile_dir, 'task-id', profiler,
+        {'job_type': 'alignment', 'stage_seconds': {'registration': 2.0}})
+
+    with open(os.path.join(task_dir, 'profile.folded')) as f:
+        assert f.read() == 'MainThread;f (a.py:1) 3\n'
+    with open(os.path.join(task_dir, 'report.json')) as f:
+        report = json.load(f)
+    assert report['stage_seconds'] == {'registration': 2.0}
+    assert report['sample_count'] == 3
+    assert report['profile_truncated'] is False
+
+    profiles = profiling.list_profiles(profile_dir)
+    assert len(profiles) == 1
+    assert profiles[0]['task_id'] == 'task-id'
+    assert profiles[0]['job_type'] == 'alignment'
+    assert profiles[0]['size_bytes'] > 0
+
+
+def test_remove_expired(tmp_path):
+    profile_dir = str(tmp_path)
+    profiler = profiling.SamplingProfiler()
+    profiler.stack_counts['MainThread;f (a.py:1)'] = 1
+    for i, age in enumerate([3600, 60, 0]):
+        task_dir = profiling.save_profile(profile_dir, str(i), profiler, {})
+        mtime = time.time() - age
+        os.utime(task_dir, (mtime, mtime))
+
+    profiling.remove_expired(profile_dir, 600)
+    assert sorted(os.listdir(profile_dir)) == ['1', '2']
+
+    # The oldest profiles are removed first to enforce the size limit
+    size = profiling.list_profiles(profile_dir)[0]['size_bytes']
+    profiling.remove_expired(profile_dir, 600, max_total_bytes=size)
+    assert os.listdir(profile_dir) == ['2']
+
+    profiling.remove_expired(str(tmp_path / 'nonexistent'), 600)
@@ -0,0 +1,237 @@
+# Copyright 2020 CEA
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# This file is part of cortical-voluba.
+#
+# cortical-voluba is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# cortical-voluba is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License
+# for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with cortical-voluba. If not, see <https://www.gnu.org/licenses/>.
+
+import os.path
+import re
+import shutil
+
+import nibabel
+import numpy
+import pytest
+
+from cortical_voluba import alignment
+from cortical_voluba import processes
+from cortical_voluba import registration_backends
+from cortical_voluba import registration_schedule
+
+
+def test_get_backend():
+    backend = registration_backends.get_backend('ants-cli')
+    assert isinstance(backend, registration_backends.AntsCliBackend)
+    with pytest.raises(ValueError):
+        registration_backends.get_backend('nonexistent')
+
+
+def test_registration_arguments_default_schedule():
+    schedule = registration_schedule.plan_schedule((300, 200, 100))
+    assert registration_backends.registration_arguments(
+        'fixed.nii', 'moving.nii', 'template_to_incoming_affine.txt',
+        schedule, 'cortical') == [
+        '--verbose', '1',
+        '--float', '1',
+        '--dimensionality', '3',
+        '--initial-moving-transform', '[template_to_incoming_affine.txt,1]',
+        '--metric', 'MeanSquares[fixed.nii,moving.nii]',
+        '--transform', 'SyN[0.1,3,0]',
+        '--convergence', '[500x500x500,1e-6,10]',
+        '--shrink-factors', '4x2x1',
+        '--smoothing-sigmas', '2x1x0vox',
+        '--output', 'cortical',
+    ]
+
+
+def test_cli_backend(tmp_path, monkeypatch):
+    commands = []
+
+    def check_call_mock(command, cwd):
+        commands.append(command)
+    monkeypatch.setattr(processes, 'check_call', check_call_mock)
+    backend = registration_backends.AntsCliBackend()
+    schedule = registration_schedule.plan_schedule((64, 64, 64))
+    backend.register('fixed.nii', 'moving.nii', 'affine.txt', schedule,
+                     'out', work_dir=str(tmp_path))
+    backend.apply_transforms('in.nii', 'ref.nii', 'out.nii',
+                             ['warp.nii.gz', 'affine.txt'],
+                             work_dir=str(tmp_path))
+    assert commands[0][0] == 'antsRegistration'
+    assert 'MeanSquares[fixed.nii,moving.nii]' in commands[0]
+    assert '[affine.txt,1]' in commands[0]
+    assert commands[1][0] == 'antsApplyTransforms'
+    assert commands[1][-4:] == ['--transform', 'warp.nii.gz',
+                                '--transform', 'affine.txt']
+
+
+def make_conformance_images(directory):
+    """Two smooth depth-like images that differ by a small deformation."""
+    grid = numpy.mgrid[0:40, 0:40, 0:40].astype(numpy.float32)
+    radius = numpy.sqrt(numpy.sum((grid - 20) ** 2, axis=0))
+    wobble = 1.5 * numpy.sin(grid[0] / 6)
+    fixed = numpy.clip((radius - 8) / 8, 0, 1)
+    moving = numpy.clip((radius + wobble - 8) / 8, 0, 1)
+    fixed_path = os.path.join(directory, 'fixed.nii.gz')
+    moving_path = os.path.join(directory, 'moving.nii.gz')
+    nibabel.save(nibabel.Nifti1Image(fixed, numpy.eye(4)), fixed_path)
+    nibabel.save(nibabel.Nifti1Image(moving, numpy.eye(4)), moving_path)
+    affine_path = os.path.join(directory, 'identity.txt')
+    alignment.write_itk_affine_transform(numpy.eye(4), affine_path)
+    return fixed_path, moving_path, affine_path
+
+
+def run_backend(backend, directory, fixed_path, moving_path, affine_path):
+    """Register and resample the conformance images with a backend.
+
+    :returns: the inverse warp and the resampled moving image
+    :rtype: tuple of nibabel.Nifti1Image
+    """
+    schedule = registration_schedule.plan_schedule((40, 40, 40), 'fast')
+    work_dir = os.path.join(directory, backend.name)
+    os.mkdir(work_dir)
+    backend.register(fixed_path, moving_path, affine_path, schedule,
+                     os.path.join(work_dir, 'cortical'), work_dir=work_dir)
+    backend.apply_transforms(
+        moving_path, fixed_path, os.path.join(work_dir, 'resampled.nii.gz'),
+        [os.path.join(work_dir, 'cortical1Warp.nii.gz'),
+         '[{0},1]'.format(affine_path)],
+        work_dir=work_dir)
+    return tuple(
+        nibabel.load(os.path.join(work_dir, file_name))
+        for file_name in ('cortical1InverseWarp.nii.gz', 'resampled.nii.gz')
+    )
+
+
+def check_conformance(warp_img, resampled_img, fixed_path):
+    """Check the outputs of a backend against the backend interface."""
+    fixed_img = nibabel.load(fixed_path)
+    assert warp_img.shape == fixed_img.shape + (1, 3)
+    numpy.testing.assert_allclose(warp_img.affine, fixed_img.affine,
+                                  atol=1e-4)
+    assert resampled_img.shape == fixed_img.shape
+    numpy.testing.assert_allclose(resampled_img.affine, fixed_img.affine,
+                                  atol=1e-4)
+
+
+def fake_ants_cli(command, cwd):
+    """Emulate the outputs of the ANTs tools, for a zero deformation."""
+    def argument(option):
+        return command[command.index(option) + 1]
+    if command[0] == 'antsRegistration':
+        metric = argument('--metric')
+        fixed_img = nibabel.load(metric[len('MeanSquares['):].split(',')[0])
+        warp = nibabel.Nifti1Image(
+            numpy.zeros(fixed_img.shape + (1, 3), dtype=numpy.float32),
+            fixed_img.affine)
+        warp.header.set_intent('vector')
+        for suffix in ('1Warp.nii.gz', '1InverseWarp.nii.gz'):
+            nibabel.save(warp, os.path.join(cwd, argument('--output')
+                                            + suffix))
+    else:
+        assert command[0] == 'antsApplyTransforms'
+        for index, option in enumerate(command):
+            if option == '--transform':
+                transform = command[index + 1]
+                assert os.path.exists(
+                    re.sub(r'^\[(.*),1\]$', r'\1', transform))
+        reference_img = nibabel.load(argument('--reference-image'))
+        input_data = numpy.asanyarray(
+            nibabel.load(argument('--input')).dataobj)
+        # Only the resampling onto the same grid is emulated
+        assert input_data.shape == reference_img.shape
+        nibabel.save(nibabel.Nifti1Image(input_data.astype(numpy.float32),
+                                         reference_img.affine),
+                     argument('--output'))
+
+
+def test_cli_backend_conformance(tmp_path, monkeypatch):
+    monkeypatch.setattr(processes, 'check_call', fake_ants_cli)
+    images = make_conformance_images(str(tmp_path))
+    warp_img, resampled_img = run_backend(
+        registration_backends.AntsCliBackend(), str(tmp_path), *images)
+    check_conformance(warp_img, resampled_img, images[0])
+
+
+def test_antspy_backend(tmp_path):
+    pytest.importorskip('ants')
+    fixed_path, moving_path, affine_path = make_conformance_images(
+        str(tmp_path))
+    warp_img, resampled_img = run_backend(
+        registration_backends.AntsPyBackend(), str(tmp_path), fixed_path,
+        moving_path, affine_path)
+    check_conformance(warp_img, resampled_img, fixed_path)
+    # The registration brings the moving image closer to the fixed image
+    fixed = numpy.asanyarray(nibabel.load(fixed_path).dataobj)
+    moving = numpy.asanyarray(nibabel.load(moving_path).dataobj)
+    resampled = numpy.asanyarray(resampled_img.dataobj)
+    assert (numpy.mean((resampled - fixed) ** 2)
+            < 0.5 * numpy.mean((moving - fixed) ** 2))
+
+
+def test_antspy_backend_keeps_data_in_memory(tmp_path, monkeypatch):
+    ants = pytest.importorskip('ants')
+    fixed_path, moving_path, affine_path = make_conformance_images(
+        str(tmp_path))
+    backend = registration_backends.AntsPyBackend()
+    schedule = registration_schedule.plan_schedule((40, 40, 40), 'fast')
+    output_prefix = str(tmp_path / 'cortical')
+    backend.register(fixed_path, moving_path, affine_path, schedule,
+                     output_prefix, work_dir=str(tmp_path))
+    read_paths = []
+
+    def image_read(path, *args, **kwargs):
+        read_paths.append(path)
+        return original_image_read(path, *args, **kwargs)
+    original_image_read = ants.image_read
+    monkeypatch.setattr(ants, 'image_read', image_read)
+    # The images and warps of the registration are not read again
+    backend.apply_transforms(
+        moving_path, fixed_path, str(tmp_path / 'resampled.nii.gz'),
+        [output_prefix + '1Warp.nii.gz', '[{0},1]'.format(affine_path)],
+        work_dir=str(tmp_path))
+    backend.apply_transforms(
+        fixed_path, fixed_path, str(tmp_path / 'resampled2.nii.gz'),
+        [output_prefix + '1InverseWarp.nii.gz'], work_dir=str(tmp_path))
+    assert read_paths == []
+    # A file that is rewritten is read again
+    os.utime(fixed_path, ns=(0, 0))
+    backend.apply_transforms(
+        fixed_path, fixed_path, str(tmp_path / 'resampled3.nii.gz'),
+        [output_prefix + '1InverseWarp.nii.gz'], work_dir=str(tmp_path))
+    assert read_paths == [fixed_path]
+
+
+@pytest.mark.skipif(shutil.which('antsRegistration') is None,
+                    reason='the ANTs command-line tools are not installed')
+def test_backend_conformance(tmp_path):
+    """Compare the outputs of the real backends.
+
+    The speed of the backends is compared by
+    ``benchmarks/registration_backends.py``.
+    """
+    pytest.importorskip('ants')
+    images = make_conformance_images(str(tmp_path))
+    cli_warp, cli_resampled = (
+        numpy.asanyarray(img.dataobj) for img in run_backend(
+            registration_backends.AntsCliBackend(), str(tmp_path), *images))
+    inprocess_warp, inprocess_resampled = (
+        numpy.asanyarray(img.dataobj) for img in run_backend(
+            registration_backends.AntsPyBackend(), str(tmp_path), *images))
+    assert cli_warp.shape == inprocess_warp.shape
+    # The backends run the same registration, differences come from the
+    # convergence criterion and multi-threading (within a fraction of a
+    # voxel).
+    assert numpy.max(numpy.abs(cli_warp - inprocess_warp)) < 0.25
+    assert numpy.max(numpy.abs(cli_resampled - inprocess_resampled)) < 0.1
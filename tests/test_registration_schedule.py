@@ -0,0 +1,73 @@
+# Copyright 2020 CEA
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# This file is part of cortical-voluba.
+#
+# cortical-voluba is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# cortical-voluba is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License
+# for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with cortical-voluba. If not, see <https://www.gnu.org/licenses/>.
+
+import pytest
+
+from cortical_voluba import registration_schedule
+
+
+def test_downsampling_factors():
+    assert registration_schedule.downsampling_factors(
+        [0.02, 0.02, 0.1], [0.2, 0.2, 0.2], 'balanced') == [10, 10, 2]
+    assert registration_schedule.downsampling_factors(
+        [0.15, 0.15, 0.15], [0.2, 0.2, 0.2], 'balanced') == [1, 1, 1]
+    assert registration_schedule.downsampling_factors(
+        [0.02, 0.02, 0.1], [0.2, 0.2, 0.2], 'quality') == [1, 1, 1]
+
+
+def test_plan_schedule_small_image():
+    schedule = registration_schedule.plan_schedule((20, 30, 40), 'balanced')
+    assert schedule['shrink_factors'] == [1]
+    assert schedule['smoothing_sigmas'] == [0]
+    assert schedule['iterations'] == [500]
+
+
+def test_plan_schedule_large_image():
+    schedule = registration_schedule.plan_schedule((512, 512, 512),
+                                                   'balanced')
+    assert schedule['shrink_factors'] == [8, 4, 2, 1]
+    assert schedule['smoothing_sigmas'] == [3, 2, 1, 0]
+    # Iterations are capped on the finest levels, which are large
+    assert schedule['iterations'] == [500, 500, 62, 20]
+
+
+@pytest.mark.parametrize('shape', [(20, 30, 40), (100, 100, 100),
+                                   (2000, 2000, 500)])
+def test_default_schedule_is_baseline(shape):
+    # Without a preset, the registration must be run with the same arguments
+    # as the original, fixed schedule
+    assert registration_schedule.downsampling_factors(
+        [0.02, 0.02, 0.1], [0.2, 0.2, 0.2]) == [1, 1, 1]
+    schedule = registration_schedule.plan_schedule(
+        shape, registration_schedule.DEFAULT_PRESET)
+    assert registration_schedule.to_ants_arguments(schedule) == [
+        '--convergence', '[500x500x500,1e-6,10]',
+        '--shrink-factors', '4x2x1',
+        '--smoothing-sigmas', '2x1x0vox',
+    ]
+
+
+@pytest.mark.parametrize('preset', sorted(registration_schedule.PRESETS))
+def test_to_ants_arguments(preset):
+    schedule = registration_schedule.plan_schedule((100, 100, 100), preset)
+    args = registration_schedule.to_ants_arguments(schedule)
+    assert args[0] == '--convergence'
+    num_levels = len(schedule['shrink_factors'])
+    assert args[1].count('x') == num_levels - 1
+    assert args[3].count('x') == num_levels - 1
+    assert args[5].endswith('vox')
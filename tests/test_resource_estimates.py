@@ -0,0 +1,91 @@
+# Copyright 2020 CEA
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# This file is part of cortical-voluba.
+#
+# cortical-voluba is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# cortical-voluba is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License
+# for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with cortical-voluba. If not, see <https://www.gnu.org/licenses/>.
+
+
+import nibabel
+import numpy
+import pytest
+
+from cortical_voluba import resource_estimates
+from cortical_voluba.resource_estimates import (
+    estimate_resources,
+    InvalidHeaderError,
+    parse_nifti_header,
+)
+
+
+@pytest.mark.parametrize('header_class', [nibabel.Nifti1Header,
+                                          nibabel.Nifti2Header])
+@pytest.mark.parametrize('endianness', ['<', '>'])
+def test_parse_nifti_header(header_class, endianness):
+    header = header_class(endianness=endianness)
+    header.set_data_shape((10, 20, 30, 2))
+    header.set_data_dtype(numpy.int16)
+    info = parse_nifti_header(header.binaryblock + b'\0' * 4)
+    assert info == {
+        'shape': [10, 20, 30, 2],
+        'voxels': 6000,
+        'volumes': 2,
+        'bytes_per_voxel': 2,
+    }
+
+
+def test_parse_nifti_header_errors():
+    header = nibabel.Nifti1Header()
+    header.set_data_shape((10, 20, 30))
+    data = header.binaryblock
+    with pytest.raises(InvalidHeaderError):
+        parse_nifti_header(data[:100])
+    with pytest.raises(InvalidHeaderError):
+        parse_nifti_header(b'\0' * 540)
+    header['dim'][0] = 0
+    with pytest.raises(InvalidHeaderError):
+        parse_nifti_header(header.binaryblock)
+
+
+def make_info(shape, bytes_per_voxel=1):
+    header = nibabel.Nifti1Header()
+    header.set_data_shape(shape)
+    header.set_data_dtype(numpy.dtype('u' + str(bytes_per_voxel)))
+    return parse_nifti_header(header.binaryblock)
+
+
+def test_estimate_resources():
+    seg = make_info((100, 100, 100))
+    estimate = estimate_resources('depth-map', {'segmentation': seg})
+    assert estimate['input_voxels'] == 10 ** 6
+    assert estimate['memory_bytes'] == (
+        10 ** 6 * resource_estimates.DEPTH_MAP_BYTES_PER_VOXEL)
+    assert estimate['runtime_seconds'] == pytest.approx(
+        resource_estimates.DEPTH_MAP_SECONDS_PER_MEGAVOXEL)
+
+    image = make_info((200, 200, 100), bytes_per_voxel=2)
+    estimate = estimate_resources('depth-map-and-alignment',
+                                  {'segmentation': seg, 'image': image})
+    assert estimate['input_voxels'] == 4 * 10 ** 6
+    assert estimate['memory_bytes'] == max(
+        10 ** 6 * resource_estimates.DEPTH_MAP_BYTES_PER_VOXEL,
+        4 * 10 ** 6 * (2 + resource_estimates.RESAMPLING_BYTES_PER_VOXEL))
+    combined_runtime = estimate['runtime_seconds']
+
+    estimate = estimate_resources('alignment',
+                                  {'depth_map': seg, 'image': image})
+    assert estimate['runtime_seconds'] < combined_runtime
+
+    with pytest.raises(ValueError):
+        estimate_resources('unknown', {'segmentation': seg})
@@ -0,0 +1,133 @@
+# Copyright 2020 CEA
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# This file is part of cortical-voluba.
+#
+# cortical-voluba is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# cortical-voluba is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License
+# for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with cortical-voluba. If not, see <https://www.gnu.org/licenses/>.
+
+import nibabel
+import numpy
+
+from cortical_voluba import roi
+
+
+TEST_AFFINE = numpy.array([[-0.5, 0, 0, 10],
+                           [0, 0.5, 0, -20],
+                           [0, 0, 2, 3],
+                           [0, 0, 0, 1]])
+
+
+def make_labels():
+    labels = numpy.zeros((20, 30, 40), dtype=numpy.int16)
+    labels[5:8, 10:20, 30:35] = 100
+    labels[6, 12, 31] = 200
+    return labels
+
+
+def test_support_bounding_box():
+    labels = make_labels()
+    assert roi.support_bounding_box(labels) == (
+        slice(5, 8), slice(10, 20), slice(30, 35))
+    assert roi.support_bounding_box(labels, margin=2) == (
+        slice(3, 10), slice(8, 22), slice(28, 37))
+    assert roi.support_bounding_box(labels, margin=[1, 100, 6]) == (
+        slice(4, 9), slice(0, 30), slice(24, 40))
+    assert roi.support_bounding_box(numpy.zeros((3, 3, 3))) is None
+
+
+def test_crop_uncrop_image():
+    labels = make_labels()
+    img = nibabel.Nifti1Image(labels, TEST_AFFINE)
+    img.set_qform(TEST_AFFINE, code=1)
+    bbox = roi.support_bounding_box(labels, margin=1)
+    cropped = roi.crop_image(img, bbox)
+    assert cropped.shape == (5, 12, 7)
+    # The cropped voxels are at the same position in space
+    numpy.testing.assert_allclose(
+        cropped.affine @ [0, 0, 0, 1],
+        TEST_AFFINE @ [bbox[0].start, bbox[1].start, bbox[2].start, 1])
+    numpy.testing.assert_allclose(cropped.get_qform(), cropped.affine)
+
+    uncropped = roi.uncrop_image(cropped, bbox, labels.shape)
+    assert uncropped.shape == labels.shape
+    numpy.testing.assert_array_equal(
+        numpy.asanyarray(uncropped.dataobj), labels)
+    numpy.testing.assert_allclose(uncropped.affine, TEST_AFFINE)
+    numpy.testing.assert_allclose(uncropped.get_qform(), TEST_AFFINE)
+
+
+def test_downsample_image():
+    data = numpy.arange(5 * 4 * 2, dtype=numpy.float32).reshape((5, 4, 2))
+    img = nibabel.Nifti1Image(data, TEST_AFFINE)
+    downsampled = roi.downsample_image(img, [2, 2, 1])
+    assert downsampled.shape == (3, 2, 2)
+    assert downsampled.get_data_dtype() == numpy.float32
+    downsampled_data = numpy.asanyarray(downsampled.dataobj)
+    assert downsampled_data[0, 0, 0] == numpy.mean(data[0:2, 0:2, 0])
+    # The last block is padded with the edge values
+    assert downsampled_data[2, 1, 1] == numpy.mean(data[4, 2:4, 1])
+    # Each output voxel is at the centre of its block
+    numpy.testing.assert_allclose(
+        downsampled.affine @ [1, 1, 1, 1],
+        TEST_AFFINE @ [2.5, 2.5, 1, 1])
+
+
+def test_crop_to_labels_and_uncrop_result(tmp_path):
+    labels = make_labels()
+    labels_path = str(tmp_path / 'labels.nii.gz')
+    cropped_labels_path = str(tmp_path / 'labels_cropped.nii.gz')
+    nibabel.save(nibabel.Nifti1Image(labels, TEST_AFFINE), labels_path)
+
+    bbox = roi.crop_to_labels(labels_path, cropped_labels_path, 2)
+    assert bbox == (slice(3, 10), slice(8, 22), slice(28, 37))
+    cropped_labels_img = nibabel.load(cropped_labels_path)
+    cropped_labels = numpy.asanyarray(cropped_labels_img.dataobj)
+
+    # Simulate a depth map computed on the cropped labels
+    result = numpy.where(cropped_labels == 100, 0.5,
+                         numpy.where(cropped_labels == 200, 1, 0))
+    result = result.astype(numpy.float32)
+    result_path = str(tmp_path / 'result_cropped.nii.gz')
+    nibabel.save(nibabel.Nifti1Image(result, cropped_labels_img.affine),
+                 result_path)
+
+    output_path = str(tmp_path / 'result.nii.gz')
+    roi.uncrop_result(result_path, cropped_labels_path, labels_path,
+                      output_path, bbox)
+    output_img = nibabel.load(output_path)
+    output = numpy.asanyarray(output_img.dataobj)
+    assert output.shape == labels.shape
+    assert output.dtype == numpy.float32
+    numpy.testing.assert_allclose(output_img.affine, TEST_AFFINE)
+    numpy.testing.assert_array_equal(output[labels == 100], 0.5)
+    numpy.testing.assert_array_equal(output[labels == 0], 0)
+
+
+def test_crop_to_labels_no_gain(tmp_path):
+    labels = numpy.ones((4, 4, 4), dtype=numpy.int16)
+    labels_path = str(tmp_path / 'labels.nii.gz')
+    nibabel.save(nibabel.Nifti1Image(labels, TEST_AFFINE), labels_path)
+    assert roi.crop_to_labels(labels_path, str(tmp_path / 'out.nii.gz'),
+                              1) is None
+    assert not (tmp_path / 'out.nii.gz').exists()
+
+
+def test_background_value():
+    labels = make_labels()
+    values = numpy.full(labels.shape, 0.25)
+    values[labels != 0] = 0.75
+    values[0, 0, 0] = 1
+    assert roi.background_value(nibabel.Nifti1Image(values, TEST_AFFINE),
+                                nibabel.Nifti1Image(labels, TEST_AFFINE)
+                                ) == 0.25
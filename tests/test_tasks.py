@@ -16,20 +16,28 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with cortical-voluba. If not, see <https://www.gnu.org/licenses/>.
 
+import json
 import os.path
+import threading
+import time
 from unittest.mock import ANY, patch
 
+import pytest
+import requests
+
 from testdata import DUMMY_NIFTI_GZ, DUMMY_IMAGE_LIST
 from cortical_voluba import image_service
+from cortical_voluba import ledger
+from cortical_voluba import registration_backends
 
 
-def transform_image_mock(_, resampled_image_path, work_dir):
+def transform_image_mock(_, resampled_image_path, work_dir, **kwargs):
     with open(os.path.join(work_dir, resampled_image_path), 'wb') as f:
         f.write(DUMMY_NIFTI_GZ)
 
 
 class ImageServiceStub():
-    def __init__(self, base_url, auth=None, timeout=10):
+    def __init__(self, base_url, auth=None, timeout=10, download_cache=None):
         self.base_url = base_url
         self._image_list = DUMMY_IMAGE_LIST.copy()
 
@@ -47,6 +55,9 @@ def upload_image_and_get_name(self, image_file, *, file_name):
         })
         return (name, nifti_extra)
 
+    def preflight_image(self, image_file, *, file_name):
+        pass
+
     def download_compressed_nifti(self, name, output_file):
         output_file.write(DUMMY_NIFTI_GZ)
 
@@ -94,8 +105,14 @@ def test_alignment_task(transform_image_mock,
                         image_service_client_mock,
                         monkeypatch,
                         flask_app):
-    monkeypatch.setattr(image_service, 'ImageServiceClient', ImageServiceStub)
+    image_service_client_mock.side_effect = ImageServiceStub
     flask_app.config['TEMPLATE_EQUIVOLUMETRIC_DEPTH'] = '/some/file'
+    estimate_deformation_mock.return_value = {
+        'registration_schedule': {'preset': 'balanced'},
+        'transformation_matrix':
+        TEST_ALIGNMENT_REQUEST['transformation_matrix'],
+        'landmark_report': None,
+    }
 
     from cortical_voluba.tasks import alignment_computation_task
     ret = alignment_computation_task(TEST_ALIGNMENT_REQUEST,
@@ -107,8 +124,15 @@ def test_alignment_task(transform_image_mock,
         TEST_ALIGNMENT_REQUEST['transformation_matrix'],
         TEST_ALIGNMENT_REQUEST['landmark_pairs'],
         work_dir=ANY,
+        preset='standard',
+        backend=ANY,
     )
     assert transform_image_mock.called
+    assert transform_image_mock.call_args[1]['output_data_type'] == 'input'
+    # The same backend instance is used for the registration and resampling
+    backend = estimate_deformation_mock.call_args[1]['backend']
+    assert isinstance(backend, registration_backends.AntsCliBackend)
+    assert transform_image_mock.call_args[1]['backend'] is backend
 
     assert 'message' in ret
     assert 'results' in ret
@@ -116,6 +140,217 @@ def test_alignment_task(transform_image_mock,
     assert 'transformed_image_name' in ret['results']
     assert 'transformed_image_neuroglancer_url' in ret['results']
     assert 'transformation_matrix' in ret['results']
+    assert ret['results']['registration_schedule']['preset'] == 'balanced'
+
+
+@patch('cortical_voluba.alignment.estimate_deformation', autospec=True)
+@patch('cortical_voluba.alignment.transform_image', autospec=True,
+       side_effect=transform_image_mock)
+def test_alignment_task_resume(transform_image_mock,
+                               estimate_deformation_mock,
+                               monkeypatch,
+                               flask_app,
+                               tmp_path):
+    monkeypatch.setattr(image_service, 'ImageServiceClient', ImageServiceStub)
+    downloaded_images = []
+    monkeypatch.setattr(
+        ImageServiceStub, 'download_compressed_nifti',
+        lambda self, name, output_file: downloaded_images.append(name))
+    flask_app.config['TEMPLATE_EQUIVOLUMETRIC_DEPTH'] = '/some/file'
+    flask_app.config['CHECKPOINT_DIR'] = str(tmp_path / 'checkpoints')
+    flask_app.config['JOB_LEDGER_PATH'] = str(tmp_path / 'ledger.sqlite')
+    estimate_deformation_mock.side_effect = [
+        requests.ConnectionError,
+        {
+            'registration_schedule': {'preset': 'balanced'},
+            'transformation_matrix':
+            TEST_ALIGNMENT_REQUEST['transformation_matrix'],
+            'landmark_report': None,
+        },
+    ]
+
+    job_ledger = ledger.JobLedger(flask_app.config['JOB_LEDGER_PATH'])
+    job_ledger.record_queued('some-task-id', 'alignment', 'celery',
+                             time.time())
+
+    from cortical_voluba.tasks import alignment_computation_task
+    ret = alignment_computation_task.apply(
+        (TEST_ALIGNMENT_REQUEST,), {'bearer_token': 'token'},
+        task_id='some-task-id').get()
+
+    # The task has left the queue when it started
+    assert job_ledger.get_queued('some-task-id') is None
+    # The task was retried, but the images were only downloaded once
+    assert estimate_deformation_mock.call_count == 2
+    assert downloaded_images == ['depthmap', 'img']
+    assert 'transformed_image_name' in ret['results']
+    # The checkpoints are removed after success
+    assert os.listdir(str(tmp_path / 'checkpoints')) == []
+
+    # Both attempts are recorded in the ledger
+    statistics = ledger.JobLedger(
+        flask_app.config['JOB_LEDGER_PATH']).get_statistics()
+    assert len(statistics) == 1
+    assert statistics[0]['job_type'] == 'alignment'
+    assert statistics[0]['outcomes'] == {'failure': 1, 'success': 1}
+    # The stages that were completed by the first attempt are recorded with
+    # the second
+    assert set(statistics[0]['stage_seconds']) == {
+        'download depth map', 'download image', 'registration',
+        'resampling', 'upload transformed image'}
+
+
+@patch('cortical_voluba.alignment.estimate_deformation', autospec=True)
+def test_alignment_task_failure_removes_checkpoints(estimate_deformation_mock,
+                                                    monkeypatch,
+                                                    flask_app,
+                                                    tmp_path):
+    monkeypatch.setattr(image_service, 'ImageServiceClient', ImageServiceStub)
+    flask_app.config['TEMPLATE_EQUIVOLUMETRIC_DEPTH'] = '/some/file'
+    flask_app.config['CHECKPOINT_DIR'] = str(tmp_path / 'checkpoints')
+    estimate_deformation_mock.side_effect = RuntimeError
+
+    from cortical_voluba.tasks import alignment_computation_task
+    result = alignment_computation_task.apply(
+        (TEST_ALIGNMENT_REQUEST,), {'bearer_token': 'token'},
+        task_id='some-task-id')
+    assert isinstance(result.result, RuntimeError)
+    # The error is not retried, so the checkpoints are removed
+    assert os.listdir(str(tmp_path / 'checkpoints')) == []
+
+
+def test_will_be_retried(flask_app):
+    from cortical_voluba.processes import TaskCancelledError
+    from cortical_voluba.tasks import alignment_computation_task as task
+    from cortical_voluba.tasks import will_be_retried
+    task.push_request(retries=0)
+    try:
+        assert will_be_retried(task, requests.ConnectionError())
+        assert not will_be_retried(task, RuntimeError())
+        assert not will_be_retried(task, TaskCancelledError())
+    finally:
+        task.pop_request()
+    task.push_request(retries=3)
+    try:
+        assert not will_be_retried(task, requests.ConnectionError())
+    finally:
+        task.pop_request()
+
+
+@patch('cortical_voluba.alignment.estimate_deformation', autospec=True)
+@patch('cortical_voluba.alignment.transform_image', autospec=True,
+       side_effect=transform_image_mock)
+def test_alignment_task_profiling(transform_image_mock,
+                                  estimate_deformation_mock,
+                                  monkeypatch,
+                                  flask_app,
+                                  tmp_path):
+    monkeypatch.setattr(image_service, 'ImageServiceClient', ImageServiceStub)
+    flask_app.config['TEMPLATE_EQUIVOLUMETRIC_DEPTH'] = '/some/file'
+    flask_app.config['ALLOW_PROFILE_REQUESTS'] = True
+    flask_app.config['PROFILE_DIR'] = str(tmp_path / 'profiles')
+    flask_app.config['PROFILE_SAMPLING_INTERVAL'] = 0.001
+    estimate_deformation_mock.return_value = {
+        'registration_schedule': {'preset': 'balanced'},
+        'transformation_matrix':
+        TEST_ALIGNMENT_REQUEST['transformation_matrix'],
+        'landmark_report': None,
+    }
+
+    from cortical_voluba.tasks import alignment_computation_task
+    alignment_computation_task.apply(
+        (TEST_ALIGNMENT_REQUEST,), {'bearer_token': 'token'},
+        task_id='unprofiled-task-id').get()
+    assert not os.path.exists(flask_app.config['PROFILE_DIR'])
+
+    alignment_computation_task.apply(
+        (dict(TEST_ALIGNMENT_REQUEST, profile=True),),
+        {'bearer_token': 'token'}, task_id='profiled-task-id').get()
+    profile_dir = tmp_path / 'profiles' / 'profiled-task-id'
+    assert (profile_dir / 'profile.folded').exists()
+    report = json.loads((profile_dir / 'report.json').read_text())
+    assert report['job_type'] == 'alignment'
+    assert report['outcome'] == 'success'
+    assert 'registration' in report['stage_seconds']
+    assert report['processes'] == []
+
+
+def compute_depth_map_mock(task, segmentation_path, depth_map_path,
+                           work_dir):
+    with open(depth_map_path, 'wb') as f:
+        f.write(DUMMY_NIFTI_GZ)
+    return None
+
+
+@patch('cortical_voluba.tasks.compute_depth_map', autospec=True,
+       side_effect=compute_depth_map_mock)
+@patch('cortical_voluba.alignment.estimate_deformation', autospec=True)
+@patch('cortical_voluba.alignment.transform_image', autospec=True,
+       side_effect=transform_image_mock)
+def test_depth_map_and_alignment_task(transform_image_mock,
+                                      estimate_deformation_mock,
+                                      compute_depth_map_mock,
+                                      monkeypatch,
+                                      flask_app):
+    monkeypatch.setattr(image_service, 'ImageServiceClient', ImageServiceStub)
+    flask_app.config['TEMPLATE_EQUIVOLUMETRIC_DEPTH'] = '/some/file'
+    estimate_deformation_mock.return_value = {
+        'registration_schedule': {'preset': 'balanced'},
+        'transformation_matrix':
+        TEST_ALIGNMENT_REQUEST['transformation_matrix'],
+        'landmark_report': None,
+    }
+    params = dict(TEST_ALIGNMENT_REQUEST, segmentation_name='seg')
+    del params['depth_map_name']
+
+    from cortical_voluba.tasks import depth_map_and_alignment_computation_task
+    ret = depth_map_and_alignment_computation_task(params,
+                                                   bearer_token='token')
+
+    # The depth map is used directly from the scratch directory
+    depth_map_path = compute_depth_map_mock.call_args[0][2]
+    assert estimate_deformation_mock.call_args[0][0] == depth_map_path
+    assert ret['results']['depth_map_name'] == 'seg-equivolumetric-depth'
+    assert ret['results']['depth_map_neuroglancer_url'].startswith(
+        'precomputed://')
+    assert 'transformed_image_name' in ret['results']
+    assert 'transformation_matrix' in ret['results']
+
+
+@patch('cortical_voluba.tasks.compute_depth_map', autospec=True,
+       side_effect=compute_depth_map_mock)
+@patch('cortical_voluba.alignment.estimate_deformation', autospec=True)
+def test_depth_map_and_alignment_task_waits_for_upload(
+        estimate_deformation_mock, compute_depth_map_mock, monkeypatch,
+        flask_app):
+    monkeypatch.setattr(image_service, 'ImageServiceClient', ImageServiceStub)
+    flask_app.config['TEMPLATE_EQUIVOLUMETRIC_DEPTH'] = '/some/file'
+    upload_started = threading.Event()
+    uploaded = []
+
+    def slow_upload(self, image_file, *, file_name):
+        upload_started.set()
+        time.sleep(0.2)
+        uploaded.append(image_file.read())
+        raise requests.HTTPError('upload failed')
+    monkeypatch.setattr(ImageServiceStub, 'upload_image_and_get_name',
+                        slow_upload)
+
+    def failing_registration(*args, **kwargs):
+        upload_started.wait(5)
+        raise RuntimeError('registration failed')
+    estimate_deformation_mock.side_effect = failing_registration
+    params = dict(TEST_ALIGNMENT_REQUEST, segmentation_name='seg')
+    del params['depth_map_name']
+
+    from cortical_voluba.tasks import depth_map_and_alignment_computation_task
+    with pytest.raises(RuntimeError):
+        depth_map_and_alignment_computation_task(params,
+                                                 bearer_token='token')
+    # The upload has completed before the scratch directory was removed
+    assert uploaded == [DUMMY_NIFTI_GZ]
+    depth_map_path = compute_depth_map_mock.call_args[0][2]
+    assert not os.path.exists(depth_map_path)
 
 
 def test_worker_health_task(flask_app, tmp_path):
@@ -130,3 +365,15 @@ def test_worker_health_task(flask_app, tmp_path):
     depth_path.touch()
     ret = worker_health_task()
     assert ret is True
+
+
+def test_task_stubs_match_tasks(flask_app):
+    from celery import current_app
+    from cortical_voluba import task_stubs
+    import cortical_voluba.tasks  # noqa: F401
+
+    for stub in (task_stubs.depth_map_computation_task,
+                 task_stubs.alignment_computation_task,
+                 task_stubs.depth_map_and_alignment_computation_task,
+                 task_stubs.worker_health_task):
+        assert stub.name in current_app.tasks
@@ -0,0 +1,144 @@
+# Copyright 2020 CEA
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# This file is part of cortical-voluba.
+#
+# cortical-voluba is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# cortical-voluba is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License
+# for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with cortical-voluba. If not, see <https://www.gnu.org/licenses/>.
+
+import concurrent.futures
+import json
+
+import celery.app.base
+import celery.result
+import pytest
+
+from cortical_voluba import tracing
+
+from testdata import DUMMY_IMAGE_LIST
+
+
+TRACEPARENT = '00-0af7651916cd43dd8448eb211c80319c-b7ad6b7169203331-01'
+
+
+@pytest.fixture
+def trace_file(tmp_path):
+    path = str(tmp_path / 'spans.jsonl')
+    tracing.configure(path)
+    yield path
+    tracing.configure(None)
+
+
+def read_spans(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f]
+
+
+def test_parse_traceparent():
+    assert tracing.parse_traceparent(TRACEPARENT) == (
+        '0af7651916cd43dd8448eb211c80319c', 'b7ad6b7169203331')
+    assert tracing.parse_traceparent(None) is None
+    assert tracing.parse_traceparent('garbage') is None
+    assert tracing.parse_traceparent(
+        '00-00000000000000000000000000000000-b7ad6b7169203331-01') is None
+
+
+def test_nested_spans(trace_file):
+    assert tracing.current_span() is None
+    with tracing.Span('outer', parent=TRACEPARENT, kind='SERVER') as outer:
+        assert tracing.current_traceparent() == outer.traceparent
+        with tracing.Span('inner', stage='x') as inner:
+            assert tracing.current_span() is inner
+        with pytest.raises(ValueError):
+            with tracing.Span('failing'):
+                raise ValueError
+    assert tracing.current_span() is None
+
+    spans = {span['name']: span for span in read_spans(trace_file)}
+    assert spans['outer']['traceId'] == '0af7651916cd43dd8448eb211c80319c'
+    assert spans['outer']['parentId'] == 'b7ad6b7169203331'
+    assert spans['outer']['kind'] == 'SERVER'
+    assert spans['inner']['traceId'] == spans['outer']['traceId']
+    assert spans['inner']['parentId'] == outer.span_id
+    assert spans['inner']['tags'] == {'stage': 'x'}
+    assert spans['failing']['tags'] == {'error': 'ValueError'}
+
+
+def test_record_span(trace_file):
+    with tracing.Span('outer') as outer:
+        tracing.record_span('queue wait', 1000.0, 1002.5, queue='celery')
+    span = read_spans(trace_file)[0]
+    assert span['parentId'] == outer.span_id
+    assert span['timestamp'] == 1000000000
+    assert span['duration'] == 2500000
+    assert span['tags'] == {'queue': 'celery'}
+
+
+def test_wrap_propagates_to_threads(trace_file):
+    def get_parent():
+        with tracing.Span('in thread') as span:
+            return span.parent_id
+    with tracing.Span('outer') as outer:
+        with concurrent.futures.ThreadPoolExecutor(1) as executor:
+            assert executor.submit(tracing.wrap(get_parent)).result() \
+                == outer.span_id
+            assert executor.submit(get_parent).result() is None
+
+
+def test_no_export_without_trace_file(tmp_path):
+    tracing.configure(None)
+    with tracing.Span('span'):
+        pass
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_trace_propagated_to_task(flask_app, flask_client, trace_file,
+                                  requests_mock, monkeypatch, tmp_path):
+    sent_headers = []
+
+    def mock_send_task(self, task_name, *args, **kwargs):
+        sent_headers.append(kwargs.get('headers'))
+        return celery.result.AsyncResult('dummy_id')
+    monkeypatch.setattr(celery.app.base.Celery, 'send_task', mock_send_task)
+    requests_mock.get('http://h.test/b/list', json=DUMMY_IMAGE_LIST)
+    flask_client.application.config['PROBE_INPUT_HEADERS'] = False
+
+    response = flask_client.post(
+        '/v0/depth-map-computation/',
+        headers={'Authorization': 'Bearer test', 'traceparent': TRACEPARENT},
+        json={
+            'image_service_base_url': 'http://h.test/b/',
+            'segmentation_name': 'seg',
+        },)
+    assert response.status_code == 202
+    traceparent = sent_headers[0]['traceparent']
+    assert traceparent.startswith('00-0af7651916cd43dd8448eb211c80319c-')
+
+    spans = {span['name']: span for span in read_spans(trace_file)}
+    request_span = spans['POST /v0/depth-map-computation/']
+    assert request_span['parentId'] == 'b7ad6b7169203331'
+    assert request_span['tags']['http.status_code'] == '202'
+    assert spans['verify images']['parentId'] == request_span['id']
+    assert spans['send depth_map_computation_task']['parentId'] \
+        == request_span['id']
+
+    # The worker continues the trace
+    flask_app.config['TEMPLATE_EQUIVOLUMETRIC_DEPTH'] = str(
+        tmp_path / 'template.nii.gz')
+    from cortical_voluba.tasks import worker_health_task
+    worker_health_task.apply(headers={'traceparent': traceparent})
+    task_span = read_spans(trace_file)[-1]
+    assert task_span['name'] == 'run worker_health_task'
+    assert task_span['kind'] == 'CONSUMER'
+    assert task_span['traceId'] == '0af7651916cd43dd8448eb211c80319c'
+    assert task_span['parentId'] == tracing.parse_traceparent(traceparent)[1]
@@ -18,6 +18,9 @@
 
 import gzip
 
+import nibabel
+import numpy
+
 
 DUMMY_IMAGE_LIST = [
     {
@@ -81,3 +84,11 @@
 
 
 DUMMY_NIFTI_GZ = gzip.compress(b'dummy-nifti-gz')
+
+
+def make_nifti_header_gz(shape, dtype=numpy.uint8):
+    """Gzip-compressed beginning of a Nifti file (the data are truncated)."""
+    header = nibabel.Nifti1Header()
+    header.set_data_shape(shape)
+    header.set_data_dtype(dtype)
+    return gzip.compress(header.binaryblock + b'\0' * 4 + b'\0' * 1024)